@@ -26,8 +26,11 @@ Bridge stability metrics are calculated using the model introduced in
 """
 
 import logging
+import numpy
 import bridgedb.Storage
 
+from ipaddr import IPAddress
+
 from bridgedb.schedule import toUnixSeconds
 
 
@@ -257,13 +260,254 @@ def updateWeightedTime(statusPublicationMillis):
         for bh in bhToUpdate:
             db.updateIntoBridgeHistory(bh)
 
+class BridgeHistoryBatch(object):
+    """The histories of all bridges, held in NumPy arrays so that many status
+    publications can be applied to them at once.
+
+    For each status publication, :func:`addOrUpdateBridgeHistory` reads and
+    rewrites every row of the ``BridgeHistory`` table twice, in order to
+    discount, prune, and update the weighted times of all bridges.  This class
+    loads the table once, does each of those passes as a few vectorized
+    operations over every bridge, and writes the results back with
+    :meth:`save`.  The results are the same as if each status had been given
+    to :func:`addOrUpdateBridgeHistory` in the same order.
+
+    :ivar list fingerprints: The fingerprint of the bridge in each row.
+    :ivar list addresses: The address (as a string) in each row.
+    :ivar list ports: The port in each row.
+    :ivar present: A boolean array, ``True`` for each row which holds a
+        history (rather than one which was pruned, or not yet created).
+    """
+
+    #: The names of the integer fields of :class:`BridgeHistory`.
+    intFields = ('weightedUptime', 'weightedTime', 'weightedRunLength',
+                 'lastSeenWithDifferentAddressAndPort',
+                 'lastSeenWithThisAddressAndPort',
+                 'lastDiscountedHistoryValues', 'lastUpdatedWeightedTime')
+
+    def __init__(self, rows=()):
+        """Create a batch from some rows of the ``BridgeHistory`` table.
+
+        :param list rows: The rows, as returned by
+            :meth:`bridgedb.Storage.Database.getAllBridgeHistoryRows`.
+        """
+        rows = list(rows)
+        size = len(rows)
+        self.fingerprints = [row[0] for row in rows]
+        self.addresses = [str(row[1]) for row in rows]
+        self.ports = [row[2] for row in rows]
+        self.index = dict([(fp, i) for i, fp in enumerate(self.fingerprints)])
+        self.stored = set(self.fingerprints)
+        self.present = numpy.ones(size, dtype=bool)
+        columns = list(zip(*rows)) or [()] * 11
+        # Like BridgeHistory.__init__(), truncate the integer fields:
+        for name, column in zip(self.intFields, columns[3:6] + columns[7:]):
+            setattr(self, name, numpy.array(column, dtype=float).astype(numpy.int64))
+        self.totalRunWeights = numpy.array(columns[6], dtype=float)
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def _grow(self):
+        """Double the number of rows in each array."""
+        extra = max(len(self.present), 16)
+        self.present = numpy.concatenate(
+            [self.present, numpy.zeros(extra, dtype=bool)])
+        for name in self.intFields:
+            setattr(self, name, numpy.concatenate(
+                [getattr(self, name), numpy.zeros(extra, dtype=numpy.int64)]))
+        self.totalRunWeights = numpy.concatenate(
+            [self.totalRunWeights, numpy.zeros(extra)])
+
+    def _create(self, bridge, statusPublicationMillis):
+        """Start a new history for **bridge**, as
+        :func:`addOrUpdateBridgeHistory` does for bridges it hasn't seen.
+
+        :rtype: int
+        :returns: The row of the new history.
+        """
+        i = self.index.get(bridge.fingerprint)
+        if i is None:
+            i = len(self.fingerprints)
+            if i == len(self.present):
+                self._grow()
+            self.fingerprints.append(bridge.fingerprint)
+            self.addresses.append(None)
+            self.ports.append(None)
+            self.index[bridge.fingerprint] = i
+
+        self.addresses[i] = str(bridge.address)
+        self.ports[i] = bridge.orPort
+        for name in self.intFields:
+            getattr(self, name)[i] = 0
+        self.totalRunWeights[i] = 0
+        self.lastSeenWithDifferentAddressAndPort[i] = statusPublicationMillis
+        self.lastSeenWithThisAddressAndPort[i] = statusPublicationMillis
+        self.present[i] = True
+        return i
+
+    def addStatus(self, bridge, timestamp):
+        """Update the histories of all bridges for a status publication
+        from **bridge**, at **timestamp**.
+
+        :type bridge: :class:`bridgedb.bridges.Bridge`
+        :param bridge: The bridge which published a status.
+        :param int timestamp: When it was published, in seconds since the
+            Unix Epoch.
+        :rtype: bool
+        :returns: ``False`` if the status was older than the last one from
+            that bridge, and was ignored.  ``True`` otherwise.
+        """
+        statusPublicationMillis = timestamp * 1000
+        i = self.index.get(bridge.fingerprint)
+        if i is None or not self.present[i]:
+            i = self._create(bridge, statusPublicationMillis)
+
+        # Calculate the seconds since the last parsed status, capped to 60
+        # minutes:
+        elapsed = statusPublicationMillis - \
+            int(self.lastSeenWithThisAddressAndPort[i])
+        if elapsed > 60*60*1000:
+            secondsSinceLastStatusPublication = 60*60
+        else:
+            secondsSinceLastStatusPublication = elapsed / 1000
+        if secondsSinceLastStatusPublication <= 0 and self.weightedTime[i] > 0:
+            logging.warn("Received old descriptor for bridge %s with timestamp %d",
+                         bridge.fingerprint, timestamp)
+            return False
+
+        self.discountAndPrune(statusPublicationMillis)
+        self.updateWeightedTime(statusPublicationMillis)
+
+        if not self.present[i]:
+            logging.info("%s was pruned from the history" % bridge.fingerprint)
+            return True
+        if not bridge.flags.running:
+            logging.info("%s is not running" % bridge.fingerprint)
+            return True
+
+        # If the bridge changed its address or port, store the weighted run
+        # time:
+        if bridge.orPort != self.ports[i] or str(bridge.address) != self.addresses[i]:
+            tosa = (int(self.lastSeenWithThisAddressAndPort[i]) -
+                    int(self.lastSeenWithDifferentAddressAndPort[i])) / 1000
+            self.totalRunWeights[i] += 1.0
+            self.weightedRunLength[i] = int(self.weightedRunLength[i] + tosa)
+            self.lastSeenWithDifferentAddressAndPort[i] = \
+                self.lastSeenWithThisAddressAndPort[i]
+
+        self.weightedUptime[i] = int(self.weightedUptime[i] +
+                                     secondsSinceLastStatusPublication)
+        self.lastSeenWithThisAddressAndPort[i] = statusPublicationMillis
+        self.addresses[i] = str(bridge.address)
+        self.ports[i] = bridge.orPort
+        return True
+
+    def discountAndPrune(self, discountUntilMillis):
+        """Discount the histories of all bridges by :data:`weighting_factor`
+        for every :data:`discountIntervalMillis` since they were last
+        discounted, and prune those which have been around for a day with a
+        weighted fractional uptime below 1.
+
+        :param int discountUntilMillis: The time to discount until, in
+            milliseconds since the Unix Epoch.
+        """
+        size = len(self.fingerprints)
+        present = self.present[:size]
+        lastDiscounted = self.lastDiscountedHistoryValues[:size]
+        lastDiscounted[present & (lastDiscounted == 0)] = discountUntilMillis
+
+        elapsed = discountUntilMillis - lastDiscounted
+        rounds = numpy.where(present & (elapsed > 0),
+                             elapsed // discountIntervalMillis, 0)
+        discounted = rounds > 0
+
+        weightedUptime = self.weightedUptime[:size].astype(float)
+        weightedTime = self.weightedTime[:size].astype(float)
+        if discounted.any():
+            factor = numpy.power(weighting_factor, rounds[discounted])
+            weightedUptime[discounted] *= factor
+            weightedTime[discounted] *= factor
+            self.weightedUptime[:size][discounted] = weightedUptime[discounted]
+            self.weightedTime[:size][discounted] = weightedTime[discounted]
+            self.weightedRunLength[:size][discounted] = \
+                self.weightedRunLength[:size][discounted] * factor
+            self.totalRunWeights[:size][discounted] *= factor
+            lastDiscounted[discounted] += \
+                discountIntervalMillis * rounds[discounted]
+
+        # Prune with the discounted values, before they are truncated, like
+        # BridgeHistory.weightedFractionalUptime:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            wfu = numpy.where(weightedTime < 0.0001, 0,
+                              10000 * weightedUptime / weightedTime)
+        pruned = present & (wfu < 1) & (weightedTime > 60*60*24)
+        if pruned.any():
+            for i in numpy.flatnonzero(pruned):
+                logging.debug("Removing bridge from history: %s"
+                              % self.fingerprints[i])
+            self.present[:size][pruned] = False
+
+    def updateWeightedTime(self, statusPublicationMillis):
+        """Add the time since they were last updated, capped to one hour, to
+        the weighted times of all bridges.
+
+        :param int statusPublicationMillis: The time of the status
+            publication, in milliseconds since the Unix Epoch.
+        """
+        size = len(self.fingerprints)
+        lastUpdated = self.lastUpdatedWeightedTime[:size]
+        update = self.present[:size] & (lastUpdated < statusPublicationMillis)
+        interval = (statusPublicationMillis - lastUpdated[update]) / 1000
+        self.weightedTime[:size][update] = \
+            self.weightedTime[:size][update] + numpy.minimum(3600, interval)
+        lastUpdated[update] = statusPublicationMillis
+
+    def getBridgeHistory(self, fingerprint):
+        """Get the history of a bridge.
+
+        :param str fingerprint: The fingerprint of the bridge.
+        :rtype: :class:`BridgeHistory` or ``None``
+        """
+        i = self.index.get(fingerprint)
+        if i is None or not self.present[i]:
+            return
+        values = [int(getattr(self, name)[i]) for name in self.intFields]
+        values.insert(3, float(self.totalRunWeights[i]))
+        return BridgeHistory(fingerprint, IPAddress(self.addresses[i]),
+                             self.ports[i], *values)
+
+    def save(self, db):
+        """Write all of the histories back to the database, and remove those
+        which were pruned.  It does not commit.
+
+        :type db: :class:`bridgedb.Storage.Database`
+        :param db: The database to write to.
+        """
+        size = len(self.fingerprints)
+        present = self.present[:size]
+        rows = numpy.flatnonzero(present).tolist()
+        columns = [getattr(self, name)[:size][present].tolist()
+                   for name in self.intFields]
+        columns.insert(3, self.totalRunWeights[:size][present].tolist())
+        db.updateIntoBridgeHistories(list(zip(
+            [self.fingerprints[i] for i in rows],
+            [self.addresses[i] for i in rows],
+            [self.ports[i] for i in rows],
+            *columns)))
+
+        removed = [fp for fp in self.stored if not present[self.index[fp]]]
+        db.delBridgeHistories(removed)
+        self.stored = set([self.fingerprints[i] for i in rows])
+
+
 def updateBridgeHistory(bridges, timestamps):
     """Process all the timestamps and update the bridge stability statistics in
     the database.
 
-    .. warning: This function is extremely expensive, and will keep getting
-        more and more expensive, on a linearithmic scale, every time it is
-        called. Blame the :mod:`bridgedb.Stability` module.
+    The status publications of all bridges are applied in the order they were
+    published, with a :class:`BridgeHistoryBatch`, and the results are
+    committed.  The database lock is released while they are applied.
 
     :param dict bridges: All bridges from the descriptors, parsed into
         :class:`bridgedb.bridges.Bridge`s.
@@ -277,19 +521,34 @@ def updateBridgeHistory(bridges, timestamps):
     """
     logging.debug("Beginning bridge stability calculations")
     sortedTimestamps = {}
+    statuses = []
 
     for fingerprint, stamps in timestamps.items():
         stamps.sort()
-        bridge = bridges[fingerprint]
         for timestamp in stamps:
-            logging.debug(
-                ("Adding/updating timestamps in BridgeHistory for %s in "
-                 "database: %s") % (fingerprint, timestamp))
-            timestamp = toUnixSeconds(timestamp.timetuple())
-            addOrUpdateBridgeHistory(bridge, timestamp)
+            statuses.append((toUnixSeconds(timestamp.timetuple()), fingerprint))
         # Replace the timestamps so the next sort is (hopefully) less
         # expensive:
         sortedTimestamps[fingerprint] = stamps
 
+    # Apply the status publications in the order they were published:
+    statuses.sort()
+
+    # Only hold the database lock while reading and writing the histories, so
+    # that the distributors aren't kept waiting on the calculations.  (Nothing
+    # else writes to the BridgeHistory table.)
+    with bridgedb.Storage.getDB() as db:
+        rows = db.getAllBridgeHistoryRows()
+
+    batch = BridgeHistoryBatch(rows)
+    logging.debug("Adding/updating %d timestamps for %d bridges in "
+                  "BridgeHistory" % (len(statuses), len(sortedTimestamps)))
+    for timestamp, fingerprint in statuses:
+        batch.addStatus(bridges[fingerprint], timestamp)
+
+    with bridgedb.Storage.getDB() as db:
+        batch.save(db)
+        db.commit()
+
     logging.debug("Stability calculations complete")
     return sortedTimestamps
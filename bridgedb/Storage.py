@@ -15,7 +15,9 @@ import sys
 import datetime
 
 from bridgedb.Stability import BridgeHistory
+from bridgedb import openmetrics
 import threading
+import weakref
 
 toHex = binascii.b2a_hex
 fromHex = binascii.a2b_hex
@@ -116,6 +118,28 @@ SCHEMA_2TO3_SCRIPT = """
  """
 SCHEMA3_SCRIPT = SCHEMA2_SCRIPT + SCHEMA_2TO3_SCRIPT
 
+SCHEMA_3TO4_SCRIPT = """
+ CREATE INDEX BridgeMeasurementsKeyIndex on BridgeMeasurements
+     ( hex_key, blocking_country, address, port );
+
+ CREATE TABLE BridgeMeasurementVerdicts (
+     hex_key NOT NULL,
+     blocking_country NOT NULL,
+     address NOT NULL,
+     port NOT NULL,
+     last_blocked,
+     last_reachable,
+     PRIMARY KEY ( hex_key, blocking_country, address, port )
+ );
+
+ INSERT OR REPLACE INTO Config VALUES ( 'schema-version', 4 );
+ """
+SCHEMA4_SCRIPT = SCHEMA3_SCRIPT + SCHEMA_3TO4_SCRIPT
+
+#: The ``Config`` key for the ID of the newest row of ``BridgeMeasurements``
+#: which has been folded into ``BridgeMeasurementVerdicts``.
+MEASUREMENTS_HIGH_WATER_MARK = 'bridge-measurements-high-water-mark'
+
 
 class BridgeData(object):
     """Value class carrying bridge information:
@@ -138,10 +162,13 @@ class BridgeData(object):
 
 
 class Database(object):
-    def __init__(self, sqlite_fname):
+    def __init__(self, sqlite_fname, readOnly=False):
         self._conn = openDatabase(sqlite_fname)
         self._cur = self._conn.cursor()
         self.sqlite_fname = sqlite_fname
+        self.readOnly = readOnly
+        if readOnly:
+            self._cur.execute("PRAGMA query_only = ON")
 
     def commit(self):
         self._conn.commit()
@@ -210,6 +237,116 @@ class Database(object):
                         (h, str(bridge.address), bridge.orPort, setRing, t, t))
             return setRing
 
+    def getBridgeDistributors(self, bridges, validRings):
+        """Get the distributors of all **bridges** already in the database,
+        using a single query.
+
+        :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+        :param list validRings: The names of all currently valid rings.
+        :rtype: dict
+        :returns: A dictionary mapping the fingerprints of any **bridges**
+            which are in the database, and whose distributors are in
+            **validRings**, to the names of those distributors.
+        """
+        wanted = set([bridge.fingerprint for bridge in bridges])
+        distributors = {}
+
+        for hex_key, distributor in self._selectByHexKeys("distributor",
+                                                          wanted):
+            if distributor in validRings:
+                distributors[hex_key] = distributor
+
+        return distributors
+
+    def _selectByHexKeys(self, columns, fingerprints):
+        """Select some **columns** of the rows in the ``Bridges`` table whose
+        ``hex_key`` is one of **fingerprints**.
+
+        The fingerprints are looked up :data:`SQL_VARIABLES_PER_QUERY` at a
+        time, using the index on ``hex_key``, rather than scanning the whole
+        table.
+
+        :param str columns: The columns to select, after ``hex_key``, as
+            they would be written in the query (e.g. ``"distributor"``).  If
+            empty, only ``hex_key`` is selected.
+        :param fingerprints: An iterable of hex-encoded bridge fingerprints.
+        :rtype: list
+        :returns: A list of ``(hex_key, ...)`` tuples, in no particular order.
+        """
+        fingerprints = list(fingerprints)
+        select = "SELECT hex_key%s FROM Bridges WHERE hex_key IN " % (
+            ", " + columns if columns else "")
+        rows = []
+
+        for i in range(0, len(fingerprints), SQL_VARIABLES_PER_QUERY):
+            chunk = fingerprints[i:i + SQL_VARIABLES_PER_QUERY]
+            self._cur.execute(select + "(%s)" % ", ".join("?" * len(chunk)),
+                              chunk)
+            rows.extend(self._cur.fetchall())
+
+        return rows
+
+    def insertBridgesAndGetRings(self, assignments, seenAt, validRings,
+                                 defaultPool="unallocated"):
+        """Update info about many bridges at once.
+
+        This does the same as calling :meth:`insertBridgeAndGetRing` for each
+        item in **assignments**, in order, but it uses a single query to find
+        which bridges are already known, and it writes all of the inserts and
+        updates with :meth:`sqlite3.Cursor.executemany`.  It does not commit.
+
+        :param list assignments: A list of ``(bridge, setRing)`` two-tuples.
+        :param float seenAt: The time when all of the bridges were seen.
+        :param list validRings: The names of all currently valid rings.  Any
+            bridge whose ``setRing`` isn't in here is moved into
+            **defaultPool**.
+        :rtype: list
+        :returns: The names of the distributors the bridges were assigned
+            to, in the same order as **assignments**.
+        """
+        t = timeToStr(seenAt)
+        cur = self._cur
+        ringnames = []
+        inserts = {}
+        updates = {}
+
+        wanted = set([bridge.fingerprint for bridge, _ in assignments])
+        known = set([row[0] for row in self._selectByHexKeys("", wanted)])
+
+        for bridge, setRing in assignments:
+            h = bridge.fingerprint
+            assert len(h) == HEX_ID_LEN
+
+            if setRing not in validRings:
+                setRing = defaultPool
+            ringnames.append(setRing)
+
+            if h in known:
+                updates[h] = (str(bridge.address), bridge.orPort, setRing, t, h)
+            else:
+                inserts[h] = (h, str(bridge.address), bridge.orPort, setRing, t, t)
+
+        cur.executemany("UPDATE Bridges SET address = ?, or_port = ?, "
+                        "distributor = ?, last_seen = ? WHERE hex_key = ?",
+                        list(updates.values()))
+        cur.executemany("INSERT INTO Bridges (hex_key, address, or_port, "
+                        "distributor, first_seen, last_seen) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        list(inserts.values()))
+        return ringnames
+
+    def updateBridgesLastSeen(self, fingerprints, seenAt):
+        """Record that the already-known bridges with the given
+        **fingerprints** were seen at **seenAt**.  It does not commit.
+
+        :param list fingerprints: The hex-encoded fingerprints of some bridges.
+        :param float seenAt: The time when all of the bridges were seen.
+        """
+        t = timeToStr(seenAt)
+        self._cur.executemany("UPDATE Bridges SET last_seen = ? "
+                              "WHERE hex_key = ?",
+                              [(t, h) for h in fingerprints])
+
     def cleanEmailedBridges(self, expireBefore):
         cur = self._cur
         t = timeToStr(expireBefore)
@@ -248,30 +385,100 @@ class Database(object):
     def getBlockedBridges(self):
         """Return a dictionary of bridges that are blocked.
 
+        For each bridge, address, port, and country, we believe the newest
+        measurement from the last three years (see
+        :func:`getBlockedBridgesFromSql`).  Only the measurements added since
+        the last call are read; see :meth:`updateMeasurementVerdicts`.  The
+        caller should commit afterwards, so that they needn't be read again.
+
         :rtype: dict
         :returns: A dictionary that maps bridge fingerprints (as strings) to a
             three-tuple that captures its blocking state: (country,  address,
             port).
         """
-        ms = self.__fetchBridgeMeasurements()
-        return getBlockedBridgesFromSql(ms)
+        if not self.readOnly:
+            self.updateMeasurementVerdicts()
 
-    def __fetchBridgeMeasurements(self):
-        """Return all bridge measurement rows from the last three years.
-
-        We limit our search to three years for performance reasons because the
-        bridge measurement table keeps growing and therefore slowing down
-        queries.
-
-        :rtype: list
-        :returns: A list of tuples.
-        """
         cur = self._cur
         old_year = datetime.datetime.utcnow() - datetime.timedelta(days=365*3)
-        cur.execute("SELECT * FROM BridgeMeasurements WHERE last_measured > "
-                    "'%s' ORDER BY blocking_country DESC" %
-                    old_year.strftime("%Y-%m-%d"))
-        return cur.fetchall()
+        old_year = old_year.strftime("%Y-%m-%d")
+        # A measurement saying that the bridge is reachable only counts if
+        # it's recent enough, and at least as new as the newest one saying
+        # that it's blocked.
+        cur.execute("SELECT hex_key, blocking_country, address, port "
+                    "FROM BridgeMeasurementVerdicts WHERE last_blocked > ? "
+                    "AND (last_reachable IS NULL OR last_reachable <= ? "
+                    "OR last_reachable <= last_blocked) "
+                    "ORDER BY blocking_country DESC", (old_year, old_year))
+
+        blocked = {}
+        for fingerprint, country, address, port in cur.fetchall():
+            blocked.setdefault(fingerprint, []).append((country, address, port))
+        return blocked
+
+    def updateMeasurementVerdicts(self):
+        """Fold any measurements which were added to ``BridgeMeasurements``
+        since the last call into ``BridgeMeasurementVerdicts``, which keeps
+        the dates of the newest "blocked" and "reachable" verdicts for each
+        bridge, address, port, and country.
+
+        Measurements without a fingerprint, country, address, or port are
+        ignored.  The ID of the newest measurement read is kept in the
+        ``Config`` table, under :data:`MEASUREMENTS_HIGH_WATER_MARK`.  If
+        ``BridgeMeasurements`` no longer goes up that far, the verdicts are
+        rebuilt from scratch.
+
+        :rtype: int
+        :returns: The ID of the newest measurement which has been read.
+        """
+        cur = self._cur
+        cur.execute("SELECT value FROM Config WHERE key = ?",
+                    (MEASUREMENTS_HIGH_WATER_MARK,))
+        row = cur.fetchone()
+        mark = int(row[0]) if row else 0
+
+        cur.execute("SELECT MAX(id) FROM BridgeMeasurements")
+        newest = cur.fetchone()[0] or 0
+        if newest < mark:
+            logging.info("Bridge measurements were removed; rebuilding "
+                         "verdicts from scratch.")
+            cur.execute("DELETE FROM BridgeMeasurementVerdicts")
+            mark = 0
+        elif newest == mark:
+            return mark
+
+        cur.execute("""
+            INSERT OR REPLACE INTO BridgeMeasurementVerdicts
+                (hex_key, blocking_country, address, port,
+                 last_blocked, last_reachable)
+            SELECT m.hex_key, m.blocking_country, m.address, m.port,
+                CASE WHEN v.last_blocked IS NULL OR
+                          m.last_blocked > v.last_blocked
+                     THEN m.last_blocked ELSE v.last_blocked END,
+                CASE WHEN v.last_reachable IS NULL OR
+                          m.last_reachable > v.last_reachable
+                     THEN m.last_reachable ELSE v.last_reachable END
+            FROM (SELECT hex_key, blocking_country, address, port,
+                      MAX(CASE WHEN verdict = ? THEN last_measured END)
+                          AS last_blocked,
+                      MAX(CASE WHEN verdict IS NOT ? THEN last_measured END)
+                          AS last_reachable
+                  FROM BridgeMeasurements WHERE id > ? AND id <= ?
+                  AND hex_key IS NOT NULL AND blocking_country IS NOT NULL
+                  AND address IS NOT NULL AND port IS NOT NULL
+                  GROUP BY hex_key, blocking_country, address, port) AS m
+            LEFT JOIN BridgeMeasurementVerdicts AS v
+                ON v.hex_key = m.hex_key
+                AND v.blocking_country = m.blocking_country
+                AND v.address = m.address
+                AND v.port = m.port
+            """, (BRIDGE_BLOCKED, BRIDGE_BLOCKED, mark, newest))
+        logging.info("Read bridge measurements %d through %d."
+                     % (mark + 1, newest))
+
+        cur.execute("INSERT OR REPLACE INTO Config VALUES (?, ?)",
+                    (MEASUREMENTS_HIGH_WATER_MARK, newest))
+        return newest
 
     def getBridgesForDistributor(self, distributor):
         """Return a list of BridgeData value classes of all bridges in the
@@ -347,6 +554,36 @@ class Database(object):
         for h in v:
             yield BridgeHistory(h[0],IPAddress(h[1]),h[2],h[3],h[4],h[5],h[6],h[7],h[8],h[9],h[10])
 
+    def getAllBridgeHistoryRows(self):
+        """Return every row of the ``BridgeHistory`` table, as is.
+
+        :rtype: list
+        :returns: A list of tuples, in the same order as the arguments to
+            :class:`~bridgedb.Stability.BridgeHistory`.
+        """
+        cur = self._cur
+        cur.execute("SELECT * FROM BridgeHistory")
+        return cur.fetchall()
+
+    def updateIntoBridgeHistories(self, rows):
+        """Insert or replace many rows of the ``BridgeHistory`` table with
+        :meth:`sqlite3.Cursor.executemany`.  It does not commit.
+
+        :param list rows: A list of tuples, in the same order as the
+            arguments to :class:`~bridgedb.Stability.BridgeHistory`.
+        """
+        self._cur.executemany("INSERT OR REPLACE INTO BridgeHistory values "
+                              "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def delBridgeHistories(self, fingerprints):
+        """Remove the histories of the bridges with the given
+        **fingerprints**.  It does not commit.
+
+        :param list fingerprints: The hex-encoded fingerprints of some bridges.
+        """
+        self._cur.executemany("DELETE FROM BridgeHistory WHERE fingerprint = ?",
+                              [(fp,) for fp in fingerprints])
+
     def getBridgesLastUpdatedBefore(self, statusPublicationMillis):
         cur = self._cur
         v = cur.execute("SELECT * FROM BridgeHistory WHERE lastUpdatedWeightedTime < ?",
@@ -356,21 +593,44 @@ class Database(object):
             yield BridgeHistory(h[0],IPAddress(h[1]),h[2],h[3],h[4],h[5],h[6],h[7],h[8],h[9],h[10])
 
 
+#: How long, in seconds, a connection waits for another connection's write
+#: transaction to finish before giving up with "database is locked".
+BUSY_TIMEOUT = 30
+
+#: The number of prepared statements each connection keeps compiled.
+CACHED_STATEMENTS = 256
+
+#: The most fingerprints looked up by a single ``WHERE hex_key IN (...)``
+#: query.  This is below SQLite's historical limit of 999 bound parameters.
+SQL_VARIABLES_PER_QUERY = 500
+
 def openDatabase(sqlite_file):
-    conn = sqlite3.Connection(sqlite_file)
+    # Connections are only used by the thread which opened them, but
+    # clearPool() may close them from another thread.
+    conn = sqlite3.Connection(sqlite_file, timeout=BUSY_TIMEOUT,
+                              cached_statements=CACHED_STATEMENTS,
+                              check_same_thread=False)
     cur = conn.cursor()
     try:
+        # With write-ahead logging, readers see the last committed state and
+        # never block (nor are blocked by) a writer.
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = NORMAL")
         try:
             cur.execute("SELECT value FROM Config WHERE key = 'schema-version'")
             val, = cur.fetchone()
             if val == 2:
                 logging.info("Adding new table BridgeHistory")
                 cur.executescript(SCHEMA_2TO3_SCRIPT)
-            elif val != 3:
+                val = 3
+            if val == 3:
+                logging.info("Adding new table BridgeMeasurementVerdicts")
+                cur.executescript(SCHEMA_3TO4_SCRIPT)
+            elif val != 4:
                 logging.warn("Unknown schema version %s in database.", val)
         except sqlite3.OperationalError:
             logging.warn("No Config table found in DB; creating tables")
-            cur.executescript(SCHEMA3_SCRIPT)
+            cur.executescript(SCHEMA4_SCRIPT)
             conn.commit()
     finally:
         cur.close()
@@ -383,6 +643,19 @@ _LOCKED = 0
 _OPENED_DB = None
 _REFCOUNT = 0
 
+#: Each thread's open :class:`Database`s, in a ``dbs`` dict keyed by
+#: ``(filename, readOnly)``.  Connections are reused by the thread which
+#: opened them, rather than being re-opened for every query, and are dropped
+#: along with the thread.
+_POOL = threading.local()
+#: Every pooled :class:`Database` which is still open, so that
+#: :func:`clearPool` can close them.
+_POOLED = weakref.WeakSet()
+#: Incremented by :func:`clearPool`, so that threads know to discard the
+#: connections in their pool.
+_POOL_GENERATION = 0
+_POOL_LOCK = threading.Lock()
+
 class BridgeMeasurement(object):
     def __init__(self, id, fingerprint, bridge_type, address, port,
             country, asn, measured_by, last_measured, verdict):
@@ -493,12 +766,45 @@ def clearGlobalDB():
     global _LOCK
     global _LOCKED
     global _OPENED_DB
+    global _REFCOUNT
 
     _DB_FNAME = None
     _LOCK = None
     _LOCKED = 0
     _OPENED_DB = None
     _REFCOUNT = 0
+    clearPool()
+
+def clearPool():
+    """Close and forget all pooled database connections, in every thread."""
+    global _POOL_GENERATION
+
+    with _POOL_LOCK:
+        _POOL_GENERATION += 1
+        dbs = list(_POOLED)
+        _POOLED.clear()
+    for db in dbs:
+        db.close()
+
+def _getPooledDB(readOnly=False):
+    """Get the current thread's :class:`Database` for the current database
+    file, opening it if necessary.
+
+    :param bool readOnly: If ``True``, get a separate connection which
+        refuses to write to the database.
+    :rtype: :class:`Database`
+    """
+    if getattr(_POOL, "generation", None) != _POOL_GENERATION:
+        _POOL.dbs = {}
+        _POOL.generation = _POOL_GENERATION
+    key = (_DB_FNAME, readOnly)
+    db = _POOL.dbs.get(key)
+    if db is None:
+        db = Database(_DB_FNAME, readOnly=readOnly)
+        _POOL.dbs[key] = db
+        with _POOL_LOCK:
+            _POOLED.add(db)
+    return db
 
 def initializeDBLock():
     """Create the lock
@@ -523,8 +829,13 @@ def getDB(block=True):
     usable within the current thread. If a connection already exists
     and it was created by the current thread, then return the
     associated :class:`bridgedb.Storage.Database` instance. Otherwise,
-    create a new instance, blocking until the existing connection
-    is closed, if applicable.
+    reuse the current thread's pooled connection (or open one), blocking
+    until any other thread has finished with the database, if applicable.
+
+    This is the write path: only one thread at a time may hold it.  Any
+    changes which were not committed by the time the outermost caller is
+    finished are rolled back.  Code which only needs to read should use
+    :func:`getReadDB` instead.
 
     Note: This is a blocking call (by default), be careful about
         deadlocks!
@@ -541,13 +852,14 @@ def getDB(block=True):
 
     assert _LOCK
     try:
-        own_lock = _LOCK.acquire(block)
+        with openmetrics.DB_LOCK_WAIT.time():
+            own_lock = _LOCK.acquire(block)
         if own_lock:
             _LOCKED += 1
 
             if not _OPENED_DB:
                 assert _REFCOUNT == 0
-                _OPENED_DB = Database(_DB_FNAME)
+                _OPENED_DB = _getPooledDB()
 
             _REFCOUNT += 1
             yield _OPENED_DB
@@ -558,11 +870,67 @@ def getDB(block=True):
         try:
             _REFCOUNT -= 1
             if _REFCOUNT == 0:
-                _OPENED_DB.close()
+                if _OPENED_DB._conn.in_transaction:
+                    _OPENED_DB.rollback()
                 _OPENED_DB = None
         finally:
             _LOCKED -= 1
             _LOCK.release()
 
+@contextmanager
+def getReadDB():
+    """Generator: Return a database handler for reading only.
+
+    This returns the current thread's pooled read-only
+    :class:`bridgedb.Storage.Database`, without taking the lock used by
+    :func:`getDB`.  Since the database uses write-ahead logging, reads see the
+    last committed state of the database, and neither wait for, nor hold up,
+    any thread which is writing to it (i.e. while reloading bridges).
+
+    :rtype: :class:`bridgedb.Storage.Database`
+    :returns: An instance of :class:`bridgedb.Storage.Database` which
+        refuses any attempts to modify the database.
+    """
+    assert _DB_FNAME
+    yield _getPooledDB(readOnly=True)
+
+@contextmanager
+def getTransactionDB():
+    """Generator: Return a database handler for a short read-modify-write.
+
+    This returns the current thread's pooled :class:`bridgedb.Storage.Database`
+    within a single ``BEGIN IMMEDIATE`` transaction, without taking the lock
+    used by :func:`getDB`.  Whatever is read within the transaction can't be
+    changed by anyone else before it is committed.  If another connection is
+    writing to the database (i.e. while reloading bridges), this waits at most
+    :data:`BUSY_TIMEOUT` seconds, only for that connection's current write
+    transaction, rather than for the whole time the lock is held.
+
+    The transaction is committed when the caller is finished, or rolled back
+    if they raise an exception.  If the current thread is already within
+    :func:`getDB`, its transaction is used instead, and left for
+    :func:`getDB`'s caller to commit.
+
+    :rtype: :class:`bridgedb.Storage.Database`
+    :returns: An instance of :class:`bridgedb.Storage.Database` used to
+        query the database
+    """
+    assert _DB_FNAME
+    db = _getPooledDB()
+    if db is _OPENED_DB:
+        yield db
+        return
+
+    if db._conn.in_transaction:
+        db.rollback()
+    db._cur.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
 def dbIsLocked():
     return _LOCKED != 0
@@ -12,18 +12,21 @@ them into hashrings for distributors.
 
 import binascii
 import bisect
+import collections
 import logging
 import re
 import hashlib
 import socket
 import time
-import ipaddr
+import types
 import random
 
 import bridgedb.Storage
 
+from bridgedb import metrics
 from bridgedb.bridges import Bridge
 from bridgedb.crypto import getHMACFunc
+from bridgedb.crypto import positionCache
 from bridgedb.parse import addr
 from bridgedb.parse.fingerprint import isValidFingerprint
 from bridgedb.parse.fingerprint import toHex
@@ -83,6 +86,218 @@ class BridgeRingParameters(object):
         self.needFlags = [(flag.lower(), count) for flag, count in needFlags[:]]
 
 
+class RingIndex(object):
+    """A sorted index of hashring positions and the bridges assigned to them.
+
+    Positions are fixed-width digests stored back-to-back in a single
+    contiguous :class:`bytearray`, kept in sorted order at all times.  A
+    parallel list holds the bridge assigned to each position, such that the
+    bridge at ``bridges[i]`` sits at the ``i``th position in the buffer.
+
+    Compared to keeping a list of ``bytes`` objects plus a dictionary keyed by
+    those same objects, this costs :data:`width` bytes (plus one pointer) per
+    bridge, and it never needs to be re-sorted: :meth:`insert` and
+    :meth:`remove` splice the buffer in place after an O(log n) bisection.
+
+    The bisection itself needs a list of ``bytes`` objects to hand to
+    :func:`bisect.bisect_left`, which is built from the buffer the first time
+    an index is searched after :meth:`load`, and then kept up to date.  Indices
+    which are loaded but never searched (e.g. subrings which are about to be
+    replaced) don't pay for it.
+
+    :ivar int width: The length, in bytes, of every position.
+    """
+
+    def __init__(self, width=DIGEST_LEN):
+        self.width = width
+        self._buf = bytearray()
+        self._bridges = []
+        self._keys = None
+        self._mapping = None
+
+    def __len__(self):
+        return len(self._bridges)
+
+    def __iter__(self):
+        """Iterate over all positions, in sorted order."""
+        for i in range(len(self)):
+            yield self.positionAt(i)
+
+    def __contains__(self, pos):
+        return self._find(pos) is not None
+
+    def clear(self):
+        """Remove all positions and bridges from this index."""
+        self._buf = bytearray()
+        self._bridges = []
+        self._keys = None
+        self._mapping = None
+
+    def copy(self):
+        """Get a new :class:`RingIndex` holding the same positions and
+        bridges as this one.
+        """
+        index = self.__class__(self.width)
+        index._buf = bytearray(self._buf)
+        index._bridges = list(self._bridges)
+        if self._keys is not None:
+            index._keys = list(self._keys)
+        return index
+
+    def load(self, pairs):
+        """Replace the contents of this index with **pairs**, in one shot.
+
+        :param pairs: An iterable of ``(position, bridge)`` two-tuples.  If a
+            position is given more than once, the last bridge given for it
+            wins, just as with repeated calls to :meth:`insert`.
+        """
+        merged = dict(pairs)
+        positions = sorted(merged)
+        for pos in positions:
+            self._checkWidth(pos)
+        self._buf = bytearray(b''.join(positions))
+        self._bridges = [merged[pos] for pos in positions]
+        self._keys = None
+        self._mapping = None
+
+    def _checkWidth(self, pos):
+        if len(pos) != self.width:
+            raise ValueError("Hashring positions must be %d bytes, got %d."
+                             % (self.width, len(pos)))
+
+    def positionAt(self, index):
+        """Get the position stored at **index** in the sorted buffer.
+
+        :rtype: bytes
+        """
+        start = index * self.width
+        return bytes(self._buf[start:start + self.width])
+
+    def bridgeAt(self, index):
+        """Get the bridge assigned to the position at **index**."""
+        return self._bridges[index]
+
+    def _getKeys(self):
+        """Get the sorted list of every position, building it from the buffer
+        if it isn't already built.
+
+        :rtype: list
+        """
+        if self._keys is None:
+            buf, width = bytes(self._buf), self.width
+            self._keys = [buf[i:i + width] for i in range(0, len(buf), width)]
+        return self._keys
+
+    def bisect(self, pos):
+        """Locate the insertion point for **pos** in the sorted buffer.
+
+        :param bytes pos: A position in the hashring.
+        :rtype: int
+        :returns: The index of the first stored position which is greater than
+            or equal to **pos**.
+        """
+        return bisect.bisect_left(self._getKeys(), pos)
+
+    def _find(self, pos):
+        """Get the index of **pos**, or ``None`` if it isn't stored here."""
+        keys = self._getKeys()
+        idx = bisect.bisect_left(keys, pos)
+        if idx < len(keys) and keys[idx] == pos:
+            return idx
+        return None
+
+    def get(self, pos, default=None):
+        """Get the bridge at position **pos**, or **default** if there isn't
+        one.
+        """
+        idx = self._find(pos)
+        if idx is None:
+            return default
+        return self._bridges[idx]
+
+    def insert(self, pos, bridge):
+        """Assign **bridge** to position **pos**.
+
+        If there is already a bridge at **pos**, it is replaced.
+
+        :rtype: bool
+        :returns: ``True`` if **pos** was not previously in this index.
+        """
+        self._checkWidth(pos)
+        self._mapping = None
+        pos = bytes(pos)
+        keys = self._getKeys()
+        idx = bisect.bisect_left(keys, pos)
+        if idx < len(keys) and keys[idx] == pos:
+            self._bridges[idx] = bridge
+            return False
+        start = idx * self.width
+        self._buf[start:start] = pos
+        self._bridges.insert(idx, bridge)
+        keys.insert(idx, pos)
+        return True
+
+    def remove(self, pos):
+        """Remove position **pos** and its bridge from this index.
+
+        :returns: The bridge which was at **pos**, or ``None`` if there
+            wasn't one.
+        """
+        idx = self._find(pos)
+        if idx is None:
+            return None
+        self._mapping = None
+        start = idx * self.width
+        del self._buf[start:start + self.width]
+        del self._keys[idx]
+        return self._bridges.pop(idx)
+
+    def items(self):
+        """Iterate over ``(position, bridge)`` two-tuples, in sorted order."""
+        for i in range(len(self)):
+            yield self.positionAt(i), self._bridges[i]
+
+    def bridges(self):
+        """Get a list of every bridge, ordered by position."""
+        return list(self._bridges)
+
+    def iterBridges(self):
+        """Iterate over every bridge, ordered by position, without copying
+        them into a list first.
+        """
+        return iter(self._bridges)
+
+    def asMapping(self):
+        """Get a read-only mapping of positions to bridges.
+
+        The mapping is built once, and then shared by every caller until this
+        index is next changed.
+
+        :rtype: :class:`types.MappingProxyType`
+        """
+        if self._mapping is None:
+            self._mapping = types.MappingProxyType(dict(self.items()))
+        return self._mapping
+
+    def getPositionsAt(self, pos, N=1):
+        """Get **N** positions, starting at (and including) **pos**, wrapping
+        around to the beginning of the hashring if necessary.
+
+        If **N** is at least the number of positions in this index, every
+        position is returned, in sorted order.
+
+        :param bytes pos: The position to start from.
+        :param int N: The number of positions to return.
+        :rtype: list
+        """
+        total = len(self._bridges)
+        if N >= total:
+            return list(self)
+        keys = self._getKeys()
+        idx = bisect.bisect_left(keys, pos)
+        return [keys[(idx + i) % total] for i in range(N)]
+
+
 class BridgeRing(object):
     """Arranges bridges into a hashring based on an hmac function."""
 
@@ -94,16 +309,14 @@ class BridgeRing(object):
              :func:`~bridgedb.crypto.getKey`.
         :type answerParameters: :class:`BridgeRingParameters`
         :param answerParameters: DOCDOC
-        :ivar dict bridges: A dictionary which maps HMAC keys to
-            :class:`~bridgedb.bridges.Bridge`s.
+        :ivar positions: A :class:`RingIndex` which maps HMAC keys to
+            :class:`~bridgedb.bridges.Bridge`s, in sorted order.
         :ivar dict bridgesByID: A dictionary which maps raw hash digests of
             bridge ID keys to :class:`~bridgedb.bridges.Bridge`s.
         :type hmac: callable
         :ivar hmac: An HMAC function, which uses the **key** parameter to
              generate new HMACs for storing, inserting, and retrieving
              :class:`~bridgedb.bridges.Bridge`s within mappings.
-        :ivar bool isSorted: ``True`` if ``sortedKeys`` is currently sorted.
-        :ivar list sortedKeys: A sorted list of all of the HMACs.
         :ivar str name: A string which identifies this hashring, used mostly
             for differentiating this hashring in log messages, but it is also
             used for naming subrings. If this hashring is a subring, the
@@ -135,11 +348,9 @@ class BridgeRing(object):
                 contains ``count`` number of
                 :class:`~bridgedb.bridges.Bridge`s of a certain ``type``.
         """
-        self.bridges = {}
+        self.positions = RingIndex(DIGEST_LEN)
         self.bridgesByID = {}
-        self.hmac = getHMACFunc(key, hex=False)
-        self.isSorted = False
-        self.sortedKeys = []
+        self.hmac = getHMACFunc(key, hex=False, cache=positionCache)
         if answerParameters is None:
             answerParameters = BridgeRingParameters()
         self.answerParameters = answerParameters
@@ -168,25 +379,57 @@ class BridgeRing(object):
 
     def __len__(self):
         """Get the number of unique bridges this hashring contains."""
-        return len(self.bridges)
+        return len(self.positions)
+
+    @property
+    def bridges(self):
+        """A read-only mapping of HMAC keys to
+        :class:`~bridgedb.bridges.Bridge`s.
+
+        This is built from :data:`positions`, and cached until this hashring
+        is next changed.  To just loop over the bridges, use
+        :meth:`iterBridges` instead.
+        """
+        return self.positions.asMapping()
+
+    def iterBridges(self):
+        """Iterate over all of the :class:`~bridgedb.bridges.Bridge`s in this
+        hashring, in order of their positions.
+        """
+        return self.positions.iterBridges()
 
     def clear(self):
         """Remove all bridges and mappings from this hashring and subrings."""
-        self.bridges = {}
+        self.positions.clear()
         self.bridgesByID = {}
-        self.isSorted = False
-        self.sortedKeys = []
 
         for tp, val, count, subring in self.subrings:
             subring.clear()
 
+    def copy(self):
+        """Get a new hashring, with the same key, answer parameters, and name
+        as this one, which holds the same bridges (in copies of all of this
+        hashring's subrings).
+
+        Changing the copy does not change this hashring.
+        """
+        ring = self.__class__.__new__(self.__class__)
+        ring.positions = self.positions.copy()
+        ring.bridgesByID = self.bridgesByID.copy()
+        ring.hmac = self.hmac
+        ring.answerParameters = self.answerParameters
+        ring.subrings = [(tp, val, count, subring.copy())
+                         for (tp, val, count, subring) in self.subrings]
+        ring.name = self.name
+        return ring
+
     def remove(self, bridge):
         """Remove a **bridge** from this hashring."""
         for tp, val, _, subring in self.subrings:
             subring.remove(bridge)
         pos = self.hmac(bridge.identity)
-        if pos in self.bridges:
-            del self.bridges[pos]
+        if self.positions.remove(pos) is not None:
+            self.bridgesByID.pop(bridge.identity, None)
 
     def insert(self, bridge):
         """Add a **bridge** to this hashring.
@@ -212,18 +455,34 @@ class BridgeRing(object):
                     subring.insert(bridge)
 
         pos = self.hmac(bridge.identity)
-        if not pos in self.bridges:
-            self.sortedKeys.append(pos)
-            self.isSorted = False
-        self.bridges[pos] = bridge
+        self.positions.insert(pos, bridge)
         self.bridgesByID[bridge.identity] = bridge
         logging.debug("Adding %s to %s" % (bridge.address, self.name))
 
-    def _sort(self):
-        """Helper: put the keys in sorted order."""
-        if not self.isSorted:
-            self.sortedKeys.sort()
-            self.isSorted = True
+    def bulkInsert(self, bridges):
+        """Add many **bridges** to this hashring (and its subrings) at once.
+
+        This is equivalent to calling :meth:`insert` for each bridge, in
+        order, except that each sorted index is rebuilt only once, rather than
+        spliced once per bridge.
+
+        :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+        """
+        bridges = list(bridges)
+
+        for tp, val, _, subring in self.subrings:
+            if tp == 'port':
+                subring.bulkInsert([b for b in bridges if b.orPort == val])
+            else:
+                assert tp == 'flag' and val == 'stable'
+                subring.bulkInsert([b for b in bridges if b.flags.stable])
+
+        pairs = list(self.positions.items())
+        pairs.extend([(self.hmac(b.identity), b) for b in bridges])
+        self.positions.load(pairs)
+        for bridge in bridges:
+            self.bridgesByID[bridge.identity] = bridge
+        logging.debug("Added %d bridges to %s" % (len(bridges), self.name))
 
     def _getBridgeKeysAt(self, pos, N=1):
         """Bisect a list of bridges at a specified position, **pos**, and
@@ -233,22 +492,20 @@ class BridgeRing(object):
         If the number of bridges requested, **N**, is larger that the size of
         this hashring, return the entire ring. Otherwise:
 
-          1. Sort this bridges in this hashring, if it is currently unsorted.
-
-          2. Bisect the sorted bridges. If the bridge at the desired position,
+          1. Bisect the sorted bridges. If the bridge at the desired position,
              **pos**, already exists within this hashring, the the bisection
              result is the bridge at position **pos**. Otherwise, the bisection
              result is the first position after **pos** which has a bridge
              assigned to it.
 
-          3. Try to obtain **N** bridges, starting at (and including) the
+          2. Try to obtain **N** bridges, starting at (and including) the
              bridge in the requested position, **pos**.
 
                a. If there aren't **N** bridges after **pos**, wrap back
                   around to the beginning of the hashring and obtain bridges
                   until we have **N** bridges.
 
-          4. Check that the number of bridges obtained is indeed **N**, then
+          3. Check that the number of bridges obtained is indeed **N**, then
              return them.
 
         :param bytes pos: The position to jump to. Any bridges returned will
@@ -260,16 +517,8 @@ class BridgeRing(object):
         :returns: A list of :class:`~bridgedb.bridges.Bridge`s.
         """
         assert len(pos) == DIGEST_LEN
-        if N >= len(self.sortedKeys):
-            return self.sortedKeys
-        if not self.isSorted:
-            self._sort()
-        idx = bisect.bisect_left(self.sortedKeys, pos)
-        r = self.sortedKeys[idx:idx+N]
-        if len(r) < N:
-            # wrap around as needed.
-            r.extend(self.sortedKeys[:N - len(r)])
-        assert len(r) == N
+        r = self.positions.getPositionsAt(pos, N)
+        assert len(r) == min(N, len(self.positions))
         return r
 
     def filterDistinctSubnets(self, fingerprints):
@@ -279,11 +528,10 @@ class BridgeRing(object):
         logging.debug("Got %d possible bridges to filter" % len(fingerprints))
 
         bridges = []
-        subnets = []
+        subnets = set()
 
         for fingerprint in fingerprints:
-            bridge = self.bridges[fingerprint]
-            jump = False
+            bridge = self.positions.get(fingerprint)
 
             # HOTFIX for https://bugs.torproject.org/26150
             if not bridge.address:
@@ -291,23 +539,17 @@ class BridgeRing(object):
                               % toHex(fingerprint))
                 continue
 
-            for subnet in subnets:
-                if bridge.address in subnet:
-                    jump = True
-                    logging.debug(
-                        ("Skipping distribution of bridge %s in a subnet which "
-                         "contains another bridge we're already distributing")
-                        % bridge)
-                    break
-            if jump:
+            # Each bridge's IPv4 /16 or IPv6 /32 was computed when its
+            # address was set, so this is a single set lookup:
+            if bridge.subnetPrefix in subnets:
+                logging.debug(
+                    ("Skipping distribution of bridge %s in a subnet which "
+                     "contains another bridge we're already distributing")
+                    % bridge)
                 continue
 
             bridges.append(bridge)
-            if bridge.address.version == 4:
-                cidr = str(bridge.address) + "/16"
-            else:
-                cidr = str(bridge.address) + "/32"
-            subnets.append(ipaddr.IPNetwork(cidr))
+            subnets.add(bridge.subnetPrefix)
 
         return bridges
 
@@ -344,7 +586,7 @@ class BridgeRing(object):
         if filterBySubnet:
             bridges = self.filterDistinctSubnets(keys)
         else:
-            bridges = [self.bridges[k] for k in keys]
+            bridges = [self.positions.get(k) for k in keys]
 
         bridges = bridges[:N]
         logging.debug("Caller asked for N=%d, filterBySubnet=%s bridges.  "
@@ -364,7 +606,7 @@ class BridgeRing(object):
 
     def dumpAssignments(self, f, description=""):
         logging.info("Dumping bridge assignments for %s..." % self.name)
-        for b in self.bridges.values():
+        for b in self.positions.bridges():
             desc = [ description ]
             for tp,val,_,subring in self.subrings:
                 if subring.getBridgeByID(b.identity):
@@ -396,9 +638,16 @@ class UnallocatedHolder(object):
     def __len__(self):
         return len(self.fingerprints)
 
+    def __contains__(self, bridge):
+        return bridge.fingerprint in self.fingerprints
+
     def clear(self):
         self.fingerprints = []
 
+    def copyFrom(self, other):
+        """Replace our bridges with those held by **other**."""
+        self.fingerprints = list(other.fingerprints)
+
     def dumpAssignments(self, f, description=""):
         with bridgedb.Storage.getDB() as db:
             allBridges = db.getAllBridges()
@@ -412,18 +661,54 @@ class UnallocatedHolder(object):
                 f.write("%s %s\n" % (bridge.hex_key, " ".join(desc).strip()))
 
 
+def getBridgeState(bridge):
+    """Summarise everything about a **bridge** which affects where, and how,
+    it is distributed.
+
+    Two versions of the same bridge with equal states can be swapped for one
+    another without changing any hashrings.  Most of this is pinned down by
+    the digests of the bridge's server and extrainfo descriptors; the rest
+    comes from the bridge's networkstatus entry and the blocking database.
+
+    :type bridge: :class:`~bridgedb.bridges.Bridge`
+    :param bridge: The bridge to summarise.
+    :rtype: tuple
+    """
+    flags = bridge.flags
+    transports = [(pt.methodname, str(pt.address), pt.port,
+                   tuple(sorted(pt.arguments.items())))
+                  for pt in bridge.transports]
+    blocked = [(key, tuple(sorted(set(countries))))
+               for key, countries in bridge._blockedIn.items()]
+
+    return (bridge.descriptorDigest,
+            bridge.extrainfoDigest,
+            (flags.fast, flags.guard, flags.running, flags.stable, flags.valid),
+            bridge.distribution_request,
+            str(bridge.address),
+            bridge.orPort,
+            tuple([(str(ip), port, version)
+                   for (ip, port, version) in bridge.orAddresses]),
+            tuple(sorted(transports)),
+            tuple(sorted(blocked)))
+
+
 class BridgeSplitter(object):
     """Splits incoming bridges up based on an HMAC, and assigns them to
     sub-bridgeholders with different probabilities.  Bridge ←→ BridgeSplitter
     associations are recorded in a store.
     """
     def __init__(self, key):
-        self.hmac = getHMACFunc(key, hex=True)
+        self.hmac = getHMACFunc(key, hex=True, cache=positionCache)
         self.ringsByName = {}
         self.totalP = 0
         self.pValues = []
         self.rings = []
         self.statsHolders = []
+        #: A dictionary mapping the fingerprint of every bridge which was
+        #: assigned to one of our subrings to its
+        #: :class:`~bridgedb.bridges.Bridge`.
+        self.bridges = {}
 
     def __len__(self):
         n = 0
@@ -451,28 +736,181 @@ class BridgeSplitter(object):
         self.statsHolders.append(t)
 
     def clear(self):
+        self.bridges = {}
         for r in self.ringsByName.values():
             r.clear()
 
+    def copyFrom(self, other):
+        """Replace the bridges in all of our subrings with copies of those in
+        the identically-named subrings of **other**.
+
+        Our subrings keep their identities (so that any distributors holding
+        them see the copied bridges), but changing them afterwards does not
+        change **other**.
+
+        :type other: :class:`BridgeSplitter`
+        :param other: A hashring with the same subrings as this one.
+        :raises ValueError: If **other** has different subrings, or splits
+            bridges between them in different proportions.
+        """
+        if (self.rings != other.rings) or (self.pValues != other.pValues) or \
+           (self.totalP != other.totalP):
+            raise ValueError("Can't copy bridges from a hashring with "
+                             "different subrings: %s" % " ".join(other.rings))
+
+        for name, ring in self.ringsByName.items():
+            ring.copyFrom(other.ringsByName[name])
+        self.bridges = other.bridges.copy()
+
+    def remove(self, bridge):
+        """Remove a **bridge** from whichever of our subrings it was assigned
+        to.
+
+        :type bridge: :class:`~bridgedb.bridges.Bridge`
+        :param bridge: The bridge to remove.
+        """
+        self.bridges.pop(bridge.fingerprint, None)
+        for ring in self.ringsByName.values():
+            if bridge in ring:
+                ring.remove(bridge)
+
+    def update(self, bridges):
+        """Make this hashring hold the current versions of **bridges**,
+        touching only the bridges which have changed.
+
+        Bridges which are new, or whose :func:`getBridgeState` differs from
+        that of the bridge with the same fingerprint which we already hold,
+        are (re)assigned with :meth:`insertMany`.  Bridges which we hold, but
+        which are missing from **bridges** (or are no longer running), are
+        removed.  Everything else is left where it is.
+
+        :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+        :rtype: tuple
+        :returns: The number of bridges which were inserted, and the number
+            which were removed. (A changed bridge counts as both.)
+        """
+        current = {}
+        for bridge in bridges:
+            if bridge.flags.running:
+                current[bridge.fingerprint] = bridge
+
+        stale = [bridge for fingerprint, bridge in self.bridges.items()
+                 if fingerprint not in current]
+        fresh = []
+        unchanged = []
+        for fingerprint, bridge in current.items():
+            old = self.bridges.get(fingerprint)
+            if old is None:
+                fresh.append(bridge)
+            elif getBridgeState(old) != getBridgeState(bridge):
+                stale.append(old)
+                fresh.append(bridge)
+            else:
+                unchanged.append(old)
+
+        for bridge in unchanged:
+            for s in self.statsHolders:
+                s.insert(bridge)
+
+        if unchanged:
+            with bridgedb.Storage.getDB() as db:
+                db.updateBridgesLastSeen(
+                    [bridge.fingerprint for bridge in unchanged], time.time())
+                db.commit()
+
+        for bridge in stale:
+            self.remove(bridge)
+        if fresh:
+            self.insertMany(fresh)
+
+        logging.info("Updated hashring: %d bridges unchanged, %d inserted, "
+                     "%d removed." % (len(unchanged), len(fresh), len(stale)))
+        return len(fresh), len(stale)
+
     def insert(self, bridge):
+        """Assign a **bridge** to one of our subrings.
+
+        :type bridge: :class:`~bridgedb.bridges.Bridge`
+        :param bridge: The bridge to assign.
+        """
+        self.insertMany([bridge])
+
+    def insertMany(self, bridges):
+        """Assign many **bridges** to our subrings at once.
+
+        This is equivalent to calling :meth:`insert` for each bridge, but all
+        of the previous assignments are read in one query, and all of the
+        new assignments are written in one transaction.
+
+        :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+        """
         assert self.rings
 
-        for s in self.statsHolders:
-            s.insert(bridge)
+        bridges = list(bridges)
+        for bridge in bridges:
+            for s in self.statsHolders:
+                s.insert(bridge)
 
         # The bridge must be running to insert it:
-        if not bridge.flags.running:
+        running = [bridge for bridge in bridges if bridge.flags.running]
+        if not running:
             return
 
         validRings = self.rings
-        distribution_method = orig_method = None
+        placements = []
 
         with bridgedb.Storage.getDB() as db:
-            orig_method = db.getBridgeDistributor(bridge, validRings)
-            if orig_method is not None:
-                distribution_method = orig_method
-                logging.info("So far, bridge %s was in hashring %s" %
-                             (bridge, orig_method))
+            known = db.getBridgeDistributors(running, validRings)
+            for bridge in running:
+                distribution_method = self._placeBridge(
+                    bridge, known.get(bridge.fingerprint))
+                if distribution_method is not None:
+                    known[bridge.fingerprint] = distribution_method
+                    placements.append((bridge, distribution_method))
+
+            ringnames = db.insertBridgesAndGetRings(placements, time.time(),
+                                                    validRings)
+            db.commit()
+
+        byRing = collections.OrderedDict()
+        for (bridge, _), ringname in zip(placements, ringnames):
+            ring = self.ringsByName.get(ringname)
+            if ring is None:
+                logging.warn("Couldn't recognise ring named: '%s'" % ringname)
+                logging.info("Current rings: %s" % " ".join(self.ringsByName))
+                continue
+            byRing.setdefault(ringname, []).append(bridge)
+            self.bridges[bridge.fingerprint] = bridge
+
+        for ringname, placed in byRing.items():
+            ring = self.ringsByName[ringname]
+            if hasattr(ring, "insertMany"):
+                ring.insertMany(placed)
+            else:
+                for bridge in placed:
+                    ring.insert(bridge)
+
+    def _placeBridge(self, bridge, orig_method):
+        """Decide which subring a **bridge** should be distributed through.
+
+        If the bridge is moving away from the subring it was previously
+        assigned to, it is removed from that subring.
+
+        :type bridge: :class:`~bridgedb.bridges.Bridge`
+        :param bridge: The bridge to place.
+        :type orig_method: str or None
+        :param orig_method: The name of the subring which the **bridge** was
+            previously assigned to, if any.
+        :rtype: str or None
+        :returns: The name of the subring to assign the **bridge** to, or
+            ``None`` if it shouldn't be distributed at all.
+        """
+        validRings = self.rings
+        distribution_method = orig_method
+
+        if orig_method is not None:
+            logging.info("So far, bridge %s was in hashring %s" %
+                         (bridge, orig_method))
 
         # Check if the bridge requested a distribution method and if so, try to
         # use it.
@@ -491,11 +929,12 @@ class BridgeSplitter(object):
                             (bridge, orig_method, distribution_method))
             prevRing = self.ringsByName.get(orig_method)
             prevRing.remove(bridge)
+            self.bridges.pop(bridge.fingerprint, None)
 
         # If they requested not to be distributed, honor the request:
         if distribution_method == "none":
             logging.info("Bridge %s requested to not be distributed." % bridge)
-            return
+            return None
 
         # If we didn't know what they are talking about, or they requested
         # "any" distribution method, and we've never seen this bridge
@@ -503,8 +942,7 @@ class BridgeSplitter(object):
         if ((distribution_method not in validRings) or
             (distribution_method == "any")):
 
-            pos = self.hmac(bridge.identity)
-            n = int(pos[:8], 16) % self.totalP
+            n = self.hmac.prefix(bridge.identity) % self.totalP
             pos = bisect.bisect_right(self.pValues, n) - 1
             assert 0 <= pos < len(self.rings)
             distribution_method = self.rings[pos]
@@ -512,23 +950,51 @@ class BridgeSplitter(object):
                             " pos=%s).") % (self.__class__.__name__, bridge,
                                             distribution_method, n, pos))
 
-        with bridgedb.Storage.getDB() as db:
-            ringname = db.insertBridgeAndGetRing(bridge, distribution_method,
-                                                 time.time(), validRings)
-            db.commit()
-
-        ring = self.ringsByName.get(ringname)
-        ring.insert(bridge)
-
-        if ring is None:
-            logging.warn("Couldn't recognise ring named: '%s'" % ringname)
-            logging.info("Current rings: %s" % " ".join(self.ringsByName))
+        return distribution_method
 
     def dumpAssignments(self, f, description=""):
         for name,ring in self.ringsByName.items():
             ring.dumpAssignments(f, "%s %s" % (description, name))
 
 
+def _iterBits(bits):
+    """Iterate over the positions of the set bits in **bits**, lowest first.
+
+    >>> list(_iterBits(0b101001))
+    [0, 3, 5]
+
+    :param int bits: A non-negative integer, used as a bitset.
+    :rtype: iterator
+    """
+    # Walk the bytes, rather than repeatedly clearing the lowest bit of
+    # **bits**, since each of those would copy the whole int.
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        while byte:
+            lowest = byte & -byte
+            yield (i << 3) + lowest.bit_length() - 1
+            byte ^= lowest
+
+
+def _packBits(positions, length):
+    """Get the bitset which has a bit set for each of the **positions**.
+
+    >>> _packBits([0, 3, 5], 6) == 0b101001
+    True
+
+    :param positions: An iterable of bit positions, each less than
+        **length**.
+    :param int length: The number of bits in the bitset.
+    :rtype: int
+    """
+    # Set the bits in a little-endian bytearray, rather than or-ing together
+    # ever-larger ints, so this takes linear time in **length**.
+    buf = bytearray((length + 7) // 8)
+    for pos in positions:
+        buf[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(bytes(buf), "little")
+
+
 class FilteredBridgeSplitter(object):
     """Places bridges into subrings based upon sets of filters.
 
@@ -541,10 +1007,14 @@ class FilteredBridgeSplitter(object):
 
         :type key: DOCDOC
         :param key: An HMAC key.
-        :param int max_cached_rings: XXX max_cached_rings appears to not be
-             used anywhere.
-
-        :ivar filterRings: A dictionary of subrings which has the form
+        :param int max_cached_rings: The maximum number of subrings, other
+             than the pinned ones (i.e. those added by a distributor's
+             ``prepopulateRings()``), to keep.  When more are added, the least
+             recently used unpinned subring is dropped.  If ``None``, the
+             subrings are never dropped.
+
+        :ivar filterRings: An ordered dictionary of subrings, from least to
+             most recently used, which has the form
              ``{ringname: (filterFn, subring)}``, where:
                  - ``ringname`` is a unique string identifying the subring.
                  - ``filterFn`` is a callable which filters Bridges in some
@@ -558,22 +1028,110 @@ class FilteredBridgeSplitter(object):
         :type distributorName: str
         :ivar distributorName: The name of this splitter's distributor. See
              :meth:`~bridgedb.distributors.https.distributor.HTTPSDistributor.setDistributorName`.
+        :ivar set pinnedRings: The names of the subrings which are never
+             dropped to make room for others.
+        :ivar int hits: The number of times :meth:`getRing` found a subring.
+        :ivar int misses: The number of times :meth:`getRing` didn't.
+        :ivar int evictions: The number of subrings dropped so far.
         """
         self.key = key
-        self.filterRings = {}
-        self.hmac = getHMACFunc(key, hex=True)
+        self.filterRings = collections.OrderedDict()
+        self.pinnedRings = set()
+        self.hmac = getHMACFunc(key, hex=True, cache=positionCache)
         self.bridges = {}
         self.distributorName = ''
-
-        #XXX: unused
         self.max_cached_rings = max_cached_rings
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # An attribute index of our bridges: every bridge is given a slot
+        # number, and each individual filter used by our subrings maps to an
+        # int whose bits are set for the slots of the bridges which pass it,
+        # so that new subrings can be populated without calling any filters.
+        # (Like the subrings themselves, this means that a bridge which is
+        # changed in place must be re-inserted for the changes to count.)
+        self._slots = {}
+        self._slotBridges = []
+        self._freeSlots = []
+        self._filterBits = {}
 
     def __len__(self):
         return len(self.bridges)
 
+    def __contains__(self, bridge):
+        return bridge.fingerprint in self.bridges
+
     def clear(self):
         self.bridges = {}
-        self.filterRings = {}
+        self.filterRings = collections.OrderedDict()
+        self.pinnedRings = set()
+        self._slots = {}
+        self._slotBridges = []
+        self._freeSlots = []
+        self._filterBits = {}
+
+    def copyFrom(self, other):
+        """Replace our bridges and subrings with copies of those held by
+        **other**.
+
+        :type other: :class:`FilteredBridgeSplitter`
+        :param other: The hashring to copy from.
+        """
+        self.bridges = other.bridges.copy()
+        self.filterRings = collections.OrderedDict(
+            [(ringname, (filterFn, subring.copy()))
+             for ringname, (filterFn, subring) in list(other.filterRings.items())])
+        self.pinnedRings = set(other.pinnedRings)
+        self._slots = other._slots.copy()
+        self._slotBridges = list(other._slotBridges)
+        self._freeSlots = list(other._freeSlots)
+        self._filterBits = other._filterBits.copy()
+
+    def getRing(self, ringname):
+        """Get the subring named **ringname**, if we have it, and mark it as
+        the most recently used.
+
+        :param str ringname: A unique name identifying a sub hashring.
+        :returns: The subring, or ``None`` if there isn't one by that name.
+        """
+        internalMetrix = metrics.InternalMetrics()
+        try:
+            _, subring = self.filterRings[ringname]
+        except KeyError:
+            self.misses += 1
+            internalMetrix.recordRingCacheMiss(self.distributorName)
+            return None
+
+        self.hits += 1
+        internalMetrix.recordRingCacheHit(self.distributorName)
+        try:
+            self.filterRings.move_to_end(ringname)
+        except KeyError:  # It was dropped by another thread in the meantime
+            pass
+        return subring
+
+    def _evictRings(self):
+        """Drop the least recently used unpinned subrings until there are no
+        more than :ivar:`max_cached_rings` of them.
+        """
+        if self.max_cached_rings is None:
+            return
+
+        unpinned = [ringname for ringname in self.filterRings
+                    if ringname not in self.pinnedRings]
+        excess = len(unpinned) - self.max_cached_rings
+
+        for ringname in unpinned[:max(excess, 0)]:
+            _, subring = self.filterRings.pop(ringname)
+            self.evictions += 1
+            metrics.InternalMetrics().recordRingCacheEviction(
+                self.distributorName)
+            logging.debug("Dropped least recently used %s subring %s."
+                          % (self.distributorName, subring.name))
+
+        if excess > 0:
+            self._pruneFilterBits()
 
     def remove(self, bridge):
         """Remove a bridge from all appropriate sub-hashrings.
@@ -590,6 +1148,8 @@ class FilteredBridgeSplitter(object):
                          "from ring." % bridge)
             return
 
+        self._unindexBridge(bridge.fingerprint)
+
         for ringname, (filterFn, subring) in self.filterRings.items():
             if filterFn(bridge):
                 subring.remove(bridge)
@@ -613,6 +1173,7 @@ class FilteredBridgeSplitter(object):
 
         logging.debug("Inserting %s into hashring..." % bridge)
         self.bridges[bridge.fingerprint] = bridge
+        self._indexBridges([bridge])
 
         for ringname, (filterFn, subring) in self.filterRings.items():
             if filterFn(bridge):
@@ -620,6 +1181,39 @@ class FilteredBridgeSplitter(object):
                 logging.debug("Inserted bridge %s into %s subhashring." %
                               (bridge, ringname))
 
+    def insertMany(self, bridges):
+        """Insert many bridges into all appropriate sub-hashrings at once.
+
+        This is equivalent to calling :meth:`insert` for each bridge, except
+        that our attribute index is updated once per filter, rather than once
+        per filter per bridge, and each subring's sorted index is rebuilt
+        only once.
+
+        :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+        """
+        running = []
+        for bridge in bridges:
+            # The bridge must be running to insert it:
+            if not bridge.flags.running:
+                logging.warn(("Skipping hashring insertion for non-running "
+                              "bridge: %s") % bridge)
+                continue
+            self.bridges[bridge.fingerprint] = bridge
+            running.append(bridge)
+
+        if not running:
+            return
+
+        logging.debug("Inserting %d bridges into hashring..." % len(running))
+        self._indexBridges(running)
+
+        for ringname, (filterFn, subring) in self.filterRings.items():
+            passed = [bridge for bridge in running if filterFn(bridge)]
+            if passed:
+                subring.bulkInsert(passed)
+                logging.debug("Inserted %d bridges into %s subhashring." %
+                              (len(passed), ringname))
+
     def extractFilterNames(self, ringname):
         """Get the names of the filters applied to a particular sub hashring.
 
@@ -640,7 +1234,8 @@ class FilteredBridgeSplitter(object):
         filterNames.sort()
         return filterNames
 
-    def addRing(self, subring, ringname, filterFn, populate_from=None):
+    def addRing(self, subring, ringname, filterFn, populate_from=None,
+                pinned=False):
         """Add a subring to this hashring.
 
         :param subring: The subring to add.
@@ -650,6 +1245,8 @@ class FilteredBridgeSplitter(object):
         :type populate_from: iterable or None
         :param populate_from: A group of :class:`Bridge`s. If given, the newly
             added subring will be populated with these bridges.
+        :param bool pinned: If ``True``, the subring is never dropped to keep
+            the number of subrings under :ivar:`max_cached_rings`.
         :rtype: bool
         :returns: False if there was a problem adding the subring, True
             otherwise.
@@ -692,20 +1289,200 @@ class FilteredBridgeSplitter(object):
                      (subring.name, subringNumber, self.distributorName))
         logging.info("  Subring filters: %s" % filterNames)
 
-        #TODO: drop LRU ring if len(self.filterRings) > self.max_cached_rings
+        if populate_from:
+            self._populateRings([(ringname, filterFn, subring)], populate_from)
+
+        # Only publish the subring once it's fully populated, so that anything
+        # reading (or copying) our subrings from another thread never sees it
+        # half-full.
         self.filterRings[ringname] = (filterFn, subring)
 
-        if populate_from:
-            inserted = 0
-            for bridge in populate_from.values():
-                if isinstance(bridge, Bridge) and filterFn(bridge):
-                    subring.insert(bridge)
-                    inserted += 1
-            logging.info("Bridges inserted into %s subring %s: %d"
-                         % (subring.name, subringNumber, inserted))
+        if pinned:
+            self.pinnedRings.add(ringname)
+        else:
+            self._evictRings()
 
         return True
 
+    def addRings(self, rings, populate_from=None, pinned=False):
+        """Add several subrings to this hashring, populating them all in a
+        single pass over the bridges.
+
+        Each individual filter is evaluated at most once per bridge, no matter
+        how many of the new subrings use it, and each subring's sorted index
+        is built in one shot.
+
+        :param rings: An iterable of ``(subring, ringname, filterFn)``
+            three-tuples, where each item is as for :meth:`addRing`.
+        :type populate_from: dict or None
+        :param populate_from: A group of :class:`Bridge`s. If given, the newly
+            added subrings will be populated with these bridges.
+        :param bool pinned: If ``True``, the subrings are never dropped to
+            keep the number of subrings under :ivar:`max_cached_rings`.
+        :rtype: int
+        :returns: The number of subrings which were successfully added.
+        """
+        added = []
+        for subring, ringname, filterFn in rings:
+            # Subrings kept from a previous hashring (see
+            # :meth:`BridgeSplitter.copyFrom`) are already populated:
+            if ringname in self.filterRings:
+                logging.debug("Keeping existing %s subring %s."
+                              % (self.distributorName,
+                                 self.filterRings[ringname][1].name))
+                if pinned:
+                    self.pinnedRings.add(ringname)
+                continue
+            if self.addRing(subring, ringname, filterFn, pinned=pinned):
+                added.append((ringname, filterFn, subring))
+
+        if populate_from:
+            self._populateRings(added, populate_from)
+
+        return len(added)
+
+    @staticmethod
+    def _getRingFilters(ringname, filterFn):
+        """Get the individual filters which a subring's bridges must pass.
+
+        :param ringname: The name of the subring. For all of the
+            distributors, this is a set of filter functions.
+        :param filterFn: The subring's composite filter function.
+        :rtype: frozenset
+        :returns: The filter functions within **ringname**, if it is a set of
+            them, otherwise just **filterFn**.
+        """
+        try:
+            filters = frozenset(ringname)
+        except TypeError:
+            filters = frozenset()
+        if not filters or not all(callable(f) for f in filters):
+            filters = frozenset([filterFn])
+        return filters
+
+    def _indexBridges(self, bridges):
+        """Give each of the **bridges** a slot in our attribute index (or
+        reuse the one its fingerprint already had) and record which of the
+        indexed filters it passes.
+
+        :param list bridges: The :class:`~bridgedb.bridges.Bridge`s to index.
+        """
+        indexed = []
+        for bridge in bridges:
+            if not isinstance(bridge, Bridge):
+                continue
+            slot = self._slots.get(bridge.fingerprint)
+            if slot is None:
+                if self._freeSlots:
+                    slot = self._freeSlots.pop()
+                else:
+                    slot = len(self._slotBridges)
+                    self._slotBridges.append(None)
+                self._slots[bridge.fingerprint] = slot
+            self._slotBridges[slot] = bridge
+            indexed.append((slot, bridge))
+
+        if not indexed or not self._filterBits:
+            return
+
+        # Build the bits for all of the new bridges first, then merge them
+        # into each filter's bitset in one go, since every operation on a
+        # bitset copies all of its bits.
+        length = len(self._slotBridges)
+        mask = ~_packBits([slot for slot, _ in indexed], length)
+        for filterFn, bits in list(self._filterBits.items()):
+            passed = _packBits([slot for slot, bridge in indexed
+                                if filterFn(bridge)], length)
+            self._filterBits[filterFn] = (bits & mask) | passed
+
+    def _unindexBridge(self, fingerprint):
+        """Remove the bridge with **fingerprint** from our attribute index.
+
+        :param str fingerprint: The bridge's fingerprint.
+        """
+        slot = self._slots.pop(fingerprint, None)
+        if slot is None:
+            return
+
+        mask = ~(1 << slot)
+        for filterFn, bits in list(self._filterBits.items()):
+            self._filterBits[filterFn] = bits & mask
+        self._slotBridges[slot] = None
+        self._freeSlots.append(slot)
+
+    def _getFilterBits(self, filterFn):
+        """Get the bitset of the slots of the bridges which pass **filterFn**,
+        indexing it with a single pass over our bridges if it wasn't already.
+
+        :param callable filterFn: A filter function for bridges.
+        :rtype: int
+        """
+        bits = self._filterBits.get(filterFn)
+        if bits is None:
+            bits = _packBits([slot for slot, bridge
+                              in enumerate(self._slotBridges)
+                              if bridge is not None and filterFn(bridge)],
+                             len(self._slotBridges))
+            self._filterBits[filterFn] = bits
+        return bits
+
+    def _pruneFilterBits(self):
+        """Stop indexing any filters which none of our subrings use."""
+        used = set()
+        for ringname, (filterFn, subring) in list(self.filterRings.items()):
+            used.update(self._getRingFilters(ringname, filterFn))
+        for filterFn in list(self._filterBits):
+            if filterFn not in used:
+                del self._filterBits[filterFn]
+
+    def _populateRings(self, rings, populate_from):
+        """Bulk-insert the bridges in **populate_from** into **rings**.
+
+        If a **ringname** is a set of filter functions (as it is for all of
+        the distributors), then the filters within it are evaluated
+        individually and the results are shared between rings.  Otherwise, the
+        ring's composite **filterFn** is used.
+
+        :param list rings: A list of ``(ringname, filterFn, subring)``
+            three-tuples.
+        :param dict populate_from: A dictionary whose values are
+            :class:`Bridge`s.
+        """
+        ringFilters = [self._getRingFilters(ringname, filterFn)
+                       for ringname, filterFn, subring in rings]
+
+        # If we're populating from our own bridges, and all of them are
+        # indexed, then each ring's bridges are just the intersection of the
+        # bitsets for its filters:
+        if (populate_from is self.bridges and
+            len(self._slots) == len(self.bridges)):
+            for (ringname, filterFn, subring), filters in zip(rings, ringFilters):
+                bits = -1
+                for filterFn in filters:
+                    bits &= self._getFilterBits(filterFn)
+                subring.bulkInsert([self._slotBridges[slot]
+                                    for slot in _iterBits(bits)])
+                logging.info("Bridges inserted into %s subring: %d"
+                             % (subring.name, len(subring)))
+            return
+
+        distinct = set()
+        distinct.update(*ringFilters)
+        selected = [[] for _ in rings]
+
+        for bridge in populate_from.values():
+            if not isinstance(bridge, Bridge):
+                continue
+            passed = set([f for f in distinct if f(bridge)])
+            for i, filters in enumerate(ringFilters):
+                if filters <= passed:
+                    selected[i].append(bridge)
+
+        for (ringname, filterFn, subring), bridges in zip(rings, selected):
+            subring.bulkInsert(bridges)
+            logging.info("Bridges inserted into %s subring: %d"
+                         % (subring.name, len(bridges)))
+
     def dumpAssignments(self, f, description=""):
         # one ring per filter set
         # bridges may be present in multiple filter sets
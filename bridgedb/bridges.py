@@ -35,7 +35,9 @@ import hashlib
 import ipaddr
 import logging
 import os
+import sys
 import warnings
+import weakref
 
 from Crypto.Util import asn1
 from Crypto.Util.number import bytes_to_long
@@ -63,6 +65,158 @@ from bridgedb.parse.nickname import isValidRouterNickname
 from bridgedb.util import isascii_noncontrol
 
 
+#: A cache of the ``ipaddr`` address objects used by any :class:`Bridge` or
+#: :class:`PluggableTransport`, so that bridges and transports which share an
+#: address also share a single address object.  Addresses are dropped from
+#: the cache once nothing uses them any more.
+_addresses = weakref.WeakValueDictionary()
+
+
+def _intern(value):
+    """Intern **value**, if it is a string, so that all bridges which have
+    the same value (e.g. the same methodname, country code, or platform
+    string) share a single copy of it.
+
+    :rtype: str or ``None``
+    :returns: The interned **value**, or **value** if it wasn't a string.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def _getSharedAddress(value):
+    """Get the ``ipaddr`` address object for **value**, reusing the one
+    from :data:`_addresses` if another bridge or transport already has it.
+
+    :param value: An IP address, as a string or an ``ipaddr`` address.
+    :rtype: :class:`ipaddr.IPv4Address`, :class:`ipaddr.IPv6Address`, or
+        ``False``
+    :returns: The address object, or ``False`` if **value** wasn't a valid
+        IP address (as from :func:`~bridgedb.parse.addr.isIPAddress`).
+    """
+    try:
+        address = _addresses.get(value)
+    except TypeError:  # The value wasn't hashable
+        return isIPAddress(value, compressed=False)
+
+    if address is None:
+        address = isIPAddress(value, compressed=False)
+        if address:
+            _addresses[value] = address
+
+    return address
+
+
+def _getSubnetPrefix(address):
+    """Get an integer which is the same for all addresses in the same IPv4
+    ``/16`` or IPv6 ``/32`` subnet as **address**, and which never collides
+    between the two address families.
+
+    :type address: :class:`ipaddr.IPv4Address` or :class:`ipaddr.IPv6Address`
+    :param address: An IP address.
+    :rtype: int
+    :returns: The first 16 bits of an IPv4 **address**, or the first 32 bits
+        of an IPv6 **address** with the 33rd bit set.
+    """
+    if address.version == 4:
+        return int(address) >> 16
+    return (int(address) >> 96) | (1 << 32)
+
+
+#: Bit positions for the (lowercased) country codes which bridges have been
+#: blocked in, assigned in the order they are first seen.
+_countryBits = {}
+
+
+def _getCountryBit(countryCode, create=False):
+    """Get the bit for **countryCode** in a bridge's blocked countries mask.
+
+    :param str countryCode: A two-character country code specifier.
+    :param bool create: If ``True``, assign a bit to **countryCode** if it
+        doesn't have one yet.
+    :rtype: int
+    :returns: An int with a single bit set, or ``0`` if no bridge can be
+        blocked in **countryCode** (and **create** was ``False``).
+    """
+    countryCode = countryCode.lower()
+    position = _countryBits.get(countryCode)
+    if position is None:
+        if not create:
+            return 0
+        position = _countryBits.setdefault(countryCode, len(_countryBits))
+    return 1 << position
+
+
+def _getCountriesMask(countryCodes):
+    """Get the mask of all the bits for **countryCodes**.
+
+    :param list countryCodes: Two-character country code specifiers.
+    :rtype: int
+    """
+    mask = 0
+    for countryCode in countryCodes:
+        mask |= _getCountryBit(countryCode)
+    return mask
+
+
+class BlockingIndex(object):
+    """A compact summary of where one :class:`Bridge`'s addresses are
+    blocked, built from its :data:`~Bridge._blockedIn` reports, so that
+    checking whether the bridge is blocked somewhere doesn't require formatting
+    any keys or looping over its transports.
+
+    Each set of countries is stored as an int with one bit set per country;
+    see :func:`_getCountryBit`.
+
+    :vartype blockedIn: dict
+    :ivar blockedIn: The :data:`~Bridge._blockedIn` this was built from.
+    :vartype vanilla: list
+    :ivar vanilla: A 4-tuple of ``(address, port, version, mask)`` for each of
+        the bridge's :data:`~Bridge.allVanillaAddresses`, where ``mask`` is the
+        countries that address:port pair is blocked in.
+    :vartype transports: dict
+    :ivar transports: Maps the :data:`~PluggableTransport.methodname` of
+        each of the bridge's transports to the countries which any of its
+        transports with that methodname is blocked in.
+    :vartype mask: int
+    :ivar mask: The countries which any of the bridge's addresses or
+        transports are blocked in.
+    """
+
+    __slots__ = ('blockedIn', 'vanilla', 'transports', 'mask')
+
+    def __init__(self, bridge):
+        """Build the index for **bridge**.
+
+        :type bridge: :class:`Bridge`
+        :param bridge: The bridge to summarise.
+        """
+        blockedIn = bridge._blockedIn
+
+        def getMask(address, port):
+            countries = blockedIn.get(bridge._getBlockKey(address, port), ())
+            mask = 0
+            for countryCode in countries:
+                mask |= _getCountryBit(countryCode, create=True)
+            return mask
+
+        self.blockedIn = blockedIn
+        self.vanilla = [(address, port, version, getMask(address, port))
+                        for address, port, version in bridge.allVanillaAddresses]
+        self.transports = {}
+        for pt in bridge.transports:
+            self.transports[pt.methodname] = (
+                self.transports.get(pt.methodname, 0) |
+                getMask(pt.address, pt.port))
+
+        self.mask = 0
+        for _, _, _, mask in self.vanilla:
+            self.mask |= mask
+        for mask in self.transports.values():
+            self.mask |= mask
+
+
 class PluggableTransportUnavailable(Exception):
     """Raised when a :class:`Bridge` doesn't have the requested
     :class:`PluggableTransport`.
@@ -115,11 +269,14 @@ class IBridge(Interface):
 class Flags(object):
     """All the flags which a :class:`Bridge` may have."""
 
-    fast = False
-    guard = False
-    running = False
-    stable = False
-    valid = False
+    __slots__ = ('fast', 'guard', 'running', 'stable', 'valid')
+
+    def __init__(self):
+        self.fast = False
+        self.guard = False
+        self.running = False
+        self.stable = False
+        self.valid = False
 
     def update(self, flags):
         """Update with **flags** taken from an ``@type networkstatus-bridge``
@@ -174,6 +331,10 @@ class BridgeAddressBase(object):
     :ivar address: The IP address of :class:`Bridge` or one of its
         :class:`PluggableTransport`s.
 
+    :type subnetPrefix: int
+    :ivar subnetPrefix: An integer identifying the IPv4 ``/16`` or IPv6
+        ``/32`` subnet of the :ivar:`address`. See :func:`_getSubnetPrefix`.
+
     :type country: str
     :ivar country: The two-letter GeoIP country code of the :ivar:`address`.
 
@@ -182,9 +343,13 @@ class BridgeAddressBase(object):
         (or :class:`PluggableTransport`) is listening on.
     """
 
+    __slots__ = ('_fingerprint', '_address', '_subnetPrefix', '_country',
+                 '_port')
+
     def __init__(self):
         self._fingerprint = None
         self._address = None
+        self._subnetPrefix = None
         self._country = None
         self._port = None
 
@@ -210,7 +375,10 @@ class BridgeAddressBase(object):
         :param str value: The fingerprint for this Bridge.
         """
         if value and isValidFingerprint(value):
-            self._fingerprint = value.upper()
+            fingerprint = value.upper()
+            # Don't keep a new copy if it was already uppercased, so that
+            # transports can share their bridge's fingerprint string:
+            self._fingerprint = value if value == fingerprint else fingerprint
 
     @fingerprint.deleter
     def fingerprint(self):
@@ -263,12 +431,26 @@ class BridgeAddressBase(object):
         :param value: The main ORPort IP address of this bridge.
         """
         if value and isValidIP(value): # XXX only conditionally set _address?
-            self._address = isIPAddress(value, compressed=False)
+            self._address = _getSharedAddress(value)
+            self._subnetPrefix = _getSubnetPrefix(self._address)
+            self._addressChanged()
 
     @address.deleter
     def address(self):
         """Reset this Bridge's address to ``None``."""
         self._address = None
+        self._subnetPrefix = None
+        self._addressChanged()
+
+    @property
+    def subnetPrefix(self):
+        """Get an integer identifying the IPv4 ``/16`` or IPv6 ``/32``
+        subnet which contains this bridge's address.
+
+        :rtype: int or ``None``
+        :returns: The subnet prefix, or ``None`` if there is no address.
+        """
+        return self._subnetPrefix
 
     @property
     def country(self):
@@ -302,11 +484,20 @@ class BridgeAddressBase(object):
         """
         if isinstance(value, int) and (0 <= value <= 65535):
             self._port = value
+            self._addressChanged()
 
     @port.deleter
     def port(self):
         """Reset this ``Bridge``'s port to ``None``."""
         self._port = None
+        self._addressChanged()
+
+    def _addressChanged(self):
+        """Called whenever :data:`address` or :data:`port` is set or reset.
+
+        Subclasses which keep anything derived from them should override this
+        to throw it away.
+        """
 
 
 
@@ -364,6 +555,8 @@ class PluggableTransport(BridgeAddressBase):
             {'password': 'NEQGQYLUMUQGK5TFOJ4XI2DJNZTS4LRO'}
     """
 
+    __slots__ = ('_methodname', '_blockedIn', 'arguments')
+
     # A list of PT names that are resistant to active probing attacks.
     probing_resistant_transports = []
 
@@ -431,7 +624,7 @@ class PluggableTransport(BridgeAddressBase):
                     logging.warn("  Couldn't parse K=V from PT arg: %r" % arg)
                 else:
                     logging.debug("  Parsed PT Argument: %s: %s" % (key, value))
-                    argDict[key] = value
+                    argDict[_intern(key)] = value
 
         return argDict
 
@@ -527,7 +720,7 @@ class PluggableTransport(BridgeAddressBase):
         """
         if value:
             try:
-                self._methodname = value.lower()
+                self._methodname = _intern(value.lower())
             except (AttributeError, TypeError):
                 raise TypeError("methodname must be a str or unicode")
 
@@ -636,6 +829,9 @@ class PluggableTransport(BridgeAddressBase):
 class BridgeBase(BridgeAddressBase):
     """The base class for all bridge implementations."""
 
+    __slots__ = ('_nickname', '_orPort', 'socksPort', 'dirPort',
+                 '_orAddresses', 'transports', 'flags')
+
     def __init__(self):
         super(BridgeBase, self).__init__()
 
@@ -695,11 +891,32 @@ class BridgeBase(BridgeAddressBase):
         """Reset this Bridge's ORPort."""
         del self.port
 
+    @property
+    def orAddresses(self):
+        """Get this bridge's additional ORPort addresses.
+
+        :rtype: list
+        :returns: A list of ``(address, port, version)`` 3-tuples.
+        """
+        return self._orAddresses
+
+    @orAddresses.setter
+    def orAddresses(self, value):
+        """Replace this bridge's additional ORPort addresses.
+
+        :param list value: A list of ``(address, port, version)`` 3-tuples.
+        """
+        self._orAddresses = value
+        self._addressChanged()
+
 
 @implementer(IBridge)
 class BridgeBackwardsCompatibility(BridgeBase):
     """Backwards compatibility methods for the old Bridge class."""
 
+    __slots__ = ('desc_digest', 'ei_digest', 'running', 'stable',
+                 'descriptorDigest', 'extrainfoDigest')
+
     def __init__(self, nickname=None, ip=None, orport=None,
                  fingerprint=None, id_digest=None, or_addresses=None):
         """Create a :class:`Bridge <bridgedb.bridges.IBridge>` which is
@@ -938,6 +1155,10 @@ class Bridge(BridgeBackwardsCompatibility):
         lowercased, two-letter country codes (e.g. ``"us"``, ``"gb"``,
         ``"cn"``, etc.) which that ``ADDRESS:PORT`` pair is blocked in.
 
+    :vartype _blocking: :class:`BlockingIndex` or ``None``
+    :ivar _blocking: A summary of :data:`_blockedIn`, built by
+        :meth:`buildBlockingIndex` when it's first needed.
+
     :vartype contact: :any:`str` or ``None``
     :ivar contact: The contact information for the this Bridge's operator.
 
@@ -955,6 +1176,13 @@ class Bridge(BridgeBackwardsCompatibility):
     :vartype os: :any:`str` or ``None``
     :ivar os: The OS portion of the ``platform`` line.
     """
+    # There are many thousands of these, so don't give each one a __dict__:
+    __slots__ = ('hibernating', '_blockedIn', '_blocking', 'distribution_request',
+                 'bandwidth', 'bandwidthAverage', 'bandwidthBurst',
+                 'bandwidthObserved', 'contact', 'family', 'platform',
+                 'software', 'os', 'uptime', 'bridgeIPs', 'onionKey',
+                 'ntorOnionKey', 'signingKey', 'descriptors')
+
     #: (:any:`bool`) If ``True``, check that the signature of the bridge's
     #: ``@type bridge-server-descriptor`` is valid and that the signature was
     #: created with the ``signing-key`` contained in that descriptor.
@@ -982,6 +1210,7 @@ class Bridge(BridgeBackwardsCompatibility):
         self.flags = Flags()
         self.hibernating = False
         self._blockedIn = {}
+        self._blocking = None
         self.distribution_request = "any"
 
         self.bandwidth = None
@@ -1185,9 +1414,9 @@ class Bridge(BridgeBackwardsCompatibility):
                 "have any of that transport!") % (desired, self))
 
         unblocked = []
+        countries = _getCountriesMask(bridgeRequest.notBlockedIn)
         for pt in transports:
-            if not sum([self.transportIsBlockedIn(cc, pt.methodname)
-                        for cc in bridgeRequest.notBlockedIn]):
+            if not (self._getTransportBlockedMask(pt.methodname) & countries):
                 unblocked.append(pt)
 
         if unblocked:
@@ -1219,22 +1448,21 @@ class Bridge(BridgeBackwardsCompatibility):
             (self, bridgeRequest.ipVersion))
 
         addresses = []
+        countries = _getCountriesMask(bridgeRequest.notBlockedIn)
 
-        for address, port, version in self.allVanillaAddresses:
-            # Filter ``allVanillaAddresses`` by whether IPv4 or IPv6 was requested:
-            if version == bridgeRequest.ipVersion:
-                # Determine if the address is blocked in any of the country
-                # codes.  Because :meth:`addressIsBlockedIn` returns a bool,
-                # we get a list like: ``[True, False, False, True]``, and
-                # because bools are ints, they may be summed.  What we care
-                # about is that there are no ``True``s, for any country code,
-                # so we check that the sum is zero (meaning the list was full
-                # of ``False``s).
-                #
-                # XXX Do we want to add a method for this construct?
-                if not sum([self.addressIsBlockedIn(cc, address, port)
-                            for cc in bridgeRequest.notBlockedIn]):
-                    addresses.append((address, port, version))
+        if self._blockedIn and countries:
+            vanillas = self.buildBlockingIndex().vanilla
+        else:
+            # Nothing to check against, so don't bother building the index:
+            vanillas = [(address, port, version, 0) for address, port, version
+                        in self.allVanillaAddresses]
+
+        for address, port, version, blockedIn in vanillas:
+            # Filter ``allVanillaAddresses`` by whether IPv4 or IPv6 was
+            # requested, and by whether the address is blocked in any of the
+            # countries:
+            if version == bridgeRequest.ipVersion and not (blockedIn & countries):
+                addresses.append((address, port, version))
 
         if addresses:
             # Use the client's unique data to HMAC them into their position in
@@ -1264,7 +1492,7 @@ class Bridge(BridgeBackwardsCompatibility):
                      "format may have changed!")))
                 version = 4
 
-            validatedAddress = isIPAddress(address, compressed=False)
+            validatedAddress = _getSharedAddress(address)
             if validatedAddress:
                 self.orAddresses.append( (validatedAddress, port, version,) )
 
@@ -1369,6 +1597,36 @@ class Bridge(BridgeBackwardsCompatibility):
                                                    bridgePrefix)
         return bridgeLine
 
+    def _addressChanged(self):
+        """Throw away our :class:`BlockingIndex`, since its addresses are no
+        longer ours.
+        """
+        self._blocking = None
+
+    def buildBlockingIndex(self):
+        """Get the :class:`BlockingIndex` for this bridge's current
+        :data:`_blockedIn`, building it if necessary.
+
+        :rtype: :class:`BlockingIndex`
+        """
+        blocking = self._blocking
+        # Someone may have replaced the whole dictionary:
+        if blocking is None or blocking.blockedIn is not self._blockedIn:
+            blocking = self._blocking = BlockingIndex(self)
+        return blocking
+
+    def _getTransportBlockedMask(self, methodname):
+        """Get the countries which any of this bridge's transports of type
+        **methodname** are blocked in.
+
+        :param str methodname: The type of pluggable transport to check.
+        :rtype: int
+        :returns: A mask of countries; see :func:`_getCountryBit`.
+        """
+        if not self._blockedIn:
+            return 0
+        return self.buildBlockingIndex().transports.get(methodname.lower(), 0)
+
     def _addBlockByKey(self, key, countryCode):
         """Create or append to the list of blocked countries for a **key**.
 
@@ -1377,10 +1635,13 @@ class Bridge(BridgeBackwardsCompatibility):
             :meth:`_getBlockKey`.
         :param str countryCode: A two-character country code specifier.
         """
+        countryCode = _intern(countryCode.lower())
+        self._blocking = None
+
         if key in self._blockedIn:
-            self._blockedIn[key].append(countryCode.lower())
+            self._blockedIn[key].append(countryCode)
         else:
-            self._blockedIn[key] = [countryCode.lower(),]
+            self._blockedIn[key] = [countryCode,]
 
     def addressIsBlockedIn(self, countryCode, address, port):
         """Determine if a specific (address, port) tuple is blocked in
@@ -1394,6 +1655,9 @@ class Bridge(BridgeBackwardsCompatibility):
         :returns: ``True`` if the **address**:**port** pair is blocked in
             **countryCode**, ``False`` otherwise.
         """
+        if not self._blockedIn:
+            return False  # Most bridges aren't blocked anywhere
+
         key = self._getBlockKey(address, port)
 
         try:
@@ -1418,12 +1682,10 @@ class Bridge(BridgeBackwardsCompatibility):
             running a :class:`PluggableTransport` on is blocked in
             **countryCode**, ``False`` otherwise.
         """
-        for pt in self.transports:
-            if pt.methodname == methodname.lower():
-                if self.addressIsBlockedIn(countryCode, pt.address, pt.port):
-                    logging.info("Transport %s of bridge %s is blocked in %s."
-                                 % (pt.methodname, self, countryCode))
-                    return True
+        if self._getTransportBlockedMask(methodname) & _getCountryBit(countryCode):
+            logging.info("Transport %s of bridge %s is blocked in %s."
+                         % (methodname.lower(), self, countryCode))
+            return True
         return False
 
     def isBlockedIn(self, countryCode):
@@ -1436,16 +1698,10 @@ class Bridge(BridgeBackwardsCompatibility):
         :returns: ``True`` if at least one address:port pair used by this
             bridge is blocked in **countryCode**; ``False`` otherwise.
         """
-        # Check all supported pluggable tranport types:
-        for methodname in self.supportedTransportTypes:
-            if self.transportIsBlockedIn(countryCode.lower(), methodname):
-                return True
-
-        for address, port, version in self.allVanillaAddresses:
-            if self.addressIsBlockedIn(countryCode.lower(), address, port):
-                return True
-
-        return False
+        # Check all pluggable transports and vanilla addresses at once:
+        if not self._blockedIn:
+            return False
+        return bool(self.buildBlockingIndex().mask & _getCountryBit(countryCode))
 
     def setBlockedIn(self, countryCode, address=None, port=None, methodname=None):
         """Mark this :class:`Bridge` as being blocked in **countryCode**.
@@ -1559,6 +1815,9 @@ class Bridge(BridgeBackwardsCompatibility):
         :param bool ignoreNetworkstatus: If ``True``, then ignore most of the
            information in the networkstatus document.
         """
+        # Our addresses and transports may change, so forget where they were
+        # blocked (until we are asked again):
+        self._blocking = None
         self.descriptors['networkstatus'] = descriptor
 
         # These fields are *only* found in the networkstatus document:
@@ -1600,6 +1859,9 @@ class Bridge(BridgeBackwardsCompatibility):
             networkstatus entry, or its **descriptor** digest didn't match the
             expected digest (from the networkstatus entry).
         """
+        # Our addresses and transports may change, so forget where they were
+        # blocked (until we are asked again):
+        self._blocking = None
         if ignoreNetworkstatus:
             try:
                 self._checkServerDescriptor(descriptor)
@@ -1623,7 +1885,7 @@ class Bridge(BridgeBackwardsCompatibility):
         self.hibernating = descriptor.hibernating
 
         if descriptor.bridge_distribution:
-            self.distribution_request = descriptor.bridge_distribution
+            self.distribution_request = _intern(descriptor.bridge_distribution)
 
         self.onionKey = descriptor.onion_key
         self.ntorOnionKey = descriptor.ntor_onion_key
@@ -1635,9 +1897,9 @@ class Bridge(BridgeBackwardsCompatibility):
 
         self.contact = descriptor.contact
         self.family = descriptor.family
-        self.platform = descriptor.platform
+        self.platform = _intern(descriptor.platform)
         self.software = descriptor.tor_version
-        self.os = descriptor.operating_system
+        self.os = _intern(descriptor.operating_system)
         self.uptime = descriptor.uptime
 
         self.extrainfoDigest = descriptor.extra_info_digest
@@ -1757,6 +2019,9 @@ class Bridge(BridgeBackwardsCompatibility):
             on the extrainfo **descriptor** is a valid signature from
             :data:`signingkey`.
         """
+        # Our addresses and transports may change, so forget where they were
+        # blocked (until we are asked again):
+        self._blocking = None
         if verify:
             try:
                 self._verifyExtraInfoSignature(descriptor)
@@ -45,6 +45,12 @@
           |- sched - A class for timing out CAPTCHAs after an interval.
           \_ get() - Get a CAPTCHA image from the cache and create a challenge.
 
+  CaptchaPool - An index of the CAPTCHA images in a local cache directory.
+   |- pick() - Choose a random CAPTCHA image and its answer.
+   \_ refresh() - Re-index the cache directory, if it has changed.
+
+  getCaptchaPool() - Get the shared CaptchaPool for a cache directory.
+
 ..
 
 There are two types of CAPTCHAs which BridgeDB knows how to serve: those
@@ -56,6 +62,7 @@ gimp-captcha_ and then cached locally.
 .. _gimp-captcha: https://github.com/isislovecruft/gimp-captcha
 """
 
+from base64 import b64encode
 from base64 import urlsafe_b64encode
 from base64 import urlsafe_b64decode
 
@@ -66,9 +73,12 @@ import time
 import urllib.request
 
 from bs4 import BeautifulSoup
+from twisted.internet import task
+from twisted.internet import threads
 from zope.interface import Interface, Attribute, implementer
 
 from bridgedb import crypto
+from bridgedb import openmetrics
 from bridgedb import schedule
 from bridgedb.txrecaptcha import API_SSL_SERVER
 
@@ -184,7 +194,8 @@ class ReCaptcha(Captcha):
         form = "/noscript?k=%s" % self.publicKey
 
         # Extract and store image from recaptcha
-        html = urllib.request.urlopen(urlbase + form).read()
+        with openmetrics.CAPTCHA_DURATION.time("recaptcha", "generate"):
+            html = urllib.request.urlopen(urlbase + form).read()
         # FIXME: The remaining lines currently cannot be reliably unit tested:
         soup = BeautifulSoup(html)                           # pragma: no cover
         imgurl = urlbase + "/" +  soup.find('img')['src']    # pragma: no cover
@@ -224,7 +235,7 @@ class GimpCaptcha(Captcha):
     sched = schedule.ScheduledInterval(30, 'minutes')
 
     def __init__(self, publicKey=None, secretKey=None, hmacKey=None,
-                 cacheDir=None):
+                 cacheDir=None, pool=None):
         """Create a ``GimpCaptcha`` which retrieves images from **cacheDir**.
 
         :param str publicKey: A PKCS#1 OAEP-padded, public RSA key, used for
@@ -236,6 +247,9 @@ class GimpCaptcha(Captcha):
         :param str cacheDir: The local directory which pre-generated CAPTCHA
             images have been stored in. This can be set via the
             ``GIMP_CAPTCHA_DIR`` setting in the config file.
+        :type pool: :class:`CaptchaPool` or ``None``
+        :param pool: An index of the images in **cacheDir**, to choose them
+            from, rather than listing the directory each time.
         :raises GimpCaptchaError: if :attr:`cacheDir` is not a directory.
         :raises CaptchaKeyError: if any of :attr:`secretKey`,
             :attr:`publicKey`, or :attr:`hmacKey` are invalid or missing.
@@ -252,7 +266,9 @@ class GimpCaptcha(Captcha):
                                           secretKey=secretKey)
         self.hmacKey = hmacKey
         self.cacheDir = cacheDir
+        self.pool = pool
         self.answer = None
+        self.encodedImage = None
 
     @classmethod
     def check(cls, challenge, solution, secretKey, hmacKey):
@@ -271,6 +287,12 @@ class GimpCaptcha(Captcha):
             stale. ``False`` otherwise.
         """
 
+        with openmetrics.CAPTCHA_DURATION.time("gimp", "verify"):
+            return cls._check(challenge, solution, secretKey, hmacKey)
+
+    @classmethod
+    def _check(cls, challenge, solution, secretKey, hmacKey):
+        """Check a client's CAPTCHA **solution**; see :meth:`check`."""
         if isinstance(solution, bytes):
             solution = solution.decode('utf-8')
 
@@ -388,6 +410,16 @@ class GimpCaptcha(Captcha):
         :returns: A 2-tuple containing the image file contents as a string,
             and a challenge string (used for checking the client's solution).
         """
+        with openmetrics.CAPTCHA_DURATION.time("gimp", "generate"):
+            return self._get()
+
+    def _get(self):
+        """Get a random CAPTCHA from the cache directory; see :meth:`get`."""
+        if self.pool is not None:
+            self.answer, self.image, self.encodedImage = self.pool.pick()
+            self.challenge = self.createChallenge(self.answer)
+            return (self.image, self.challenge)
+
         try:
             imageFilename = random.SystemRandom().choice(os.listdir(self.cacheDir))
             imagePath = os.path.join(self.cacheDir, imageFilename)
@@ -404,3 +436,219 @@ class GimpCaptcha(Captcha):
         self.challenge = self.createChallenge(self.answer)
 
         return (self.image, self.challenge)
+
+    def getEncodedImage(self):
+        """Get the base64 encoding of :attr:`image`, for embedding it in a
+        page or a JSON response.  If the image was preloaded by our
+        :attr:`pool`, its encoding was already computed along with it.
+
+        :rtype: bytes or ``None``
+        :returns: The encoded image, or ``None`` if there isn't an image.
+        """
+        if self.encodedImage is None and self.image is not None:
+            self.encodedImage = b64encode(self.image)
+        return self.encodedImage
+
+
+class CaptchaPool(object):
+    """An index of the CAPTCHA images in a local cache directory, so that one
+    can be chosen without listing the directory for each client.
+
+    The directory is only listed again when it changes, in the reactor's
+    threadpool, so that the reactor isn't held up while a large directory is
+    listed.  Only the reactor thread should use the pool itself.
+
+    :ivar str cacheDir: The directory which the CAPTCHA images are in.
+    :ivar bool preload: Whether to keep the images (and their base64
+        encodings) in memory, rather than reading the one which was chosen
+        from disk.
+    :ivar list captchas: A list of ``(answer, path, image, encodedImage)``
+        tuples, one for each CAPTCHA.  ``image`` and ``encodedImage`` are
+        ``None`` unless :attr:`preload` is set.
+    :ivar float mtime: The modification time of :attr:`cacheDir` when it was
+        last listed, or ``None``.
+    """
+
+    #: How often to check whether :attr:`cacheDir` has changed, in seconds.
+    refreshInterval = 60
+
+    def __init__(self, cacheDir, preload=False,
+                 runInThread=threads.deferToThread):
+        """Create an index of the CAPTCHA images in **cacheDir**.
+
+        :param str cacheDir: The directory which the CAPTCHA images are in.
+        :param bool preload: If ``True``, keep the images and their base64
+            encodings in memory.
+        :param callable runInThread: A function which calls its first
+            argument in another thread, and returns a ``Deferred`` which fires
+            with the result.
+        """
+        self.cacheDir = cacheDir
+        self.preload = preload
+        self.runInThread = runInThread
+        self.random = random.SystemRandom()
+        self.refreshing = False
+        self.refresher = None
+        self.mtime, self.captchas = self.scan()
+
+    def __len__(self):
+        return len(self.captchas)
+
+    def getMTime(self):
+        """Get the modification time of :attr:`cacheDir`.
+
+        :rtype: float or ``None``
+        :returns: The modification time, or ``None`` if the directory doesn't
+            exist.
+        """
+        try:
+            return os.stat(self.cacheDir).st_mtime
+        except (OSError, TypeError):
+            return None
+
+    def scan(self):
+        """List :attr:`cacheDir`, and read and encode the images if
+        :attr:`preload` is set.  This is safe to call from another thread.
+
+        :rtype: tuple
+        :returns: A 2-tuple of the modification time of :attr:`cacheDir`,
+            and a list of CAPTCHAs (see :attr:`captchas`).
+        """
+        mtime = self.getMTime()
+        captchas = []
+
+        # os.listdir(None) would list the current directory.
+        if not self.cacheDir or not os.path.isdir(self.cacheDir):
+            logging.warn("Gimp captcha cache dir %r isn't a directory."
+                         % self.cacheDir)
+            return (mtime, captchas)
+
+        try:
+            filenames = os.listdir(self.cacheDir)
+        except OSError as error:
+            logging.warn("Couldn't list Gimp captcha cache dir %r: %s"
+                         % (self.cacheDir, error))
+            return (mtime, captchas)
+
+        for filename in filenames:
+            path = os.path.join(self.cacheDir, filename)
+            image = encodedImage = None
+            if self.preload:
+                try:
+                    with open(path, 'rb') as imageFile:
+                        image = imageFile.read()
+                except (OSError, IOError) as error:
+                    logging.warn("Could not read Gimp captcha image file: %s"
+                                 % error)
+                    continue
+                encodedImage = b64encode(image)
+            answer = filename.rsplit(os.path.extsep, 1)[0]
+            captchas.append((answer, path, image, encodedImage))
+
+        logging.info("Indexed %d CAPTCHAs in %r." % (len(captchas),
+                                                     self.cacheDir))
+        return (mtime, captchas)
+
+    def pick(self):
+        """Choose a random CAPTCHA.
+
+        :raises GimpCaptchaError: if there aren't any CAPTCHAs, or if the
+            chosen CAPTCHA image file could not be read.
+        :rtype: tuple
+        :returns: A 3-tuple of the answer to the CAPTCHA, the contents of its
+            image file, and their base64 encoding (or ``None``, if the images
+            aren't preloaded).
+        """
+        try:
+            answer, path, image, encodedImage = self.random.choice(self.captchas)
+        except IndexError:
+            raise GimpCaptchaError("CAPTCHA cache dir appears empty: %r"
+                                   % self.cacheDir)
+
+        if image is None:
+            try:
+                with open(path, 'rb') as imageFile:
+                    image = imageFile.read()
+            except (OSError, IOError):
+                raise GimpCaptchaError("Could not read Gimp captcha image file: %r"
+                                       % os.path.basename(path))
+
+        return (answer, image, encodedImage)
+
+    def refresh(self):
+        """List :attr:`cacheDir` again in a thread, if it has changed since it
+        was last listed.
+
+        :rtype: :api:`twisted.internet.defer.Deferred` or ``None``
+        :returns: A ``Deferred`` which fires when the new list of CAPTCHAs is
+            in use, or ``None`` if the directory hasn't changed.
+        """
+        if self.refreshing or self.getMTime() == self.mtime:
+            return None
+
+        def scanned(result):
+            self.mtime, self.captchas = result
+
+        def failed(failure):
+            logging.error("Couldn't index Gimp captchas in %r: %s"
+                          % (self.cacheDir, failure.getErrorMessage()))
+
+        def finished(_):
+            self.refreshing = False
+
+        self.refreshing = True
+        d = self.runInThread(self.scan)
+        d.addCallbacks(scanned, failed)
+        d.addBoth(finished)
+        return d
+
+    def startRefreshing(self, interval=None, clock=None):
+        """Check whether :attr:`cacheDir` has changed every **interval**
+        seconds, and :meth:`refresh` the pool if it has.
+
+        :param int interval: How often to check, in seconds.  Defaults to
+            :attr:`refreshInterval`.
+        :type clock: :api:`twisted.internet.interfaces.IReactorTime`
+        :param clock: The clock to schedule the checks with.  Defaults to the
+            reactor.
+        """
+        if self.refresher is not None and self.refresher.running:
+            return
+        self.refresher = task.LoopingCall(self.refresh)
+        if clock is not None:
+            self.refresher.clock = clock
+        self.refresher.start(interval or self.refreshInterval, now=False)
+
+    def stopRefreshing(self):
+        """Stop checking whether :attr:`cacheDir` has changed."""
+        if self.refresher is not None and self.refresher.running:
+            self.refresher.stop()
+        self.refresher = None
+
+
+#: The :class:`CaptchaPool` for each cache directory.
+_pools = {}
+
+def getCaptchaPool(cacheDir, preload=None):
+    """Get the :class:`CaptchaPool` for **cacheDir**, creating it if there
+    isn't one yet.  All CAPTCHA resources which use the same directory share a
+    pool, so that it is only listed (and its images are only kept in memory)
+    once.
+
+    :param str cacheDir: The directory which the CAPTCHA images are in.
+    :type preload: bool or ``None``
+    :param preload: If ``True``, keep the images in memory.  If ``None``,
+        use the existing pool however it was created, or create one which
+        doesn't keep the images in memory.
+    :raises ValueError: if **preload** isn't ``None``, and the existing pool
+        for **cacheDir** was created with a different **preload**.
+    :rtype: :class:`CaptchaPool`
+    """
+    key = os.path.abspath(cacheDir) if cacheDir else cacheDir
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = CaptchaPool(cacheDir, preload=bool(preload))
+    elif preload is not None and bool(preload) != pool.preload:
+        raise ValueError("The CAPTCHA pool for %r was already created with "
+                         "preload=%s." % (cacheDir, pool.preload))
+    return pool
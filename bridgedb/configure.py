@@ -113,7 +113,8 @@ def loadConfig(configFile=None, configCls=None):
                  "MOAT_CERT_FILE", "MOAT_KEY_FILE",
                  "LOG_FILE", "COUNTRY_BLOCK_FILE",
                  "GIMP_CAPTCHA_DIR", "GIMP_CAPTCHA_HMAC_KEYFILE",
-                 "GIMP_CAPTCHA_RSA_KEYFILE", "NO_DISTRIBUTION_FILE"]:
+                 "GIMP_CAPTCHA_RSA_KEYFILE", "NO_DISTRIBUTION_FILE",
+                 "HTTPS_TEMPLATE_MODULE_DIR"]:
         setting = getattr(config, attr, None)
         if setting is None:
             setattr(config, attr, setting)
@@ -122,7 +123,12 @@ def loadConfig(configFile=None, configCls=None):
 
     for attr in ["MOAT_ROTATION_PERIOD",
                  "HTTPS_ROTATION_PERIOD",
-                 "EMAIL_ROTATION_PERIOD"]:
+                 "EMAIL_ROTATION_PERIOD",
+                 "METRICS_HTTP_PORT",
+                 "METRICS_HTTP_BIND_IP",
+                 "SLOW_REQUEST_BUDGET",
+                 "SLOW_REQUEST_SAMPLE_RATE",
+                 "GIMP_CAPTCHA_PRELOAD"]:
         setting = getattr(config, attr, None) # Default to None
         setattr(config, attr, setting)
 
@@ -136,6 +142,23 @@ def loadConfig(configFile=None, configCls=None):
         setting = getattr(config, attr, True) # Default to True
         setattr(config, attr, setting)
 
+    for attr in ["DESCRIPTOR_PARSE_PROCESSES"]:
+        setting = getattr(config, attr, 1) # Default to parsing in-process
+        setattr(config, attr, setting)
+
+    for attr in ["FAST_NETWORKSTATUS_PARSER"]:
+        setting = getattr(config, attr, False) # Default to parsing with Stem
+        setattr(config, attr, setting)
+
+    for attr in ["HTTPS_CACHED_RINGS_PER_SUBRING",
+                 "MOAT_CACHED_RINGS_PER_SUBRING"]:
+        setting = getattr(config, attr, 16) # Default to 16 filtered subrings
+        setattr(config, attr, setting)
+
+    for attr in ["EMAIL_MAX_CACHED_RINGS"]:
+        setting = getattr(config, attr, 32) # Default to 32 filtered subrings
+        setattr(config, attr, setting)
+
     for attr in ["FORCE_PORTS", "FORCE_FLAGS", "NO_DISTRIBUTION_COUNTRIES"]:
         setting = getattr(config, attr, []) # Default to empty lists
         setattr(config, attr, setting)
@@ -21,6 +21,7 @@ and/or storing key material.
    bridgedb.crypto
      |_getHMAC() - Compute an HMAC with some key for some data.
      |_getHMACFunc() - Get a callable for producing HMACs with the given key.
+     |_HMACPositionCache - Caches HMACs of bridge identities, per HMAC key.
      |_getKey() - Load the master HMAC key from a file, or create a new one.
      |_getRSAKey() - Load an RSA key from a file, or create a new one.
      |_writeKeyToFile() - Write to a file readable only by the process owner.
@@ -38,6 +39,7 @@ and/or storing key material.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import binascii
 import hashlib
 import hmac
 import io
@@ -57,6 +59,10 @@ from twisted.python.procutils import which
 #: The hash digest to use for HMACs.
 DIGESTMOD = hashlib.sha1
 
+#: The number of leading bytes of an HMAC digest which make up its integer
+#: prefix. See :meth:`HMACPositionCache.getPrefix`.
+PREFIX_LEN = 4
+
 
 class PKCS1PaddingError(Exception):
     """Raised when there is a problem adding or removing PKCS#1 padding."""
@@ -196,28 +202,168 @@ def getHMAC(key, value):
     h = hmac.new(key, value, digestmod=DIGESTMOD)
     return h.digest()
 
-def getHMACFunc(key, hex=True):
+def getHMACFunc(key, hex=True, cache=None):
     """Return a function that computes the HMAC of its input using the **key**.
 
+    The returned function also has a ``prefix`` attribute, which is a function
+    that returns the first :data:`PREFIX_LEN` bytes of the HMAC of its input,
+    as a big-endian integer.  (This is the same as ``int(hmac_fn(value)[:8],
+    16)`` for a hex-encoding **hmac_fn**.)  Its ``uncached`` attribute is a
+    function which returns the same as it does, but never uses the **cache**.
+
     :param bool hex: If True, the output of the function will be hex-encoded.
+    :type cache: :class:`HMACPositionCache` or ``None``
+    :param cache: If given, look up HMACs in this cache before computing them,
+        and store any newly computed HMACs in it.
     :rtype: callable
     :returns: A function which can be uses to generate HMACs.
     """
 
     key = key.encode('utf-8') if isinstance(key, str) else key
     h = hmac.new(key, digestmod=DIGESTMOD)
+    keyID = HMACPositionCache.getKeyID(key) if cache is not None else None
 
-    def hmac_fn(value):
-        value = value.encode('utf-8') if isinstance(value, str) else value
+    def compute(value):
         h_tmp = h.copy()
         h_tmp.update(value)
+        return h_tmp.digest()
+
+    def digest_fn(value):
+        value = value.encode('utf-8') if isinstance(value, str) else value
+        if cache is not None:
+            return cache.getDigest(keyID, value, compute)
+        return compute(value)
+
+    def encode(digest):
         if hex:
-            return h_tmp.hexdigest()
+            return binascii.hexlify(digest).decode('utf-8')
         else:
-            return h_tmp.digest()
+            return digest
+
+    def hmac_fn(value):
+        return encode(digest_fn(value))
 
+    def uncached_fn(value):
+        value = value.encode('utf-8') if isinstance(value, str) else value
+        return encode(compute(value))
+
+    def prefix_fn(value):
+        return int.from_bytes(digest_fn(value)[:PREFIX_LEN], 'big')
+
+    hmac_fn.prefix = prefix_fn
+    hmac_fn.uncached = uncached_fn
     return hmac_fn
 
+
+class HMACPositionCache(object):
+    """A cache of HMAC digests, keyed by HMAC key and input.
+
+    Bridges are placed into hashrings (and into subrings, and into
+    distributors) according to the HMACs of their identity digests.  These
+    positions only depend upon the HMAC key and the identity, and all of the
+    HMAC keys used by the hashrings are derived from the master key, so the
+    same HMACs would otherwise be recomputed for every bridge, for every ring,
+    on every reload.
+
+    The cache holds one table per HMAC key, so that it is simple to
+    :meth:`retain` only the entries for bridges we still know about.  It is
+    only ever invalidated wholesale, when the master key changes (see
+    :meth:`setMasterKey`).
+
+    :ivar int hits: The number of lookups which were answered from the cache.
+    :ivar int misses: The number of lookups which required computing an HMAC.
+    """
+
+    def __init__(self):
+        self.masterKeyID = None
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+
+    def __len__(self):
+        """Get the total number of cached digests, across all HMAC keys."""
+        return sum([len(table) for table in list(self._tables.values())])
+
+    @staticmethod
+    def getKeyID(key):
+        """Get a short identifier for an HMAC **key**, such that the cache
+        itself doesn't hold copies of key material.
+
+        :param bytes key: An HMAC key.
+        :rtype: bytes
+        """
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        return DIGESTMOD(key).digest()[:8]
+
+    def setMasterKey(self, key):
+        """Set the master key which all of the cached HMAC keys are derived
+        from, clearing the cache if it changed.
+
+        :param bytes key: The master key, as returned from :func:`getKey`.
+        """
+        keyID = self.getKeyID(key)
+        if keyID != self.masterKeyID:
+            if self.masterKeyID is not None:
+                logging.info("Master key changed; clearing HMAC cache.")
+            self.clear()
+            self.masterKeyID = keyID
+
+    def clear(self):
+        """Remove all cached digests."""
+        self._tables = {}
+
+    def retain(self, values):
+        """Remove cached digests for anything not in **values**.
+
+        :param values: A collection of inputs (i.e. bridge identity digests)
+            whose HMACs should be kept.
+        """
+        # This is called from the thread which reloads the bridges, while the
+        # reactor may be adding to the tables, so build the new tables from
+        # copies, and replace the old ones in a single assignment.  Anything
+        # added meanwhile is simply computed again if it's needed.
+        values = set(values)
+        tables = {}
+        for keyID, table in list(self._tables.items()):
+            tables[keyID] = dict([(value, digest) for value, digest
+                                  in table.copy().items() if value in values])
+        self._tables = tables
+
+    def getDigest(self, keyID, value, compute):
+        """Get the HMAC digest of **value** under the key **keyID**.
+
+        :param bytes keyID: The key identifier, from :meth:`getKeyID`.
+        :param bytes value: The HMAC input.
+        :param callable compute: A function which computes the HMAC of
+            **value** using the real key, if it isn't already cached.
+        :rtype: bytes
+        """
+        table = self._tables.get(keyID)
+        if table is None:
+            table = self._tables.setdefault(keyID, {})
+        digest = table.get(value)
+        if digest is None:
+            self.misses += 1
+            digest = table[value] = compute(value)
+        else:
+            self.hits += 1
+        return digest
+
+    def getPrefix(self, keyID, value, compute):
+        """Get the integer prefix of the HMAC digest of **value** under the
+        key **keyID**.
+
+        :rtype: int
+        :returns: The first :data:`PREFIX_LEN` bytes of the digest, as a
+            big-endian integer.
+        """
+        return int.from_bytes(self.getDigest(keyID, value, compute)[:PREFIX_LEN],
+                              'big')
+
+
+#: The cache of bridge positions which is shared by all of the hashrings.
+positionCache = HMACPositionCache()
+
 def removePKCS1Padding(message):
     """Remove PKCS#1 padding from a **message**.
 
@@ -245,7 +245,7 @@ class Distributor(Named):
         self._name = name
 
         try:
-            self.hashring.distributor = name
+            self.hashring.distributorName = name
         except AttributeError:
             logging.debug(("Couldn't set distributor attribute for %s "
                            "Distributor's hashring." % name))
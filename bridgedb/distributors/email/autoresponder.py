@@ -51,6 +51,7 @@ from twisted.python import failure
 
 from bridgedb import strings
 from bridgedb import metrics
+from bridgedb import openmetrics
 from bridgedb import safelog
 from bridgedb.distributors.email import dkim
 from bridgedb.distributors.email import request
@@ -91,7 +92,7 @@ def createResponseBody(lines, context, client, lang='en'):
         returns a string containing the (optionally translated) body for the
         email response which we should send out.
     """
-    translator = translations.installTranslations(lang)
+    translator = translations.getTranslations(lang)
     bridges = None
     try:
         bridgeRequest = request.determineBridgeRequestOptions(lines)
@@ -383,7 +384,12 @@ class SMTPAutoresponder(smtp.SMTPClient):
         if not safelog.safe_logging:
             logging.debug("Incoming email was from %s ..." % client)
 
-        if not self.runChecks(client): return
+        timer = openmetrics.currentRequest()
+        if timer is not None:
+            timer.client = client
+
+        with openmetrics.stage("checks"):
+            if not self.runChecks(client): return
 
         recipient = self.getMailFrom()
         # Look up the locale part in the 'To:' address, if there is one, and
@@ -391,25 +397,28 @@ class SMTPAutoresponder(smtp.SMTPClient):
         lang = translations.getLocaleFromPlusAddr(recipient)
         logging.info("Client requested email translation: %s" % lang)
 
-        body = createResponseBody(self.incoming.lines,
-                                  self.incoming.context,
-                                  client, lang)
+        with openmetrics.stage("response-body"):
+            body = createResponseBody(self.incoming.lines,
+                                      self.incoming.context,
+                                      client, lang)
 
         # The string EMAIL_MISC_TEXT[1] shows up in an email if BridgeDB
         # responds with bridges.  Everything else we count as an invalid
         # request.
-        translator = translations.installTranslations(lang)
-        if body is not None and translator.gettext(strings.EMAIL_MISC_TEXT[1]) in body:
-            emailMetrix.recordValidEmailRequest(self)
-        else:
-            emailMetrix.recordInvalidEmailRequest(self)
+        with openmetrics.stage("metrics"):
+            translator = translations.getTranslations(lang)
+            if body is not None and translator.gettext(strings.EMAIL_MISC_TEXT[1]) in body:
+                emailMetrix.recordValidEmailRequest(self)
+            else:
+                emailMetrix.recordInvalidEmailRequest(self)
 
         if not body: return  # The client was already warned.
 
         messageID = self.incoming.message.get("Message-ID", None)
         subject = self.incoming.message.get("Subject", None)
-        response = generateResponse(recipient, client,
-                                    body, subject, messageID)
+        with openmetrics.stage("response"):
+            response = generateResponse(recipient, client,
+                                        body, subject, messageID)
         return response
 
     def getMailTo(self):
@@ -575,7 +584,8 @@ class SMTPAutoresponder(smtp.SMTPClient):
         """
         logging.info("Got an email; deciding whether to reply.")
 
-        response = self.getMailData()
+        with openmetrics.RequestTimer("email"):
+            response = self.getMailData()
         if not response:
             return self.deferred
 
@@ -29,6 +29,7 @@ import time
 
 import bridgedb.Storage
 
+from bridgedb import openmetrics
 from bridgedb.bridgerings import BridgeRing
 from bridgedb.bridgerings import FilteredBridgeSplitter
 from bridgedb.crypto import getHMAC
@@ -69,7 +70,7 @@ class EmailDistributor(Distributor):
     emailRateMax = MAX_EMAIL_RATE
 
     def __init__(self, key, domainmap, domainrules,
-                 answerParameters=None, whitelist=None):
+                 answerParameters=None, whitelist=None, maxCachedRings=32):
         """Create a bridge distributor which uses email.
 
         :type emailHmac: callable
@@ -83,6 +84,9 @@ class EmailDistributor(Distributor):
         :type whitelist: dict or ``None``
         :param whitelist: A dictionary that maps whitelisted email addresses
             to GnuPG fingerprints.
+        :param int maxCachedRings: How many subrings to keep for the
+            combinations of filters which clients ask for beyond the
+            prepopulated ones.
         """
         super(EmailDistributor, self).__init__(key)
 
@@ -95,8 +99,7 @@ class EmailDistributor(Distributor):
         key2 = getHMAC(key, "Order-Bridges-In-Ring")
 
         self.emailHmac = getHMACFunc(key1, hex=False)
-        #XXX cache options not implemented
-        self.hashring = FilteredBridgeSplitter(key2, max_cached_rings=5)
+        self.hashring = FilteredBridgeSplitter(key2, max_cached_rings=maxCachedRings)
 
         self.name = "Email"
 
@@ -142,52 +145,62 @@ class EmailDistributor(Distributor):
         if clock:
             now = clock.seconds()
 
-        with bridgedb.Storage.getDB() as db:
-            wasWarned = db.getWarnedEmail(bridgeRequest.client)
-            lastSaw = db.getEmailTime(bridgeRequest.client)
-            if lastSaw is not None:
-                if bridgeRequest.client in self.whitelist:
-                    logging.info(
-                        "Whitelisted address %s was last seen %d seconds ago."
-                        % (bridgeRequest.client, now - lastSaw))
-                elif (lastSaw + self.emailRateMax) >= now:
-                    wait = (lastSaw + self.emailRateMax) - now
-                    logging.info("Client %s must wait another %d seconds."
-                                 % (bridgeRequest.client, wait))
-                    if wasWarned:
-                        raise IgnoreEmail(
-                            "Client %s was warned." % bridgeRequest.client,
-                            bridgeRequest.client)
-                    else:
-                        logging.info("Sending duplicate request warning.")
-                        db.setWarnedEmail(bridgeRequest.client, True, now)
-                        db.commit()
-                        raise TooSoonEmail("Must wait %d seconds" % wait,
-                                           bridgeRequest.client)
-            # warning period is over
-            elif wasWarned:
-                db.setWarnedEmail(bridgeRequest.client, False)
-
-            pos = self.emailHmac("<%s>%s" % (interval, bridgeRequest.client))
-
-            ring = None
-            filtres = frozenset(bridgeRequest.filters)
-            if filtres in self.hashring.filterRings:
-                logging.debug("Cache hit %s" % filtres)
-                _, ring = self.hashring.filterRings[filtres]
-            else:
-                logging.debug("Cache miss %s" % filtres)
+        # Check and update the client's rate limit in one short transaction,
+        # rather than waiting for the lock which a reload holds for as long
+        # as it is writing bridges to the database:
+        tooSoon = None
+        with openmetrics.stage("rate-limit"):
+            with bridgedb.Storage.getTransactionDB() as db:
+                wasWarned = db.getWarnedEmail(bridgeRequest.client)
+                lastSaw = db.getEmailTime(bridgeRequest.client)
+                if lastSaw is not None:
+                    if bridgeRequest.client in self.whitelist:
+                        logging.info(
+                            "Whitelisted address %s was last seen %d seconds ago."
+                            % (bridgeRequest.client, now - lastSaw))
+                    elif (lastSaw + self.emailRateMax) >= now:
+                        wait = (lastSaw + self.emailRateMax) - now
+                        logging.info("Client %s must wait another %d seconds."
+                                     % (bridgeRequest.client, wait))
+                        if wasWarned:
+                            raise IgnoreEmail(
+                                "Client %s was warned." % bridgeRequest.client,
+                                bridgeRequest.client)
+                        else:
+                            logging.info("Sending duplicate request warning.")
+                            db.setWarnedEmail(bridgeRequest.client, True, now)
+                            tooSoon = wait
+                # warning period is over
+                elif wasWarned:
+                    db.setWarnedEmail(bridgeRequest.client, False)
+
+                if tooSoon is None:
+                    db.setEmailTime(bridgeRequest.client, now)
+
+        if tooSoon is not None:
+            raise TooSoonEmail("Must wait %d seconds" % tooSoon,
+                               bridgeRequest.client)
+
+        pos = self.emailHmac("<%s>%s" % (interval, bridgeRequest.client))
+
+        ring = None
+        filtres = frozenset(bridgeRequest.filters)
+        with openmetrics.stage("ring-lookup"):
+            ring = self.hashring.getRing(filtres)
+        if ring is not None:
+            logging.debug("Cache hit %s" % filtres)
+        else:
+            logging.debug("Cache miss %s" % filtres)
+            with openmetrics.stage("ring-build"):
                 key = getHMAC(self.key, "Order-Bridges-In-Ring")
                 ring = BridgeRing(key, self.answerParameters)
                 self.hashring.addRing(ring, filtres, byFilters(filtres),
                                       populate_from=self.hashring.bridges)
 
+        with openmetrics.stage("ring-answer"):
             returnNum = self.bridgesPerResponse(ring)
             result = ring.getBridges(pos, returnNum, filterBySubnet=False)
 
-            db.setEmailTime(bridgeRequest.client, now)
-            db.commit()
-
         return result
 
     def cleanDatabase(self):
@@ -210,12 +223,15 @@ class EmailDistributor(Distributor):
         """
         logging.info("Prepopulating %s distributor hashrings..." % self.name)
 
+        rings = []
         for filterFn in [byIPv4, byIPv6]:
             ruleset = frozenset([filterFn])
             key = getHMAC(self.key, "Order-Bridges-In-Ring")
             ring = BridgeRing(key, self.answerParameters)
-            self.hashring.addRing(ring, ruleset, byFilters([filterFn]),
-                                  populate_from=self.hashring.bridges)
+            rings.append((ring, ruleset, byFilters([filterFn])))
+
+        self.hashring.addRings(rings, populate_from=self.hashring.bridges,
+                               pinned=True)
 
         # Since prepopulateRings is called every half hour when the bridge
         # descriptors are re-parsed, we should clean the database then.
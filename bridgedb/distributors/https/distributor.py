@@ -16,16 +16,20 @@ bridgedb.distributors.https.distributor
 
 A Distributor that hands out bridges through a web interface.
 
-.. inheritance-diagram:: HTTPSDistributor
+.. inheritance-diagram:: AnswerCache HTTPSDistributor
     :parts: 1
 """
 
+import array
 import binascii
+import collections
 import ipaddr
 import logging
+import socket
 
 import bridgedb.Storage
 
+from bridgedb import openmetrics
 from bridgedb import proxy
 from bridgedb.bridgerings import BridgeRing
 from bridgedb.bridgerings import FilteredBridgeSplitter
@@ -38,6 +42,90 @@ from bridgedb.filters import byFilters
 from bridgedb.filters import bySubring
 
 
+class AnswerCache(object):
+    """A bounded cache of the bridges given to clients during the current
+    interval.
+
+    Within one interval, every client in the same subnet (or proxy group)
+    who asks for the same kind of bridges is mapped to the same subring and
+    the same position within it, and so they all get the same answer.  This
+    caches those answers, so that bursts of requests from behind large NATs
+    or Tor Exits don't each have to recompute them.
+
+    The cache is emptied whenever the interval changes, whenever it is used
+    with a different hashring (i.e. after
+    :func:`bridgedb.main.replaceBridgeRings` swaps in a new one), and
+    whenever the number of bridges in the hashring changes.  If it becomes
+    full, the least recently used answer is dropped.
+
+    :ivar int maxSize: The maximum number of answers to keep.
+    :ivar int hits: The number of answers which were found in the cache.
+    :ivar int misses: The number of answers which weren't.
+    """
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._answers = collections.OrderedDict()
+        self._hashring = None
+        self._interval = None
+        self._length = None
+
+    def __len__(self):
+        return len(self._answers)
+
+    def clear(self):
+        """Remove all cached answers."""
+        self._answers.clear()
+
+    def _checkValidity(self, hashring, interval):
+        """Empty the cache if any of **hashring**, its length, or the
+        **interval** have changed since the cached answers were stored.
+        """
+        if not (hashring is self._hashring and interval == self._interval
+                and len(hashring) == self._length):
+            self.clear()
+            self._hashring = hashring
+            self._interval = interval
+            self._length = len(hashring)
+
+    def get(self, hashring, interval, key):
+        """Get the cached answer for **key**.
+
+        :type hashring: :class:`~bridgedb.bridgerings.FilteredBridgeSplitter`
+        :param hashring: The distributor's current hashring.
+        :param str interval: The current interval.
+        :param key: A hashable identifier for the client's answer, i.e. their
+            subnet and the filters for the bridges they requested.
+        :rtype: list or ``None``
+        :returns: A copy of the cached list of bridges, or ``None`` if there
+            wasn't one.
+        """
+        self._checkValidity(hashring, interval)
+
+        answer = self._answers.get(key)
+        if answer is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._answers.move_to_end(key)
+        return list(answer)
+
+    def put(self, hashring, interval, key, answer):
+        """Store the **answer** (a list of bridges) for **key**.
+
+        See :meth:`get` for the other parameters.
+        """
+        self._checkValidity(hashring, interval)
+
+        self._answers[key] = list(answer)
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.maxSize:
+            self._answers.popitem(last=False)
+
+
 class HTTPSDistributor(Distributor):
     """A Distributor that hands out bridges based on the IP address of an
     incoming request and the current time period.
@@ -49,9 +137,13 @@ class HTTPSDistributor(Distributor):
     :ivar hashring: A hashring that assigns bridges to subrings with fixed
         proportions. Used to assign bridges into the subrings of this
         distributor.
+    :type answerCache: :class:`AnswerCache`
+    :ivar answerCache: The answers given to clients during the current
+        interval, by subnet and requested filters.
     """
 
-    def __init__(self, totalSubrings, key, proxies=None, answerParameters=None):
+    def __init__(self, totalSubrings, key, proxies=None, answerParameters=None,
+                 cachedRingsPerSubring=16):
         """Create a Distributor that decides which bridges to distribute based
         upon the client's IP address and the current time.
 
@@ -75,6 +167,10 @@ class HTTPSDistributor(Distributor):
             bridges that this distributor answers a client with fit certain
             parameters, i.e. that an answer has "at least two obfsproxy
             bridges" or "at least one bridge on port 443", etc.
+        :param int cachedRingsPerSubring: How many subrings to keep, for each
+            of the **totalSubrings** (plus the proxy subring, if any), for the
+            combinations of filters which clients ask for beyond the
+            prepopulated ones.
         """
         super(HTTPSDistributor, self).__init__(key)
         self.totalSubrings = totalSubrings
@@ -90,7 +186,19 @@ class HTTPSDistributor(Distributor):
             self.proxies = proxy.ProxySet()
             self.proxySubring = 0
 
-        self.ringCacheSize = self.totalSubrings * 3
+        # The number of subrings, on top of the prepopulated ones, built for
+        # the other combinations of filters which clients ask for:
+        self.ringCacheSize = self.totalSubrings * cachedRingsPerSubring
+        self.answerCache = AnswerCache()
+
+        # The subring for each IPv4 /16, indexed by the first two octets of
+        # the client's address. Zero means "not yet computed", since subrings
+        # are numbered from one:
+        self._ipv4Subrings = array.array('H', [0]) * 65536
+        # A small LRU of ``(subnet, subring)`` for each IPv6 /32 we've seen,
+        # keyed by the first 32 bits of the client's address:
+        self._ipv6Areas = collections.OrderedDict()
+        self.ipv6AreaCacheSize = 16384
 
         key2 = getHMAC(key, "Assign-Bridges-To-Rings")
         key3 = getHMAC(key, "Order-Areas-In-Rings")
@@ -181,6 +289,64 @@ class HTTPSDistributor(Distributor):
         else:
             return self.proxySubring
 
+    def getClientArea(self, ip, usingProxy=False):
+        """Determine both the subnet and the subhashring for a client.
+
+        The results are identical to calling :meth:`getSubnet` and then
+        :meth:`mapSubnetToSubring`, but the **ip** is parsed only once,
+        straight into an integer, and the subring (which requires an HMAC) is
+        remembered for each IPv4 ``/16`` and for recently seen IPv6 ``/32``
+        subnets.  Anything which doesn't parse as a plain IPv4 or IPv6
+        address falls back to :meth:`getSubnet`, so that the same exceptions
+        are raised.
+
+        :param str ip: A string representing an IPv4 or IPv6 address.
+        :param bool usingProxy: Set to ``True`` if the client was using one of
+            the known :data:`proxies`.
+        :rtype: tuple
+        :returns: A 2-tuple of the client's subnet (a string, as returned by
+            :meth:`getSubnet`) and their subring (an int).
+        """
+        packed = None
+
+        if isinstance(ip, str):
+            family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+            try:
+                packed = socket.inet_pton(family, ip)
+            except (OSError, ValueError):
+                pass
+
+        if packed is None:
+            subnet = self.getSubnet(ip, usingProxy)
+            return (subnet, self.mapSubnetToSubring(subnet, usingProxy))
+
+        if usingProxy:
+            group = (int.from_bytes(packed, 'big') % 4) + 1
+            subnet = "proxy-group-%d" % group
+            subring = self.proxySubring
+        elif len(packed) == 4:
+            subnet = "%d.%d.0.0/16" % (packed[0], packed[1])
+            prefix = (packed[0] << 8) | packed[1]
+            subring = self._ipv4Subrings[prefix]
+            if not subring:
+                subring = self.mapSubnetToSubring(subnet)
+                self._ipv4Subrings[prefix] = subring
+        else:
+            prefix = int.from_bytes(packed[:4], 'big')
+            area = self._ipv6Areas.get(prefix)
+            if area is None:
+                subnet = self.getSubnet(ip)
+                area = (subnet, self.mapSubnetToSubring(subnet))
+                self._ipv6Areas[prefix] = area
+                while len(self._ipv6Areas) > self.ipv6AreaCacheSize:
+                    self._ipv6Areas.popitem(last=False)
+            else:
+                self._ipv6Areas.move_to_end(prefix)
+            subnet, subring = area
+
+        logging.debug("Client IP was within area: %s" % subnet)
+        return (subnet, subring)
+
     def mapClientToHashringPosition(self, interval, subnet):
         """Map the client to a position on a (sub)hashring, based upon the
         **interval** which the client's request occurred within, as well as
@@ -251,6 +417,7 @@ class HTTPSDistributor(Distributor):
         """
         logging.info("Prepopulating %s distributor hashrings..." % self.name)
 
+        rings = []
         for filterFn in [byIPv4, byIPv6]:
             for subring in range(1, self.totalSubrings + 1):
                 filters = self._buildHashringFilters([filterFn,], subring)
@@ -261,8 +428,10 @@ class HTTPSDistributor(Distributor):
                 # distributor's proxies:
                 if subring == self.proxySubring:
                     ring.setName('{0} Proxy Ring'.format(self.name))
-                self.hashring.addRing(ring, filters, byFilters(filters),
-                                      populate_from=self.hashring.bridges)
+                rings.append((ring, filters, byFilters(filters)))
+
+        self.hashring.addRings(rings, populate_from=self.hashring.bridges,
+                               pinned=True)
 
         logging.info("Bridges allotted for %s distribution: %d"
                      % (self.name, len(self.hashring)))
@@ -281,8 +450,9 @@ class HTTPSDistributor(Distributor):
 
     def _buildHashringFilters(self, previousFilters, subring):
         f = bySubring(self.hashring.hmac, subring, self.totalSubrings)
-        previousFilters.append(f)
-        return frozenset(previousFilters)
+        # Don't append to **previousFilters**, since it may be a client's
+        # bridgeRequest.filters, which we use to look up cached answers:
+        return frozenset(list(previousFilters) + [f])
 
     def getBridges(self, bridgeRequest, interval):
         """Return a list of bridges to give to a user.
@@ -319,8 +489,19 @@ class HTTPSDistributor(Distributor):
             logging.info("Client was from known proxy (tag: %s): %s" %
                          (tag, bridgeRequest.client))
 
-        subnet = self.getSubnet(bridgeRequest.client, usingProxy)
-        subring = self.mapSubnetToSubring(subnet, usingProxy)
+        with openmetrics.stage("subnet"):
+            subnet, subring = self.getClientArea(bridgeRequest.client,
+                                                 usingProxy)
+
+        # Every other client in this subnet who asked for the same kind of
+        # bridges during this interval gets the same answer:
+        cacheKey = (subnet, frozenset(bridgeRequest.filters))
+        with openmetrics.stage("answer-cache"):
+            answer = self.answerCache.get(self.hashring, interval, cacheKey)
+        if answer is not None:
+            logging.debug("Answer cache hit for client area: %s" % subnet)
+            return answer
+
         position = self.mapClientToHashringPosition(interval, subnet)
         filters = self._buildHashringFilters(bridgeRequest.filters, subring)
 
@@ -331,19 +512,23 @@ class HTTPSDistributor(Distributor):
         logging.debug("Bridge filters: %s" % ' '.join([x.__name__ for x in filters]))
 
         # Check wheth we have a cached copy of the hashring:
-        if filters in self.hashring.filterRings.keys():
+        with openmetrics.stage("ring-lookup"):
+            ring = self.hashring.getRing(filters)
+        if ring is not None:
             logging.debug("Cache hit %s" % filters)
-            _, ring = self.hashring.filterRings[filters]
         # Otherwise, construct a new hashring and populate it:
         else:
             logging.debug("Cache miss %s" % filters)
-            key1 = getHMAC(self.key, "Order-Bridges-In-Ring-%d" % subring)
-            ring = BridgeRing(key1, self.answerParameters)
-            self.hashring.addRing(ring, filters, byFilters(filters),
-                                  populate_from=self.hashring.bridges)
+            with openmetrics.stage("ring-build"):
+                key1 = getHMAC(self.key, "Order-Bridges-In-Ring-%d" % subring)
+                ring = BridgeRing(key1, self.answerParameters)
+                self.hashring.addRing(ring, filters, byFilters(filters),
+                                      populate_from=self.hashring.bridges)
 
         # Determine the appropriate number of bridges to give to the client:
-        returnNum = self.bridgesPerResponse(ring)
-        answer = ring.getBridges(position, returnNum, filterBySubnet=True)
+        with openmetrics.stage("ring-answer"):
+            returnNum = self.bridgesPerResponse(ring)
+            answer = ring.getBridges(position, returnNum, filterBySubnet=True)
+        self.answerCache.put(self.hashring, interval, cacheKey, answer)
 
         return answer
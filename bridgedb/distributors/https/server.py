@@ -22,13 +22,15 @@ Servers which interface with clients and distribute bridges over HTTP(S).
 """
 
 import base64
-import gettext
+import collections
+import hashlib
 import logging
 import random
 import re
 import time
 import os
 import operator
+import zlib
 
 from functools import partial
 
@@ -57,13 +59,15 @@ from bridgedb import translations
 from bridgedb import txrecaptcha
 from bridgedb import metrics
 from bridgedb import antibot
+from bridgedb import openmetrics
+from bridgedb import qrcodes
+from bridgedb.captcha import getCaptchaPool
 from bridgedb.distributors.common.http import setFQDN
 from bridgedb.distributors.common.http import getFQDN
 from bridgedb.distributors.common.http import getClientIP
 from bridgedb.distributors.https.request import HTTPSBridgeRequest
 from bridgedb.parse import headers
 from bridgedb.parse.addr import isIPAddress
-from bridgedb.qrcodes import generateQR
 from bridgedb.safelog import logSafely
 from bridgedb.schedule import Unscheduled
 from bridgedb.schedule import ScheduledInterval
@@ -87,6 +91,24 @@ lookup = TemplateLookup(directories=[TEMPLATE_DIR],
                         collection_size=500)
 logging.debug("Set template root to %s" % TEMPLATE_DIR)
 
+
+def setTemplateModuleDirectory(directory):
+    """Keep the Python modules which Mako compiles our templates into in
+    **directory**, so that they needn't be compiled again the next time
+    BridgeDB starts (unless the templates have changed).
+
+    :param str directory: The directory for the compiled templates.  It is
+        created if it doesn't exist.
+    """
+    global lookup
+
+    lookup = TemplateLookup(directories=[TEMPLATE_DIR],
+                            output_encoding='utf-8',
+                            filesystem_checks=False,
+                            collection_size=500,
+                            module_directory=directory)
+    logging.debug("Set compiled template directory to %s" % directory)
+
 #: A list of supported language tuples. Use getSortedLangList() to read this variable.
 supported_langs = []
 
@@ -142,6 +164,12 @@ def replaceErrorPage(request, error, template_name=None, html=True):
                   % (template_name or 'template',
                      mako.exceptions.text_error_template().render()))
 
+    try:
+        langs = translations.getLangsFromHTTPRequest(request)
+    except Exception:
+        langs = []
+    _ = translations.getTranslations(langs).gettext
+
     # TRANSLATORS: Please DO NOT translate the following words and/or phrases in
     # any string (regardless of capitalization and/or punctuation):
     #
@@ -382,39 +410,182 @@ class CustomErrorHandlingResource(resource.Resource):
         return resource404
 
 
+def acceptsGzip(header):
+    """Check whether a client's ``Accept-Encoding:`` header accepts gzip.
+
+    :type header: str or ``None``
+    :param header: The contents of the ``Accept-Encoding:`` header, if any.
+    :rtype: bool
+    """
+    if not header:
+        return False
+    if isinstance(header, bytes):
+        header = header.decode('utf-8', 'replace')
+
+    for coding in header.lower().split(','):
+        name, _, params = coding.partition(';')
+        if name.strip() in ('gzip', 'x-gzip'):
+            params = params.replace(' ', '')
+            return params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+class RenderedPage(object):
+    """A page which was rendered ahead of time, and a gzipped copy of it.
+
+    :ivar bytes body: The page.
+    :ivar bytes gzipped: The page, gzipped.
+    :ivar str etag: The entity tag of the page.
+    :ivar str gzippedETag: The entity tag of the gzipped page.
+    """
+
+    __slots__ = ('body', 'gzipped', 'etag', 'gzippedETag')
+
+    def __init__(self, body):
+        self.body = body
+        # A zlib stream with a gzip header, so that the gzipped page doesn't
+        # depend on when it was compressed:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.gzipped = compressor.compress(body) + compressor.flush()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = '"%s"' % digest
+        self.gzippedETag = '"%s-gzip"' % digest
+
+    def serve(self, request):
+        """Serve this page (gzipped, if the client accepts that), or tell the
+        client that the copy it has is still fresh.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A ``Request`` for this page.
+        :rtype: bytes
+        """
+        gzipped = acceptsGzip(request.getHeader('accept-encoding'))
+        etag = self.gzippedETag if gzipped else self.etag
+
+        request.setHeader("Vary", "Accept-Language, Accept-Encoding")
+        request.setHeader("ETag", etag)
+
+        ifNoneMatch = request.getHeader('if-none-match')
+        if ifNoneMatch:
+            if isinstance(ifNoneMatch, bytes):
+                ifNoneMatch = ifNoneMatch.decode('utf-8', 'replace')
+            if etag in [tag.strip() for tag in ifNoneMatch.split(',')]:
+                request.setResponseCode(304)
+                return b""
+
+        if gzipped:
+            request.setHeader("Content-Encoding", "gzip")
+            return self.gzipped
+        return self.body
+
+
 class TranslatedTemplateResource(CustomErrorHandlingResource, CSPResource):
     """A generalised resource which uses gettext translations and Mako
     templates.
+
+    The page only depends on the translations for the languages which the
+    client asked for, and whether they chose one with a ``lang`` argument, so
+    it is only rendered once for each of those, and kept as a
+    :class:`RenderedPage`.  The pages for each of our supported languages can
+    be rendered ahead of time with :meth:`prerender`.
+
+    :ivar collections.OrderedDict pages: The :class:`RenderedPage`s, by
+        :meth:`getPageKey`, least recently used first.
     """
     isLeaf = True
 
+    #: The most pages to keep.
+    maxPages = 256
+
     def __init__(self, template=None, showFaq=True):
         """Create a new :api:`Resource <twisted.web.resource.Resource>` for a
         Mako-templated webpage.
         """
-        gettext.install("bridgedb")
         CSPResource.__init__(self)
         self.template = template
         self.showFaq = showFaq
+        self.pages = collections.OrderedDict()
+
+    def getPageKey(self, langs, langOverride):
+        """Get a key which is the same for all requests which get the same
+        page.
+
+        :param list langs: All requested languages.
+        :param bool langOverride: Whether the client chose a language with a
+            ``lang`` argument.
+        :rtype: tuple
+        """
+        return (translations.getTranslationFiles(tuple(langs)),
+                langs[0] if langs else None,
+                translations.getFirstSupportedLang(langs),
+                langOverride)
+
+    def renderPage(self, langs, langOverride):
+        """Render the page for a client who asked for **langs**.
+
+        :param list langs: All requested languages.
+        :param bool langOverride: Whether the client chose a language with a
+            ``lang`` argument.
+        :rtype: bytes
+        """
+        translator = translations.getTranslations(langs)
+        rtl = translations.usingRTLLang(langs)
+        template = lookup.get_template(self.template)
+        return template.render(strings,
+                               getSortedLangList(),
+                               _=translator.gettext,
+                               rtl=rtl,
+                               lang=langs[0],
+                               langOverride=langOverride,
+                               showFaq=self.showFaq)
+
+    def getPage(self, langs, langOverride):
+        """Get the page for a client who asked for **langs**, rendering it if
+        it hasn't been already.
+
+        :param list langs: All requested languages.
+        :param bool langOverride: Whether the client chose a language with a
+            ``lang`` argument.
+        :rtype: :class:`RenderedPage`
+        """
+        key = self.getPageKey(langs, langOverride)
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+            openmetrics.PAGE_CACHE_EVENTS.inc(self.template, "hits")
+            return page
+
+        openmetrics.PAGE_CACHE_EVENTS.inc(self.template, "misses")
+        page = self.pages[key] = RenderedPage(
+            self.renderPage(langs, langOverride))
+        while len(self.pages) > self.maxPages:
+            self.pages.popitem(last=False)
+            openmetrics.PAGE_CACHE_EVENTS.inc(self.template, "evictions")
+        return page
+
+    def prerender(self):
+        """Render the page for each of our supported languages, as asked for
+        with and without a ``lang`` argument, by a client which didn't send an
+        ``Accept-Language:`` header.
+        """
+        for chosenLang in [None] + sorted(translations.getSupportedLangs()):
+            langs = translations.getRequestedLangs(None, chosenLang)
+            self.getPage(langs, chosenLang is not None)
+        logging.debug("Rendered %d versions of %s." %
+                      (len(self.pages), self.template))
 
     def render_GET(self, request):
         self.setCSPHeader(request)
         request.args = stringifyRequestArgs(request.args)
-        rtl = False
         try:
-            langs = translations.getLocaleFromHTTPRequest(request)
-            rtl = translations.usingRTLLang(langs)
-            template = lookup.get_template(self.template)
-            rendered = template.render(strings,
-                                       getSortedLangList(),
-                                       rtl=rtl,
-                                       lang=langs[0],
-                                       langOverride=translations.isLangOverridden(request),
-                                       showFaq=self.showFaq)
+            langs = translations.getLangsFromHTTPRequest(request)
+            page = self.getPage(langs,
+                                translations.isLangOverridden(request))
         except Exception as err:  # pragma: no cover
-            rendered = replaceErrorPage(request, err)
+            request.setHeader("Content-Type", "text/html; charset=utf-8")
+            return replaceErrorPage(request, err)
         request.setHeader("Content-Type", "text/html; charset=utf-8")
-        return rendered
+        return page.serve(request)
 
     render_POST = render_GET
 
@@ -485,6 +656,19 @@ class CaptchaProtectedResource(CustomErrorHandlingResource, CSPResource):
         """
         return (b'', '')
 
+    def getEncodedCaptchaImage(self, request=None):
+        """Get a CAPTCHA image, base64-encoded for embedding in a page.
+
+        :rtype: tuple
+        :returns: A 2-tuple of ``(encodedImage, challenge)``, where
+            ``encodedImage`` is the base64 encoding of the image returned by
+            :meth:`getCaptchaImage`, or ``None`` if there wasn't one.
+        """
+        image, challenge = self.getCaptchaImage(request)
+        if image is None:
+            return (None, challenge)
+        return (base64.b64encode(image), challenge)
+
     def extractClientSolution(self, request):
         """Extract the client's CAPTCHA solution from a POST request.
 
@@ -531,16 +715,18 @@ class CaptchaProtectedResource(CustomErrorHandlingResource, CSPResource):
         request.args = stringifyRequestArgs(request.args)
 
         rtl = False
-        image, challenge = self.getCaptchaImage(request)
+        encodedImage, challenge = self.getEncodedCaptchaImage(request)
 
         try:
-            langs = translations.getLocaleFromHTTPRequest(request)
+            langs = translations.getLangsFromHTTPRequest(request)
+            translator = translations.getTranslations(langs)
             rtl = translations.usingRTLLang(langs)
             # TODO: this does not work for versions of IE < 8.0
-            imgstr = b'data:image/jpeg;base64,%s' % base64.b64encode(image)
+            imgstr = b'data:image/jpeg;base64,%s' % encodedImage
             template = lookup.get_template('captcha.html')
             rendered = template.render(strings,
                                        getSortedLangList(),
+                                       _=translator.gettext,
                                        rtl=rtl,
                                        lang=langs[0],
                                        langOverride=translations.isLangOverridden(request),
@@ -605,7 +791,8 @@ class GimpCaptchaProtectedResource(CaptchaProtectedResource):
     .. _gimp-captcha: https://github.com/isislovecruft/gimp-captcha
     """
 
-    def __init__(self, hmacKey=None, captchaDir='', **kwargs):
+    def __init__(self, hmacKey=None, captchaDir='', captchaPool=None,
+                 **kwargs):
         """Protect a resource via this one, using a local CAPTCHA cache.
 
         :param str secretkey: A PKCS#1 OAEP-padded, private RSA key, used for
@@ -621,6 +808,10 @@ class GimpCaptchaProtectedResource(CaptchaProtectedResource):
             ``GIMP_CAPTCHA_HMAC_KEYFILE`` option in the config file.
         :param str captchaDir: The directory where the cached CAPTCHA images
             are stored. See the ``GIMP_CAPTCHA_DIR`` config setting.
+        :type captchaPool: :class:`~bridgedb.captcha.CaptchaPool` or ``None``
+        :param captchaPool: The index of the images in **captchaDir** to
+            choose CAPTCHAs from.  If ``None``, the shared pool for
+            **captchaDir** is used.
         :param bool useForwardedHeader: If ``True``, obtain the client's IP
             address from the ``X-Forwarded-For`` HTTP header.
         :type protectedResource: :api:`twisted.web.resource.Resource`
@@ -632,6 +823,9 @@ class GimpCaptchaProtectedResource(CaptchaProtectedResource):
         CaptchaProtectedResource.__init__(self, **kwargs)
         self.hmacKey = hmacKey
         self.captchaDir = captchaDir
+        if captchaPool is None:
+            captchaPool = getCaptchaPool(captchaDir)
+        self.captchaPool = captchaPool
 
     def checkSolution(self, request):
         """Process a solved CAPTCHA via :meth:`bridgedb.captcha.GimpCaptcha.check`.
@@ -661,25 +855,23 @@ class GimpCaptchaProtectedResource(CaptchaProtectedResource):
                       % ("C" if valid else "Inc", clientIP, solution))
         return valid
 
-    def getCaptchaImage(self, request):
-        """Get a random CAPTCHA image from our **captchaDir**.
-
-        Creates a :class:`~bridgedb.captcha.GimpCaptcha`, and calls its
-        :meth:`~bridgedb.captcha.GimpCaptcha.get` method to return a random
-        CAPTCHA and challenge string.
+    def getCaptcha(self, request):
+        """Get a random CAPTCHA from our **captchaPool**, for the client who
+        made the **request**.
 
         :type request: :api:`twisted.web.http.Request`
         :param request: A client's initial request for some other resource
             which is protected by this one (i.e. protected by a CAPTCHA).
-        :returns: A 2-tuple of ``(image, challenge)``, where::
-            - ``image`` is a string holding a binary, JPEG-encoded image.
-            - ``challenge`` is a unique string associated with the request.
+        :rtype: :class:`~bridgedb.captcha.GimpCaptcha`
+        :returns: The CAPTCHA, whose ``image`` is ``None`` if one couldn't
+            be retrieved.
         """
         # Create a new HMAC key, specific to requests from this client:
         clientIP = self.getClientIP(request)
         clientHMACKey = crypto.getHMAC(self.hmacKey, clientIP)
         capt = captcha.GimpCaptcha(self.publicKey, self.secretKey,
-                                   clientHMACKey, self.captchaDir)
+                                   clientHMACKey, self.captchaDir,
+                                   self.captchaPool)
         try:
             capt.get()
         except captcha.GimpCaptchaError as error:
@@ -688,8 +880,41 @@ class GimpCaptchaProtectedResource(CaptchaProtectedResource):
             logging.error("Unhandled error while retrieving Gimp captcha!")
             logging.exception(error)
 
+        return capt
+
+    def getCaptchaImage(self, request):
+        """Get a random CAPTCHA image from our **captchaDir**.
+
+        Creates a :class:`~bridgedb.captcha.GimpCaptcha`, and calls its
+        :meth:`~bridgedb.captcha.GimpCaptcha.get` method to return a random
+        CAPTCHA and challenge string.  The CAPTCHA is chosen from our
+        **captchaPool**.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A client's initial request for some other resource
+            which is protected by this one (i.e. protected by a CAPTCHA).
+        :returns: A 2-tuple of ``(image, challenge)``, where::
+            - ``image`` is a string holding a binary, JPEG-encoded image.
+            - ``challenge`` is a unique string associated with the request.
+        """
+        capt = self.getCaptcha(request)
         return (capt.image, capt.challenge)
 
+    def getEncodedCaptchaImage(self, request):
+        """Get a random CAPTCHA image from our **captchaDir**, base64-encoded.
+
+        If our **captchaPool** preloads its images, then it has already
+        encoded them, too.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A client's initial request for some other resource
+            which is protected by this one (i.e. protected by a CAPTCHA).
+        :returns: A 2-tuple of ``(encodedImage, challenge)``; see
+            :meth:`CaptchaProtectedResource.getEncodedCaptchaImage`.
+        """
+        capt = self.getCaptcha(request)
+        return (capt.getEncodedImage(), capt.challenge)
+
     def render_GET(self, request):
         """Get a random CAPTCHA from our local cache directory and serve it to
         the client.
@@ -753,6 +978,9 @@ class ReCaptchaProtectedResource(CaptchaProtectedResource):
                 rendered = self.resource.render(request)
             except Exception as err:  # pragma: no cover
                 rendered = replaceErrorPage(request, err)
+            if rendered is NOT_DONE_YET:
+                # The resource will finish the request itself.
+                return
         else:
             logging.info("Client failed a CAPTCHA; redirecting to %s"
                          % request.uri)
@@ -918,7 +1146,6 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
         :param bool includeFingerprints: Do we include the bridge's
             fingerprint in the response?
         """
-        gettext.install("bridgedb")
         CSPResource.__init__(self)
         self.distributor = distributor
         self.schedule = schedule
@@ -945,7 +1172,8 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
         request.args = stringifyRequestArgs(request.args)
 
         try:
-            response = self.getBridgeRequestAnswer(request)
+            with openmetrics.RequestTimer("https"):
+                response = self.getBridgeRequestAnswer(request)
         except Exception as err:
             logging.exception(err)
             response = self.renderAnswer(request)
@@ -975,7 +1203,11 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
         """
         bridgeLines = None
         interval = self.schedule.intervalStart(time.time())
-        ip = self.getClientIP(request)
+        with openmetrics.stage("client-ip"):
+            ip = self.getClientIP(request)
+        timer = openmetrics.currentRequest()
+        if timer is not None:
+            timer.client = ip
 
         logging.info("Replying to web request from %s. Parameters were %r"
                      % (ip, request.args))
@@ -989,19 +1221,23 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
         request.args = str_args
 
         if ip:
-            bridgeRequest = HTTPSBridgeRequest()
-            bridgeRequest.client = ip
-            bridgeRequest.isValid(True)
-            bridgeRequest.withIPversion(request.args)
-            bridgeRequest.withPluggableTransportType(request.args)
-            bridgeRequest.withoutBlockInCountry(request)
-            bridgeRequest.generateFilters()
+            with openmetrics.stage("bridge-request"):
+                bridgeRequest = HTTPSBridgeRequest()
+                bridgeRequest.client = ip
+                bridgeRequest.isValid(True)
+                bridgeRequest.withIPversion(request.args)
+                bridgeRequest.withPluggableTransportType(request.args)
+                bridgeRequest.withoutBlockInCountry(request)
+                bridgeRequest.generateFilters()
 
             bridges = self.distributor.getBridges(bridgeRequest, interval)
-            bridgeLines = [replaceControlChars(bridge.getBridgeLine(
-                bridgeRequest, self.includeFingerprints)) for bridge in bridges]
+            with openmetrics.stage("bridge-lines"):
+                bridgeLines = [replaceControlChars(bridge.getBridgeLine(
+                    bridgeRequest, self.includeFingerprints))
+                               for bridge in bridges]
 
-            internalMetrix.recordHandoutsPerBridge(bridgeRequest, bridges)
+            with openmetrics.stage("metrics"):
+                internalMetrix.recordHandoutsPerBridge(bridgeRequest, bridges)
 
             if antibot.isRequestFromBot(request):
                 transports = bridgeRequest.transports
@@ -1056,10 +1292,12 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
             to use a bridge. If ``None``, then the returned page will instead
             explain that there were no bridges of the type they requested,
             with instructions on how to proceed.
-        :rtype: bytes
-        :returns: A plaintext or HTML response to serve.
+        :rtype: bytes or int
+        :returns: A plaintext or HTML response to serve, or
+            :api:`twisted.web.server.NOT_DONE_YET` if the HTML response is
+            waiting for its QRCode to be generated, in which case it will be
+            written by :meth:`writeAnswer`.
         """
-        rtl = False
         format = self.getResponseFormat(request)
 
         if not bridgeLines:
@@ -1073,29 +1311,89 @@ class BridgesResource(CustomErrorHandlingResource, CSPResource):
                 rendered = replaceErrorPage(request, err, html=False)
         else:
             request.setHeader("Content-Type", "text/html; charset=utf-8")
-            qrcode = None
-            qrjpeg = generateQR(bridgeLines)
+            with openmetrics.stage("qrcode"):
+                d = qrcodes.getQRDataURI(bridgeLines)
+
+            if d.called:
+                # The QRCode was cached, so we can answer straight away.
+                return self.renderHTMLAnswer(d.result, request, bridgeLines)
+
+            # Otherwise, it's being generated in a thread; answer once it's
+            # done, without holding up anyone else in the meantime.  We're
+            # still answering the request until then, so keep timing it.
+            resumed = openmetrics.pauseRequest()
+            finished = request.notifyFinish()
+            finished.addErrback(lambda failure: None)
+            d.addCallback(self.writeAnswer, request, bridgeLines, resumed,
+                          finished)
+            return NOT_DONE_YET
 
-            if qrjpeg:
-                qrcode = b'data:image/jpeg;base64,%s' % base64.b64encode(qrjpeg)
-                qrcode = qrcode.decode("utf-8")
+        return rendered.encode("utf-8") if isinstance(rendered, str) else rendered
 
-            try:
-                langs = translations.getLocaleFromHTTPRequest(request)
+    def renderHTMLAnswer(self, qrcode, request, bridgeLines=None):
+        """Render the HTML page for a client which includes **bridgeLines**.
+
+        :type qrcode: str or ``None``
+        :param qrcode: The ``data:`` URI of the QRCode for the
+            **bridgeLines**, if there is one.
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A ``Request`` object containing the HTTP method, full
+            URI, and any URL/POST arguments and headers present.
+        :type bridgeLines: list or None
+        :param bridgeLines: A list of strings used to configure a Tor client
+            to use a bridge.  See :meth:`renderAnswer`.
+        :rtype: bytes
+        :returns: An HTML response to serve.
+        """
+        try:
+            with openmetrics.stage("template"):
+                langs = translations.getLangsFromHTTPRequest(request)
+                translator = translations.getTranslations(langs)
                 rtl = translations.usingRTLLang(langs)
                 template = lookup.get_template('bridges.html')
                 rendered = template.render(strings,
                                            getSortedLangList(),
+                                           _=translator.gettext,
                                            rtl=rtl,
                                            lang=langs[0],
                                            langOverride=translations.isLangOverridden(request),
                                            answer=bridgeLines,
                                            qrcode=qrcode)
-            except Exception as err:
-                rendered = replaceErrorPage(request, err)
+        except Exception as err:
+            rendered = replaceErrorPage(request, err)
 
         return rendered.encode("utf-8") if isinstance(rendered, str) else rendered
 
+    def writeAnswer(self, qrcode, request, bridgeLines, resumed, finished):
+        """Render the HTML page for a client once its QRCode has been
+        generated, write it, and finish the **request**.
+
+        :type qrcode: str or ``None``
+        :param qrcode: The ``data:`` URI of the QRCode for the
+            **bridgeLines**, if there is one.
+        :type request: :api:`twisted.web.http.Request`
+        :param request: The ``Request`` to answer.
+        :param list bridgeLines: The bridge lines to give the client.
+        :param resumed: The context manager from
+            :func:`bridgedb.openmetrics.pauseRequest`, which finishes timing
+            the request.
+        :type finished: :api:`twisted.internet.defer.Deferred`
+        :param finished: The ``Deferred`` from the **request**'s
+            ``notifyFinish()``.  If it has fired, the client has gone away.
+        """
+        with resumed:
+            if finished.called:
+                logging.info("Client went away before their bridges were "
+                             "ready.")
+                return
+
+            rendered = self.renderHTMLAnswer(qrcode, request, bridgeLines)
+            try:
+                request.write(rendered)
+                request.finish()
+            except Exception as err:  # pragma: no cover
+                logging.exception(err)
+
 
 def addWebServer(config, distributor):
     """Set up a web server for HTTP(S)-based bridge distribution.
@@ -1120,6 +1418,7 @@ def addWebServer(config, distributor):
              RECAPTCHA_REMOTEIP
              GIMP_CAPTCHA_ENABLED
              GIMP_CAPTCHA_DIR
+             GIMP_CAPTCHA_PRELOAD
              GIMP_CAPTCHA_HMAC_KEYFILE
              GIMP_CAPTCHA_RSA_KEYFILE
              SERVER_PUBLIC_FQDN
@@ -1141,10 +1440,15 @@ def addWebServer(config, distributor):
 
     setFQDN(config.SERVER_PUBLIC_FQDN)
 
+    if config.HTTPS_TEMPLATE_MODULE_DIR:
+        setTemplateModuleDirectory(config.HTTPS_TEMPLATE_MODULE_DIR)
+
     index   = IndexResource()
     options = OptionsResource()
     howto   = HowtoResource()
     info    = InfoResource()
+    for page in (index, options, howto, info):
+        page.prerender()
     robots  = static.File(os.path.join(TEMPLATE_DIR, 'robots.txt'))
     assets  = static.File(os.path.join(TEMPLATE_DIR, 'assets/'))
     csp     = CSPResource(enabled=config.CSP_ENABLED,
@@ -1176,9 +1480,14 @@ def addWebServer(config, distributor):
         hmacKey = crypto.getHMAC(captchaKey, "Captcha-Key")
         # Load or create our encryption keys:
         secretKey, publicKey = crypto.getRSAKey(config.GIMP_CAPTCHA_RSA_KEYFILE)
+        # Index the CAPTCHAs now, rather than when the first client asks:
+        pool = getCaptchaPool(config.GIMP_CAPTCHA_DIR,
+                              config.GIMP_CAPTCHA_PRELOAD)
+        pool.startRefreshing()
         captcha = partial(GimpCaptchaProtectedResource,
                           hmacKey=hmacKey,
-                          captchaDir=config.GIMP_CAPTCHA_DIR)
+                          captchaDir=config.GIMP_CAPTCHA_DIR,
+                          captchaPool=pool)
 
     if config.HTTPS_ROTATION_PERIOD:
         count, period = config.HTTPS_ROTATION_PERIOD.split()
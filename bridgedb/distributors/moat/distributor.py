@@ -36,7 +36,8 @@ class MoatDistributor(HTTPSDistributor):
         distributor.
     """
 
-    def __init__(self, totalSubrings, key, proxies=None, answerParameters=None):
+    def __init__(self, totalSubrings, key, proxies=None, answerParameters=None,
+                 cachedRingsPerSubring=16):
         """Create a Distributor that decides which bridges to distribute based
         upon the client's IP address and the current time.
 
@@ -60,6 +61,11 @@ class MoatDistributor(HTTPSDistributor):
             bridges that this distributor answers a client with fit certain
             parameters, i.e. that an answer has "at least two obfsproxy
             bridges" or "at least one bridge on port 443", etc.
+        :param int cachedRingsPerSubring: How many subrings to keep, for each
+            of the **totalSubrings** (plus the proxy subring, if any), for the
+            combinations of filters which clients ask for beyond the
+            prepopulated ones.
         """
         super(MoatDistributor, self).__init__(totalSubrings, key, proxies,
-                                              answerParameters)
+                                              answerParameters,
+                                              cachedRingsPerSubring)
@@ -24,7 +24,6 @@ meek tunnel.
 
 from __future__ import print_function
 
-import base64
 import json
 import logging
 import time
@@ -36,17 +35,20 @@ from ipaddr import IPAddress
 from twisted.internet import reactor
 from twisted.internet.error import CannotListenError
 from twisted.web import resource
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.server import Site
 
 from bridgedb import metrics
 from bridgedb import captcha
 from bridgedb import crypto
 from bridgedb import antibot
+from bridgedb import openmetrics
+from bridgedb import qrcodes
+from bridgedb.captcha import getCaptchaPool
 from bridgedb.distributors.common.http import setFQDN
 from bridgedb.distributors.common.http import getFQDN
 from bridgedb.distributors.common.http import getClientIP
 from bridgedb.distributors.moat.request import MoatBridgeRequest
-from bridgedb.qrcodes import generateQR
 from bridgedb.schedule import Unscheduled
 from bridgedb.schedule import ScheduledInterval
 from bridgedb.util import replaceControlChars
@@ -316,7 +318,8 @@ class CaptchaFetchResource(CaptchaResource):
     isLeaf = True
 
     def __init__(self, hmacKey=None, publicKey=None, secretKey=None,
-                 captchaDir="captchas", useForwardedHeader=True, skipLoopback=False):
+                 captchaDir="captchas", useForwardedHeader=True, skipLoopback=False,
+                 captchaPool=None):
         """DOCDOC
 
         :param bytes hmacKey: The master HMAC key, used for validating CAPTCHA
@@ -336,31 +339,36 @@ class CaptchaFetchResource(CaptchaResource):
             address from the ``X-Forwarded-For`` HTTP header.
         :param bool skipLoopback: Skip loopback addresses when parsing the
             X-Forwarded-For header.
+        :type captchaPool: :class:`~bridgedb.captcha.CaptchaPool` or ``None``
+        :param captchaPool: The index of the images in **captchaDir** to
+            choose CAPTCHAs from.  If ``None``, the shared pool for
+            **captchaDir** is used.
         """
         CaptchaResource.__init__(self, hmacKey, publicKey, secretKey,
                                  useForwardedHeader)
         self.captchaDir = captchaDir
+        if captchaPool is None:
+            captchaPool = getCaptchaPool(captchaDir)
+        self.captchaPool = captchaPool
         self.supportedTransports = getSupportedTransports()
 
-    def getCaptchaImage(self, request):
-        """Get a random CAPTCHA image from our **captchaDir**.
-
-        Creates a :class:`~bridgedb.captcha.GimpCaptcha`, and calls its
-        :meth:`~bridgedb.captcha.GimpCaptcha.get` method to return a random
-        CAPTCHA and challenge string.
+    def getCaptcha(self, request):
+        """Get a random CAPTCHA from our **captchaPool**, for the client who
+        made the **request**.
 
         :type request: :api:`twisted.web.http.Request`
         :param request: A client's initial request for some other resource
             which is protected by this one (i.e. protected by a CAPTCHA).
-        :returns: A 2-tuple of ``(image, challenge)``, where::
-            - ``image`` is a string holding a binary, JPEG-encoded image.
-            - ``challenge`` is a unique string associated with the request.
+        :rtype: :class:`~bridgedb.captcha.GimpCaptcha`
+        :returns: The CAPTCHA, whose ``image`` is ``None`` if one couldn't
+            be retrieved.
         """
         # Create a new HMAC key, specific to requests from this client:
         clientIP = self.getClientIP(request)
         clientHMACKey = crypto.getHMAC(self.hmacKey, clientIP)
         capt = captcha.GimpCaptcha(self.publicKey, self.secretKey,
-                                   clientHMACKey, self.captchaDir)
+                                   clientHMACKey, self.captchaDir,
+                                   self.captchaPool)
         try:
             capt.get()
         except captcha.GimpCaptchaError as error:
@@ -369,7 +377,43 @@ class CaptchaFetchResource(CaptchaResource):
             logging.error("Unhandled error while retrieving Gimp captcha!")
             logging.error(impossible)
 
-        return (capt.image, capt.challenge.decode('utf-8') if isinstance(capt.challenge, bytes) else capt.challenge)
+        if isinstance(capt.challenge, bytes):
+            capt.challenge = capt.challenge.decode('utf-8')
+        return capt
+
+    def getCaptchaImage(self, request):
+        """Get a random CAPTCHA image from our **captchaDir**.
+
+        Creates a :class:`~bridgedb.captcha.GimpCaptcha`, and calls its
+        :meth:`~bridgedb.captcha.GimpCaptcha.get` method to return a random
+        CAPTCHA and challenge string.  The CAPTCHA is chosen from our
+        **captchaPool**.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A client's initial request for some other resource
+            which is protected by this one (i.e. protected by a CAPTCHA).
+        :returns: A 2-tuple of ``(image, challenge)``, where::
+            - ``image`` is a string holding a binary, JPEG-encoded image.
+            - ``challenge`` is a unique string associated with the request.
+        """
+        capt = self.getCaptcha(request)
+        return (capt.image, capt.challenge)
+
+    def getEncodedCaptchaImage(self, request):
+        """Get a random CAPTCHA image from our **captchaDir**, base64-encoded.
+
+        If our **captchaPool** preloads its images, then it has already
+        encoded them, too.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A client's initial request for some other resource
+            which is protected by this one (i.e. protected by a CAPTCHA).
+        :returns: A 2-tuple of ``(encodedImage, challenge)``, where
+            ``encodedImage`` is the base64 encoding of the image, or ``None``
+            if there wasn't one.
+        """
+        capt = self.getCaptcha(request)
+        return (capt.getEncodedImage(), capt.challenge)
 
     def getPreferredTransports(self, supportedTransports):
         """Choose which transport a client should request, based on their list
@@ -463,7 +507,7 @@ class CaptchaFetchResource(CaptchaResource):
 
         supported = self.extractSupportedTransports(request)
         preferred = self.getPreferredTransports(supported)
-        image, challenge = self.getCaptchaImage(request)
+        encodedImage, challenge = self.getEncodedCaptchaImage(request)
 
         data = {
             'data': [{
@@ -471,13 +515,13 @@ class CaptchaFetchResource(CaptchaResource):
                 'type': 'moat-challenge',
                 'version': MOAT_API_VERSION,
                 'transport': preferred,
-                'image': image,
+                'image': encodedImage,
                 'challenge': challenge, # The challenge is already base64-encoded
             }]
         }
 
         try:
-            data["data"][0]["image"] = base64.b64encode(image).decode('utf-8')
+            data["data"][0]["image"] = encodedImage.decode('utf-8')
         except Exception as impossible:
             logging.error("Could not construct or encode captcha!")
             logging.error(impossible)
@@ -676,6 +720,18 @@ class CaptchaCheckResource(CaptchaResource):
 
         return error_response.render(request)
 
+    def render(self, request):
+        """Render a response to a client's CAPTCHA solution, timing each of
+        its stages with a :class:`bridgedb.openmetrics.RequestTimer`.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A ``Request`` object.
+        :rtype: bytes
+        :returns: A JSON API response.
+        """
+        with openmetrics.RequestTimer("moat"):
+            return CaptchaResource.render(self, request)
+
     def render_POST(self, request):
         """Process a client's CAPTCHA solution.
 
@@ -718,12 +774,17 @@ class CaptchaCheckResource(CaptchaResource):
             # metrix module to read the request's content too.
             request.content.seek(pos)
             client_data = json.loads(encoded_client_data)["data"][0]
-            clientIP = self.getClientIP(request)
+            with openmetrics.stage("client-ip"):
+                clientIP = self.getClientIP(request)
+            timer = openmetrics.currentRequest()
+            if timer is not None:
+                timer.client = clientIP
 
             (include_qrcode, transport,
              challenge, solution) = self.extractClientSolution(client_data)
 
-            valid = self.checkSolution(challenge, solution, clientIP)
+            with openmetrics.stage("captcha"):
+                valid = self.checkSolution(challenge, solution, clientIP)
         except captcha.CaptchaExpired:
             logging.debug("The challenge had timed out")
             moatMetrix.recordInvalidMoatRequest(request)
@@ -735,21 +796,25 @@ class CaptchaCheckResource(CaptchaResource):
             return self.failureResponse(4, request)
 
         if valid:
-            qrcode = None
-            bridgeRequest = self.createBridgeRequest(clientIP, client_data)
+            with openmetrics.stage("bridge-request"):
+                bridgeRequest = self.createBridgeRequest(clientIP, client_data)
             bridges = self.getBridges(bridgeRequest)
-            bridgeLines = self.getBridgeLines(bridgeRequest, bridges)
-            moatMetrix.recordValidMoatRequest(request)
+            with openmetrics.stage("bridge-lines"):
+                bridgeLines = self.getBridgeLines(bridgeRequest, bridges)
+            with openmetrics.stage("metrics"):
+                moatMetrix.recordValidMoatRequest(request)
 
             # If we can only return less than the configured
             # MOAT_BRIDGES_PER_ANSWER then log a warning.
             if len(bridgeLines) < self.nBridgesToGive:
                 logging.warn(("Not enough bridges of the type specified to "
                               "fulfill the following request: %s") % bridgeRequest)
-            if not bridgeLines:
-                internalMetrix.recordEmptyMoatResponse()
-            else:
-                internalMetrix.recordHandoutsPerBridge(bridgeRequest, bridges)
+            with openmetrics.stage("metrics"):
+                if not bridgeLines:
+                    internalMetrix.recordEmptyMoatResponse()
+                else:
+                    internalMetrix.recordHandoutsPerBridge(bridgeRequest,
+                                                           bridges)
 
             if antibot.isRequestFromBot(request):
                 ttype = transport or "vanilla"
@@ -761,19 +826,77 @@ class CaptchaCheckResource(CaptchaResource):
             if not bridgeLines:
                 return self.failureResponse(6, request)
 
-            if include_qrcode:
-                qrjpeg = generateQR(bridgeLines)
-                if qrjpeg:
-                    qrcode = 'data:image/jpeg;base64,%s' % base64.b64encode(qrjpeg)
-
-            data["data"][0]["qrcode"] = qrcode
             data["data"][0]["bridges"] = bridgeLines
 
-            return self.formatDataForResponse(data, request)
+            if not include_qrcode:
+                return self.formatAnswer(None, data, request)
+
+            with openmetrics.stage("qrcode"):
+                d = qrcodes.getQRDataURI(bridgeLines)
+
+            if d.called:
+                # The QRCode was cached, so we can answer straight away.
+                return self.formatAnswer(d.result, data, request)
+
+            # Otherwise, it's being generated in a thread; answer once it's
+            # done, without holding up anyone else in the meantime.  We're
+            # still answering the request until then, so keep timing it.
+            resumed = openmetrics.pauseRequest()
+            finished = request.notifyFinish()
+            finished.addErrback(lambda failure: None)
+            d.addCallback(self.writeAnswer, data, request, resumed, finished)
+            return NOT_DONE_YET
         else:
             moatMetrix.recordInvalidMoatRequest(request)
             return self.failureResponse(4, request)
 
+    def formatAnswer(self, qrcode, data, request):
+        """Format the JSON API response to a client's request for bridges.
+
+        :type qrcode: str or ``None``
+        :param qrcode: The ``data:`` URI of the QRCode for the bridge lines in
+            the **data**, if the client asked for one.
+        :param dict data: The JSON API data to respond with.
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A ``Request`` object.
+        :rtype: bytes
+        :returns: The encoded JSON API response.
+        """
+        data["data"][0]["qrcode"] = qrcode
+        with openmetrics.stage("json"):
+            return self.formatDataForResponse(data, request)
+
+    def writeAnswer(self, qrcode, data, request, resumed, finished):
+        """Format the JSON API response to a client's request for bridges
+        once its QRCode has been generated, write it, and finish the
+        **request**.
+
+        :type qrcode: str or ``None``
+        :param qrcode: The ``data:`` URI of the QRCode for the bridge lines in
+            the **data**.
+        :param dict data: The JSON API data to respond with.
+        :type request: :api:`twisted.web.http.Request`
+        :param request: The ``Request`` to answer.
+        :param resumed: The context manager from
+            :func:`bridgedb.openmetrics.pauseRequest`, which finishes timing
+            the request.
+        :type finished: :api:`twisted.internet.defer.Deferred`
+        :param finished: The ``Deferred`` from the **request**'s
+            ``notifyFinish()``.  If it has fired, the client has gone away.
+        """
+        with resumed:
+            if finished.called:
+                logging.info("Client went away before their bridges were "
+                             "ready.")
+                return
+
+            rendered = self.formatAnswer(qrcode, data, request)
+            try:
+                request.write(rendered)
+                request.finish()
+            except Exception as err:  # pragma: no cover
+                logging.exception(err)
+
 
 def addMoatServer(config, distributor):
     """Set up a web server for moat bridge distribution.
@@ -782,6 +905,7 @@ def addMoatServer(config, distributor):
     :param config: A configuration object from
          :mod:`bridgedb.main`. Currently, we use these options::
              GIMP_CAPTCHA_DIR
+             GIMP_CAPTCHA_PRELOAD
              SERVER_PUBLIC_FQDN
              SUPPORTED_TRANSPORTS
              MOAT_DIST
@@ -824,6 +948,10 @@ def addMoatServer(config, distributor):
     hmacKey = crypto.getHMAC(captchaKey, "Moat-Captcha-Key")
     # Load or create our encryption keys:
     secretKey, publicKey = crypto.getRSAKey(config.MOAT_GIMP_CAPTCHA_RSA_KEYFILE)
+    # Index the CAPTCHAs now, rather than when the first client asks:
+    pool = getCaptchaPool(config.GIMP_CAPTCHA_DIR,
+                          config.GIMP_CAPTCHA_PRELOAD)
+    pool.startRefreshing()
     sched = Unscheduled()
 
     if config.MOAT_ROTATION_PERIOD:
@@ -836,7 +964,7 @@ def addMoatServer(config, distributor):
     moat = CustomErrorHandlingResource()
     fetch = CaptchaFetchResource(hmacKey, publicKey, secretKey,
                                  config.GIMP_CAPTCHA_DIR,
-                                 fwdHeaders, skipLoopback)
+                                 fwdHeaders, skipLoopback, pool)
     check = CaptchaCheckResource(distributor, sched, numBridges,
                                  hmacKey, publicKey, secretKey,
                                  fwdHeaders, skipLoopback)
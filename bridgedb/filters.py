@@ -44,13 +44,21 @@ def bySubring(hmac, assigned, total):
     logging.debug(("Creating a filter for assigning bridges to subhashring "
                    "%s-of-%s...") % (assigned, total))
 
-    name = "-".join([binascii.hexlify(str(hmac("")[:8]).encode('utf-8')).decode('utf-8'),
+    # Don't put the HMAC of "" into a shared position cache:
+    uncached = getattr(hmac, "uncached", hmac)
+    name = "-".join([binascii.hexlify(str(uncached("")[:8]).encode('utf-8')).decode('utf-8'),
                      str(assigned), "of", str(total)])
     try:
         return _cache[name]
     except KeyError:
+        # Functions from getHMACFunc() can give us the integer prefix of the
+        # HMAC directly (and from the shared position cache, if they use it):
+        prefix = getattr(hmac, "prefix", None)
+        if prefix is None:
+            prefix = lambda value: int(hmac(value)[:8], 16)
+
         def _bySubring(bridge):
-            position = int(hmac(bridge.identity)[:8], 16)
+            position = prefix(bridge.identity)
             which = (position % total) + 1
             return True if which == assigned else False
         # The `description` attribute must contain an `=`, or else
@@ -27,6 +27,7 @@ from bridgedb import runner
 from bridgedb import util
 from bridgedb import metrics
 from bridgedb import antibot
+from bridgedb import openmetrics
 from bridgedb.bridges import MalformedBridgeInfo
 from bridgedb.bridges import MissingServerDescriptorDigest
 from bridgedb.bridges import ServerDescriptorDigestMismatch
@@ -91,7 +92,7 @@ def writeMetrics(filename, measurementInterval):
     except IOError as err:
         logging.error("Failed to write metrics to '%s': %s" % (filename, err))
 
-def load(state, hashring, clear=False):
+def load(state, hashring, clear=False, incremental=False):
     """Read and parse all descriptors, and load into a bridge hashring.
 
     Read all the appropriate bridge files from the saved
@@ -104,6 +105,13 @@ def load(state, hashring, clear=False):
         Bridges in order to assign them to hashrings.
     :param boolean clear: If True, clear all previous bridges from the
         hashring before parsing for new ones.
+    :param boolean incremental: If True, the **hashring** already holds the
+        bridges from a previous load, and only the bridges which were added,
+        removed, or changed since then are touched (see
+        :meth:`~bridgedb.bridgerings.BridgeSplitter.update`).  Because it
+        affects which subrings they belong in, blocking info is loaded onto
+        the bridges before the hashring is updated, so
+        :func:`loadBlockedBridges` should not be called afterwards.
     """
     if not state:
         logging.fatal("bridgedb.main.load() could not retrieve state!")
@@ -115,10 +123,32 @@ def load(state, hashring, clear=False):
 
     logging.info("Loading bridges...")
 
+    identities = set()
+    current = {}
     ignoreNetworkstatus = state.IGNORE_NETWORKSTATUS
     if ignoreNetworkstatus:
         logging.info("Ignoring BridgeAuthority networkstatus documents.")
 
+    # If we have more than one process to parse with, parse all the files
+    # from all the BridgeAuthorities up front, in parallel:
+    processes = getattr(state, 'DESCRIPTOR_PARSE_PROCESSES', 1)
+    parallel = processes is None or processes > 1
+    fastNetworkstatus = getattr(state, 'FAST_NETWORKSTATUS_PARSER', False)
+    if parallel:
+        files = []
+        for auth in state.BRIDGE_AUTHORITY_DIRECTORIES:
+            if not fastNetworkstatus:
+                files.append((descriptors.NETWORKSTATUS,
+                              expandBridgeAuthDir(auth, state.STATUS_FILE)))
+            files.extend([(descriptors.SERVER_DESCRIPTOR,
+                           expandBridgeAuthDir(auth, fn))
+                          for fn in state.BRIDGE_FILES])
+            files.extend([(descriptors.EXTRA_INFO,
+                           expandBridgeAuthDir(auth, fn))
+                          for fn in state.EXTRA_INFO_FILES])
+        parsed = dict(zip(files, descriptors.parseDescriptorFiles(files,
+                                                                  processes)))
+
     for auth in state.BRIDGE_AUTHORITY_DIRECTORIES:
         logging.info("Processing descriptors in %s directory..." % auth)
 
@@ -126,9 +156,18 @@ def load(state, hashring, clear=False):
         timestamps = {}
 
         fn = expandBridgeAuthDir(auth, state.STATUS_FILE)
-        logging.info("Opening networkstatus file: %s" % fn)
-        networkstatuses = descriptors.parseNetworkStatusFile(fn)
-        logging.debug("Closing networkstatus file: %s" % fn)
+        if fastNetworkstatus:
+            networkstatuses = descriptors.parseNetworkStatusFileFast(fn)
+        elif parallel:
+            networkstatuses = parsed.pop((descriptors.NETWORKSTATUS, fn), [])
+        else:
+            # The bridges keep the descriptors which they were created from,
+            # so only give them the (much smaller) parts which they use:
+            logging.info("Opening networkstatus file: %s" % fn)
+            networkstatuses = [
+                descriptors.NetworkStatusRecord.fromDescriptor(router)
+                for router in descriptors.parseNetworkStatusFile(fn)]
+            logging.debug("Closing networkstatus file: %s" % fn)
 
         logging.info("Processing networkstatus descriptors...")
         for router in networkstatuses:
@@ -143,9 +182,14 @@ def load(state, hashring, clear=False):
 
         for filename in state.BRIDGE_FILES:
             fn = expandBridgeAuthDir(auth, filename)
-            logging.info("Opening bridge-server-descriptor file: '%s'" % fn)
-            serverdescriptors = descriptors.parseServerDescriptorsFile(fn)
-            logging.debug("Closing bridge-server-descriptor file: '%s'" % fn)
+            if parallel:
+                serverdescriptors = parsed.pop((descriptors.SERVER_DESCRIPTOR, fn), [])
+            else:
+                # Parse the descriptors one at a time, as we use them:
+                logging.info("Opening bridge-server-descriptor file: '%s'" % fn)
+                serverdescriptors = map(
+                    descriptors.ServerDescriptorRecord.fromDescriptor,
+                    descriptors.iterServerDescriptorsFile(fn))
 
             for router in serverdescriptors:
                 try:
@@ -183,7 +227,14 @@ def load(state, hashring, clear=False):
                         timestamps[bridge.fingerprint] = [router.published]
 
         eifiles = [expandBridgeAuthDir(auth, fn) for fn in state.EXTRA_INFO_FILES]
-        extrainfos = descriptors.parseExtraInfoFiles(*eifiles)
+        if parallel:
+            extrainfos = descriptors.deduplicate(
+                router for fn in eifiles
+                for router in parsed.pop((descriptors.EXTRA_INFO, fn), []))
+        else:
+            extrainfos = descriptors.deduplicate(
+                map(descriptors.ExtraInfoRecord.fromDescriptor,
+                    descriptors.iterExtraInfoFiles(*eifiles)))
         for fingerprint, router in extrainfos.items():
             try:
                 bridges[fingerprint].updateFromExtraInfoDescriptor(router)
@@ -196,7 +247,7 @@ def load(state, hashring, clear=False):
 
         blacklist = parseBridgeBlacklistFile(state.NO_DISTRIBUTION_FILE)
 
-        inserted = 0
+        toInsert = []
         logging.info("Trying to insert %d bridges into hashring, %d of which "
                      "have the 'Running' flag..." % (len(bridges),
                      len(list(filter(lambda b: b.flags.running, bridges.values())))))
@@ -219,16 +270,30 @@ def load(state, hashring, clear=False):
             else:
                 # If the bridge is not running, then it is skipped during the
                 # insertion process.
-                hashring.insert(bridge)
-                inserted += 1
-        logging.info("Tried to insert %d bridges into hashring.  Resulting "
-                     "hashring is of length %d." % (inserted, len(hashring)))
+                toInsert.append(bridge)
+
+        if incremental:
+            current.update([(bridge.fingerprint, bridge) for bridge in toInsert])
+        else:
+            hashring.insertMany(toInsert)
+            logging.info("Tried to insert %d bridges into hashring.  Resulting "
+                         "hashring is of length %d." % (len(toInsert), len(hashring)))
+        identities.update([bridge.identity for bridge in bridges.values()])
 
         if state.COLLECT_TIMESTAMPS:
             reactor.callInThread(updateBridgeHistory, bridges, timestamps)
 
         state.save()
 
+    if incremental:
+        setBlockedBridges(current.values())
+        hashring.update(current.values())
+        logging.info("Updated hashring with %d bridges.  Resulting hashring "
+                     "is of length %d." % (len(current), len(hashring)))
+
+    # Forget the cached hashring positions of bridges which have gone away:
+    crypto.positionCache.retain(identities)
+
 def _reloadFn(*args):
     """Placeholder callback function for :func:`_handleSIGHUP`."""
     return True
@@ -241,6 +306,26 @@ def replaceBridgeRings(current, replacement):
     """Replace the current thing with the new one"""
     current.hashring = replacement.hashring
 
+def getHashringLayout(cfg, proxyList):
+    """Get the configuration settings which decide the structure of the
+    hashrings made by :func:`createBridgeRings`, as opposed to which bridges
+    go into them.
+
+    A hashring can only be kept (and updated) across a reload if its layout
+    hasn't changed; otherwise, it must be rebuilt from scratch.
+
+    :type cfg:  :class:`Conf`
+    :param cfg: The current configuration.
+    :type proxyList: :class:`~bridgedb.proxy.ProxySet`
+    :param proxyList: The container for the IP addresses of any currently
+        known open proxies.
+    :rtype: tuple
+    """
+    return (cfg.MOAT_DIST, cfg.MOAT_SHARE, cfg.MOAT_N_IP_CLUSTERS,
+            cfg.HTTPS_DIST, cfg.HTTPS_SHARE, cfg.N_IP_CLUSTERS,
+            cfg.EMAIL_DIST, cfg.EMAIL_SHARE, cfg.RESERVED_SHARE,
+            cfg.FORCE_PORTS, cfg.FORCE_FLAGS, bool(proxyList))
+
 def createBridgeRings(cfg, proxyList, key):
     """Create the bridge distributors defined by the config file
 
@@ -276,7 +361,8 @@ def createBridgeRings(cfg, proxyList, key):
             cfg.MOAT_N_IP_CLUSTERS,
             crypto.getHMAC(key, "Moat-Dist-Key"),
             proxyList,
-            answerParameters=ringParams)
+            answerParameters=ringParams,
+            cachedRingsPerSubring=cfg.MOAT_CACHED_RINGS_PER_SUBRING)
         hashring.addRing(moatDistributor.hashring, "moat", cfg.MOAT_SHARE)
 
     # As appropriate, create an IP-based distributor.
@@ -286,7 +372,8 @@ def createBridgeRings(cfg, proxyList, key):
             cfg.N_IP_CLUSTERS,
             crypto.getHMAC(key, "HTTPS-IP-Dist-Key"),
             proxyList,
-            answerParameters=ringParams)
+            answerParameters=ringParams,
+            cachedRingsPerSubring=cfg.HTTPS_CACHED_RINGS_PER_SUBRING)
         hashring.addRing(ipDistributor.hashring, "https", cfg.HTTPS_SHARE)
 
     # As appropriate, create an email-based distributor.
@@ -297,7 +384,8 @@ def createBridgeRings(cfg, proxyList, key):
             cfg.EMAIL_DOMAIN_MAP.copy(),
             cfg.EMAIL_DOMAIN_RULES.copy(),
             answerParameters=ringParams,
-            whitelist=cfg.EMAIL_WHITELIST.copy())
+            whitelist=cfg.EMAIL_WHITELIST.copy(),
+            maxCachedRings=cfg.EMAIL_MAX_CACHED_RINGS)
         hashring.addRing(emailDistributor.hashring, "email", cfg.EMAIL_SHARE)
 
     # As appropriate, tell the hashring to leave some bridges unallocated.
@@ -308,27 +396,45 @@ def createBridgeRings(cfg, proxyList, key):
 
     return hashring, emailDistributor, ipDistributor, moatDistributor
 
-def loadBlockedBridges(hashring):
-    """Load bridge blocking info from our SQL database and add it to bridge
-    objects."""
+def setBlockedBridges(bridges):
+    """Load bridge blocking info from our SQL database and add it to
+    **bridges**.
 
+    :param bridges: An iterable of :class:`~bridgedb.bridges.Bridge`s.
+    :rtype: int
+    :returns: The number of **bridges** which are blocked somewhere.
+    """
     blockedBridges = {}
     with bridgedb.Storage.getDB() as db:
         blockedBridges = db.getBlockedBridges()
+        # Remember which measurements we've read, so we needn't read them again:
+        db.commit()
 
     num_blocked = 0
+    for bridge in bridges:
+        l = []
+        try:
+            l = blockedBridges[bridge.fingerprint]
+        except KeyError:
+            continue
+        for blocking_country, address, port in l:
+            bridge.setBlockedIn(blocking_country, address, port)
+        # Summarise it now, rather than in the middle of answering a client:
+        bridge.buildBlockingIndex()
+        num_blocked += 1
+
+    return num_blocked
+
+def loadBlockedBridges(hashring):
+    """Load bridge blocking info from our SQL database and add it to bridge
+    objects."""
+
+    bridges = []
     for name, ring in hashring.ringsByName.items():
         if name == "unallocated":
             continue
-        for _, bridge in ring.bridges.items():
-            l = []
-            try:
-                l = blockedBridges[bridge.fingerprint]
-            except KeyError:
-                continue
-            for blocking_country, address, port in l:
-                bridge.setBlockedIn(blocking_country, address, port)
-            num_blocked += 1
+        bridges.extend(ring.bridges.values())
+    num_blocked = setBlockedBridges(bridges)
 
     logging.info("Loaded blocking info for %d bridges.".format(num_blocked))
 
@@ -401,11 +507,17 @@ def run(options, reactor=reactor):
 
     # Load the master key, or create a new one.
     key = crypto.getKey(config.MASTER_KEY_FILE)
+    crypto.positionCache.setMasterKey(key)
     proxies = proxy.ProxySet()
     emailDistributor = None
     ipDistributor = None
     moatDistributor = None
 
+    # The hashring (and its layout) which the distributors are currently
+    # using, so that the next reload only needs to apply what has changed:
+    liveHashring = None
+    liveLayout = None
+
     # Save our state
     state.key = key
     state.save()
@@ -428,6 +540,11 @@ def run(options, reactor=reactor):
         :ivar hashring: A class which takes an HMAC key and splits bridges
             into their hashring assignments.
         """
+        nonlocal liveHashring, liveLayout
+
+        phase = openmetrics.RELOAD_PHASE_DURATION.time
+        started = time.monotonic()
+
         logging.debug("Caught SIGHUP")
         logging.info("Reloading...")
 
@@ -443,9 +560,11 @@ def run(options, reactor=reactor):
         logging.getLogger().setLevel(level)
 
         logging.info("Reloading the list of open proxies...")
-        for proxyfile in cfg.PROXY_LIST_FILES:
-            logging.info("Loading proxies from: %s" % proxyfile)
-            proxy.loadProxiesFromFile(proxyfile, proxies, removeStale=True)
+        with phase("proxies"):
+            for proxyfile in cfg.PROXY_LIST_FILES:
+                logging.info("Loading proxies from: %s" % proxyfile)
+                proxy.loadProxiesFromFile(proxyfile, proxies,
+                                          removeStale=True)
         metrics.setProxies(proxies)
 
         state.BLACKLISTED_TOR_VERSIONS = parseVersionsList(state.BLACKLISTED_TOR_VERSIONS)
@@ -455,35 +574,57 @@ def run(options, reactor=reactor):
         logging.info("Reloading decoy bridges...")
         antibot.loadDecoyBridges(config.DECOY_BRIDGES_FILE)
 
-        (hashring,
-         emailDistributorTmp,
-         ipDistributorTmp,
-         moatDistributorTmp) = createBridgeRings(cfg, proxies, key)
+        with phase("hashrings"):
+            (hashring,
+             emailDistributorTmp,
+             ipDistributorTmp,
+             moatDistributorTmp) = createBridgeRings(cfg, proxies, key)
+
+            # If the hashrings are laid out as before, start from copies of
+            # the ones which the distributors are using, and only apply the
+            # changes to them.  The distributors keep using the old ones until
+            # the copies are swapped in below.
+            layout = getHashringLayout(cfg, proxies)
+            incremental = False
+            if liveHashring is not None and layout == liveLayout:
+                try:
+                    hashring.copyFrom(liveHashring)
+                except ValueError as error:
+                    logging.warn(str(error))
+                else:
+                    incremental = True
+        if not incremental:
+            logging.info("Rebuilding all hashrings from scratch.")
 
         # Initialize our DB.
         bridgedb.Storage.initializeDBLock()
         bridgedb.Storage.setDBFilename(cfg.DB_FILE + ".sqlite")
         logging.info("Reparsing bridge descriptors...")
-        load(state, hashring, clear=False)
+        with phase("descriptors"):
+            load(state, hashring, clear=False, incremental=incremental)
         logging.info("Bridges loaded: %d" % len(hashring))
-        loadBlockedBridges(hashring)
+        if not incremental:
+            with phase("blocked"):
+                loadBlockedBridges(hashring)
 
-        if emailDistributorTmp is not None:
-            emailDistributorTmp.prepopulateRings() # create default rings
-        else:
-            logging.warn("No email distributor created!")
+        with phase("prepopulate"):
+            if emailDistributorTmp is not None:
+                emailDistributorTmp.prepopulateRings() # create default rings
+            else:
+                logging.warn("No email distributor created!")
 
-        if ipDistributorTmp is not None:
-            ipDistributorTmp.prepopulateRings() # create default rings
-        else:
-            logging.warn("No HTTP(S) distributor created!")
+            if ipDistributorTmp is not None:
+                ipDistributorTmp.prepopulateRings() # create default rings
+            else:
+                logging.warn("No HTTP(S) distributor created!")
 
-        if moatDistributorTmp is not None:
-            moatDistributorTmp.prepopulateRings()
-        else:
-            logging.warn("No Moat distributor created!")
+            if moatDistributorTmp is not None:
+                moatDistributorTmp.prepopulateRings()
+            else:
+                logging.warn("No Moat distributor created!")
 
         metrix = metrics.InternalMetrics()
+        openmetrics.RING_BRIDGES.clear()
         logging.info("Logging bridge ring metrics for %d rings." %
                      len(hashring.ringsByName))
         for ringName, ring in hashring.ringsByName.items():
@@ -496,13 +637,23 @@ def run(options, reactor=reactor):
                     metrix.recordBridgesInHashring(ringName,
                                                    subRingName,
                                                    len(subring))
+                    openmetrics.RING_BRIDGES.set(len(subring), ringName,
+                                                 subRingName)
             elif hasattr(ring, "fingerprints"):
                 metrix.recordBridgesInHashring(ringName, "unallocated",
                                                len(ring.fingerprints))
+                openmetrics.RING_BRIDGES.set(len(ring.fingerprints), ringName,
+                                             "unallocated")
 
         # Dump bridge pool assignments to disk.
-        writeAssignments(hashring, state.ASSIGNMENTS_FILE)
+        with phase("assignments"):
+            writeAssignments(hashring, state.ASSIGNMENTS_FILE)
         state.save()
+        openmetrics.RELOAD_PHASE_DURATION.observe(time.monotonic() - started,
+                                                  "total")
+
+        liveHashring = hashring
+        liveLayout = layout
 
         if inThread:
             # XXX shutdown the distributors if they were previously running
@@ -536,8 +687,12 @@ def run(options, reactor=reactor):
             addWebServer(config, ipDistributor)
         if config.EMAIL_DIST and config.EMAIL_SHARE:
             addSMTPServer(config, emailDistributor)
+        if config.METRICS_HTTP_PORT:
+            openmetrics.addMetricsServer(config)
 
         metrics.setSupportedTransports(config.SUPPORTED_TRANSPORTS)
+        openmetrics.setSlowRequestLog(config.SLOW_REQUEST_BUDGET,
+                                      config.SLOW_REQUEST_SAMPLE_RATE)
 
         tasks = {}
 
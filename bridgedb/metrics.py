@@ -13,15 +13,16 @@
 over time.
 """
 
+import array
 import logging
 import ipaddr
 import operator
 import json
 import datetime
-import statistics
 import numpy
 
 from bridgedb import geo
+from bridgedb import openmetrics
 from bridgedb.distributors.common.http import getClientIP
 from bridgedb.distributors.email import request
 
@@ -311,8 +312,18 @@ class InternalMetrics(Metrics):
     def __init__(self):
         super(InternalMetrics, self).__init__()
         self.keyPrefix = "internal"
-        # Maps bridges to the number of time they have been handed out.
-        self.bridgeHandouts = {}
+        # The number of times each bridge has been handed out, indexed by
+        # handoutIndices.
+        self.bridgeHandouts = array.array('L')
+        # Maps the type of bridge requested (its pluggable transport, or
+        # ``None`` for vanilla bridges, and its IP version) to a dictionary
+        # which maps bridge fingerprints to indices in bridgeHandouts.  We
+        # cannot use the bridge objects because BridgeDB reloads its
+        # descriptors every 30 minutes, at which points the bridge objects
+        # change.
+        self.handoutIndices = {}
+        # The (bridge type, fingerprint) for each index in bridgeHandouts.
+        self.handoutKeys = []
 
         # There's no reason for the following metrics to be sanitised.
         handoutsPrefix = "{}.handouts".format(self.keyPrefix)
@@ -325,19 +336,28 @@ class InternalMetrics(Metrics):
         self.doNotSanitise("{}.lower-whisker".format(handoutsPrefix))
         self.doNotSanitise("{}.upper-whisker".format(handoutsPrefix))
 
+    def rotate(self):
+        """Calculate our handout statistics, and rotate our metrics."""
+
+        self.updateHandoutStatistics()
+        super(InternalMetrics, self).rotate()
+
     def reset(self):
         """Reset bridge handouts after each interval."""
 
         # Log the bridge that has seen the most handouts.  This helps us
         # understand BridgeDB better.
-        items = self.bridgeHandouts.items()
-        if len(items):
-            bridgeLine, num = sorted(items, key=lambda x: x[1],
-                                     reverse=True)[0]
-            logging.debug("Bridge line with most handouts (%d): %s" %
-                          (num, bridgeLine))
-
-        self.bridgeHandouts = {}
+        if len(self.bridgeHandouts):
+            values = numpy.array(self.bridgeHandouts)
+            i = int(values.argmax())
+            (transport, ipVersion), fingerprint = self.handoutKeys[i]
+            logging.debug("Bridge with most handouts (%d): %s (%s, IPv%s)" %
+                          (values[i], fingerprint, transport or "vanilla",
+                           ipVersion))
+
+        self.bridgeHandouts = array.array('L')
+        self.handoutIndices = {}
+        self.handoutKeys = []
 
     def _recordEmptyResponse(self, distributor):
         """
@@ -356,12 +376,38 @@ class InternalMetrics(Metrics):
     def recordEmptyMoatResponse(self):
         self._recordEmptyResponse("moat")
 
+    def _recordRingCacheEvent(self, distributor, event):
+        """
+        Record a lookup in, or an eviction from, a distributor's cache of
+        filtered subrings.
+
+        :param str distributor: A bridge distributor, e.g., "HTTPS".
+        :param str event: One of "hits", "misses", or "evictions".
+        """
+        distributor = (distributor or "unknown").lower()
+        key = "{}.{}.ring-cache.{}".format(self.keyPrefix, distributor, event)
+        # These are counts of our own cache's behaviour, not of clients, so
+        # there's no reason to sanitise them.
+        self.doNotSanitise(key)
+        self.inc(key)
+        openmetrics.RING_CACHE_EVENTS.inc(distributor, event)
+
+    def recordRingCacheHit(self, distributor):
+        self._recordRingCacheEvent(distributor, "hits")
+
+    def recordRingCacheMiss(self, distributor):
+        self._recordRingCacheEvent(distributor, "misses")
+
+    def recordRingCacheEviction(self, distributor):
+        self._recordRingCacheEvent(distributor, "evictions")
+
     def recordHandoutsPerBridge(self, bridgeRequest, bridges):
         """
         Record how often a given bridge was handed out.
 
         Note that bridges that were not handed out will not be part of these
-        metrics.
+        metrics.  The statistics about them are calculated by
+        :meth:`updateHandoutStatistics`.
 
         :type bridgeRequest: :api:`bridgerequest.BridgeRequestBase`
         :param bridgeRequest: A bridge request for either one of our
@@ -384,43 +430,55 @@ class InternalMetrics(Metrics):
         else:
             self.inc("{}.ipv{}".format(handoutsPrefix, ipVersion))
 
-        # Keep track of how many times we're handing out a given bridge.
+        # Keep track of how many times we're handing out a given bridge, of
+        # the requested type.
+        bridgeType = (bridgeRequest.justOnePTType(), ipVersion)
+        indices = self.handoutIndices.get(bridgeType)
+        if indices is None:
+            indices = self.handoutIndices[bridgeType] = {}
+        handouts = self.bridgeHandouts
         for bridge in bridges:
-            # Use bridge lines as dictionary key.  We cannot use the bridge
-            # objects because BridgeDB reloads its descriptors every 30
-            # minutes, at which points the bridge objects change.
-            key = bridge.getBridgeLine(bridgeRequest)
-            num = self.bridgeHandouts.get(key, None)
-            if num is None:
-                self.bridgeHandouts[key] = 1
+            i = indices.get(bridge.fingerprint)
+            if i is None:
+                indices[bridge.fingerprint] = len(handouts)
+                self.handoutKeys.append((bridgeType, bridge.fingerprint))
+                handouts.append(1)
             else:
-                self.bridgeHandouts[key] = num + 1
+                handouts[i] += 1
+
+    def updateHandoutStatistics(self):
+        """Calculate statistics about how often each bridge was handed out.
+
+        This is done when our metrics are rotated, rather than for each
+        request, because it takes time proportional to the number of bridges
+        which have been handed out.
+        """
+
+        handoutsPrefix = "{}.handouts".format(self.keyPrefix)
 
         # We need more than two handouts to calculate our statistics.
-        values = self.bridgeHandouts.values()
-        if len(values) <= 2:
+        if len(self.bridgeHandouts) <= 2:
             return
+        values = numpy.array(self.bridgeHandouts)
 
-        # Update our statistics.
         self.set("{}.median".format(handoutsPrefix),
-                 statistics.median(values))
-        self.set("{}.min".format(handoutsPrefix), min(values))
-        self.set("{}.max".format(handoutsPrefix), max(values))
-        self.set("{}.unique-bridges".format(handoutsPrefix),
-                 len(self.bridgeHandouts))
+                 float(numpy.median(values)))
+        self.set("{}.min".format(handoutsPrefix), int(values.min()))
+        self.set("{}.max".format(handoutsPrefix), int(values.max()))
+        self.set("{}.unique-bridges".format(handoutsPrefix), len(values))
         # Python 3.8 comes with a statistics.quantiles function, which we
         # should use instead of numpy once 3.8 is available in Debian stable.
-        q1, q3 = numpy.quantile(numpy.array(list(values)), [0.25, 0.75])
+        q1, q3 = numpy.quantile(values, [0.25, 0.75])
         self.set("{}.quartile1".format(handoutsPrefix), q1)
         self.set("{}.quartile3".format(handoutsPrefix), q3)
         # Determine our inter-quartile range (the difference between quartile 3
         # and quartile 1) and use it to calculate the upper and lower whiskers
         # as you would see them in a boxplot.
         iqr = q3 - q1
-        lowerWhisker = min([x for x in values if x >= q1 - (1.5 * iqr)])
-        upperWhisker = max([x for x in values if x <= q3 + (1.5 * iqr)])
-        self.set("{}.lower-whisker".format(handoutsPrefix), lowerWhisker)
-        self.set("{}.upper-whisker".format(handoutsPrefix), upperWhisker)
+        lowerWhisker = values[values >= q1 - (1.5 * iqr)].min()
+        upperWhisker = values[values <= q3 + (1.5 * iqr)].max()
+        self.set("{}.lower-whisker".format(handoutsPrefix), int(lowerWhisker))
+        self.set("{}.upper-whisker".format(handoutsPrefix), int(upperWhisker))
 
     def recordBridgesInHashring(self, ringName, subRingName, numBridges):
         """
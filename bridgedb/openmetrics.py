@@ -0,0 +1,642 @@
+# -*- coding: utf-8 ; test-case-name: bridgedb.test.test_openmetrics ; -*-
+# _____________________________________________________________________________
+#
+# This file is part of BridgeDB, a Tor bridge distribution system.
+#
+# :authors: please see included AUTHORS file
+# :copyright: (c) 2007-2017, The Tor Project, Inc.
+# :license: see LICENSE for licensing information
+# _____________________________________________________________________________
+
+"""Live counters, gauges, and histograms of BridgeDB's own performance, which
+can be served in the `Prometheus text format`_ from a local HTTP endpoint.
+
+Unlike :mod:`bridgedb.metrics`, which exports binned and sanitised counts of
+client requests every ``EXPORT_METRICS`` interval, these describe BridgeDB
+itself (how long things take, how often caches are hit, and so on), and are
+available as soon as they are recorded.  Nothing here is about clients, so
+there's nothing to sanitise.
+
+Each metric keeps a lock of its own, so recording is safe from any thread, and
+cheap.  The endpoint is only started if ``METRICS_HTTP_PORT`` is set; see
+:func:`addMetricsServer`.
+
+The stages of answering a request for bridges are timed with a
+:class:`RequestTimer`, and code which runs while answering one can time its
+own stages with :func:`stage`.  Requests which take longer than
+``SLOW_REQUEST_BUDGET`` seconds are logged; see :func:`setSlowRequestLog`.
+
+.. _Prometheus text format:
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.web import resource
+from twisted.web.server import Site
+
+from bridgedb import safelog
+
+
+#: The ``Content-Type`` of a rendered :class:`Registry`.
+CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
+
+#: The default upper bounds, in seconds, of the buckets of a
+#: :class:`Histogram`.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escapeLabelValue(value):
+    """Escape a label value for the Prometheus text format.
+
+    :param value: The value of a label.
+    :rtype: str
+    """
+    value = str(value).replace('\\', '\\\\')
+    return value.replace('\n', '\\n').replace('"', '\\"')
+
+
+def _formatLabels(labelNames, labelValues, extra=None):
+    """Format some labels as ``{name="value",...}``.
+
+    :param tuple labelNames: The names of the labels.
+    :param tuple labelValues: The values of the labels, in the same order.
+    :param tuple extra: Another (name, value) pair to add at the end, if any.
+    :rtype: str
+    """
+    pairs = list(zip(labelNames, labelValues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, _escapeLabelValue(value))
+                              for name, value in pairs])
+
+
+def _sortKey(item):
+    """Sort the (labels, value) items of a :class:`Metric` by their labels."""
+    return tuple(map(str, item[0]))
+
+
+def _formatValue(value):
+    """Format a sample value for the Prometheus text format.
+
+    :rtype: str
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    """A metric, with a value for each combination of its labels.
+
+    :ivar str name: The name of the metric.
+    :ivar str documentation: A description of the metric.
+    :ivar tuple labelNames: The names of the metric's labels, if any.
+    """
+
+    #: The type of the metric, as given in the ``# TYPE`` line.
+    metricType = "untyped"
+
+    #: Appended to :attr:`name` in the ``# HELP`` and ``# TYPE`` lines, so
+    #: that they name the same metric as the samples.
+    familySuffix = ""
+
+    def __init__(self, name, documentation, labelNames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _checkLabels(self, labels):
+        if len(labels) != len(self.labelNames):
+            raise ValueError("Metric %s takes labels %r, not %r"
+                             % (self.name, self.labelNames, labels))
+
+    def clear(self):
+        """Forget all values of this metric."""
+        with self._lock:
+            self._values = {}
+
+    def get(self, *labels):
+        """Get the value of this metric for some **labels**.
+
+        :returns: The value, or ``None`` if nothing was recorded.
+        """
+        with self._lock:
+            return self._values.get(labels)
+
+    def samples(self):
+        """Get the samples of this metric.
+
+        :rtype: list
+        :returns: A list of (suffix, labels, value) tuples.
+        """
+        with self._lock:
+            values = sorted(self._values.items(), key=_sortKey)
+        return [("", labels, value) for labels, value in values]
+
+    def render(self):
+        """Render this metric in the Prometheus text format.
+
+        :rtype: list
+        :returns: A list of lines.
+        """
+        family = self.name + self.familySuffix
+        lines = ["# HELP %s %s" % (family, self.documentation),
+                 "# TYPE %s %s" % (family, self.metricType)]
+        for suffix, labels, value in self.samples():
+            if len(labels) > len(self.labelNames):
+                labelText = _formatLabels(self.labelNames, labels[:-1],
+                                          labels[-1])
+            else:
+                labelText = _formatLabels(self.labelNames, labels)
+            lines.append("%s%s%s %s" % (self.name, suffix, labelText,
+                                        _formatValue(value)))
+        return lines
+
+
+class Counter(Metric):
+    """A count which only goes up."""
+
+    metricType = "counter"
+    familySuffix = "_total"
+
+    def inc(self, *labels, amount=1):
+        """Add **amount** to the count for some **labels**."""
+        self._checkLabels(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        return [("_total", labels, value)
+                for _, labels, value in super(Counter, self).samples()]
+
+
+class Gauge(Metric):
+    """A value which may go up and down.
+
+    A gauge may also be given a function with :meth:`setFunction`, which is
+    called to get its value whenever it is rendered.
+    """
+
+    metricType = "gauge"
+
+    def __init__(self, name, documentation, labelNames=()):
+        super(Gauge, self).__init__(name, documentation, labelNames)
+        self._function = None
+
+    def set(self, value, *labels):
+        """Set the value for some **labels**."""
+        self._checkLabels(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def setFunction(self, function):
+        """Get the value of this (unlabelled) gauge by calling **function**
+        whenever it is rendered.
+
+        :param callable function: A function which takes no arguments, and
+            returns a number.  If ``None``, stop calling the last one.
+        """
+        self._function = function
+
+    def samples(self):
+        function = self._function
+        if function is not None:
+            try:
+                return [("", (), function())]
+            except Exception as error:
+                logging.warn("Couldn't get the value of %s: %s"
+                             % (self.name, error))
+                return []
+        return super(Gauge, self).samples()
+
+
+class _Timer(object):
+    """A context manager which records how long its context took in a
+    :class:`Histogram`.
+    """
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, *self.labels)
+
+
+class Histogram(Metric):
+    """Counts of observations (usually durations, in seconds) in buckets.
+
+    :ivar tuple buckets: The upper bounds of the buckets, in increasing order.
+        There's always a last, infinite one.
+    """
+
+    metricType = "histogram"
+
+    def __init__(self, name, documentation, labelNames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, *labels):
+        """Record an observation of **value** for some **labels**."""
+        self._checkLabels(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # The count in each bucket, then the sum of all observations.
+                state = self._values[labels] = [0] * len(self.buckets) + [0]
+            state[i] += 1
+            state[-1] += value
+
+    def time(self, *labels):
+        """Get a context manager which observes how many seconds its context
+        took, for some **labels**.
+        """
+        self._checkLabels(labels)
+        return _Timer(self, labels)
+
+    def get(self, *labels):
+        """Get the number of observations, and their sum, for some
+        **labels**.
+
+        :rtype: tuple
+        :returns: (count, sum), or ``None`` if nothing was observed.
+        """
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                return
+            return (sum(state[:-1]), state[-1])
+
+    def samples(self):
+        with self._lock:
+            values = sorted([(labels, list(state))
+                             for labels, state in self._values.items()],
+                            key=_sortKey)
+        samples = []
+        for labels, state in values:
+            count = 0
+            for bound, n in zip(self.buckets, state):
+                count += n
+                samples.append(("_bucket", labels + (("le", _formatValue(bound)),),
+                                count))
+            samples.append(("_sum", labels, state[-1]))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class Registry(object):
+    """All the metrics which we serve."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a **metric** to be rendered, and return it."""
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """Forget all values of all metrics (necessary for unit tests)."""
+        for metric in list(self.metrics):
+            metric.clear()
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        lines = []
+        for metric in list(self.metrics):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+#: The :class:`Registry` of all of BridgeDB's metrics.
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "bridgedb_request_duration_seconds",
+    "How long it took to answer requests for bridges.",
+    ("distributor",)))
+
+RING_CACHE_EVENTS = REGISTRY.register(Counter(
+    "bridgedb_ring_cache_events",
+    "Lookups in, and evictions from, each distributor's cache of filtered "
+    "subrings.",
+    ("distributor", "event")))
+
+RING_BRIDGES = REGISTRY.register(Gauge(
+    "bridgedb_ring_bridges",
+    "The number of bridges in each hashring and subring, as of the last "
+    "reload.",
+    ("ring", "subring")))
+
+RELOAD_PHASE_DURATION = REGISTRY.register(Histogram(
+    "bridgedb_reload_phase_duration_seconds",
+    "How long each phase of reloading the bridges took.",
+    ("phase",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+             600.0)))
+
+DB_LOCK_WAIT = REGISTRY.register(Histogram(
+    "bridgedb_db_lock_wait_seconds",
+    "How long threads waited for the database lock."))
+
+CAPTCHA_DURATION = REGISTRY.register(Histogram(
+    "bridgedb_captcha_duration_seconds",
+    "How long it took to generate or verify CAPTCHAs.",
+    ("captcha", "operation")))
+
+THREADPOOL_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "bridgedb_threadpool_queue_depth",
+    "The number of calls waiting for a thread in the reactor's threadpool."))
+
+THREADPOOL_WORKERS_BUSY = REGISTRY.register(Gauge(
+    "bridgedb_threadpool_workers_busy",
+    "The number of threads in the reactor's threadpool which are working."))
+
+QRCODE_CACHE_EVENTS = REGISTRY.register(Counter(
+    "bridgedb_qrcode_cache_events",
+    "Hits, misses, and evictions in the cache of QRCodes.",
+    ("event",)))
+
+QRCODE_RENDER_DURATION = REGISTRY.register(Histogram(
+    "bridgedb_qrcode_render_seconds",
+    "How long it took to generate QRCodes, in the threadpool."))
+
+PAGE_CACHE_EVENTS = REGISTRY.register(Counter(
+    "bridgedb_page_cache_events",
+    "Hits, misses, and evictions in the caches of rendered static pages.",
+    ("page", "event")))
+
+REQUEST_STAGE_DURATION = REGISTRY.register(Histogram(
+    "bridgedb_request_stage_duration_seconds",
+    "How long each stage of answering requests for bridges took.",
+    ("distributor", "stage")))
+
+
+#: Requests which take more than this many seconds are logged, or ``None`` to
+#: log none of them.
+slowRequestBudget = None
+
+#: The fraction of slow requests which are logged.
+slowRequestSampleRate = 1.0
+
+#: The :class:`RequestTimer` of the request which each thread is answering.
+_current = threading.local()
+
+
+def setSlowRequestLog(budget, sampleRate=1.0):
+    """Log (some of the) requests which take longer than **budget** seconds.
+
+    :type budget: float or None
+    :param budget: Log requests which take longer than this many seconds.  If
+        ``None``, don't log any.
+    :param float sampleRate: Only log this fraction of the slow requests,
+        chosen at random.  This keeps the log from filling up while
+        everything is slow.
+    """
+    global slowRequestBudget, slowRequestSampleRate
+
+    slowRequestBudget = budget
+    slowRequestSampleRate = 1.0 if sampleRate is None else float(sampleRate)
+
+
+class _Stage(object):
+    """A context manager which records how long its context took as a stage of
+    a :class:`RequestTimer`.
+    """
+
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.record(self.name, time.monotonic() - self.start)
+
+
+class _NoStage(object):
+    """A context manager which does nothing, for timing a stage when no
+    request is being timed.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class RequestTimer(object):
+    """Times the stages of answering one request for bridges.
+
+    Use it as a context manager around answering the request.  Within it, the
+    stages are timed with :meth:`stage` (or :func:`stage`, which finds the
+    current timer by itself, so the timer needn't be passed around).  Stages
+    can nest; a nested stage's time is also counted in its enclosing one.
+
+    When the context exits, the whole request's duration is recorded in
+    :data:`REQUEST_DURATION`, and, if it took longer than
+    :data:`slowRequestBudget`, it may be logged along with the duration of
+    each of its stages.  If the request will be answered later (in a
+    ``Deferred``'s callback), :func:`pauseRequest` stops that from happening
+    until the context is entered and exited again.
+
+    :ivar str distributor: The name of the distributor answering the request.
+    :ivar str client: The client's IP or email address, once it's known.  It's
+        only logged if ``SAFELOGGING`` is disabled.
+    :ivar list stages: The (name, seconds) of each stage, in the order in
+        which they finished.
+    :ivar bool paused: Whether the request is still being answered after the
+        context exits.
+    """
+
+    def __init__(self, distributor, client=None):
+        self.distributor = distributor
+        self.client = client
+        self.stages = []
+        self.start = None
+        self.duration = None
+        self.paused = False
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_current, "timer", None)
+        _current.timer = self
+        self.paused = False
+        if self.start is None:
+            self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        _current.timer = self._previous
+        self._previous = None
+        if not self.paused:
+            self.finish()
+
+    def finish(self):
+        """Record how long the request took, and log it if it was slow."""
+        self.duration = time.monotonic() - self.start
+        REQUEST_DURATION.observe(self.duration, self.distributor)
+
+        budget = slowRequestBudget
+        if budget is not None and self.duration > budget:
+            if random.random() < slowRequestSampleRate:
+                self.logSlowRequest(budget)
+
+    def stage(self, name):
+        """Get a context manager which times the stage **name**."""
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """Record that the stage **name** took **seconds**."""
+        self.stages.append((name, seconds))
+        REQUEST_STAGE_DURATION.observe(seconds, self.distributor, name)
+
+    def logSlowRequest(self, budget):
+        """Log this request's stages as a line of JSON.
+
+        :param float budget: The number of seconds it should have taken.
+        """
+        record = {
+            "distributor": self.distributor,
+            "client": safelog.logSafely(str(self.client)),
+            "budget_ms": round(budget * 1000, 3),
+            "total_ms": round(self.duration * 1000, 3),
+            "stages_ms": [[name, round(seconds * 1000, 3)]
+                          for name, seconds in self.stages],
+        }
+        logging.warning("Slow request: %s" % json.dumps(record))
+
+
+def currentRequest():
+    """Get the :class:`RequestTimer` of the request which this thread is
+    answering.
+
+    :rtype: :class:`RequestTimer` or ``None``
+    """
+    return getattr(_current, "timer", None)
+
+
+def pauseRequest():
+    """Keep timing the request which this thread is answering after its
+    :class:`RequestTimer`'s context exits, because it will be answered later.
+
+    :returns: A context manager which should be used around answering the
+        request later.  It times the rest of the request's stages, and when
+        it exits, the request is finished.  If no request is being timed, it
+        does nothing.
+    """
+    timer = getattr(_current, "timer", None)
+    if timer is None:
+        return _NO_STAGE
+    timer.paused = True
+    return timer
+
+
+def stage(name):
+    """Time the stage **name** of the request which this thread is answering.
+
+    If no request is being timed, this does nothing, so it's safe to call from
+    code which isn't always run while answering one (for example, building a
+    hashring, which is also done while reloading).
+
+    :param str name: The name of the stage.
+    :returns: A context manager.
+    """
+    timer = getattr(_current, "timer", None)
+    if timer is None:
+        return _NO_STAGE
+    return _Stage(timer, name)
+
+
+class MetricsResource(resource.Resource):
+    """Serve a :class:`Registry` in the Prometheus text format."""
+
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        """Render all metrics.
+
+        :type request: :api:`twisted.web.http.Request`
+        :param request: A ``Request`` for the metrics.
+        :rtype: bytes
+        """
+        request.setHeader(b"Content-Type", CONTENT_TYPE)
+        return self.registry.render().encode("utf-8")
+
+
+def addMetricsServer(config, reactor=reactor):
+    """Serve our metrics at ``/metrics``, over plain HTTP, on
+    ``METRICS_HTTP_BIND_IP:METRICS_HTTP_PORT``.
+
+    The endpoint has no authentication, so it should only be reachable by
+    whatever is collecting the metrics.  It defaults to listening on the
+    loopback interface.
+
+    :type config: :class:`bridgedb.configure.Conf`
+    :param config: A configuration object.
+    :param reactor: An implementer of
+        :api:`twisted.internet.interfaces.IReactorTCP`.
+    :rtype: :api:`twisted.web.server.Site`
+    :returns: The site serving our metrics.
+    """
+    ip = config.METRICS_HTTP_BIND_IP or "127.0.0.1"
+    port = config.METRICS_HTTP_PORT
+
+    pool = reactor.getThreadPool()
+    THREADPOOL_QUEUE_DEPTH.setFunction(lambda: pool.q.qsize())
+    THREADPOOL_WORKERS_BUSY.setFunction(lambda: len(pool.working))
+
+    root = resource.Resource()
+    root.putChild(b"metrics", MetricsResource())
+    site = Site(root)
+    site.displayTracebacks = False
+
+    try:
+        reactor.listenTCP(port, site, interface=ip)
+    except CannotListenError as error:
+        raise SystemExit(error)
+    logging.info("Started metrics server on %s:%d" % (str(ip), int(port)))
+
+    return site
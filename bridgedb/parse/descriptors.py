@@ -26,18 +26,39 @@ bridgedb.parse.descriptors
                descriptor for each router.
  parseNetworkStatusFile - Parse a bridge-networkstatus document generated and
                           given to us by the BridgeAuthority.
+ parseNetworkStatusFileFast - Parse a bridge-networkstatus document, without
+                              using Stem.
  parseServerDescriptorsFile - Parse a file containing
                               bridge-server-descriptors.
+ iterServerDescriptorsFile - Parse a file containing
+                             bridge-server-descriptors, one at a time.
  parseExtraInfoFiles - Parse (multiple) file(s) containing bridge-extrainfo
                        descriptors.
+ iterExtraInfoFiles - Parse (multiple) file(s) containing bridge-extrainfo
+                      descriptors, one at a time.
+ parseDescriptorFiles - Parse many descriptor files at once, with a pool of
+                        worker processes.
+ splitDescriptorFile - Split a descriptor file into byte ranges which can be
+                       parsed separately.
+ NetworkStatusRecord - The parts of a bridge-networkstatus document which
+                       BridgeDB uses.
+ ServerDescriptorRecord - The parts of a bridge-server-descriptor which
+                          BridgeDB uses.
+ ExtraInfoRecord - The parts of a bridge-extrainfo descriptor which BridgeDB
+                   uses.
 ..
 """
 
 from __future__ import print_function
 
+import binascii
+import collections
+import concurrent.futures
 import datetime
+import io
 import logging
 import os
+import re
 import shutil
 
 from stem import ProtocolError
@@ -49,10 +70,93 @@ from bridgedb import safelog
 from bridgedb.parse.nickname import InvalidRouterNickname
 
 
+#: The kinds of descriptor files which :func:`parseDescriptorFiles` can parse.
+NETWORKSTATUS = 'networkstatus'
+SERVER_DESCRIPTOR = 'server-descriptor'
+EXTRA_INFO = 'extra-info'
+
+#: The keyword which begins the first line of each kind of descriptor.
+DESCRIPTOR_KEYWORDS = {
+    NETWORKSTATUS: b'r ',
+    SERVER_DESCRIPTOR: b'router ',
+    EXTRA_INFO: b'extra-info ',
+}
+
+#: A valid router nickname, according to tor-spec.
+_NICKNAME_REGEX = re.compile(r'^[A-Za-z0-9]{1,19}$')
+
+#: The minimum number of bytes of a descriptor file which
+#: :func:`parseDescriptorFiles` gives to a single worker process.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
 class DescriptorWarning(Warning):
     """Raised when we parse a very odd descriptor."""
 
 
+class NetworkStatusRecord(collections.namedtuple(
+        'NetworkStatusRecord',
+        ['fingerprint', 'nickname', 'address', 'or_port', 'or_addresses',
+         'flags', 'digest', 'bandwidth', 'published'])):
+    """A compact, picklable copy of the parts of a
+    :class:`~stem.descriptor.router_status_entry.RouterStatusEntryV3` which
+    :meth:`bridgedb.bridges.Bridge.updateFromNetworkStatus` uses.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromDescriptor(cls, descriptor):
+        return cls(*[getattr(descriptor, field) for field in cls._fields])
+
+
+class ServerDescriptorRecord(collections.namedtuple(
+        'ServerDescriptorRecord',
+        ['fingerprint', 'nickname', 'address', 'or_port', 'or_addresses',
+         'hibernating', 'bridge_distribution', 'onion_key', 'ntor_onion_key',
+         'signing_key', 'average_bandwidth', 'burst_bandwidth',
+         'observed_bandwidth', 'contact', 'family', 'platform', 'tor_version',
+         'operating_system', 'uptime', 'extra_info_digest', 'published',
+         'descriptor_digest'])):
+    """A compact, picklable copy of the parts of a
+    :class:`~stem.descriptor.server_descriptor.RelayDescriptor` which
+    :meth:`bridgedb.bridges.Bridge.updateFromServerDescriptor` uses.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromDescriptor(cls, descriptor):
+        values = [getattr(descriptor, field) for field in cls._fields[:-1]]
+        return cls(*(values + [descriptor.digest()]))
+
+    def digest(self):
+        """Get the hash digest of the original descriptor, as from
+        :meth:`stem.descriptor.server_descriptor.RelayDescriptor.digest`.
+        """
+        return self.descriptor_digest
+
+
+class ExtraInfoRecord(collections.namedtuple(
+        'ExtraInfoRecord',
+        ['fingerprint', 'nickname', 'published', 'transport', 'bridge_ips',
+         'contents'])):
+    """A compact, picklable copy of the parts of a
+    :class:`~stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor`
+    which :meth:`bridgedb.bridges.Bridge.updateFromExtraInfoDescriptor` uses.
+
+    The descriptor's full ``contents`` are kept, since they're needed to
+    verify its signature.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromDescriptor(cls, descriptor):
+        values = [getattr(descriptor, field) for field in cls._fields[:-1]]
+        return cls(*(values + [str(descriptor)]))
+
+    def __str__(self):
+        return self.contents
+
+
 def _copyUnparseableDescriptorFile(filename):
     """Save a copy of the bad descriptor file for later debugging.
 
@@ -119,8 +223,6 @@ def parseNetworkStatusFile(filename, validate=True, skipAnnotations=True,
     :returns: A list of
         :class:`stem.descriptor.router_status_entry.RouterStatusEntry`.
     """
-    routers = []
-
     logging.info("Parsing networkstatus file: %s" % filename)
     with open(filename, 'rb') as fh:
         position = fh.tell()
@@ -129,20 +231,162 @@ def parseNetworkStatusFile(filename, validate=True, skipAnnotations=True,
                 position = fh.tell()
         logging.debug("Skipping %d bytes of networkstatus file." % position)
         fh.seek(position)
-        document = _parseNSFile(fh, validate, entry_class=descriptorClass)
+        routers = _parseNetworkStatusDocument(fh, validate, descriptorClass)
 
-        try:
-            routers.extend(list(document))
-        except ValueError as error:
-            if "nickname isn't valid" in str(error):
-                raise InvalidRouterNickname(str(error))
-            else:
-                raise ValueError(str(error))
+    logging.info("Closed networkstatus file: %s" % filename)
 
+    return routers
+
+def _parseNetworkStatusDocument(fh, validate, descriptorClass):
+    """Parse all the networkstatus entries from the file-like object **fh**.
+
+    :raises InvalidRouterNickname: if one of the routers had a nickname which
+        does not conform to Tor's nickname specification.
+    :raises ValueError: if the contents of a descriptor are malformed and
+        **validate** is ``True``.
+    :rtype: list
+    """
+    document = _parseNSFile(fh, validate, entry_class=descriptorClass)
+
+    try:
+        return list(document)
+    except ValueError as error:
+        if "nickname isn't valid" in str(error):
+            raise InvalidRouterNickname(str(error))
+        else:
+            raise ValueError(str(error))
+
+def parseNetworkStatusFileFast(filename, validate=False):
+    """Quickly parse a file which contains an ``@type bridge-networkstatus``
+    document, without using Stem.
+
+    Only the ``r``, ``a``, ``s``, and ``w`` lines of each entry are read
+    (all other lines, i.e. ``p``, are skipped), and each entry is returned as
+    a :class:`NetworkStatusRecord`, which
+    :meth:`bridgedb.bridges.Bridge.updateFromNetworkStatus` accepts in place
+    of a :class:`~stem.descriptor.router_status_entry.RouterStatusEntryV3`.
+    Apart from router nicknames, and the number of fields and the address in
+    ``r`` lines, nothing is checked for correctness.
+
+    :param str filename: The location of the file containing bridge
+        networkstatus descriptors.
+    :param bool validate: If ``True``, also parse **filename** with
+        :func:`parseNetworkStatusFile`, and check that Stem agrees with us
+        about every entry.  This is *much* slower, and is meant for testing.
+    :raises InvalidRouterNickname: if one of the routers in the networkstatus
+        file had a nickname which does not conform to Tor's nickname
+        specification.
+    :raises ValueError: if an entry is malformed, or if **validate** is
+        ``True`` and Stem parsed some entry differently.
+    :raises IOError: if the file at **filename** can't be read.
+    :rtype: list
+    :returns: A list of :class:`NetworkStatusRecord`s.
+    """
+    logging.info("Parsing networkstatus file without Stem: %s" % filename)
+    with io.open(filename, 'r', encoding='utf-8') as fh:
+        routers = list(_iterNetworkStatusRecords(fh))
     logging.info("Closed networkstatus file: %s" % filename)
 
+    if validate:
+        expected = [NetworkStatusRecord.fromDescriptor(router) for router in
+                    parseNetworkStatusFile(filename, validate=True)]
+        if len(routers) != len(expected):
+            raise ValueError(("Parsed %d networkstatus entries from %s, but "
+                              "Stem parsed %d.") % (len(routers), filename,
+                                                    len(expected)))
+        for router, stemRouter in zip(routers, expected):
+            if router != stemRouter:
+                raise ValueError(("Networkstatus entry for %s differs from "
+                                  "Stem's: %r != %r") % (
+                                      safelog.logSafely(router.fingerprint),
+                                      router, stemRouter))
+
     return routers
 
+def _iterNetworkStatusRecords(lines):
+    """Parse networkstatus entries from an iterable of **lines**, for
+    :func:`parseNetworkStatusFileFast`.
+
+    Everything before the first ``r`` line (i.e. ``@type`` annotations) is
+    skipped.
+
+    :rtype: generator
+    :returns: A generator of :class:`NetworkStatusRecord`s.
+    """
+    entry = None
+
+    for line in lines:
+        keyword, _, value = line.rstrip('\n').partition(' ')
+        if keyword == 'r':
+            if entry is not None:
+                yield NetworkStatusRecord(*entry)
+            entry = _parseNetworkStatusRLine(value)
+        elif entry is None:
+            continue
+        elif keyword == 'a':
+            address, _, port = value.rpartition(':')
+            if not address or not port.isdigit():
+                raise ValueError("Networkstatus 'a' line must be of the form "
+                                 "'[address]:port': a %s" % value)
+            entry[4].append((address.lstrip('[').rstrip(']'), int(port),
+                             ':' in address))
+        elif keyword == 's':
+            entry[5] = value.split(' ') if value else []
+        elif keyword == 'w':
+            for item in value.split(' '):
+                if item.startswith('Bandwidth='):
+                    entry[7] = int(item[len('Bandwidth='):])
+
+    if entry is not None:
+        yield NetworkStatusRecord(*entry)
+
+def _parseNetworkStatusRLine(value):
+    """Parse the **value** of a networkstatus ``r`` line, i.e.::
+
+        nickname identity digest publication-date publication-time IP ORPort DirPort
+
+    :raises InvalidRouterNickname: if the router's nickname is invalid.
+    :raises ValueError: if the line doesn't have enough fields, its address
+        isn't IPv4, or its identity or digest aren't base64-encoded.
+    :rtype: list
+    :returns: The fields of a :class:`NetworkStatusRecord`, where the
+        ``or_addresses`` and ``flags`` are empty lists and the ``bandwidth``
+        is ``None``, to be filled in from the rest of the entry.
+    """
+    fields = value.split(' ')
+    if len(fields) < 8:
+        raise ValueError("Networkstatus 'r' line must have eight values: r %s"
+                         % value)
+
+    nickname = fields[0]
+    if not _NICKNAME_REGEX.match(nickname):
+        raise InvalidRouterNickname("Networkstatus nickname isn't valid: %s"
+                                    % nickname)
+
+    try:
+        fingerprint = _base64ToHex(fields[1])
+        digest = _base64ToHex(fields[2])
+    except (binascii.Error, UnicodeEncodeError):
+        raise ValueError("Networkstatus 'r' line has an invalid identity or "
+                         "digest: r %s" % value)
+
+    if ':' in fields[5]:
+        raise ValueError("Networkstatus 'r' line must have an IPv4 address: "
+                         "r %s" % value)
+
+    # This is several times faster than datetime.datetime.strptime():
+    published = datetime.datetime(*[int(x) for x in
+                                    fields[3].split('-') + fields[4].split(':')])
+
+    return [fingerprint, nickname, fields[5], int(fields[6]), [], [], digest,
+            None, published]
+
+def _base64ToHex(value):
+    """Decode the unpadded base64 **value** to an uppercase hex string."""
+    value = value.encode('ascii')
+    value += b'=' * (-len(value) % 4)
+    return binascii.hexlify(binascii.a2b_base64(value)).upper().decode('ascii')
+
 def parseServerDescriptorsFile(filename, validate=True):
     """Open and parse **filename**, which should contain
     ``@type bridge-server-descriptor``.
@@ -158,21 +402,45 @@ def parseServerDescriptorsFile(filename, validate=True):
     :returns: A list of
         :class:`stem.descriptor.server_descriptor.RelayDescriptor`s.
     """
+    return list(iterServerDescriptorsFile(filename, validate))
+
+def iterServerDescriptorsFile(filename, validate=True):
+    """Open and parse **filename**, which should contain
+    ``@type bridge-server-descriptor``, yielding each descriptor as soon as
+    it is parsed.
+
+    This is the same as :func:`parseServerDescriptorsFile`, except that
+    only one descriptor is held in memory at a time.
+
+    :param str filename: The file to parse descriptors from.
+    :param bool validate: Whether or not to validate descriptor
+        contents. (default: ``True``)
+    :rtype: generator
+    :returns: A generator of
+        :class:`stem.descriptor.server_descriptor.RelayDescriptor`s.
+    """
     logging.info("Parsing server descriptors with Stem: %s" % filename)
     descriptorType = 'server-descriptor 1.0'
     document = parse_file(filename, descriptorType, validate=validate)
-    return list(document)
+    for router in document:
+        yield router
 
 
 def deduplicate(descriptors, statistics=False):
     """Deduplicate some descriptors, returning only the newest for each router.
 
+    The **descriptors** are consumed one at a time, and only the newest one
+    seen so far for each router is kept, so **descriptors** may be a
+    generator (i.e. from :func:`iterExtraInfoFiles`) which yields many more
+    descriptors than there are routers.  If two descriptors for the same
+    router have the same published timestamp, the later one is kept.
+
     .. note:: If two descriptors for the same router are discovered, AND both
         descriptors have the **same** published timestamp, then the router's
         fingerprint WILL BE LOGGED ON PURPOSE, because we assume that router
         to be broken or malicious.
 
-    :param list descriptors: A list of
+    :param list descriptors: A list (or other iterable) of
         :class:`stem.descriptor.server_descriptor.RelayDescriptor`,
         :class:`stem.descriptor.extrainfo_descriptor.BridgeExtraInfoDescriptor`,
         or :class:`stem.descriptor.router_status_entry.RouterStatusEntry`.
@@ -187,23 +455,21 @@ def deduplicate(descriptors, statistics=False):
 
     for descriptor in descriptors:
         fingerprint = descriptor.fingerprint
-        if fingerprint in duplicates:
-            duplicates[fingerprint].append(descriptor)
-        else:
-            duplicates[fingerprint] = [descriptor,]
+        current = newest.get(fingerprint)
+        if current is None:
+            newest[fingerprint] = descriptor
+            duplicates[fingerprint] = 0
+            continue
 
-    for fingerprint, dupes in duplicates.items():
-        dupes.sort(key=lambda x: x.published)
-        first = dupes.pop()
-        newest[fingerprint] = first
-        duplicates[fingerprint] = dupes
+        duplicates[fingerprint] += 1
+        if descriptor.published >= current.published:
+            newest[fingerprint] = descriptor
 
     if statistics:
-        # sorted() won't sort by values (or anything that isn't the first item
-        # in its container), period, no matter what the cmp function is.
-        totals  = sorted([(len(v), k,) for k, v in duplicates.viewitems()])
+        totals  = sorted([(v, k,) for k, v in duplicates.items() if v],
+                         reverse=True)
         total   = sum([k for (k, v) in totals])
-        bridges = len(duplicates)
+        bridges = len(totals)
         top     = 10 if bridges >= 10 else bridges
         logging.info("Number of bridges with duplicates: %5d" % bridges)
         logging.info("Total duplicate descriptors:       %5d" % total)
@@ -227,7 +493,9 @@ def parseExtraInfoFiles(*filenames, **kwargs):
         ``signing-key`` for the Bridge.
 
     .. note:: This function will call :func:`deduplicate` to deduplicate the
-        extrainfo descriptors parsed from all **filenames**.
+        extrainfo descriptors parsed from all **filenames**, as they are
+        parsed (see :func:`iterExtraInfoFiles`), so at most one descriptor
+        per bridge is held in memory.
 
     :kwargs validate: If there is a ``'validate'`` keyword argument, its value
         will be passed along as the ``'validate'`` argument to
@@ -241,8 +509,22 @@ def parseExtraInfoFiles(*filenames, **kwargs):
         deduplicated
         :class:`stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor`.
     """
-    descriptors = []
+    routers = deduplicate(iterExtraInfoFiles(*filenames, **kwargs))
+    return routers
+
+def iterExtraInfoFiles(*filenames, **kwargs):
+    """Open **filenames** and yield each ``@type bridge-extrainfo-descriptor``
+    contained within, as soon as it is parsed.
 
+    The descriptors are *not* deduplicated; see :func:`parseExtraInfoFiles`.
+    If a file contains an unparseable descriptor, the error is logged, a copy
+    of the file is saved for debugging, and the rest of that file is skipped.
+
+    :kwargs validate: As for :func:`parseExtraInfoFiles`.
+    :rtype: generator
+    :returns: A generator of
+        :class:`stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor`.
+    """
     # The ``stem.descriptor.extrainfo_descriptor.BridgeExtraInfoDescriptor``
     # class (with ``descriptorType = 'bridge-extra-info 1.1``) is unsuitable
     # for our purposes for the following reasons:
@@ -266,12 +548,154 @@ def parseExtraInfoFiles(*filenames, **kwargs):
 
         try:
             for router in document:
-                descriptors.append(router)
+                yield router
         except (ValueError, ProtocolError) as error:
             logging.error(
                 ("Stem exception while parsing extrainfo descriptor from "
                  "file '%s':\n%s") % (filename, str(error)))
             _copyUnparseableDescriptorFile(filename)
 
-    routers = deduplicate(descriptors)
-    return routers
+def splitDescriptorFile(filename, keyword, chunkSize=CHUNK_SIZE,
+                        skipAnnotations=False):
+    """Split **filename** into byte ranges, each holding whole descriptors,
+    which can be parsed independently of one another.
+
+    A new range is only started at a line beginning with **keyword** (or at
+    the annotations, if there are any, directly above that line), once the
+    current range holds at least **chunkSize** bytes.
+
+    :param str filename: The descriptor file to split.
+    :param bytes keyword: The keyword which begins the first line of each
+        descriptor in the file, i.e. ``b'router '``.
+    :param int chunkSize: The minimum number of bytes in each range (except
+        the last).
+    :param bool skipAnnotations: If ``True``, skip everything before the first
+        line beginning with **keyword**, as
+        :func:`parseNetworkStatusFile` does.
+    :raises IOError: if the file at **filename** can't be read.
+    :rtype: list
+    :returns: A list of ``(start, end)`` byte offsets into the file.
+    """
+    offsets = []
+    annotations = None
+    position = 0
+
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'@') and not skipAnnotations:
+                if annotations is None:
+                    annotations = position
+            else:
+                if line.startswith(keyword):
+                    offsets.append(position if annotations is None
+                                   else annotations)
+                annotations = None
+            position += len(line)
+
+    if skipAnnotations:
+        if not offsets:
+            return []
+        start = offsets[0]
+    else:
+        start = 0
+
+    chunks = []
+    for offset in offsets[1:]:
+        if offset - start >= chunkSize:
+            chunks.append((start, offset))
+            start = offset
+    chunks.append((start, position))
+
+    return chunks
+
+def _parseChunk(kind, filename, start, end, validate=True):
+    """Parse the descriptors between the **start** and **end** byte offsets of
+    **filename**, in a worker process for :func:`parseDescriptorFiles`.
+
+    :rtype: tuple
+    :returns: A list of records (i.e. :class:`NetworkStatusRecord`s), and
+        either ``None`` or, if some :data:`EXTRA_INFO` descriptors were
+        unparseable, a string describing the error.
+    """
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        chunk = io.BytesIO(fh.read(end - start))
+
+    error = None
+    if kind == NETWORKSTATUS:
+        routers = _parseNetworkStatusDocument(chunk, validate,
+                                              RouterStatusEntryV3)
+        record = NetworkStatusRecord
+    elif kind == SERVER_DESCRIPTOR:
+        routers = list(parse_file(chunk, 'server-descriptor 1.0',
+                                  validate=validate))
+        record = ServerDescriptorRecord
+    else:
+        routers = []
+        record = ExtraInfoRecord
+        try:
+            for router in parse_file(chunk, 'extra-info 1.0',
+                                     validate=validate):
+                routers.append(router)
+        except (ValueError, ProtocolError) as err:
+            error = str(err)
+
+    return [record.fromDescriptor(router) for router in routers], error
+
+def parseDescriptorFiles(files, processes=None, validate=True,
+                         chunkSize=CHUNK_SIZE):
+    """Parse many descriptor files at once, with a pool of worker processes.
+
+    Each file (or, for files larger than **chunkSize**, each chunk of it; see
+    :func:`splitDescriptorFile`) is parsed with Stem in a separate process,
+    and the descriptors are sent back to us as compact, picklable records
+    which the ``Bridge.updateFrom*`` methods accept in place of the
+    descriptors themselves.
+
+    Errors are handled as in :func:`parseNetworkStatusFile`,
+    :func:`parseServerDescriptorsFile`, and :func:`parseExtraInfoFiles`,
+    respectively.
+
+    :param list files: A list of ``(kind, filename)`` two-tuples, where
+        ``kind`` is one of :data:`NETWORKSTATUS`, :data:`SERVER_DESCRIPTOR`,
+        or :data:`EXTRA_INFO`.
+    :type processes: int or None
+    :param processes: The number of worker processes to use.  If ``None``,
+        use one per CPU.
+    :param bool validate: Passed along to Stem's parsers.
+    :param int chunkSize: The minimum number of bytes to give to each worker.
+    :rtype: list
+    :returns: For each item in **files**, a list of
+        :class:`NetworkStatusRecord`s, :class:`ServerDescriptorRecord`s, or
+        :class:`ExtraInfoRecord`s, in the order in which they appear in the
+        file.  The :class:`ExtraInfoRecord`s are *not* deduplicated.
+    """
+    jobs = []
+    for index, (kind, filename) in enumerate(files):
+        chunks = splitDescriptorFile(filename, DESCRIPTOR_KEYWORDS[kind],
+                                     chunkSize, kind == NETWORKSTATUS)
+        jobs.extend([(index, kind, filename, start, end)
+                     for (start, end) in chunks])
+
+    logging.info("Parsing %d descriptor files in %d chunks..."
+                 % (len(files), len(jobs)))
+
+    results = [[] for _ in files]
+    unparseable = []
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_parseChunk, kind, filename, start, end,
+                               validate)
+                   for (_, kind, filename, start, end) in jobs]
+        for (index, kind, filename, _, _), future in zip(jobs, futures):
+            records, error = future.result()
+            results[index].extend(records)
+            if error is not None:
+                logging.error(
+                    ("Stem exception while parsing extrainfo descriptor from "
+                     "file '%s':\n%s") % (filename, error))
+                if filename not in unparseable:
+                    unparseable.append(filename)
+                    _copyUnparseableDescriptorFile(filename)
+
+    return results
@@ -13,8 +13,16 @@
 """Utilities for working with QRCodes."""
 
 
+import base64
+import collections
 import io
 import logging
+import time
+
+from twisted.internet import defer
+from twisted.internet import threads
+
+from bridgedb import openmetrics
 
 try:
     import qrcode
@@ -75,3 +83,162 @@ def generateQR(bridgelines, imageFormat='JPEG', bridgeSchema=False):
     except Exception as error:  # pragma: no cover
         logging.error(("There was an error while attempting to generate the "
                        "QRCode: %s") % str(error))
+
+
+def generateQRDataURI(bridgelines):
+    """Generate a QRCode for the client's bridge lines, as a ``data:`` URI.
+
+    :param bridgelines: The bridge lines which we are distributing to the
+        client.
+    :rtype: str or ``None``
+    :returns: The generated JPEG QRCode, as a base64-encoded ``data:`` URI,
+        or ``None`` if it couldn't be generated.
+    """
+    start = time.monotonic()
+    qrjpeg = generateQR(bridgelines)
+    openmetrics.QRCODE_RENDER_DURATION.observe(time.monotonic() - start)
+
+    if qrjpeg:
+        return 'data:image/jpeg;base64,%s' % \
+            base64.b64encode(qrjpeg).decode('utf-8')
+
+
+class QRCodeCache(object):
+    """A bounded cache of the ``data:`` URIs of the QRCodes for some bridge
+    lines.
+
+    The same bridge lines are handed out to many clients during each
+    interval, so there's no need to generate their QRCode again and again.
+    Generating a QRCode (encoding it, drawing it, and compressing the JPEG) is
+    slow enough to hold up every other client waiting on the reactor, so it is
+    done in the reactor's threadpool.  Only the reactor thread should use the
+    cache itself.
+
+    :ivar int size: The most QRCodes to keep.  When there are more, the least
+        recently used one is forgotten.
+    """
+
+    def __init__(self, size=256, generate=generateQRDataURI,
+                 runInThread=threads.deferToThread):
+        """Create a cache of QRCodes.
+
+        :param int size: The most QRCodes to keep.
+        :param callable generate: A function which takes some bridge lines,
+            and returns the ``data:`` URI of their QRCode (or ``None``).
+        :param callable runInThread: A function which calls its first
+            argument with the rest of its arguments in another thread, and
+            returns a ``Deferred`` which fires with the result.
+        """
+        self.size = size
+        self.generate = generate
+        self.runInThread = runInThread
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def _key(bridgelines):
+        if isinstance(bridgelines, str):
+            return bridgelines
+        return tuple(bridgelines)
+
+    def __getitem__(self, bridgelines):
+        """Get the cached ``data:`` URI of the QRCode for **bridgelines**.
+
+        :raises KeyError: if it hasn't been generated yet.
+        :rtype: str or ``None``
+        :returns: The ``data:`` URI, or ``None`` if it couldn't be generated.
+        """
+        key = self._key(bridgelines)
+        try:
+            uri = self._cache[key]
+        except KeyError:
+            openmetrics.QRCODE_CACHE_EVENTS.inc("misses")
+            raise
+        self._cache.move_to_end(key)
+        openmetrics.QRCODE_CACHE_EVENTS.inc("hits")
+        return uri
+
+    def _put(self, key, uri):
+        self._cache[key] = uri
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+            openmetrics.QRCODE_CACHE_EVENTS.inc("evictions")
+
+    def get(self, bridgelines):
+        """Get the ``data:`` URI of the QRCode for **bridgelines**,
+        generating it in a thread if it isn't cached.
+
+        If it's already being generated for another client, wait for that,
+        rather than generating it twice.
+
+        :param bridgelines: The bridge lines which we are distributing to the
+            client.
+        :rtype: :api:`twisted.internet.defer.Deferred`
+        :returns: A ``Deferred`` which fires with the ``data:`` URI, or with
+            ``None`` if there are no bridge lines, or if the QRCode couldn't
+            be generated.  If it was cached, the ``Deferred`` has already
+            fired.
+        """
+        if not bridgelines:
+            return defer.succeed(None)
+
+        try:
+            return defer.succeed(self[bridgelines])
+        except KeyError:
+            pass
+
+        key = self._key(bridgelines)
+        d = defer.Deferred()
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            waiting.append(d)
+        else:
+            self._pending[key] = [d]
+            generating = self.runInThread(self.generate, bridgelines)
+            generating.addCallbacks(self._generated, self._failed,
+                                    callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def _generated(self, uri, key):
+        """Cache the ``data:`` URI of a newly-generated QRCode, and give it
+        to everyone who was waiting for it.
+
+        If it couldn't be generated (:func:`generateQR` logs the error and
+        returns ``None``), don't cache that, so that it's tried again next
+        time.
+        """
+        if uri is not None:
+            self._put(key, uri)
+        for d in self._pending.pop(key, []):
+            d.callback(uri)
+
+    def _failed(self, failure, key):
+        """Give everyone who was waiting for a QRCode which couldn't be
+        generated ``None`` instead, but don't cache that, so that it's tried
+        again next time.
+        """
+        logging.error("Couldn't generate QRCode: %s"
+                      % failure.getErrorMessage())
+        for d in self._pending.pop(key, []):
+            d.callback(None)
+
+    def clear(self):
+        """Forget all cached QRCodes."""
+        self._cache.clear()
+
+
+#: The :class:`QRCodeCache` used by the HTTPS and Moat distributors.
+cache = QRCodeCache()
+
+
+def getQRDataURI(bridgelines):
+    """Get the ``data:`` URI of the QRCode for **bridgelines**, from
+    :data:`cache`.  See :meth:`QRCodeCache.get`.
+
+    :rtype: :api:`twisted.internet.defer.Deferred`
+    """
+    return cache.get(bridgelines)
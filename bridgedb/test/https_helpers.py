@@ -35,6 +35,7 @@ HTTPS_KEY_FILE = 'privkey.pem'
 HTTPS_CERT_FILE = 'cert'
 N_IP_CLUSTERS = 4
 HTTPS_ROTATION_PERIOD = "3 hours"
+HTTPS_TEMPLATE_MODULE_DIR = None
 HTTP_UNENCRYPTED_BIND_IP = None
 HTTP_UNENCRYPTED_PORT = None
 HTTP_USE_IP_FROM_FORWARDED_HEADER = False
@@ -44,6 +45,7 @@ RECAPTCHA_SEC_KEY = ''
 RECAPTCHA_REMOTEIP = ''
 GIMP_CAPTCHA_ENABLED = True
 GIMP_CAPTCHA_DIR = 'captchas'
+GIMP_CAPTCHA_PRELOAD = False
 GIMP_CAPTCHA_HMAC_KEYFILE = 'captcha_hmac_key'
 GIMP_CAPTCHA_RSA_KEYFILE = 'captcha_rsa_key'
 CSP_ENABLED = True
@@ -62,6 +64,7 @@ HTTPS_KEY_FILE = %r
 HTTPS_CERT_FILE = %r
 N_IP_CLUSTERS = %r
 HTTPS_ROTATION_PERIOD = %r
+HTTPS_TEMPLATE_MODULE_DIR = %r
 HTTP_UNENCRYPTED_BIND_IP = %r
 HTTP_UNENCRYPTED_PORT = %r
 HTTP_USE_IP_FROM_FORWARDED_HEADER = %r
@@ -71,6 +74,7 @@ RECAPTCHA_SEC_KEY = %r
 RECAPTCHA_REMOTEIP = %r
 GIMP_CAPTCHA_ENABLED = %r
 GIMP_CAPTCHA_DIR = %r
+GIMP_CAPTCHA_PRELOAD = %r
 GIMP_CAPTCHA_HMAC_KEYFILE = %r
 GIMP_CAPTCHA_RSA_KEYFILE = %r
 CSP_ENABLED = %r
@@ -87,6 +91,7 @@ CSP_INCLUDE_SELF = %r
        HTTPS_CERT_FILE,
        N_IP_CLUSTERS,
        HTTPS_ROTATION_PERIOD,
+       HTTPS_TEMPLATE_MODULE_DIR,
        HTTP_UNENCRYPTED_BIND_IP,
        HTTP_UNENCRYPTED_PORT,
        HTTP_USE_IP_FROM_FORWARDED_HEADER,
@@ -96,6 +101,7 @@ CSP_INCLUDE_SELF = %r
        RECAPTCHA_REMOTEIP,
        GIMP_CAPTCHA_ENABLED,
        GIMP_CAPTCHA_DIR,
+       GIMP_CAPTCHA_PRELOAD,
        GIMP_CAPTCHA_HMAC_KEYFILE,
        GIMP_CAPTCHA_RSA_KEYFILE,
        CSP_ENABLED,
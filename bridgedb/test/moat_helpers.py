@@ -19,6 +19,7 @@ from . import util
 
 
 GIMP_CAPTCHA_DIR = 'captchas'
+GIMP_CAPTCHA_PRELOAD = False
 SERVER_PUBLIC_FQDN = 'bridges.torproject.org'
 SUPPORTED_TRANSPORTS = {
     'obfs2': False,
@@ -50,6 +51,7 @@ MOAT_GIMP_CAPTCHA_RSA_KEYFILE = 'moat_captcha_rsa_key'
 
 TEST_CONFIG_FILE = io.StringIO("""\
 GIMP_CAPTCHA_DIR = %r
+GIMP_CAPTCHA_PRELOAD = %r
 SERVER_PUBLIC_FQDN = %r
 SUPPORTED_TRANSPORTS = %r
 MOAT_DIST = %r
@@ -70,6 +72,7 @@ MOAT_ROTATION_PERIOD = %r
 MOAT_GIMP_CAPTCHA_HMAC_KEYFILE = %r
 MOAT_GIMP_CAPTCHA_RSA_KEYFILE = %r
 """ % (GIMP_CAPTCHA_DIR,
+       GIMP_CAPTCHA_PRELOAD,
        SERVER_PUBLIC_FQDN,
        SUPPORTED_TRANSPORTS,
        MOAT_DIST,
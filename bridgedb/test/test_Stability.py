@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of BridgeDB, a Tor bridge distribution system.
+#
+# :copyright: (c) 2007-2017, The Tor Project, Inc.
+# :license: see LICENSE for licensing information
+
+"""Unittests for the :mod:`bridgedb.Stability` module."""
+
+from __future__ import print_function
+
+import datetime
+import os
+import random
+import threading
+
+import ipaddr
+
+from twisted.trial import unittest
+
+# Storage must be imported before Stability, which it imports in turn:
+from bridgedb import Storage
+from bridgedb import Stability
+from bridgedb.bridges import Flags
+from bridgedb.test.util import Benchmarker
+
+
+class StatusBridge(object):
+    """A bridge with the attributes used by both
+    :func:`bridgedb.Stability.addOrUpdateBridgeHistory` and
+    :class:`bridgedb.Stability.BridgeHistoryBatch`.
+    """
+    def __init__(self, fingerprint, address, port, running=True):
+        self.fingerprint = fingerprint
+        self.flags = Flags()
+        self.flags.running = running
+        self.running = running
+        self.move(address, port)
+
+    def move(self, address, port):
+        self.address = self.ip = ipaddr.IPAddress(address)
+        self.orPort = self.orport = port
+
+
+class BridgeHistoryBatchTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.Stability.BridgeHistoryBatch`."""
+
+    def setUp(self):
+        self.dbfname = 'test-stability.sqlite'
+        Storage.setDBFilename(self.dbfname)
+        Storage.initializeDBLock()
+        self.start = 1500000000
+
+    def tearDown(self):
+        if os.path.isfile(self.dbfname):
+            os.unlink(self.dbfname)
+        Storage.clearGlobalDB()
+
+    def makeStatuses(self, count=20, hours=72):
+        """Make some bridges, and a list of hourly status publications, in
+        which some bridges go missing and one changes its address.
+        """
+        bridges = [StatusBridge("%040X" % n,
+                                "1.2.%d.%d" % (n // 250, n % 250 + 1), 443)
+                   for n in range(count)]
+        statuses = []
+        for hour in range(hours):
+            for n, bridge in enumerate(bridges):
+                # Some bridges are only seen once, so that they are pruned,
+                # and some are only seen from time to time:
+                if (n % 4 == 1 and hour) or (n % 4 == 2 and hour % 5):
+                    continue
+                statuses.append((self.start + hour * 3600 + n, bridge))
+        return bridges, statuses
+
+    def assertSameHistories(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for fingerprint, bh in expected.items():
+            other = actual[fingerprint]
+            for name in ('ip', 'port', 'weightedUptime', 'weightedTime',
+                         'weightedRunLength',
+                         'lastSeenWithDifferentAddressAndPort',
+                         'lastSeenWithThisAddressAndPort',
+                         'lastDiscountedHistoryValues',
+                         'lastUpdatedWeightedTime'):
+                self.assertEqual(getattr(bh, name), getattr(other, name),
+                                 "%s differs for %s" % (name, fingerprint))
+            self.assertAlmostEqual(bh.totalRunWeights, other.totalRunWeights)
+
+    def getHistories(self):
+        with Storage.getDB() as db:
+            return dict([(bh.fingerprint, bh)
+                         for bh in db.getAllBridgeHistory()])
+
+    def test_BridgeHistoryBatch_matches_addOrUpdateBridgeHistory(self):
+        """Applying the statuses with a BridgeHistoryBatch should give the
+        same histories as giving each to addOrUpdateBridgeHistory().
+        """
+        bridges, statuses = self.makeStatuses()
+        moveAt = len(statuses) // 2
+
+        with Storage.getDB() as db:
+            # addOrUpdateBridgeHistory() doesn't commit, so keep the database
+            # open until we've seen what it did:
+            for n, (timestamp, bridge) in enumerate(statuses):
+                if n == moveAt:
+                    bridges[0].move("4.3.2.1", 9001)
+                Stability.addOrUpdateBridgeHistory(bridge, timestamp)
+            expected = self.getHistories()
+
+            bridges[0].move("1.2.3.1", 443)
+            db._cur.execute("DELETE FROM BridgeHistory")
+            batch = Stability.BridgeHistoryBatch(db.getAllBridgeHistoryRows())
+            for n, (timestamp, bridge) in enumerate(statuses):
+                if n == moveAt:
+                    bridges[0].move("4.3.2.1", 9001)
+                batch.addStatus(bridge, timestamp)
+            batch.save(db)
+            actual = self.getHistories()
+
+        self.assertSameHistories(expected, actual)
+        # Some bridges should have been pruned, and one should have moved:
+        self.assertLess(len(actual), len(bridges))
+        self.assertGreater(actual[bridges[0].fingerprint].totalRunWeights, 0)
+
+        for fingerprint, bh in actual.items():
+            other = batch.getBridgeHistory(fingerprint)
+            self.assertEqual(other.weightedTime, bh.weightedTime)
+            self.assertEqual(other.ip, bh.ip)
+
+    def test_BridgeHistoryBatch_load(self):
+        """A batch loaded from the database should carry on where the last
+        one left off, and remove pruned histories from the database.
+        """
+        bridges, statuses = self.makeStatuses()
+        half = len(statuses) // 2
+
+        with Storage.getDB() as db:
+            for timestamp, bridge in statuses:
+                Stability.addOrUpdateBridgeHistory(bridge, timestamp)
+            expected = self.getHistories()
+
+            db._cur.execute("DELETE FROM BridgeHistory")
+            for part in (statuses[:half], statuses[half:]):
+                batch = Stability.BridgeHistoryBatch(
+                    db.getAllBridgeHistoryRows())
+                for timestamp, bridge in part:
+                    batch.addStatus(bridge, timestamp)
+                batch.save(db)
+            self.assertEqual(len(batch), len(expected))
+            self.assertSameHistories(expected, self.getHistories())
+
+    def test_BridgeHistoryBatch_addStatus_old(self):
+        """A status older than the last one from the same bridge should be
+        ignored.
+        """
+        bridge = StatusBridge("%040X" % 1, "1.2.3.4", 443)
+        batch = Stability.BridgeHistoryBatch()
+        self.assertTrue(batch.addStatus(bridge, self.start))
+        self.assertTrue(batch.addStatus(bridge, self.start + 60))
+        self.assertFalse(batch.addStatus(bridge, self.start + 30))
+
+        bh = batch.getBridgeHistory(bridge.fingerprint)
+        self.assertEqual(bh.weightedUptime, 60)
+        self.assertEqual(bh.lastSeenWithThisAddressAndPort,
+                         (self.start + 60) * 1000)
+
+    def test_updateBridgeHistory(self):
+        """updateBridgeHistory() should commit the histories of all bridges,
+        and return their sorted timestamps.
+        """
+        bridges, statuses = self.makeStatuses(count=4, hours=3)
+        timestamps = {}
+        for timestamp, bridge in reversed(statuses):
+            timestamps.setdefault(bridge.fingerprint, []).append(
+                datetime.datetime.utcfromtimestamp(timestamp))
+
+        result = Stability.updateBridgeHistory(
+            dict([(b.fingerprint, b) for b in bridges]), timestamps)
+
+        for stamps in result.values():
+            self.assertEqual(stamps, sorted(stamps))
+        Storage.clearGlobalDB()
+        Storage.setDBFilename(self.dbfname)
+        Storage.initializeDBLock()
+        self.assertEqual(len(self.getHistories()), len(bridges))
+
+    def test_updateBridgeHistory_releasesLock(self):
+        """updateBridgeHistory() shouldn't hold the database lock while
+        applying the status publications.
+        """
+        bridges, statuses = self.makeStatuses(count=4, hours=3)
+        timestamps = {}
+        for timestamp, bridge in statuses:
+            timestamps.setdefault(bridge.fingerprint, []).append(
+                datetime.datetime.utcfromtimestamp(timestamp))
+
+        held = []
+        addStatus = Stability.BridgeHistoryBatch.addStatus
+
+        def checkLock(batch, bridge, timestamp):
+            # Try to take the lock from another thread:
+            acquired = []
+
+            def tryLock():
+                acquired.append(Storage._LOCK.acquire(False))
+                if acquired[0]:
+                    Storage._LOCK.release()
+
+            thread = threading.Thread(target=tryLock)
+            thread.start()
+            thread.join()
+            held.append(not acquired[0])
+            return addStatus(batch, bridge, timestamp)
+
+        self.patch(Stability.BridgeHistoryBatch, 'addStatus', checkLock)
+        Stability.updateBridgeHistory(
+            dict([(b.fingerprint, b) for b in bridges]), timestamps)
+
+        self.assertTrue(held)
+        self.assertFalse(any(held))
+        self.assertEqual(len(self.getHistories()), len(bridges))
+
+    def test_BridgeHistoryBatch_benchmark(self):
+        """Compare addOrUpdateBridgeHistory() with a BridgeHistoryBatch."""
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        bridges, statuses = self.makeStatuses(count=300, hours=6)
+        random.shuffle(bridges)
+
+        with Storage.getDB() as db:
+            print("addOrUpdateBridgeHistory() for %d statuses:" % len(statuses))
+            with Benchmarker():
+                for timestamp, bridge in statuses:
+                    Stability.addOrUpdateBridgeHistory(bridge, timestamp)
+
+            db._cur.execute("DELETE FROM BridgeHistory")
+            print("BridgeHistoryBatch for %d statuses:" % len(statuses))
+            with Benchmarker():
+                batch = Stability.BridgeHistoryBatch(
+                    db.getAllBridgeHistoryRows())
+                for timestamp, bridge in statuses:
+                    batch.addStatus(bridge, timestamp)
+                batch.save(db)
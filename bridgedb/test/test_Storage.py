@@ -2,6 +2,7 @@
 """Unittests for the :mod:`bridgedb.Storage` module."""
 
 import os
+import random
 import threading
 import time
 import datetime
@@ -15,6 +16,7 @@ import bridgedb.Storage as Storage
 import bridgedb.main as main
 from bridgedb.bridges import Bridge
 
+from bridgedb.test.util import Benchmarker
 from bridgedb.test.util import generateFakeBridges
 
 class DatabaseTest(unittest.TestCase):
@@ -64,6 +66,155 @@ class DatabaseTest(unittest.TestCase):
         d2.addErrback(self._eb_Failure)
         d2.addCallback(self._cb_assertTrue, Storage.getDB(False))
 
+    def test_getDB_reusesConnection(self):
+        """Successive calls to getDB() from one thread should reuse the same
+        pooled connection, rather than re-opening the database.
+        """
+        Storage.initializeDBLock()
+        with Storage.getDB() as db1:
+            pass
+        with Storage.getDB() as db2:
+            self.assertIs(db1, db2)
+        self.assertIsNone(Storage._OPENED_DB)
+
+    def test_clearPool_closesConnections(self):
+        """clearPool() should close every pooled connection, including those
+        opened by other threads, and they shouldn't be handed out again.
+        """
+        Storage.initializeDBLock()
+        with Storage.getReadDB() as db1:
+            pass
+        opened = []
+        thread = threading.Thread(target=lambda: opened.append(
+            Storage._getPooledDB(readOnly=True)))
+        thread.start()
+        thread.join()
+
+        Storage.clearPool()
+
+        for db in [db1] + opened:
+            self.assertRaises(Storage.sqlite3.ProgrammingError,
+                              db._conn.execute, "SELECT 1")
+        with Storage.getReadDB() as db2:
+            self.assertIsNot(db1, db2)
+
+    def test_getPooledDB_perThread(self):
+        """Each thread should get its own connection, which is dropped from
+        the pool when the thread exits.
+        """
+        Storage.initializeDBLock()
+        opened = []
+        thread = threading.Thread(target=lambda: opened.append(
+            Storage._getPooledDB(readOnly=True)))
+        thread.start()
+        thread.join()
+
+        with Storage.getReadDB() as db:
+            self.assertIsNot(db, opened[0])
+        self.assertIn(opened[0], Storage._POOLED)
+        del opened[:]
+        self.assertEqual(len(Storage._POOLED), 1)
+
+    def test_getTransactionDB_commits(self):
+        """Changes made within getTransactionDB() should be committed, without
+        taking the lock used by getDB().
+        """
+        Storage.initializeDBLock()
+        with Storage.getTransactionDB() as db:
+            self.assertFalse(Storage.dbIsLocked())
+            db.setEmailTime('a@b.c', 1200)
+        with Storage.getReadDB() as db:
+            self.assertEqual(db.getEmailTime('a@b.c'), 1200)
+
+    def test_getTransactionDB_rollsBack(self):
+        """Changes made within getTransactionDB() should be rolled back if it
+        raises an exception.
+        """
+        Storage.initializeDBLock()
+
+        def fail():
+            with Storage.getTransactionDB() as db:
+                db.setEmailTime('a@b.c', 1200)
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        with Storage.getReadDB() as db:
+            self.assertIsNone(db.getEmailTime('a@b.c'))
+
+    def test_getTransactionDB_withinGetDB(self):
+        """getTransactionDB() within getDB() should use getDB()'s transaction,
+        and leave it to getDB()'s caller to commit.
+        """
+        Storage.initializeDBLock()
+        with Storage.getDB() as outer:
+            with Storage.getTransactionDB() as db:
+                self.assertIs(db, outer)
+                db.setEmailTime('a@b.c', 1200)
+            self.assertTrue(outer._conn.in_transaction)
+        with Storage.getReadDB() as db:
+            self.assertIsNone(db.getEmailTime('a@b.c'))
+
+    def test_getDB_rollsBackUncommitted(self):
+        """Changes which weren't committed shouldn't outlive getDB()."""
+        bridge = self.fakeBridges[0]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db.insertBridgeAndGetRing(bridge, 'moat', time.time(),
+                                      self.validRings)
+        with Storage.getReadDB() as db:
+            self.assertIsNone(db.getBridgeDistributor(bridge, self.validRings))
+
+    def test_openDatabase_WAL(self):
+        """Databases should be opened with write-ahead logging."""
+        conn = Storage.openDatabase(self.dbfname)
+        mode, = conn.execute("PRAGMA journal_mode").fetchone()
+        conn.close()
+        self.assertEqual(mode, "wal")
+
+    def test_getReadDB_readOnly(self):
+        """The read path should refuse to write to the database."""
+        Storage.initializeDBLock()
+        with Storage.getReadDB() as db:
+            self.assertTrue(db.readOnly)
+            self.assertRaises(Storage.sqlite3.OperationalError,
+                              db.setEmailTime, 'a@b.c', time.time())
+
+    def test_getReadDB_doesNotBlock(self):
+        """Reading shouldn't wait for another thread's write transaction, and
+        should see only committed data.
+        """
+        bridge = self.fakeBridges[0]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db.insertBridgeAndGetRing(bridge, 'moat', time.time(),
+                                      self.validRings)
+            db.commit()
+
+        writing = threading.Event()
+        finish = threading.Event()
+
+        def write():
+            with Storage.getDB() as db:
+                db.updateDistributorForHexKey('https', bridge.fingerprint)
+                writing.set()
+                finish.wait(10)
+                db.commit()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            self.assertTrue(writing.wait(10))
+            with Storage.getReadDB() as db:
+                self.assertEqual(db.getBridgeDistributor(bridge, self.validRings),
+                                 'moat')
+        finally:
+            finish.set()
+            writer.join()
+
+        with Storage.getReadDB() as db:
+            self.assertEqual(db.getBridgeDistributor(bridge, self.validRings),
+                             'https')
+
     def test_insertBridgeAndGetRing_new_bridge(self):
         bridge = self.fakeBridges[0]
         Storage.initializeDBLock()
@@ -117,6 +268,99 @@ class DatabaseTest(unittest.TestCase):
             ringname = db.getBridgeDistributor(bridge, self.validRings)
             self.assertEqual(ringname, "unallocated")
 
+    def test_insertBridgesAndGetRings(self):
+        """Bulk inserts should assign the same rings as single inserts, and
+        unrecognised rings should be replaced with the default pool.
+        """
+        bridges = self.fakeBridges[:4]
+        assignments = list(zip(bridges, ['moat', 'https', 'godzilla', 'email']))
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            ringnames = db.insertBridgesAndGetRings(assignments, time.time(),
+                                                    self.validRings)
+            db.commit()
+        self.assertEqual(ringnames, ['moat', 'https', 'unallocated', 'email'])
+
+        with Storage.getDB() as db:
+            for bridge, ringname in zip(bridges, ringnames):
+                self.assertEqual(db.getBridgeDistributor(bridge, self.validRings),
+                                 ringname)
+
+    def test_insertBridgesAndGetRings_already_seen_bridge(self):
+        """Bulk inserts should update bridges which are already known, and
+        keep the last assignment for bridges given more than once.
+        """
+        bridge = self.fakeBridges[0]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db.insertBridgeAndGetRing(bridge, 'moat', time.time(),
+                                      self.validRings)
+            ringnames = db.insertBridgesAndGetRings(
+                [(bridge, 'https'), (self.fakeBridges[1], 'moat'),
+                 (self.fakeBridges[1], 'email')],
+                time.time(), self.validRings)
+            db.commit()
+        self.assertEqual(ringnames, ['https', 'moat', 'email'])
+
+        with Storage.getDB() as db:
+            self.assertEqual(len(db.getAllBridges()), 2)
+            self.assertEqual(db.getBridgeDistributor(bridge, self.validRings),
+                             'https')
+            self.assertEqual(
+                db.getBridgeDistributor(self.fakeBridges[1], self.validRings),
+                'email')
+
+    def test_updateBridgesLastSeen(self):
+        """Only the last_seen time of the given bridges should change."""
+        bridges = self.fakeBridges[:2]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db.insertBridgesAndGetRings([(b, 'https') for b in bridges],
+                                        1000000000, self.validRings)
+            db.updateBridgesLastSeen([bridges[0].fingerprint], 1500000000)
+            db.commit()
+
+        with Storage.getDB() as db:
+            seen = dict([(b.hex_key, b.last_seen) for b in db.getAllBridges()])
+        self.assertEqual(seen[bridges[0].fingerprint],
+                         Storage.timeToStr(1500000000))
+        self.assertEqual(seen[bridges[1].fingerprint],
+                         Storage.timeToStr(1000000000))
+
+    def test_getBridgeDistributors(self):
+        """Only bridges which are known, with valid rings, should be
+        returned.
+        """
+        bridges = self.fakeBridges[:3]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db.insertBridgeAndGetRing(bridges[0], 'moat', time.time(),
+                                      self.validRings)
+            db.insertBridgeAndGetRing(bridges[1], 'https', time.time(),
+                                      self.validRings)
+            distributors = db.getBridgeDistributors(bridges, ['moat'])
+        self.assertEqual(distributors, {bridges[0].fingerprint: 'moat'})
+
+    def test_getBridgeDistributors_manyChunks(self):
+        """Bridges should be looked up in chunks of at most
+        SQL_VARIABLES_PER_QUERY fingerprints, without missing any.
+        """
+        self.patch(Storage, "SQL_VARIABLES_PER_QUERY", 3)
+        bridges = self.fakeBridges[:10]
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            for bridge in bridges[:7]:
+                db.insertBridgeAndGetRing(bridge, 'moat', time.time(),
+                                          self.validRings)
+            distributors = db.getBridgeDistributors(bridges, self.validRings)
+            ringnames = db.insertBridgesAndGetRings(
+                [(bridge, 'https') for bridge in bridges], time.time(),
+                self.validRings)
+            self.assertEqual(ringnames, ['https'] * 10)
+            self.assertEqual(len(db.getAllBridges()), 10)
+        self.assertEqual(distributors, dict(
+            [(bridge.fingerprint, 'moat') for bridge in bridges[:7]]))
+
     def test_BridgeMeasurementComparison(self):
         m1 = Storage.BridgeMeasurement(0, "", "", "", "", "", "", "",
                                        "2020-06-17", 0)
@@ -132,8 +376,8 @@ class DatabaseTest(unittest.TestCase):
                                       "2020-06-17", 0)
         self.assertEquals(m.compact(), ("ru", "1.2.3.4", "1234"))
 
-    def test_fetchBridgeMeasurements(self):
-
+    def test_getBlockedBridges_ignoresOldMeasurements(self):
+        """Measurements from more than three years ago should be ignored."""
         query = "INSERT INTO BridgeMeasurements (hex_key, bridge_type, " \
                 "address, port, blocking_country, blocking_asn, " \
                 "measured_by, last_measured, verdict) VALUES ('key', " \
@@ -144,16 +388,12 @@ class DatabaseTest(unittest.TestCase):
         Storage.initializeDBLock()
         with Storage.getDB() as db:
             db._cur.execute(oldMsmt)
-            # We're calling _Database__fetchBridgeMeasurements instead of
-            # __fetchBridgeMeasurements to account for Python's name meddling.
-            rows = db._Database__fetchBridgeMeasurements()
-            # Outdated measurements should not be returned.
-            self.assertEquals(len(rows), 0)
+            # Outdated measurements should not count.
+            self.assertEquals(len(db.getBlockedBridges()), 0)
 
             db._cur.execute(newMsmt)
-            rows = db._Database__fetchBridgeMeasurements()
-            # Measurements that are "young enough" should be returned.
-            self.assertEquals(len(rows), 1)
+            # Measurements that are "young enough" should.
+            self.assertEquals(len(db.getBlockedBridges()), 1)
 
     def test_main_loadBlockedBridges(self):
         Storage.initializeDBLock()
@@ -167,6 +407,7 @@ class DatabaseTest(unittest.TestCase):
                 self.HTTPS_DIST = True
                 self.HTTPS_SHARE = 10
                 self.N_IP_CLUSTERS = 1
+                self.HTTPS_CACHED_RINGS_PER_SUBRING = 16
                 self.EMAIL_DIST = False
                 self.RESERVED_SHARE = 0
 
@@ -188,6 +429,10 @@ class DatabaseTest(unittest.TestCase):
                 return "https"
             def insertBridgeAndGetRing(self, bridge, setRing, seenAt, validRings, defaultPool="unallocated"):
                 return "https"
+            def getBridgeDistributors(self, bridges, validRings):
+                return dict([(b.fingerprint, "https") for b in bridges])
+            def insertBridgesAndGetRings(self, assignments, seenAt, validRings, defaultPool="unallocated"):
+                return ["https" for _ in assignments]
             def commit(self):
                 pass
 
@@ -270,3 +515,171 @@ class DatabaseTest(unittest.TestCase):
                   Storage.BRIDGE_BLOCKED)]
         b = Storage.getBlockedBridgesFromSql(elems)
         self.assertTrue(len(b) == 1)
+
+    def _insertRandomMeasurements(self, db, count, days=30):
+        """Insert **count** random measurements from the last **days** days."""
+        now = datetime.datetime.utcnow()
+        rows = []
+        for _ in range(count):
+            date = now - datetime.timedelta(days=random.randint(0, days))
+            rows.append(("%040d" % random.randint(0, 9), "obfs4",
+                         "1.2.3.%d" % random.randint(1, 2),
+                         str(random.randint(1000, 1001)),
+                         random.choice(["ru", "cn"]), "4321", "ooni",
+                         date.strftime("%Y-%m-%d"),
+                         random.choice([Storage.BRIDGE_BLOCKED,
+                                        Storage.BRIDGE_REACHABLE])))
+        db._cur.executemany(
+            "INSERT INTO BridgeMeasurements (hex_key, bridge_type, address, "
+            "port, blocking_country, blocking_asn, measured_by, last_measured, "
+            "verdict) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _fetchMeasurements(self, db):
+        """Get all measurement rows from the last three years, in the order
+        which :func:`~bridgedb.Storage.getBlockedBridgesFromSql` expects.
+        """
+        oldYear = datetime.datetime.utcnow() - datetime.timedelta(days=365*3)
+        db._cur.execute("SELECT * FROM BridgeMeasurements "
+                        "WHERE last_measured > ? "
+                        "ORDER BY blocking_country DESC",
+                        (oldYear.strftime("%Y-%m-%d"),))
+        return db._cur.fetchall()
+
+    def _assertSameBlockedBridges(self, db):
+        """getBlockedBridges() should believe the newest measurement for each
+        bridge, address, port, and country.
+        """
+        newest = {}
+        for m in self._fetchMeasurements(db):
+            m = Storage.BridgeMeasurement(*m)
+            key = (m.fingerprint,) + m.compact()
+            other = newest.get(key)
+            # On a tie, the bridge is considered blocked.
+            if other is None or m.newerThan(other) or \
+               (not other.newerThan(m) and m.verdict == Storage.BRIDGE_BLOCKED):
+                newest[key] = m
+        expected = {}
+        for m in newest.values():
+            if m.verdict == Storage.BRIDGE_BLOCKED:
+                expected.setdefault(m.fingerprint, []).append(m.compact())
+
+        blocked = db.getBlockedBridges()
+        self.assertEqual(sorted(blocked.keys()), sorted(expected.keys()))
+        for fingerprint in expected:
+            self.assertEqual(sorted(blocked[fingerprint]),
+                             sorted(expected[fingerprint]))
+        return blocked
+
+    def test_getBlockedBridges(self):
+        """The newest measurement for each bridge, address, port, and country
+        should win.
+        """
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            for _ in range(5):
+                self._insertRandomMeasurements(db, 200)
+                self._assertSameBlockedBridges(db)
+
+    def test_getBlockedBridges_incremental(self):
+        """Only measurements added since the last call should be read."""
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            self._insertRandomMeasurements(db, 100)
+            self.assertEqual(db.updateMeasurementVerdicts(), 100)
+            self.assertEqual(db.updateMeasurementVerdicts(), 100)
+            db.commit()
+
+        with Storage.getDB() as db:
+            self._insertRandomMeasurements(db, 50)
+            self._assertSameBlockedBridges(db)
+            db._cur.execute("SELECT value FROM Config WHERE key = ?",
+                            (Storage.MEASUREMENTS_HIGH_WATER_MARK,))
+            self.assertEqual(int(db._cur.fetchone()[0]), 150)
+
+    def test_getBlockedBridges_newerReachable(self):
+        """A newer "reachable" measurement, added later, should unblock a
+        bridge.
+        """
+        query = "INSERT INTO BridgeMeasurements (hex_key, bridge_type, " \
+                "address, port, blocking_country, blocking_asn, " \
+                "measured_by, last_measured, verdict) VALUES ('key', " \
+                "'obfs4', '1.2.3.4', '1234', 'ru', '1234', 'OONI', ?, ?)"
+        today = datetime.datetime.utcnow()
+        yesterday = today - datetime.timedelta(days=1)
+
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db._cur.execute(query, (yesterday.strftime("%Y-%m-%d"),
+                                    Storage.BRIDGE_BLOCKED))
+            self.assertEqual(db.getBlockedBridges(),
+                             {'key': [('ru', '1.2.3.4', '1234')]})
+            db._cur.execute(query, (today.strftime("%Y-%m-%d"),
+                                    Storage.BRIDGE_REACHABLE))
+            self.assertEqual(db.getBlockedBridges(), {})
+
+    def test_getBlockedBridges_outdated(self):
+        """Measurements from more than three years ago should be ignored."""
+        query = "INSERT INTO BridgeMeasurements (hex_key, bridge_type, " \
+                "address, port, blocking_country, blocking_asn, " \
+                "measured_by, last_measured, verdict) VALUES ('key', " \
+                "'obfs4', '1.2.3.4', '1234', 'ru', '1234', 'OONI', ?, ?)"
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            db._cur.execute(query, ("2017-01-01", Storage.BRIDGE_BLOCKED))
+            self.assertEqual(db.getBlockedBridges(), {})
+
+            # An outdated "reachable" measurement shouldn't unblock a bridge.
+            db._cur.execute(query, (
+                datetime.datetime.utcnow().strftime("%Y-%m-%d"),
+                Storage.BRIDGE_BLOCKED))
+            db._cur.execute(query, ("2017-01-02", Storage.BRIDGE_REACHABLE))
+            self.assertEqual(db.getBlockedBridges(),
+                             {'key': [('ru', '1.2.3.4', '1234')]})
+
+    def test_getBlockedBridges_rebuild(self):
+        """If measurements were removed, the verdicts should be rebuilt."""
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            self._insertRandomMeasurements(db, 100)
+            self._assertSameBlockedBridges(db)
+            db._cur.execute("DELETE FROM BridgeMeasurements WHERE id > 20")
+            self._assertSameBlockedBridges(db)
+            self.assertEqual(db.updateMeasurementVerdicts(), 20)
+
+    def test_openDatabase_upgradeSchema3(self):
+        """A database with schema version 3 should be upgraded to version 4."""
+        conn = Storage.sqlite3.connect(self.dbfname)
+        conn.executescript(Storage.SCHEMA3_SCRIPT)
+        conn.commit()
+        conn.close()
+
+        conn = Storage.openDatabase(self.dbfname)
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM Config WHERE key = 'schema-version'")
+        self.assertEqual(int(cur.fetchone()[0]), 4)
+        cur.execute("SELECT COUNT(*) FROM BridgeMeasurementVerdicts")
+        self.assertEqual(cur.fetchone()[0], 0)
+        conn.close()
+
+    def test_getBlockedBridges_benchmark(self):
+        """Compare reading all of the measurements each time with reading only
+        the new ones.
+        """
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        Storage.initializeDBLock()
+        with Storage.getDB() as db:
+            self._insertRandomMeasurements(db, 1000000, days=365*3)
+            db.commit()
+
+            print("Fetching and resolving all measurements:")
+            with Benchmarker():
+                Storage.getBlockedBridgesFromSql(self._fetchMeasurements(db))
+            print("Building the verdicts from scratch:")
+            with Benchmarker():
+                db.getBlockedBridges()
+            self._insertRandomMeasurements(db, 1000)
+            print("Reading 1000 new measurements:")
+            with Benchmarker():
+                db.getBlockedBridges()
@@ -13,10 +13,12 @@
 
 from __future__ import print_function
 
+import bisect
 import copy
 import io
 import ipaddr
 import logging
+import operator
 import tempfile
 import os
 
@@ -26,6 +28,8 @@ import bridgedb.Storage
 
 from bridgedb import bridgerings
 from bridgedb import crypto
+from bridgedb import filters as filters_
+from bridgedb import metrics
 from bridgedb.test import util
 from bridgedb.distributors.https.distributor import HTTPSDistributor
 from bridgedb.distributors.moat.distributor import MoatDistributor
@@ -36,6 +40,123 @@ logging.disable(50)
 #bridgerings.logging.getLogger().setLevel(10)
 
 
+class RingIndexTests(unittest.TestCase):
+    """Unittests for :class:`bridgedb.bridgerings.RingIndex`."""
+
+    def setUp(self):
+        self.index = bridgerings.RingIndex()
+        self.positions = [os.urandom(bridgerings.DIGEST_LEN) for _ in range(200)]
+
+    def naiveKeysAt(self, keys, pos, N):
+        """The original list-based ``BridgeRing._getBridgeKeysAt()``."""
+        keys = sorted(keys)
+        if N >= len(keys):
+            return keys
+        idx = bisect.bisect_left(keys, pos)
+        r = keys[idx:idx+N]
+        if len(r) < N:
+            r.extend(keys[:N - len(r)])
+        return r
+
+    def test_insert_sorted(self):
+        """Positions should always be kept in sorted order."""
+        for i, pos in enumerate(self.positions):
+            self.index.insert(pos, i)
+        self.assertEqual(list(self.index), sorted(self.positions))
+        self.assertEqual(len(self.index), len(self.positions))
+
+    def test_insert_replace(self):
+        """Inserting at an existing position should replace its bridge."""
+        pos = self.positions[0]
+        self.assertTrue(self.index.insert(pos, 'a'))
+        self.assertFalse(self.index.insert(pos, 'b'))
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.get(pos), 'b')
+
+    def test_insert_wrong_width(self):
+        """Inserting a position of the wrong length should raise ValueError."""
+        self.assertRaises(ValueError, self.index.insert, b'a' * 19, 'a')
+
+    def test_remove(self):
+        """Removed positions should not be returned by later lookups."""
+        for i, pos in enumerate(self.positions):
+            self.index.insert(pos, i)
+        for pos in self.positions[::2]:
+            self.index.remove(pos)
+        remaining = self.positions[1::2]
+        self.assertEqual(list(self.index), sorted(remaining))
+        for pos in self.positions[::2]:
+            self.assertNotIn(pos, self.index)
+            self.assertIsNone(self.index.get(pos))
+
+    def test_remove_missing(self):
+        """Removing a position which isn't there should return None."""
+        self.assertIsNone(self.index.remove(self.positions[0]))
+
+    def test_load(self):
+        """Bulk-loading should give the same index as repeated inserts."""
+        pairs = [(pos, i) for i, pos in enumerate(self.positions)]
+        for pos, i in pairs:
+            self.index.insert(pos, i)
+        loaded = bridgerings.RingIndex()
+        loaded.load(reversed(pairs))
+        self.assertEqual(list(loaded.items()), list(self.index.items()))
+
+    def test_getPositionsAt(self):
+        """Lookups (including wraparounds) should match the original sorted
+        list implementation exactly.
+        """
+        for i, pos in enumerate(self.positions):
+            self.index.insert(pos, i)
+        probes = [os.urandom(bridgerings.DIGEST_LEN) for _ in range(50)]
+        probes += [b'\x00' * 20, b'\xff' * 20] + self.positions[:10]
+        for probe in probes:
+            for N in (1, 3, 6, 199, 200, 500):
+                self.assertEqual(self.index.getPositionsAt(probe, N),
+                                 self.naiveKeysAt(self.positions, probe, N))
+
+    def test_load_thenInsert(self):
+        """An index which was bulk-loaded, and then searched and changed,
+        should match one built by repeated inserts.
+        """
+        half = len(self.positions) // 2
+        self.index.load([(pos, i) for i, pos in
+                         enumerate(self.positions[:half])])
+        self.assertIsNone(self.index._keys)
+        for pos in self.positions[:half:3]:
+            self.index.remove(pos)
+        for i, pos in enumerate(self.positions[half:]):
+            self.index.insert(bytearray(pos), half + i)
+
+        inserted = bridgerings.RingIndex()
+        for i, pos in enumerate(self.positions):
+            if pos not in self.positions[:half:3]:
+                inserted.insert(pos, i)
+        self.assertEqual(list(self.index.items()), list(inserted.items()))
+        self.assertEqual(self.index._getKeys(), list(inserted))
+        self.assertTrue(all(type(key) is bytes for key in self.index._keys))
+
+        copied = self.index.copy()
+        copied.remove(self.positions[-1])
+        self.assertIn(self.positions[-1], self.index)
+
+    def test_asMapping(self):
+        """asMapping() should be cached until the index is next changed."""
+        for i, pos in enumerate(self.positions[:10]):
+            self.index.insert(pos, i)
+        mapping = self.index.asMapping()
+        self.assertEqual(dict(mapping), dict(self.index.items()))
+        self.assertIs(self.index.asMapping(), mapping)
+        self.assertRaises(TypeError, operator.setitem,
+                          mapping, self.positions[10], 10)
+
+        self.index.insert(self.positions[10], 10)
+        self.assertIsNot(self.index.asMapping(), mapping)
+        self.assertIn(self.positions[10], self.index.asMapping())
+        self.index.remove(self.positions[0])
+        self.assertNotIn(self.positions[0], self.index.asMapping())
+
+
 class BridgeRingTests(unittest.TestCase):
     """Unittests for :class:`bridgedb.bridgerings.BridgeRing`."""
 
@@ -87,6 +208,32 @@ class BridgeRingTests(unittest.TestCase):
 
         self.assertGreaterEqual(len(bridges), 1)
 
+    def test_filterDistinctSubnets_matches_ipaddr(self):
+        """The bridges chosen by filterDistinctSubnets() should be the same as
+        those chosen by checking each one against ipaddr networks.
+        """
+        bridges = copy.deepcopy(util.generateFakeBridges())
+        for i, bridge in enumerate(bridges):
+            if i % 3:
+                bridge.address = ipaddr.IPAddress("81.%d.%d.1" % (i % 7, i % 256))
+            else:
+                bridge.address = ipaddr.IPAddress("2001:%x::%x" % (i % 5, i))
+            self.ring.insert(bridge)
+
+        chosen = list(self.ring.bridges.keys())
+        expected = []
+        subnets = []
+        for fingerprint in chosen:
+            bridge = self.ring.positions.get(fingerprint)
+            if any(bridge.address in subnet for subnet in subnets):
+                continue
+            expected.append(bridge)
+            prefix = "/16" if bridge.address.version == 4 else "/32"
+            subnets.append(ipaddr.IPNetwork(str(bridge.address) + prefix))
+
+        self.assertEqual(len(expected), 12)
+        self.assertEqual(self.ring.filterDistinctSubnets(chosen), expected)
+
     def test_clear(self):
         """Clear should get rid of all the inserted bridges."""
         self.addRandomBridges()
@@ -94,6 +241,64 @@ class BridgeRingTests(unittest.TestCase):
         self.ring.clear()
         self.assertEqual(len(self.ring), 0)
 
+    def test_remove(self):
+        """Removed bridges should never be handed out again."""
+        self.addRandomBridges()
+        bridges = list(self.ring.bridges.values())
+        for bridge in bridges[:250]:
+            self.ring.remove(bridge)
+        self.assertEqual(len(self.ring), len(bridges) - 250)
+        self.assertIsNone(self.ring.getBridgeByID(bridges[0].identity))
+
+        answer = self.ring.getBridges(b'a' * bridgerings.DIGEST_LEN, N=500)
+        self.assertEqual(len(answer), len(bridges) - 250)
+        for bridge in bridges[:250]:
+            self.assertNotIn(bridge, answer)
+
+    def test_bulkInsert(self):
+        """Bulk-inserting bridges should give the same hashring (and subrings)
+        as inserting them one at a time.
+        """
+        params = bridgerings.BridgeRingParameters(needPorts=[(443, 1)],
+                                                  needFlags=[("Stable", 1)])
+        bridges = copy.deepcopy(util.generateFakeBridges())
+        ring = bridgerings.BridgeRing('fake-hmac-key', params)
+        bulk = bridgerings.BridgeRing('fake-hmac-key', params)
+
+        [ring.insert(bridge) for bridge in bridges]
+        bulk.bulkInsert(bridges[:100])
+        bulk.bulkInsert(bridges[100:])
+
+        self.assertEqual(list(bulk.positions.items()),
+                         list(ring.positions.items()))
+        for (_, _, _, a), (_, _, _, b) in zip(ring.subrings, bulk.subrings):
+            self.assertEqual(list(b.positions.items()),
+                             list(a.positions.items()))
+
+    def test_copy(self):
+        """A copy should hold the same bridges, and be independent of the
+        original.
+        """
+        params = bridgerings.BridgeRingParameters(needPorts=[(443, 1)],
+                                                  needFlags=[("Stable", 1)])
+        ring = bridgerings.BridgeRing('fake-hmac-key', params)
+        ring.setName("Original")
+        bridges = copy.deepcopy(util.generateFakeBridges())
+        ring.bulkInsert(bridges)
+
+        other = ring.copy()
+        self.assertEqual(other.name, ring.name)
+        self.assertEqual(list(other.positions.items()),
+                         list(ring.positions.items()))
+        self.assertEqual(len(other.subrings), len(ring.subrings))
+
+        other.remove(bridges[0])
+        self.assertEqual(len(other), len(ring) - 1)
+        self.assertIs(ring.getBridgeByID(bridges[0].identity), bridges[0])
+        for (_, _, _, a), (_, _, _, b) in zip(ring.subrings, other.subrings):
+            self.assertIsNot(a, b)
+            self.assertIsNone(b.getBridgeByID(bridges[0].identity))
+
     def test_getBridges_filterBySubnet(self):
         """We should still get the number of bridges we asked for, even when
         filtering by distinct subnets.
@@ -120,6 +325,243 @@ class BridgeRingTests(unittest.TestCase):
         self.assertIn(first, data)
 
 
+class FilteredBridgeSplitterTests(unittest.TestCase):
+    """Unittests for :class:`bridgedb.bridgerings.FilteredBridgeSplitter`."""
+
+    def setUp(self):
+        self.bridges = copy.deepcopy(util.generateFakeBridges())
+        self.dist = HTTPSDistributor(3, 'fake-hmac-key')
+        [self.dist.insert(bridge) for bridge in self.bridges]
+
+    def test_addRings(self):
+        """Adding rings in bulk should populate them with exactly the bridges
+        which pass each ring's filters.
+        """
+        self.dist.prepopulateRings()
+        self.assertEqual(len(self.dist.hashring.filterRings), 6)
+
+        for filterFn, subring in self.dist.hashring.filterRings.values():
+            expected = [b for b in self.bridges if filterFn(b)]
+            self.assertEqual(len(subring), len(expected))
+            for bridge in expected:
+                self.assertIs(subring.getBridgeByID(bridge.identity), bridge)
+
+    def test_addRings_matches_addRing(self):
+        """Adding rings in bulk should give the same ring ordering as adding
+        them one at a time.
+        """
+        rings = []
+        for subring in range(1, 4):
+            filters = self.dist._buildHashringFilters([filters_.byIPv4], subring)
+            rings.append((filters, crypto.getHMAC('key', str(subring))))
+
+        other = HTTPSDistributor(3, 'fake-hmac-key')
+        [other.insert(bridge) for bridge in self.bridges]
+
+        self.dist.hashring.addRings(
+            [(bridgerings.BridgeRing(key), filters, filters_.byFilters(filters))
+             for filters, key in rings],
+            populate_from=self.dist.hashring.bridges)
+        for filters, key in rings:
+            other.hashring.addRing(bridgerings.BridgeRing(key), filters,
+                                   filters_.byFilters(filters),
+                                   populate_from=other.hashring.bridges)
+
+        for filters, _ in rings:
+            _, bulk = self.dist.hashring.filterRings[filters]
+            _, single = other.hashring.filterRings[filters]
+            self.assertGreater(len(bulk), 0)
+            self.assertEqual(list(bulk.positions.items()),
+                             list(single.positions.items()))
+
+    def test_addRings_duplicate(self):
+        """Rings which already exist should not be added again."""
+        filters = self.dist._buildHashringFilters([filters_.byIPv4], 1)
+        rings = [(bridgerings.BridgeRing('a'), filters, filters_.byFilters(filters)),
+                 (bridgerings.BridgeRing('b'), filters, filters_.byFilters(filters))]
+        added = self.dist.hashring.addRings(rings,
+                                            populate_from=self.dist.hashring.bridges)
+        self.assertEqual(added, 1)
+
+
+    def test_populateRings_index_matches_scan(self):
+        """Subrings populated from the attribute index should hold the same
+        bridges as ones populated by calling the filters on every bridge,
+        even after bridges have been removed and (re)inserted.
+        """
+        for bridge in self.bridges[::7]:
+            bridge.setBlockedIn('ir')
+        for bridge in self.bridges[::3]:
+            bridge.setBlockedIn('cn', methodname='obfs4')
+        dist = HTTPSDistributor(3, 'fake-hmac-key')
+        [dist.insert(bridge) for bridge in self.bridges]
+        dist.prepopulateRings()
+
+        combinations = [
+            [filters_.byIPv6],
+            [filters_.byTransport('obfs4')],
+            [filters_.byTransport('obfs4', 6)],
+            [filters_.byNotBlockedIn('ir')],
+            [filters_.byNotBlockedIn('cn', 'obfs4'), filters_.byIPv4],
+            [filters_.byProbingResistance('vanilla', 4)],
+        ]
+
+        def check():
+            for combination in combinations:
+                for subring in range(1, 4):
+                    filters = dist._buildHashringFilters(combination, subring)
+                    indexed = bridgerings.BridgeRing('key')
+                    scanned = bridgerings.BridgeRing('key')
+                    dist.hashring._populateRings(
+                        [(filters, filters_.byFilters(filters), indexed)],
+                        dist.hashring.bridges)
+                    dist.hashring._populateRings(
+                        [(filters, filters_.byFilters(filters), scanned)],
+                        dict(dist.hashring.bridges))
+                    self.assertEqual(list(indexed.positions.items()),
+                                     list(scanned.positions.items()))
+
+        check()
+        self.assertGreater(len(dist.hashring._filterBits), 6)
+
+        for bridge in self.bridges[:100]:
+            dist.hashring.remove(bridge)
+        check()
+        for bridge in self.bridges[50:150]:
+            dist.insert(bridge)
+        check()
+
+        for bridge in self.bridges[:200]:
+            dist.hashring.remove(bridge)
+        for bridge in self.bridges[:200:2]:
+            bridge.setBlockedIn('ir')
+        dist.hashring.insertMany(self.bridges[:200])
+        check()
+
+    def test_insertMany_matches_insert(self):
+        """insertMany() should leave the subrings and the attribute index
+        exactly as calling insert() for each bridge would.
+        """
+        one = HTTPSDistributor(3, 'fake-hmac-key')
+        many = HTTPSDistributor(3, 'fake-hmac-key')
+        for dist in (one, many):
+            [dist.insert(bridge) for bridge in self.bridges[:100]]
+            dist.prepopulateRings()
+
+        for bridge in self.bridges[100:]:
+            one.hashring.insert(bridge)
+        many.hashring.insertMany(self.bridges[100:])
+
+        self.assertEqual(one.hashring._filterBits, many.hashring._filterBits)
+        self.assertEqual(list(one.hashring.filterRings),
+                         list(many.hashring.filterRings))
+        for ringname in one.hashring.filterRings:
+            self.assertEqual(
+                list(one.hashring.filterRings[ringname][1].positions.items()),
+                list(many.hashring.filterRings[ringname][1].positions.items()))
+
+    def test_iterBits(self):
+        """_iterBits() should give the positions of the set bits."""
+        self.assertEqual(list(bridgerings._iterBits(0)), [])
+        self.assertEqual(list(bridgerings._iterBits((1 << 300) | 6)),
+                         [1, 2, 300])
+
+    def test_packBits(self):
+        """_packBits() should set exactly the bits at the given positions."""
+        self.assertEqual(bridgerings._packBits([], 0), 0)
+        self.assertEqual(bridgerings._packBits([300, 1, 2], 301),
+                         (1 << 300) | 6)
+
+    def test_getFilterBits(self):
+        """_getFilterBits() should set exactly the bits of the slots whose
+        bridges pass the filter, skipping free slots.
+        """
+        hashring = self.dist.hashring
+        for bridge in self.bridges[:20]:
+            hashring.remove(bridge)
+        filterFn = filters_.byIPv6
+
+        bits = hashring._getFilterBits(filterFn)
+
+        expected = [slot for slot, bridge in enumerate(hashring._slotBridges)
+                    if bridge is not None and filterFn(bridge)]
+        self.assertTrue(expected)
+        self.assertEqual(list(bridgerings._iterBits(bits)), expected)
+        self.assertIs(hashring._getFilterBits(filterFn), bits)
+
+    def addTransportRings(self, transports):
+        """Add an unpinned subring for each of the **transports**, as if
+        clients had asked for them.
+        """
+        ringnames = []
+        for transport in transports:
+            filters = self.dist._buildHashringFilters(
+                [filters_.byIPv4, filters_.byTransport(transport)], 1)
+            self.dist.hashring.addRing(bridgerings.BridgeRing('key'), filters,
+                                       filters_.byFilters(filters),
+                                       populate_from=self.dist.hashring.bridges)
+            ringnames.append(filters)
+        return ringnames
+
+    def test_getRing(self):
+        """getRing() should return the subring, or None, and count hits and
+        misses.
+        """
+        metrics.InternalMetrics.clear()
+        self.dist.prepopulateRings()
+        ringname, (_, subring) = list(self.dist.hashring.filterRings.items())[0]
+
+        self.assertIs(self.dist.hashring.getRing(ringname), subring)
+        self.assertIsNone(self.dist.hashring.getRing(frozenset()))
+        self.assertEqual(self.dist.hashring.hits, 1)
+        self.assertEqual(self.dist.hashring.misses, 1)
+
+        hotMetrics = metrics.InternalMetrics().hotMetrics
+        self.assertEqual(hotMetrics["internal.https.ring-cache.hits"], 1)
+        self.assertEqual(hotMetrics["internal.https.ring-cache.misses"], 1)
+
+    def test_max_cached_rings(self):
+        """Once there are more than max_cached_rings unpinned subrings, the
+        least recently used ones should be dropped, but never the pinned
+        (prepopulated) ones.
+        """
+        metrics.InternalMetrics.clear()
+        self.dist.prepopulateRings()
+        pinned = list(self.dist.hashring.filterRings.keys())
+        self.dist.hashring.max_cached_rings = 2
+
+        obfs2, obfs3 = self.addTransportRings(['obfs2', 'obfs3'])
+        self.assertEqual(len(self.dist.hashring.filterRings), 8)
+        self.dist.hashring.getRing(obfs2)
+        obfs4, = self.addTransportRings(['obfs4'])
+
+        self.assertEqual(len(self.dist.hashring.filterRings), 8)
+        self.assertEqual(self.dist.hashring.evictions, 1)
+        self.assertNotIn(obfs3, self.dist.hashring.filterRings)
+        self.assertIn(obfs2, self.dist.hashring.filterRings)
+        self.assertIn(obfs4, self.dist.hashring.filterRings)
+        for ringname in pinned:
+            self.assertIn(ringname, self.dist.hashring.filterRings)
+
+        hotMetrics = metrics.InternalMetrics().hotMetrics
+        self.assertEqual(hotMetrics["internal.https.ring-cache.evictions"], 1)
+
+    def test_copyFrom_pinned(self):
+        """copyFrom() should keep the other hashring's pinned subrings
+        pinned.
+        """
+        self.dist.prepopulateRings()
+        self.addTransportRings(['obfs4'])
+        other = HTTPSDistributor(3, 'fake-hmac-key')
+        other.hashring.copyFrom(self.dist.hashring)
+        other.hashring.max_cached_rings = 0
+        other.hashring._evictRings()
+
+        self.assertEqual(other.hashring.pinnedRings,
+                         self.dist.hashring.pinnedRings)
+        self.assertEqual(len(other.hashring.filterRings), 6)
+
+
 class BridgeSplitterTests(unittest.TestCase):
     """Unittests for :class:`bridgedb.bridgerings.BridgeSplitter`."""
 
@@ -165,6 +607,38 @@ class BridgeSplitterTests(unittest.TestCase):
         all_subrings = [subring for _, subring in ring.filterRings.values()]
         return sum([len(subring) for subring in all_subrings])
 
+    def _newSplitter(self):
+        """Create another splitter laid out like :data:`splitter`, and return
+        it along with its HTTPS distributor.
+        """
+        key = 'fake-hmac-key'
+        splitter = bridgerings.BridgeSplitter(key)
+        ringParams = bridgerings.BridgeRingParameters(needPorts=[(443, 1)],
+                                                      needFlags=[("Stable", 1)])
+        https = HTTPSDistributor(4, crypto.getHMAC(key, "HTTPS-IP-Dist-Key"),
+                                 None, answerParameters=ringParams)
+        moat = MoatDistributor(4, crypto.getHMAC(key, "Moat-Dist-Key"),
+                               None, answerParameters=ringParams)
+        splitter.addRing(https.hashring, "https", p=10)
+        splitter.addRing(moat.hashring, "moat", p=10)
+        splitter.addRing(bridgerings.UnallocatedHolder(), "unallocated", p=10)
+        return splitter, https
+
+    def _contents(self, splitter):
+        """Get the fingerprints of the bridges in every ring and subring of
+        **splitter**, in hashring order.
+        """
+        contents = {}
+        for name, ring in splitter.ringsByName.items():
+            if name == "unallocated":
+                contents[name] = sorted(ring.fingerprints)
+                continue
+            contents[name] = sorted(ring.bridges)
+            for ringname, (_, subring) in ring.filterRings.items():
+                contents[(name, ringname)] = [
+                    b.fingerprint for b in subring.positions.bridges()]
+        return contents
+
     def test_no_distribution(self):
         """Make sure that bridges can un-distribute themselves."""
         bridge = self.bridges[0]
@@ -231,6 +705,83 @@ class BridgeSplitterTests(unittest.TestCase):
         self.assertEqual(len(self.moat_ring), 0)
         self.assertEqual(self._len_all_subrings(self.moat_ring), 0)
 
+    def test_insertMany(self):
+        """Inserting many bridges at once should place them exactly as
+        inserting them one at a time does.
+        """
+        self.splitter.insertMany(self.bridges[:100])
+        first = dict([(name, sorted([b.fingerprint for b in ring.bridges.values()]))
+                      for name, ring in self.splitter.ringsByName.items()
+                      if name != "unallocated"])
+        self.assertEqual(sum([len(v) for v in first.values()]) +
+                         len(self.unallocated_ring), 100)
+
+        # Inserting them again, one by one, shouldn't move any of them:
+        self.splitter.clear()
+        [self.splitter.insert(bridge) for bridge in self.bridges[:100]]
+        second = dict([(name, sorted([b.fingerprint for b in ring.bridges.values()]))
+                       for name, ring in self.splitter.ringsByName.items()
+                       if name != "unallocated"])
+        self.assertEqual(first, second)
+
+    def test_copyFrom(self):
+        """Copying a splitter should copy all of its rings and subrings,
+        without sharing any of them.
+        """
+        self.splitter.insertMany(self.bridges[:100])
+        self.https_distributor.prepopulateRings()
+
+        other, https = self._newSplitter()
+        other.copyFrom(self.splitter)
+        self.assertEqual(self._contents(other), self._contents(self.splitter))
+        self.assertEqual(len(other.bridges), len(self.splitter.bridges))
+
+        bridge = list(self.https_ring.bridges.values())[0]
+        other.remove(bridge)
+        self.assertNotIn(bridge, other.ringsByName["https"])
+        self.assertNotIn(bridge.fingerprint, other.bridges)
+        self.assertIn(bridge, self.https_ring)
+        self.assertLess(self._len_all_subrings(https.hashring),
+                        self._len_all_subrings(self.https_ring))
+
+    def test_copyFrom_differentRings(self):
+        """Copying from a splitter with different rings should fail."""
+        other = bridgerings.BridgeSplitter('fake-hmac-key')
+        other.addRing(bridgerings.UnallocatedHolder(), "unallocated", p=10)
+        self.assertRaises(ValueError, self.splitter.copyFrom, other)
+
+    def test_update(self):
+        """Updating a splitter should touch only the bridges which changed,
+        and give the same rings as building them from scratch.
+        """
+        self.splitter.insertMany(self.bridges[:100])
+        self.https_distributor.prepopulateRings()
+
+        # Reparse: ten bridges went away, ten got new descriptors, and ten
+        # are new.
+        bridges = copy.deepcopy(self.bridges[10:110])
+        for bridge in bridges[:10]:
+            bridge.descriptorDigest = "0" * 40
+        inserted, removed = self.splitter.update(bridges)
+        self.assertEqual(inserted, 20)
+        self.assertEqual(removed, 20)
+
+        # Unchanged bridges are kept as they were:
+        for bridge in self.https_ring.bridges.values():
+            fresh = [b for b in bridges if b.fingerprint == bridge.fingerprint][0]
+            if bridges.index(fresh) < 10 or bridges.index(fresh) >= 90:
+                self.assertIs(bridge, fresh)
+            else:
+                self.assertIsNot(bridge, fresh)
+
+        other, https = self._newSplitter()
+        other.insertMany(bridges)
+        https.prepopulateRings()
+        self.assertEqual(self._contents(other), self._contents(self.splitter))
+
+        # Nothing changed, so nothing should be touched:
+        self.assertEqual(self.splitter.update(copy.deepcopy(bridges)), (0, 0))
+
     def test_https_remove(self):
         """Make sure that we can remove bridges from our BridgeRing."""
         bridge = self.bridges[0]
@@ -29,6 +29,7 @@ from bridgedb.bridgerequest import BridgeRequestBase
 from bridgedb.parse import descriptors
 from bridgedb.parse.addr import PortList
 from bridgedb.parse.nickname import InvalidRouterNickname
+from bridgedb.test.util import Benchmarker
 
 
 # Don't print "WARNING:root: Couldn't parse K=V from PT arg: ''" a bunch of
@@ -459,6 +460,31 @@ class BridgeAddressBaseTests(unittest.TestCase):
         self.assertIsNone(self.bab.address)
         self.assertIsNone(self.bab._address)
 
+    def test_BridgeAddressBase_subnetPrefix(self):
+        """The subnetPrefix should be the same for addresses in the same IPv4
+        /16 or IPv6 /32, and should be reset along with the address.
+        """
+        self.assertIsNone(self.bab.subnetPrefix)
+
+        self.bab.address = '11.12.13.14'
+        ipv4 = self.bab.subnetPrefix
+        self.bab.address = '11.12.200.1'
+        self.assertEqual(self.bab.subnetPrefix, ipv4)
+        self.bab.address = '11.13.13.14'
+        self.assertNotEqual(self.bab.subnetPrefix, ipv4)
+
+        self.bab.address = '2001:db8::1'
+        ipv6 = self.bab.subnetPrefix
+        self.bab.address = '2001:db8:ffff::1'
+        self.assertEqual(self.bab.subnetPrefix, ipv6)
+        self.assertNotEqual(ipv6, ipv4)
+        # An IPv6 address whose first 16 bits match the IPv4 prefix value:
+        self.bab.address = '::b0c:0:0:0:0:1'
+        self.assertNotEqual(self.bab.subnetPrefix, ipv4)
+
+        del(self.bab.address)
+        self.assertIsNone(self.bab.subnetPrefix)
+
     def test_BridgeAddressBase_country(self):
         """The getter method for the country property should get the
         address's geoIP country code.
@@ -1239,6 +1265,98 @@ class BridgeTests(unittest.TestCase):
         self.assertEqual(self.bridge.bandwidthObserved, 1623207134)
         self.assertEqual(len(self.bridge.transports), 4)
 
+    def test_Bridge_slots(self):
+        """Bridges, their Flags, and their PluggableTransports shouldn't each
+        have a ``__dict__``.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        self.bridge.updateFromServerDescriptor(self.serverdescriptor)
+        self.bridge.updateFromExtraInfoDescriptor(self.extrainfo)
+
+        self.assertFalse(hasattr(self.bridge, '__dict__'))
+        self.assertFalse(hasattr(self.bridge.flags, '__dict__'))
+        for pt in self.bridge.transports:
+            self.assertFalse(hasattr(pt, '__dict__'))
+
+    def test_Bridge_shared_addresses(self):
+        """A Bridge's PluggableTransports which use the same IP address as the
+        Bridge should share its address object and fingerprint string.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        self.bridge.updateFromServerDescriptor(self.serverdescriptor)
+        self.bridge.updateFromExtraInfoDescriptor(self.extrainfo)
+
+        self.assertEqual(len(self.bridge.transports), 4)
+        for pt in self.bridge.transports:
+            self.assertIs(pt.fingerprint, self.bridge.fingerprint)
+            self.assertIs(pt.address, self.bridge.address)
+
+        other = bridges.Bridge()
+        other.updateFromNetworkStatus(self.networkstatus)
+        self.assertIs(other.address, self.bridge.address)
+        self.assertIs(other.orAddresses[0][0], self.bridge.orAddresses[0][0])
+
+    def test_Bridge_setBlockedIn_interned(self):
+        """Bridges blocked in the same country should share the country code
+        string.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        other = bridges.Bridge()
+        other.updateFromNetworkStatus(self.networkstatus)
+
+        self.bridge.setBlockedIn(''.join(['C', 'N']))
+        other.setBlockedIn(''.join(['c', 'n']))
+
+        self.assertIs(list(self.bridge._blockedIn.values())[0][0],
+                      list(other._blockedIn.values())[0][0])
+
+    def test_Bridge_memory_benchmark(self):
+        """Report the number of bytes used by each Bridge (and its transports,
+        blocking info, and stored descriptors).
+
+        Before Bridges and PluggableTransports used ``__slots__`` and shared
+        their strings and addresses, this was 16354 bytes per bridge.
+        """
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        import gc
+        import tracemalloc
+
+        count = 2000
+        self._writeDescriptorFiles(BRIDGE_NETWORKSTATUS * count,
+                                   BRIDGE_SERVER_DESCRIPTOR * count,
+                                   BRIDGE_EXTRAINFO * count,
+                                   BRIDGE_EXTRAINFO_NEW)
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        print()
+        allBridges = []
+        with Benchmarker():
+            for ns, server, extrainfo in zip(
+                    descriptors.parseNetworkStatusFile(self._networkstatusFile),
+                    descriptors.iterServerDescriptorsFile(self._serverDescriptorFile),
+                    descriptors.iterExtraInfoFiles(self._extrainfoFile)):
+                bridge = bridges.Bridge()
+                bridge.updateFromNetworkStatus(
+                    descriptors.NetworkStatusRecord.fromDescriptor(ns))
+                bridge.updateFromServerDescriptor(
+                    descriptors.ServerDescriptorRecord.fromDescriptor(server))
+                bridge.updateFromExtraInfoDescriptor(
+                    descriptors.ExtraInfoRecord.fromDescriptor(extrainfo))
+                bridge.setBlockedIn('cn')
+                bridge.setBlockedIn('ir')
+                allBridges.append(bridge)
+
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print("Benchmark: %d bytes per bridge (16354 before)"
+              % ((after - before) / count))
+
     def test_Bridge_updateFromExtraInfoDescriptor_bad_signature_changed(self):
         """Calling updateFromExtraInfoDescriptor() with a descriptor which
         has a bad signature should not continue to process the descriptor.
@@ -1750,6 +1868,89 @@ class BridgeTests(unittest.TestCase):
         self.assertTrue(self.bridge.addressIsBlockedIn('GB', '179.178.155.140', 36493))
         self.assertFalse(self.bridge.addressIsBlockedIn('gb', '179.178.155.140', 36488))
 
+    def test_Bridge_buildBlockingIndex(self):
+        """The blocking index should agree with the blocking reports on which
+        addresses and transports are blocked where.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        self.bridge.updateFromServerDescriptor(self.serverdescriptor)
+        self.bridge.updateFromExtraInfoDescriptor(self.extrainfo)
+
+        self.bridge.setBlockedIn('GB', address='179.178.155.140', port=36493)
+        self.bridge.setBlockedIn('cn', methodname='obfs2')
+        self.bridge.setBlockedIn('IR', methodname='vanilla')
+
+        index = self.bridge.buildBlockingIndex()
+        self.assertIs(index, self.bridge.buildBlockingIndex())
+        self.assertTrue(index.mask & bridges._getCountryBit('gb'))
+        self.assertTrue(index.mask & bridges._getCountryBit('CN'))
+        self.assertTrue(index.mask & bridges._getCountryBit('ir'))
+        self.assertFalse(index.mask & bridges._getCountryBit('de'))
+
+        for cc in ('gb', 'cn', 'ir', 'de'):
+            for methodname in self.bridge.supportedTransportTypes + ['foo']:
+                expected = any([
+                    self.bridge.addressIsBlockedIn(cc, pt.address, pt.port)
+                    for pt in self.bridge.transports
+                    if pt.methodname == methodname])
+                self.assertEqual(
+                    self.bridge.transportIsBlockedIn(cc, methodname), expected)
+            for address, port, version, mask in index.vanilla:
+                self.assertEqual(
+                    bool(mask & bridges._getCountryBit(cc)),
+                    self.bridge.addressIsBlockedIn(cc, address, port))
+
+    def test_Bridge_buildBlockingIndex_reset(self):
+        """Replacing or adding to the blocking reports should rebuild the
+        blocking index.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        self.bridge.updateFromServerDescriptor(self.serverdescriptor)
+        self.bridge.updateFromExtraInfoDescriptor(self.extrainfo)
+
+        self.bridge.setBlockedIn('cn', methodname='obfs2')
+        self.assertTrue(self.bridge.isBlockedIn('cn'))
+        self.assertFalse(self.bridge.isBlockedIn('ir'))
+
+        self.bridge.setBlockedIn('ir', methodname='obfs4')
+        self.assertTrue(self.bridge.isBlockedIn('ir'))
+        self.assertTrue(self.bridge.transportIsBlockedIn('ir', 'obfs4'))
+
+        self.bridge._blockedIn = {}
+        self.assertFalse(self.bridge.isBlockedIn('cn'))
+        self.assertFalse(self.bridge.transportIsBlockedIn('ir', 'obfs4'))
+
+    def test_Bridge_buildBlockingIndex_addressChanged(self):
+        """Changing the bridge's address, ORPort, or additional ORPort
+        addresses should rebuild the blocking index.
+        """
+        self.bridge.updateFromNetworkStatus(self.networkstatus)
+        self.bridge.updateFromServerDescriptor(self.serverdescriptor)
+        self.bridge.updateFromExtraInfoDescriptor(self.extrainfo)
+        oldAddress, oldPort = self.bridge.address, self.bridge.orPort
+        newAddress = ipaddr.IPAddress('1.2.3.4')
+
+        def blockedVanillas():
+            index = self.bridge.buildBlockingIndex()
+            return sorted([(str(address), port) for address, port, _, mask
+                           in index.vanilla if mask])
+
+        self.bridge.setBlockedIn('cn', address=str(oldAddress), port=oldPort)
+        # The bridge doesn't have this address yet, so setBlockedIn() would
+        # ignore it:
+        self.bridge._addBlockByKey(
+            self.bridge._getBlockKey(newAddress, 443), 'ir')
+        self.assertEqual(blockedVanillas(), [(str(oldAddress), oldPort)])
+
+        self.bridge.address = newAddress
+        self.assertEqual(blockedVanillas(), [])
+        self.bridge.orPort = 443
+        self.assertEqual(blockedVanillas(), [(str(newAddress), 443)])
+
+        self.bridge.orAddresses = [(oldAddress, oldPort, 4)]
+        self.assertEqual(blockedVanillas(), [(str(newAddress), 443),
+                                             (str(oldAddress), oldPort)])
+
     def test_Bridge_updateFromExtraInfoDescriptor_changed_no_verify(self):
         """A changed extrainfo descriptor should log that a transport's
         IP and/or port changed.
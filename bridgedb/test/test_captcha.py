@@ -11,11 +11,16 @@
 
 
 import os
+import random
 import shutil
+import tempfile
 import time
 
+from base64 import b64encode
 from base64 import urlsafe_b64decode
 
+from twisted.internet import defer
+from twisted.internet import task
 from twisted.trial import unittest
 
 from zope.interface import implementedBy
@@ -23,6 +28,7 @@ from zope.interface import providedBy
 
 from bridgedb import captcha
 from bridgedb import crypto
+from bridgedb.test.util import Benchmarker
 
 
 class CaptchaTests(unittest.TestCase):
@@ -335,3 +341,230 @@ class GimpCaptchaTests(unittest.TestCase):
         self.assertEquals(
             c.check(challenge, c.answer, secretKeyBad, c.hmacKey),
             False)
+
+    def test_get_pool(self):
+        """GimpCaptcha.get() with a pool should choose a CAPTCHA from it."""
+        pool = captcha.CaptchaPool(self.cacheDir)
+        c = captcha.GimpCaptcha(self.publik, self.sekrit, self.hmacKey,
+                                self.cacheDir, pool)
+        image, challenge = c.get()
+        self.assertEqual((c.answer, image, None), pool.pick())
+        self.assertEqual(c.getEncodedImage(), b64encode(image))
+        self.assertTrue(c.check(challenge, c.answer, c.secretKey, c.hmacKey))
+
+
+class CaptchaPoolTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.captcha.CaptchaPool`."""
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        for answer in ('abc', 'def', 'ghi'):
+            self.addCaptcha(answer)
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def addCaptcha(self, answer):
+        with open(os.path.join(self.cacheDir, answer + '.jpg'), 'wb') as fh:
+            fh.write(answer.encode('utf-8') * 10)
+
+    def touch(self):
+        """Make sure the cache dir looks like it has changed."""
+        stat = os.stat(self.cacheDir)
+        os.utime(self.cacheDir, (stat.st_atime, stat.st_mtime + 10))
+
+    def makePool(self, **kwargs):
+        return captcha.CaptchaPool(self.cacheDir,
+                                   runInThread=defer.maybeDeferred, **kwargs)
+
+    def test_pick(self):
+        """pick() should return an answer and the contents of its image."""
+        pool = self.makePool()
+        self.assertEqual(len(pool), 3)
+        for _ in range(10):
+            answer, image, encodedImage = pool.pick()
+            self.assertIn(answer, ('abc', 'def', 'ghi'))
+            self.assertEqual(image, answer.encode('utf-8') * 10)
+            self.assertIsNone(encodedImage)
+
+    def test_pick_preload(self):
+        """A pool with preload set should keep the images, and their base64
+        encodings, in memory.
+        """
+        pool = self.makePool(preload=True)
+        shutil.rmtree(self.cacheDir)
+        os.makedirs(self.cacheDir)
+
+        answer, image, encodedImage = pool.pick()
+        self.assertEqual(image, answer.encode('utf-8') * 10)
+        self.assertEqual(encodedImage, b64encode(image))
+
+    def test_get_preload(self):
+        """GimpCaptcha.getEncodedImage() should use the encoding which was
+        preloaded by the pool, rather than encoding the image again.
+        """
+        pool = self.makePool(preload=True)
+        pool.captchas = pool.captchas[:1]
+        answer, path, image, encodedImage = pool.captchas[0]
+        c = captcha.GimpCaptcha('pub', 'sec', b'hmac', self.cacheDir, pool)
+        self.patch(c, 'createChallenge', lambda answer: 'challenge')
+        c.get()
+        self.assertIs(c.getEncodedImage(), encodedImage)
+
+    def test_pick_empty(self):
+        """pick() from an empty cache dir should raise GimpCaptchaError."""
+        shutil.rmtree(self.cacheDir)
+        os.makedirs(self.cacheDir)
+        pool = self.makePool()
+        self.assertRaises(captcha.GimpCaptchaError, pool.pick)
+
+    def test_pick_missingCacheDir(self):
+        """A pool for a directory which doesn't exist should be empty."""
+        pool = captcha.CaptchaPool(os.path.join(self.cacheDir, 'capt'))
+        self.assertEqual(len(pool), 0)
+        self.assertRaises(captcha.GimpCaptchaError, pool.pick)
+
+    def test_pick_noCacheDir(self):
+        """A pool without a cache dir should be empty, rather than indexing
+        the current directory.
+        """
+        pool = captcha.CaptchaPool(None)
+        self.assertEqual(len(pool), 0)
+        self.assertIsNone(pool.mtime)
+        self.assertRaises(captcha.GimpCaptchaError, pool.pick)
+
+    def test_pick_cacheDirIsFile(self):
+        """A pool for a path which isn't a directory should be empty."""
+        path = os.path.join(self.cacheDir, 'abc.jpg')
+        pool = captcha.CaptchaPool(path)
+        self.assertEqual(len(pool), 0)
+        self.assertRaises(captcha.GimpCaptchaError, pool.pick)
+
+    def test_getCaptchaPool_noCacheDir(self):
+        """getCaptchaPool(None) should return an empty pool."""
+        self.addCleanup(captcha._pools.clear)
+        self.assertEqual(len(captcha.getCaptchaPool(None)), 0)
+
+    def test_pick_removedFile(self):
+        """pick() should raise GimpCaptchaError if the chosen image was
+        removed since the cache dir was listed.
+        """
+        pool = self.makePool()
+        for answer in ('abc', 'def', 'ghi'):
+            os.unlink(os.path.join(self.cacheDir, answer + '.jpg'))
+        self.assertRaises(captcha.GimpCaptchaError, pool.pick)
+
+    def test_refresh_unchanged(self):
+        """refresh() shouldn't list the cache dir if it hasn't changed."""
+        pool = self.makePool()
+        self.assertIsNone(pool.refresh())
+
+    def test_refresh(self):
+        """refresh() should list the cache dir again if it has changed."""
+        pool = self.makePool()
+        self.addCaptcha('jkl')
+        self.touch()
+
+        d = pool.refresh()
+        self.assertIsNotNone(d)
+        self.assertEqual(len(pool), 4)
+        self.assertFalse(pool.refreshing)
+        self.assertIsNone(pool.refresh())
+
+    def test_refresh_pending(self):
+        """refresh() shouldn't start listing the cache dir while it is already
+        being listed, and should keep using the old list until it's done.
+        """
+        pending = defer.Deferred()
+        pool = captcha.CaptchaPool(self.cacheDir,
+                                   runInThread=lambda f: pending)
+        self.addCaptcha('jkl')
+        self.touch()
+
+        self.assertIsNotNone(pool.refresh())
+        self.assertIsNone(pool.refresh())
+        self.assertEqual(len(pool), 3)
+
+        pending.callback(pool.scan())
+        self.assertEqual(len(pool), 4)
+        self.assertFalse(pool.refreshing)
+
+    def test_refresh_failed(self):
+        """If listing the cache dir fails, the old list should be kept."""
+        pool = captcha.CaptchaPool(
+            self.cacheDir,
+            runInThread=lambda f: defer.fail(OSError("Nope")))
+        self.touch()
+
+        pool.refresh()
+        self.assertEqual(len(pool), 3)
+        self.assertFalse(pool.refreshing)
+
+    def test_startRefreshing(self):
+        """startRefreshing() should refresh the pool periodically."""
+        clock = task.Clock()
+        pool = self.makePool()
+        pool.startRefreshing(clock=clock)
+        self.addCleanup(pool.stopRefreshing)
+
+        self.addCaptcha('jkl')
+        self.touch()
+        self.assertEqual(len(pool), 3)
+        clock.advance(pool.refreshInterval)
+        self.assertEqual(len(pool), 4)
+
+    def test_getCaptchaPool(self):
+        """getCaptchaPool() should return the same pool for a directory each
+        time.
+        """
+        pool = captcha.getCaptchaPool(self.cacheDir)
+        self.addCleanup(captcha._pools.clear)
+        self.assertIs(captcha.getCaptchaPool(self.cacheDir + os.sep), pool)
+        self.assertIsNot(
+            captcha.getCaptchaPool(os.path.join(self.cacheDir, 'capt')), pool)
+
+    def test_getCaptchaPool_preload(self):
+        """getCaptchaPool() should create a pool with the given preload
+        setting, and refuse to return it for a different setting.
+        """
+        self.addCleanup(captcha._pools.clear)
+        pool = captcha.getCaptchaPool(self.cacheDir, preload=True)
+        self.assertTrue(pool.preload)
+        self.assertIs(captcha.getCaptchaPool(self.cacheDir), pool)
+        self.assertIs(captcha.getCaptchaPool(self.cacheDir, True), pool)
+        self.assertRaises(ValueError, captcha.getCaptchaPool,
+                          self.cacheDir, False)
+
+    def test_pick_benchmark(self):
+        """Compare listing the cache dir for each CAPTCHA with a pool."""
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        for n in range(20000):
+            self.addCaptcha('%08d' % n)
+        requests = 1000
+        chooser = random.SystemRandom()
+
+        print("Listing %d CAPTCHAs for %d requests:"
+              % (len(os.listdir(self.cacheDir)), requests))
+        with Benchmarker():
+            for _ in range(requests):
+                filename = chooser.choice(os.listdir(self.cacheDir))
+                with open(os.path.join(self.cacheDir, filename), 'rb') as fh:
+                    b64encode(fh.read())
+
+        pool = self.makePool()
+        print("Picking from a pool of %d CAPTCHAs for %d requests:"
+              % (len(pool), requests))
+        with Benchmarker():
+            for _ in range(requests):
+                answer, image, encodedImage = pool.pick()
+                encodedImage or b64encode(image)
+
+        pool = self.makePool(preload=True)
+        print("Picking from a preloaded pool of %d CAPTCHAs for %d requests:"
+              % (len(pool), requests))
+        with Benchmarker():
+            for _ in range(requests):
+                answer, image, encodedImage = pool.pick()
+                encodedImage or b64encode(image)
@@ -91,6 +91,80 @@ class GetKeyTests(unittest.TestCase):
                          % (binascii.hexlify(key).decode('utf-8'), binascii.hexlify(SEKRIT_KEY).decode('utf-8')))
 
 
+class HMACPositionCacheTests(unittest.TestCase):
+    """Unittests for :class:`bridgedb.crypto.HMACPositionCache`."""
+
+    def setUp(self):
+        self.cache = crypto.HMACPositionCache()
+        self.identity = b'\x01' * 20
+
+    def test_getHMACFunc_cached_matches_uncached(self):
+        """Cached and uncached HMAC functions should return the same values,
+        in both hex and binary, and the same integer prefixes.
+        """
+        for hexed in (True, False):
+            plain = crypto.getHMACFunc(SEKRIT_KEY, hex=hexed)
+            cached = crypto.getHMACFunc(SEKRIT_KEY, hex=hexed, cache=self.cache)
+            self.assertEqual(cached(self.identity), plain(self.identity))
+            self.assertEqual(cached(self.identity), plain(self.identity))
+
+        hexfn = crypto.getHMACFunc(SEKRIT_KEY, hex=True, cache=self.cache)
+        self.assertEqual(hexfn.prefix(self.identity),
+                         int(hexfn(self.identity)[:8], 16))
+
+    def test_getDigest_hits(self):
+        """Repeated lookups should only compute each HMAC once per key."""
+        fn1 = crypto.getHMACFunc('key1', hex=False, cache=self.cache)
+        fn2 = crypto.getHMACFunc('key2', hex=False, cache=self.cache)
+        fn1(self.identity)
+        fn1(self.identity)
+        fn2(self.identity)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotEqual(fn1(self.identity), fn2(self.identity))
+
+    def test_setMasterKey(self):
+        """Changing the master key should clear the cache, but setting the
+        same key again should not.
+        """
+        fn = crypto.getHMACFunc('key1', cache=self.cache)
+        self.cache.setMasterKey(SEKRIT_KEY)
+        fn(self.identity)
+        self.cache.setMasterKey(SEKRIT_KEY)
+        self.assertEqual(len(self.cache), 1)
+        self.cache.setMasterKey(b'another master key')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_retain(self):
+        """Only the cached HMACs of retained values should be kept."""
+        fn = crypto.getHMACFunc('key1', cache=self.cache)
+        fn(self.identity)
+        fn(b'\x02' * 20)
+        self.cache.retain([self.identity])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_retain_whileInserting(self):
+        """retain() shouldn't fail if HMACs are cached (i.e. by the reactor)
+        while it is filtering the tables.
+        """
+        fn = crypto.getHMACFunc('key1', cache=self.cache)
+
+        class Identity(bytes):
+            """An identity which caches another HMAC whenever it's hashed."""
+            def __hash__(inner):
+                fn(os.urandom(20))
+                return bytes.__hash__(inner)
+
+        identity = Identity(self.identity)
+        fn(identity)
+        fn(b'\x02' * 20)
+        self.cache.retain([identity])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(fn(self.identity),
+                         crypto.getHMACFunc('key1')(self.identity))
+
+
 class RemovePKCS1PaddingTests(unittest.TestCase):
     """Unittests for :func:`bridgedb.crypto.removePKCS1Padding`."""
 
@@ -21,11 +21,17 @@ import os
 import shutil
 import tempfile
 
+from twisted.internet import defer
+from twisted.internet.error import ConnectionLost
+from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web.resource import Resource
 from twisted.web.test import requesthelper
 
+from bridgedb import captcha
 from bridgedb import crypto
+from bridgedb import openmetrics
+from bridgedb import qrcodes
 from bridgedb.distributors.moat import server
 from bridgedb.schedule import ScheduledInterval
 
@@ -454,16 +460,54 @@ class CaptchaFetchResourceTests(unittest.TestCase):
         request = DummyRequest([self.pagename])
         request.method = b'GET'
 
-        captchaDirOrig = self.resource.captchaDir
         captchaDirNew = tempfile.mkdtemp()
-        self.resource.captchaDir = captchaDirNew
-        image, challenge = self.resource.getCaptchaImage(request)
-        self.resource.captchaDir = captchaDirOrig
+        resource = server.CaptchaFetchResource(
+            self.hmacKey, self.publicKey, self.secretKey, captchaDirNew,
+            captchaPool=captcha.CaptchaPool(captchaDirNew))
+        image, challenge = resource.getCaptchaImage(request)
         shutil.rmtree(captchaDirNew)
 
         self.assertIsNone(image)
         self.assertIsNone(challenge)
 
+    def test_getCaptchaImage_captchaPool(self):
+        """The CAPTCHA should be chosen from the pool the resource was
+        created with.
+        """
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        pool = captcha.CaptchaPool(self.captchaDir)
+        pool.captchas = pool.captchas[:1]
+        answer, path, _, _ = pool.captchas[0]
+        resource = server.CaptchaFetchResource(self.hmacKey, self.publicKey,
+                                               self.secretKey, self.captchaDir,
+                                               captchaPool=pool)
+        self.assertIs(resource.captchaPool, pool)
+
+        image, challenge = resource.getCaptchaImage(request)
+
+        with open(path, 'rb') as fh:
+            self.assertEqual(image, fh.read())
+
+    def test_getEncodedCaptchaImage_preload(self):
+        """The base64 encoding of a CAPTCHA from a preloaded pool should be
+        the one which the pool encoded when it read the image.
+        """
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        pool = captcha.CaptchaPool(self.captchaDir, preload=True)
+        pool.captchas = pool.captchas[:1]
+        answer, path, image, encodedImage = pool.captchas[0]
+        resource = server.CaptchaFetchResource(self.hmacKey, self.publicKey,
+                                               self.secretKey, self.captchaDir,
+                                               captchaPool=pool)
+
+        encoded, challenge = resource.getEncodedCaptchaImage(request)
+
+        self.assertIs(encoded, encodedImage)
+        self.assertEqual(base64.b64decode(encoded), image)
+        self.assertIsInstance(challenge, str)
+
     def test_extractSupportedTransports_missing_type(self):
         data = {
             'data': [{
@@ -611,6 +655,11 @@ class CaptchaCheckResourceTests(unittest.TestCase):
         self.root = Resource()
         self.root.putChild(self.pagename, self.resource)
 
+        # Generate QRCodes straight away, so that responses are rendered
+        # synchronously:
+        self.patch(qrcodes, "cache",
+                   qrcodes.QRCodeCache(runInThread=defer.maybeDeferred))
+
         self.solution = 'Tvx74PMy'
         self.expiredChallenge = (
             "Vu-adMmSRsgr9PmPpGAznhrBQlys3zMkczIG2YQ7AngWqWnVn2y-LdAl8iHkrqkNhn"
@@ -952,13 +1001,96 @@ class CaptchaCheckResourceTests(unittest.TestCase):
         self.assertEqual(len(datas), 1)
 
         data = datas[0]
-        self.assertIsNotNone(data['qrcode'])
+        self.assertTrue(data['qrcode'].startswith('data:image/jpeg;base64,'))
         self.assertIsNotNone(data['bridges'])
         self.assertEqual(data['version'], server.MOAT_API_VERSION)
         self.assertEqual(data['type'], 'moat-bridges')
         self.assertEqual(data['id'], '3')
 
 
+    def createQRCodeRequest(self):
+        """Create a request with a valid CAPTCHA solution, for bridges and
+        their QRCode.
+        """
+        request = DummyRequest([self.pagename])
+        request.client = requesthelper.IPv4Address('TCP', '3.3.3.3', 443)
+        resource = server.CaptchaFetchResource(self.hmacKey, self.publicKey,
+                                               self.secretKey, self.captchaDir,
+                                               useForwardedHeader=False)
+        image, challenge = resource.getCaptchaImage(request)
+
+        data = {
+            'data': [{
+                'id': '2',
+                'type': 'moat-solution',
+                'version': server.MOAT_API_VERSION,
+                'transport': 'obfs4',
+                'challenge': challenge,
+                'solution': self.solution,
+                'qrcode': 'true',
+            }]
+        }
+        request = self.create_POST_with_data(json.dumps(data))
+        request.client = requesthelper.IPv4Address('TCP', '3.3.3.3', 443)
+        request.requestHeaders.addRawHeader('X-Forwarded-For', '3.3.3.3')
+        return request
+
+    def useThreadlessQRCodeCache(self):
+        """Generate QRCodes when :meth:`finishGenerating` is called, rather
+        than in a thread.
+        """
+        self.generating = []
+
+        def runInThread(generate, bridgelines):
+            d = defer.Deferred()
+            self.generating.append((d, generate, bridgelines))
+            return d
+
+        self.patch(qrcodes, "cache",
+                   qrcodes.QRCodeCache(runInThread=runInThread))
+
+    def finishGenerating(self):
+        for d, generate, bridgelines in self.generating:
+            d.callback(generate(bridgelines))
+
+    def test_render_POST_qrcodeNotCached(self):
+        """If the QRCode isn't cached, the response should be written once it
+        has been generated, and the request should be timed until then.
+        """
+        self.useThreadlessQRCodeCache()
+        openmetrics.REQUEST_DURATION.clear()
+        openmetrics.REQUEST_STAGE_DURATION.clear()
+        self.addCleanup(openmetrics.REQUEST_DURATION.clear)
+        self.addCleanup(openmetrics.REQUEST_STAGE_DURATION.clear)
+
+        request = self.createQRCodeRequest()
+        self.assertIs(self.resource.render(request), server.NOT_DONE_YET)
+        self.assertFalse(request.finished)
+        self.assertIsNone(openmetrics.REQUEST_DURATION.get("moat"))
+
+        self.finishGenerating()
+
+        self.assertTrue(request.finished)
+        data = json.loads(b"".join(request.written))['data'][0]
+        self.assertTrue(data['qrcode'].startswith('data:image/jpeg;base64,'))
+        self.assertEqual(openmetrics.REQUEST_DURATION.get("moat")[0], 1)
+        self.assertEqual(
+            openmetrics.REQUEST_STAGE_DURATION.get("moat", "json")[0], 1)
+
+    def test_render_POST_qrcodeNotCached_clientGone(self):
+        """If the client goes away while their QRCode is being generated,
+        nothing should be written to the request.
+        """
+        self.useThreadlessQRCodeCache()
+
+        request = self.createQRCodeRequest()
+        self.assertIs(self.resource.render(request), server.NOT_DONE_YET)
+        request.processingFailed(failure.Failure(ConnectionLost()))
+        self.finishGenerating()
+
+        self.assertEqual(request.written, [])
+        self.assertFalse(request.finished)
+
 class AddMoatServerTests(unittest.TestCase):
     """Tests for :func:`bridgedb.distributors.moat.server.addMoatServer()`."""
 
@@ -966,5 +1098,19 @@ class AddMoatServerTests(unittest.TestCase):
         self.config = _createConfig()
         self.distributor = DummyMoatDistributor()
 
+    def tearDown(self):
+        captcha.getCaptchaPool(self.config.GIMP_CAPTCHA_DIR).stopRefreshing()
+
     def test_addMoatServer(self):
         server.addMoatServer(self.config, self.distributor)
+
+    def test_addMoatServer_captchaPool(self):
+        """addMoatServer() should index the CAPTCHAs, and keep the index up to
+        date.
+        """
+        site = server.addMoatServer(self.config, self.distributor)
+        pool = captcha.getCaptchaPool(self.config.GIMP_CAPTCHA_DIR)
+        self.assertEqual(pool.cacheDir, self.config.GIMP_CAPTCHA_DIR)
+        self.assertTrue(pool.refresher.running)
+        fetch = site.resource.children[b"moat"].children[b"fetch"]
+        self.assertIs(fetch.captchaPool, pool)
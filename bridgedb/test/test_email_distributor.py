@@ -13,6 +13,7 @@ from __future__ import print_function
 
 import logging
 import tempfile
+import threading
 import os
 
 from twisted.internet.task import Clock
@@ -133,6 +134,32 @@ class EmailDistributorTests(unittest.TestCase):
         # The fourth from 'ghi' is ignored.
         self.assertRaises(IgnoreEmail,  dist.getBridges, bridgeRequest3, 1)
 
+    def test_EmailDistributor_getBridges_doesNotWaitForLock(self):
+        """Rate limiting shouldn't wait for another thread which holds the
+        database lock (i.e. while reloading), but isn't writing.
+        """
+        dist = EmailDistributor(self.key, self.domainmap, self.domainrules)
+        [dist.hashring.insert(bridge) for bridge in self.bridges]
+        bridgeRequest = self.makeClientRequest('abc@example.com')
+
+        locked = threading.Event()
+        release = threading.Event()
+
+        def holdLock():
+            with bridgedb.Storage.getDB():
+                locked.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=holdLock)
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertEqual(len(dist.getBridges(bridgeRequest, 1)), 3)
+            self.assertRaises(TooSoonEmail, dist.getBridges, bridgeRequest, 1)
+        finally:
+            release.set()
+            holder.join()
+
     def test_EmailDistributor_getBridges_rate_limit(self):
         """A client's first email should return bridges.  The second should
         return a warning, and the third should receive no response.
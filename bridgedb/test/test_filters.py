@@ -19,6 +19,7 @@ from twisted.trial import unittest
 from bridgedb import filters
 from bridgedb.bridges import Bridge
 from bridgedb.bridges import PluggableTransport
+from bridgedb.crypto import HMACPositionCache
 from bridgedb.crypto import getHMACFunc
 
 
@@ -67,6 +68,15 @@ class FiltersTests(unittest.TestCase):
         filtre = filters.bySubring(self.hmac, 2, 2)
         self.assertFalse(filtre(self.bridge))
 
+    def test_bySubring_doesNotCacheEmptyString(self):
+        """Naming a bySubring() filter shouldn't put the HMAC of "" into the
+        shared HMAC position cache.
+        """
+        cache = HMACPositionCache()
+        hmac = getHMACFunc('cached plasma', cache=cache)
+        filters.bySubring(hmac, 1, 2)
+        self.assertEqual(len(cache), 0)
+
     def test_byFilters_bySubring_byTransport_correct_subhashring_with_transport(self):
         """Filtering byTransport('voltron') and bySubring(HMAC, 1, 2) when the
         Bridge has a voltron transport and is assigned to sub-hashring 1-of-2
@@ -18,6 +18,7 @@ import logging
 import random
 
 from twisted.trial import unittest
+from twisted.trial.unittest import SkipTest
 
 from bridgedb.bridges import PluggableTransport
 from bridgedb.bridgerings import BridgeRing
@@ -28,6 +29,8 @@ from bridgedb.distributors.https import distributor
 from bridgedb.distributors.https.request import HTTPSBridgeRequest
 from bridgedb.proxy import ProxySet
 
+from bridgedb.test.util import Benchmarker
+from bridgedb.test.util import randomIPv6
 from bridgedb.test.util import randomValidIPv4String
 from bridgedb.test.util import generateFakeBridges
 from bridgedb.test.https_helpers import DummyRequest
@@ -79,6 +82,15 @@ class HTTPSDistributorTests(unittest.TestCase):
         self.assertEqual(dist.proxySubring, 4)
         self.assertEqual(dist.totalSubrings, 4)
 
+    def test_HTTPSDistributor_init_cachedRingsPerSubring(self):
+        """The HTTPSDistributor should keep cachedRingsPerSubring filtered
+        subrings for each of its subrings, including the proxy subring.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key, ProxySet(['1.1.1.1']),
+                                            cachedRingsPerSubring=2)
+        self.assertEqual(dist.ringCacheSize, 8)
+        self.assertEqual(dist.hashring.max_cached_rings, 8)
+
     def test_HTTPSDistributor_bridgesPerResponse_120(self):
         dist = distributor.HTTPSDistributor(3, self.key)
         [dist.insert(bridge) for bridge in self.bridges[:120]]
@@ -136,6 +148,71 @@ class HTTPSDistributorTests(unittest.TestCase):
         subring = dist.mapSubnetToSubring(subnet, usingProxy=False)
         self.assertNotEqual(subring, dist.proxySubring)
 
+    def test_HTTPSDistributor_getClientArea_matches_getSubnet(self):
+        """HTTPSDistributor.getClientArea() should give the same subnet and
+        subring as getSubnet() and mapSubnetToSubring(), for IPv4 and IPv6
+        clients, with and without proxies.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key, ProxySet(['1.1.1.1', '2.2.2.2']))
+        clients = [randomValidIPv4String() for _ in range(500)]
+        clients += [randomIPv6().compressed for _ in range(500)]
+        clients += ['1.2.3.4', '1.2.211.154', '::ffff:1.2.3.4', '::1',
+                    '2001:f::bc1:b13:2808', '2A00:C98:2030:A020:2::42']
+
+        for _ in range(2):
+            for client in clients:
+                for usingProxy in (False, True):
+                    subnet = dist.getSubnet(client, usingProxy)
+                    subring = dist.mapSubnetToSubring(subnet, usingProxy)
+                    self.assertEqual(dist.getClientArea(client, usingProxy),
+                                     (subnet, subring))
+
+    def test_HTTPSDistributor_getClientArea_invalid(self):
+        """HTTPSDistributor.getClientArea() should raise the same errors as
+        getSubnet() for things which aren't IP addresses.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key)
+        for client in ['1.2.3', '01.2.3.4', '1.2.3.4 ', 'fe80::1%eth0', 'foo']:
+            self.assertRaises(ValueError, dist.getSubnet, client)
+            self.assertRaises(ValueError, dist.getClientArea, client)
+
+    def test_HTTPSDistributor_getClientArea_ipv6_cache_size(self):
+        """HTTPSDistributor.getClientArea() shouldn't remember more IPv6
+        subnets than its ipv6AreaCacheSize.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key)
+        dist.ipv6AreaCacheSize = 10
+        for _ in range(50):
+            dist.getClientArea(randomIPv6().compressed)
+        self.assertEqual(len(dist._ipv6Areas), 10)
+
+    def test_HTTPSDistributor_getClientArea_benchmark(self):
+        """Compare the speed of HTTPSDistributor.getClientArea() with that of
+        getSubnet() followed by mapSubnetToSubring(), and report how much
+        faster getClientArea() is, for IPv4 and IPv6 clients.
+        """
+        raise SkipTest(("This test takes a while to complete. "
+                        "Run it on your own free time."))
+
+        dist = distributor.HTTPSDistributor(3, self.key)
+        ipv4 = [randomValidIPv4String() for _ in range(50000)]
+        ipv6 = ['2001:%x::%x' % (random.randint(0, 0xffff), i)
+                for i in range(50000)]
+
+        print()
+        for name, clients in (("IPv4", ipv4), ("IPv6", ipv6)):
+            print("getSubnet() and mapSubnetToSubring() for %d %s clients:"
+                  % (len(clients), name))
+            with Benchmarker() as separate:
+                for client in clients:
+                    dist.mapSubnetToSubring(dist.getSubnet(client))
+            print("getClientArea() for %d %s clients:" % (len(clients), name))
+            with Benchmarker() as combined:
+                for client in clients:
+                    dist.getClientArea(client)
+            print("getClientArea() is %.1fx faster for %s clients."
+                  % (separate.seconds / combined.seconds, name))
+
     def test_HTTPSDistributor_prepopulateRings_with_proxies(self):
         """An HTTPSDistributor with proxies should prepopulate two extra
         subhashrings (one for each of HTTP-Proxy-IPv4 and HTTP-Proxy-IPv6).
@@ -435,3 +512,96 @@ class HTTPSDistributorTests(unittest.TestCase):
             address, port = addrport.rsplit(':', 1)
             self.assertIsInstance(ipaddr.IPAddress(address), ipaddr.IPv4Address)
             self.assertIsNotNone(byIPv4(random.choice(bridges)))
+
+    def test_HTTPSDistributor_getBridges_answerCache_same_subnet(self):
+        """Clients in the same subnet who ask for the same kind of bridges
+        within one interval should get the cached answer.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key)
+        [dist.insert(bridge) for bridge in self.bridges[:250]]
+
+        bridgeRequest1 = self.randomClientRequest()
+        bridgeRequest1.client = '5.5.1.1'
+        bridgeRequest2 = self.randomClientRequest()
+        bridgeRequest2.client = '5.5.200.3'
+
+        bridges1 = dist.getBridges(bridgeRequest1, "faketimestamp")
+        self.assertEqual(dist.answerCache.misses, 1)
+        self.assertEqual(dist.answerCache.hits, 0)
+
+        bridges2 = dist.getBridges(bridgeRequest2, "faketimestamp")
+        self.assertEqual(dist.answerCache.hits, 1)
+        self.assertEqual(len(dist.answerCache), 1)
+        self.assertGreater(len(bridges2), 0)
+        self.assertEqual(bridges1, bridges2)
+
+    def test_HTTPSDistributor_getBridges_answerCache_matches_uncached(self):
+        """Cached answers should be the same as freshly computed ones."""
+        dist = distributor.HTTPSDistributor(3, self.key)
+        [dist.insert(bridge) for bridge in self.bridges[:250]]
+
+        requests = [self.randomClientRequest() for _ in range(50)]
+        cached = [dist.getBridges(request, "faketimestamp")
+                  for request in requests + requests]
+
+        for request, answer in zip(requests + requests, cached):
+            dist.answerCache.clear()
+            self.assertEqual(dist.getBridges(request, "faketimestamp"), answer)
+
+    def test_HTTPSDistributor_getBridges_answerCache_interval(self):
+        """The answer cache should be emptied when the interval changes."""
+        dist = distributor.HTTPSDistributor(3, self.key)
+        [dist.insert(bridge) for bridge in self.bridges[:250]]
+
+        bridgeRequest = self.randomClientRequest()
+        dist.getBridges(bridgeRequest, "faketimestamp")
+        dist.getBridges(bridgeRequest, "othertimestamp")
+
+        self.assertEqual(dist.answerCache.hits, 0)
+        self.assertEqual(dist.answerCache.misses, 2)
+        self.assertEqual(len(dist.answerCache), 1)
+
+    def test_HTTPSDistributor_getBridges_answerCache_replaced_hashring(self):
+        """The answer cache should be emptied when the distributor's hashring
+        is replaced.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key)
+        [dist.insert(bridge) for bridge in self.bridges[:250]]
+        replacement = distributor.HTTPSDistributor(3, self.key)
+        [replacement.insert(bridge) for bridge in self.bridges[250:500]]
+
+        bridgeRequest = self.randomClientRequest()
+        before = dist.getBridges(bridgeRequest, "faketimestamp")
+        dist.hashring = replacement.hashring
+        after = dist.getBridges(bridgeRequest, "faketimestamp")
+
+        self.assertEqual(dist.answerCache.hits, 0)
+        for bridge in after:
+            self.assertNotIn(bridge, before)
+            self.assertIn(bridge, self.bridges[250:500])
+
+    def test_HTTPSDistributor_getBridges_answerCache_maxSize(self):
+        """The answer cache should drop the least recently used answers when
+        it is full.
+        """
+        dist = distributor.HTTPSDistributor(3, self.key)
+        dist.answerCache.maxSize = 2
+        [dist.insert(bridge) for bridge in self.bridges[:250]]
+
+        requests = []
+        for client in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+            bridgeRequest = self.randomClientRequest()
+            bridgeRequest.client = client
+            requests.append(bridgeRequest)
+
+        dist.getBridges(requests[0], "faketimestamp")
+        dist.getBridges(requests[1], "faketimestamp")
+        dist.getBridges(requests[0], "faketimestamp")
+        dist.getBridges(requests[2], "faketimestamp")
+        self.assertEqual(len(dist.answerCache), 2)
+        self.assertEqual(dist.answerCache.hits, 1)
+
+        dist.getBridges(requests[0], "faketimestamp")
+        self.assertEqual(dist.answerCache.hits, 2)
+        dist.getBridges(requests[1], "faketimestamp")
+        self.assertEqual(dist.answerCache.hits, 2)
@@ -16,24 +16,32 @@ from __future__ import print_function
 import logging
 import os
 import shutil
+import zlib
 
 import ipaddress
 
 from bs4 import BeautifulSoup
 
+from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import task
+from twisted.internet.error import ConnectionLost
+from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web.resource import Resource
 from twisted.web.test import requesthelper
 
 from bridgedb import _langs, translations
+from bridgedb import captcha
+from bridgedb import openmetrics
+from bridgedb import qrcodes
 from bridgedb.distributors.https import server
 from bridgedb.schedule import ScheduledInterval
 
 from bridgedb.test.https_helpers import _createConfig
 from bridgedb.test.https_helpers import DummyRequest
 from bridgedb.test.https_helpers import DummyHTTPSDistributor
+from bridgedb.test.util import Benchmarker
 from bridgedb.test.util import DummyBridge
 from bridgedb.test.util import DummyMaliciousBridge
 
@@ -258,6 +266,161 @@ class HowtoResourceTests(unittest.TestCase):
         self.assertSubstring("Как использовать мосты".encode("utf-8"), page)
 
 
+class TranslatedTemplateResourceTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.distributors.https.server.TranslatedTemplateResource`."""
+
+    def setUp(self):
+        self.pagename = 'howto.html'
+        self.resource = server.HowtoResource()
+        self.lookup = server.lookup
+        self.moduleDir = os.path.join(os.getcwd(), 'mako-modules')
+
+    def tearDown(self):
+        server.lookup = self.lookup
+        if os.path.isdir(self.moduleDir):
+            shutil.rmtree(self.moduleDir)
+
+    def makeRequest(self, lang=None, encoding=None, etag=None):
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        if lang:
+            request.headers['accept-language'] = lang
+        if encoding:
+            request.headers['accept-encoding'] = encoding
+        if etag:
+            request.headers['if-none-match'] = etag
+        return request
+
+    def test_render_GET_cached(self):
+        """A second request for the same page should be served the page that
+        was rendered for the first.
+        """
+        first = self.resource.render_GET(self.makeRequest())
+        self.assertEqual(len(self.resource.pages), 1)
+        page = list(self.resource.pages.values())[0]
+
+        second = self.resource.render_GET(self.makeRequest())
+        self.assertEqual(len(self.resource.pages), 1)
+        self.assertIs(list(self.resource.pages.values())[0], page)
+        self.assertEqual(first, second)
+        self.assertSubstring(b"How to start using your bridges", second)
+
+    def test_render_GET_langs(self):
+        """Requests for different languages should be rendered separately."""
+        self.resource.render_GET(self.makeRequest())
+        self.resource.render_GET(self.makeRequest(lang='xx'))
+        self.assertEqual(len(self.resource.pages), 2)
+
+    def test_render_GET_gzip(self):
+        """A client which accepts gzip should get the gzipped page, with its
+        own entity tag.
+        """
+        plain = self.makeRequest()
+        body = self.resource.render_GET(plain)
+        request = self.makeRequest(encoding='deflate, gzip;q=0.5')
+        gzipped = self.resource.render_GET(request)
+
+        self.assertEqual(zlib.decompress(gzipped, 16 + zlib.MAX_WBITS), body)
+        self.assertEqual(request.outgoingHeaders['content-encoding'], 'gzip')
+        self.assertNotIn('content-encoding', plain.outgoingHeaders)
+        self.assertNotEqual(request.outgoingHeaders['etag'],
+                            plain.outgoingHeaders['etag'])
+        self.assertIn('Accept-Encoding', request.outgoingHeaders['vary'])
+
+    def test_render_GET_ifNoneMatch(self):
+        """A client which sends the entity tag of the page it already has
+        should be told that it is still fresh.
+        """
+        request = self.makeRequest()
+        self.resource.render_GET(request)
+        etag = request.outgoingHeaders['etag']
+
+        request = self.makeRequest(etag='"foo", %s' % etag)
+        self.assertEqual(self.resource.render_GET(request), b"")
+        self.assertEqual(request.responseCode, 304)
+
+        request = self.makeRequest(encoding='gzip', etag=etag)
+        self.assertNotEqual(self.resource.render_GET(request), b"")
+        self.assertNotEqual(request.responseCode, 304)
+
+    def test_prerender(self):
+        """prerender() should render the page for a client which didn't ask
+        for a language, and for each supported language.
+        """
+        self.resource.prerender()
+        self.assertEqual(len(self.resource.pages),
+                         1 + len(translations.getSupportedLangs()))
+
+        hits = openmetrics.PAGE_CACHE_EVENTS.get(self.resource.template,
+                                                 "hits") or 0
+        self.resource.render_GET(self.makeRequest())
+        self.assertEqual(openmetrics.PAGE_CACHE_EVENTS.get(
+            self.resource.template, "hits"), hits + 1)
+
+    def test_getPage_evicts(self):
+        """No more than ``maxPages`` pages should be kept."""
+        self.resource.maxPages = 2
+        for lang in ('xx', 'yy', 'zz'):
+            self.resource.render_GET(self.makeRequest(lang=lang))
+        self.assertEqual(len(self.resource.pages), 2)
+        self.assertNotIn('xx', [key[1] for key in self.resource.pages])
+
+    def test_render_GET_translator(self):
+        """The page should be translated with the translations for the
+        client's languages, without installing them globally.
+        """
+        class Bracketed(object):
+            def gettext(self, text):
+                return "[%s]" % text
+
+        self.patch(translations, 'getTranslations', lambda langs: Bracketed())
+        page = self.resource.render_GET(self.makeRequest())
+        self.assertSubstring(b"[How to start using your bridges]", page)
+
+    def test_setTemplateModuleDirectory(self):
+        """Templates should be compiled into the directory given to
+        setTemplateModuleDirectory().
+        """
+        server.setTemplateModuleDirectory(self.moduleDir)
+        self.resource.render_GET(self.makeRequest())
+        self.assertTrue(os.listdir(self.moduleDir))
+
+    def test_render_GET_benchmark(self):
+        """Compare rendering a page for each request with serving the page
+        which was rendered ahead of time.
+        """
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        requests = 500
+
+        print("Rendering %s for %d requests:" % (self.pagename, requests))
+        with Benchmarker():
+            for _ in range(requests):
+                self.resource.renderPage(['en', 'en_US'], False)
+
+        self.resource.prerender()
+        print("Serving %s to %d requests:" % (self.pagename, requests))
+        with Benchmarker():
+            for _ in range(requests):
+                self.resource.render_GET(self.makeRequest(encoding='gzip'))
+
+
+class AcceptsGzipTests(unittest.TestCase):
+    """Tests for :func:`bridgedb.distributors.https.server.acceptsGzip`."""
+
+    def test_acceptsGzip(self):
+        self.assertTrue(server.acceptsGzip('gzip, deflate, br'))
+        self.assertTrue(server.acceptsGzip(b'deflate, GZIP;q=0.8'))
+        self.assertTrue(server.acceptsGzip('x-gzip'))
+
+    def test_acceptsGzip_not(self):
+        self.assertFalse(server.acceptsGzip(None))
+        self.assertFalse(server.acceptsGzip(''))
+        self.assertFalse(server.acceptsGzip('deflate, br'))
+        self.assertFalse(server.acceptsGzip('gzip;q=0, deflate'))
+
+
 class CaptchaProtectedResourceTests(unittest.TestCase):
     """Tests for :class:`bridgedb.distributors.https.server.CaptchaProtectedResource`."""
 
@@ -430,6 +593,49 @@ class GimpCaptchaProtectedResourceTests(unittest.TestCase):
         self.assertIs(image, None)
         self.assertIs(challenge, None)
 
+    def test_getCaptchaImage_captchaPool(self):
+        """The CAPTCHA should be chosen from the pool the resource was
+        created with, rather than from the cache dir.
+        """
+        otherDir = self.mktemp()
+        os.makedirs(otherDir)
+        with open(os.path.join(otherDir, 'abc.jpg'), 'wb') as fh:
+            fh.write(b'abc')
+        pool = captcha.CaptchaPool(otherDir)
+        resource = server.GimpCaptchaProtectedResource(
+            secretKey='42',
+            publicKey='23',
+            hmacKey='abcdefghijklmnopqrstuvwxyz012345',
+            captchaDir=self.captchaDir,
+            captchaPool=pool,
+            protectedResource=self.protectedResource)
+        self.assertIs(resource.captchaPool, pool)
+
+        self.request.method = b'GET'
+        self.assertEqual(resource.getCaptchaImage(self.request)[0], b'abc')
+
+    def test_getEncodedCaptchaImage_preload(self):
+        """The base64 encoding of a CAPTCHA from a preloaded pool should be
+        the one which the pool encoded when it read the image.
+        """
+        otherDir = self.mktemp()
+        os.makedirs(otherDir)
+        with open(os.path.join(otherDir, 'abc.jpg'), 'wb') as fh:
+            fh.write(b'abc')
+        pool = captcha.CaptchaPool(otherDir, preload=True)
+        resource = server.GimpCaptchaProtectedResource(
+            secretKey='42',
+            publicKey='23',
+            hmacKey='abcdefghijklmnopqrstuvwxyz012345',
+            captchaDir=self.captchaDir,
+            captchaPool=pool,
+            protectedResource=self.protectedResource)
+
+        self.request.method = b'GET'
+        encodedImage, challenge = resource.getEncodedCaptchaImage(self.request)
+        self.assertEqual(encodedImage, b'YWJj')
+        self.assertIs(encodedImage, pool.captchas[0][3])
+
     def test_getCaptchaImage_noCaptchaDir(self):
         """Retrieving a (captcha, challenge) with an missing captchaDir should
         raise a bridgedb.captcha.GimpCaptchaError.
@@ -651,6 +857,11 @@ class BridgesResourceTests(unittest.TestCase):
         self.sched = ScheduledInterval(1, 'hour')
         self.nBridgesPerRequest = 2
 
+        # Generate QRCodes straight away, so that pages are rendered
+        # synchronously:
+        self.patch(qrcodes, "cache",
+                   qrcodes.QRCodeCache(runInThread=defer.maybeDeferred))
+
     def useBenignBridges(self):
         self.dist._bridge_class = DummyBridge
         self.bridgesResource = server.BridgesResource(
@@ -754,6 +965,102 @@ class BridgesResourceTests(unittest.TestCase):
             'bad=Bridge 6.6.6.6:6666' in str(page),
             "Newlines in bridge lines should be removed.")
 
+    def test_render_GET_stages(self):
+        """Rendering a request should time each of its stages."""
+        self.useBenignBridges()
+        openmetrics.REQUEST_STAGE_DURATION.clear()
+        self.addCleanup(openmetrics.REQUEST_STAGE_DURATION.clear)
+
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        request.getClientIP = lambda: '1.1.1.1'
+        self.bridgesResource.render(request)
+
+        for stage in ("client-ip", "bridge-request", "bridge-lines",
+                      "metrics", "qrcode", "template"):
+            self.assertEqual(
+                openmetrics.REQUEST_STAGE_DURATION.get("https", stage)[0], 1,
+                "The %s stage wasn't timed." % stage)
+
+    def test_render_GET_qrcodeNotCached(self):
+        """If the QRCode isn't cached, the page should be written once it has
+        been generated in a thread.
+        """
+        self.useBenignBridges()
+        generating = []
+
+        def runInThread(generate, bridgelines):
+            d = defer.Deferred()
+            generating.append((d, generate, bridgelines))
+            return d
+
+        self.patch(qrcodes, "cache",
+                   qrcodes.QRCodeCache(runInThread=runInThread))
+        openmetrics.REQUEST_DURATION.clear()
+        openmetrics.REQUEST_STAGE_DURATION.clear()
+        self.addCleanup(openmetrics.REQUEST_DURATION.clear)
+        self.addCleanup(openmetrics.REQUEST_STAGE_DURATION.clear)
+
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        request.getClientIP = lambda: '1.1.1.1'
+
+        self.assertIs(self.bridgesResource.render(request), server.NOT_DONE_YET)
+        self.assertEqual(len(generating), 1)
+        self.assertFalse(request.finished)
+        # The request is still being answered, so it shouldn't be timed yet:
+        self.assertIsNone(openmetrics.REQUEST_DURATION.get("https"))
+        self.assertIsNone(openmetrics.currentRequest())
+
+        d, generate, bridgelines = generating[0]
+        d.callback(generate(bridgelines))
+
+        self.assertTrue(request.finished)
+        self.assertEqual(openmetrics.REQUEST_DURATION.get("https")[0], 1)
+        self.assertEqual(
+            openmetrics.REQUEST_STAGE_DURATION.get("https", "template")[0], 1)
+        page = b"".join(request.written).decode('utf-8')
+        self.assertIn("How to start using your bridges", page)
+        self.assertIn('data:image/jpeg;base64,', page)
+        self.assertTrue(self.parseBridgesFromHTMLPage(page))
+
+        # Now that it's cached, a page with the same bridge lines should be
+        # rendered straight away:
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        page = self.bridgesResource.renderAnswer(request, bridgelines)
+        self.assertIn(b'data:image/jpeg;base64,', page)
+        self.assertEqual(len(generating), 1)
+
+    def test_render_GET_qrcodeNotCached_clientGone(self):
+        """If the client goes away while their QRCode is being generated,
+        nothing should be written to the request.
+        """
+        self.useBenignBridges()
+        generating = []
+
+        def runInThread(generate, bridgelines):
+            d = defer.Deferred()
+            generating.append((d, generate, bridgelines))
+            return d
+
+        self.patch(qrcodes, "cache",
+                   qrcodes.QRCodeCache(runInThread=runInThread))
+
+        request = DummyRequest([self.pagename])
+        request.method = b'GET'
+        request.getClientIP = lambda: '1.1.1.1'
+
+        self.assertIs(self.bridgesResource.render(request), server.NOT_DONE_YET)
+        request.processingFailed(failure.Failure(ConnectionLost()))
+
+        d, generate, bridgelines = generating[0]
+        d.callback(generate(bridgelines))
+
+        self.assertEqual(request.written, [])
+        self.assertFalse(request.finished)
+        self.assertIsNone(openmetrics.currentRequest())
+
     def test_render_GET_vanilla(self):
         """Test rendering a request for normal, vanilla bridges."""
         self.useBenignBridges()
@@ -962,6 +1269,8 @@ class HTTPSServerServiceTests(unittest.TestCase):
 
         Basically, kill all connections with fire.
         """
+        captcha.getCaptchaPool(self.config.GIMP_CAPTCHA_DIR).stopRefreshing()
+
         for delay in reactor.getDelayedCalls():
             try:
                 delay.cancel()
@@ -977,6 +1286,15 @@ class HTTPSServerServiceTests(unittest.TestCase):
         """Call :func:`bridgedb.distributors.https.server.addWebServer` to test startup."""
         server.addWebServer(self.config, self.distributor)
 
+    def test_addWebServer_captchaPool(self):
+        """addWebServer() should give the CAPTCHA resource the pool which it
+        keeps up to date.
+        """
+        site = server.addWebServer(self.config, self.distributor)
+        pool = captcha.getCaptchaPool(self.config.GIMP_CAPTCHA_DIR)
+        self.assertTrue(pool.refresher.running)
+        self.assertIs(site.resource.children[b'bridges'].captchaPool, pool)
+
     def test_addWebServer_RECAPTCHA_ENABLED(self):
         """Call :func:`bridgedb.distributors.https.server.addWebServer` to test startup."""
         config = self.config
@@ -265,6 +265,26 @@ class BridgedbTests(unittest.TestCase):
         d.addErrback(self._eb_Failure)
         return d
 
+    def test_main_load_parallel(self):
+        """When DESCRIPTOR_PARSE_PROCESSES is more than one, main.load()
+        should parse the descriptors in parallel and load the same bridges.
+        """
+        self.state.DESCRIPTOR_PARSE_PROCESSES = 2
+        d = deferToThread(main.load, self.state, self.hashring)
+        d.addCallback(self._cbAssertFingerprints)
+        d.addErrback(self._eb_Failure)
+        return d
+
+    def test_main_load_fast_networkstatus(self):
+        """When FAST_NETWORKSTATUS_PARSER=True, main.load() should parse the
+        networkstatus documents without Stem and load the same bridges.
+        """
+        self.state.FAST_NETWORKSTATUS_PARSER = True
+        d = deferToThread(main.load, self.state, self.hashring)
+        d.addCallback(self._cbAssertFingerprints)
+        d.addErrback(self._eb_Failure)
+        return d
+
     def test_main_load_collect_timestamps(self):
         """When COLLECT_TIMESTAMPS=True, main.load() should call
         main.updateBridgeHistory().
@@ -309,6 +329,22 @@ class BridgedbTests(unittest.TestCase):
         # a MoatDistributor right, and an UnallocatedHolder ring:
         self.assertEqual(len(hashring.ringsByName.keys()), 4)
 
+    def test_main_createBridgeRings_cachedRings(self):
+        """main.createBridgeRings() should bound each distributor's cached
+        subrings as configured.
+        """
+        self.config.HTTPS_CACHED_RINGS_PER_SUBRING = 5
+        self.config.MOAT_CACHED_RINGS_PER_SUBRING = 7
+        self.config.EMAIL_MAX_CACHED_RINGS = 11
+        (hashring, emailDist, httpsDist, moatDist) = main.createBridgeRings(
+            self.config, None, self.key)
+
+        self.assertEqual(httpsDist.hashring.max_cached_rings,
+                         5 * self.config.N_IP_CLUSTERS)
+        self.assertEqual(moatDist.hashring.max_cached_rings,
+                         7 * self.config.MOAT_N_IP_CLUSTERS)
+        self.assertEqual(emailDist.hashring.max_cached_rings, 11)
+
     def test_main_createBridgeRings_with_proxyList(self):
         """main.createBridgeRings() should add three hashrings to the
         hashring and add the proxyList to the IPBasedDistibutor.
@@ -237,6 +237,7 @@ class StateTest(unittest.TestCase):
             metrix.recordHandoutsPerBridge(br, [bridge2])
         metrix.recordHandoutsPerBridge(br, [bridge3])
 
+        metrix.updateHandoutStatistics()
         self.assertEqual(m["internal.handouts.unique-bridges"], 3)
         self.assertEqual(m["internal.handouts.min"], 1)
         self.assertEqual(m["internal.handouts.max"], 10)
@@ -282,6 +283,24 @@ class StateTest(unittest.TestCase):
         self.assertEqual(list(metrix.hotMetrics.keys()),
                          ["internal.https.byipv6-bysubring1of4"])
 
+    def test_ring_cache(self):
+
+        metrix = metrics.InternalMetrics()
+
+        for i in range(3):
+            metrix.recordRingCacheHit("HTTPS")
+        metrix.recordRingCacheMiss("HTTPS")
+        metrix.recordRingCacheEviction("Email")
+
+        metrix.rotate()
+        lines = metrix.getMetrics()
+
+        # Like the other internal metrics, these aren't sanitized.
+        self.assertEqual(len(lines), 3)
+        self.assertIn("internal.https.ring-cache.hits 3", lines)
+        self.assertIn("internal.https.ring-cache.misses 1", lines)
+        self.assertIn("internal.email.ring-cache.evictions 1", lines)
+
     def test_ipv4_ipv6_requests(self):
 
         metrix = metrics.InternalMetrics()
@@ -317,15 +336,19 @@ class StateTest(unittest.TestCase):
         bridges = copy.deepcopy(util.generateFakeBridges())
 
         metrix.recordHandoutsPerBridge(req, [bridges[0]])
+        metrix.updateHandoutStatistics()
         self.assertNotIn("internal.handouts.median", metrix.hotMetrics.keys())
         metrix.recordHandoutsPerBridge(req, [bridges[1]])
+        metrix.updateHandoutStatistics()
         self.assertNotIn("internal.handouts.median", metrix.hotMetrics.keys())
         metrix.recordHandoutsPerBridge(req, [bridges[2]])
+        metrix.updateHandoutStatistics()
         self.assertEqual(metrix.hotMetrics["internal.handouts.median"], 1)
 
         metrix.recordHandoutsPerBridge(req, [bridges[1]])
         metrix.recordHandoutsPerBridge(req, [bridges[2]])
         metrix.recordHandoutsPerBridge(req, [bridges[2]])
+        metrix.updateHandoutStatistics()
         self.assertEqual(metrix.hotMetrics["internal.handouts.min"], 1)
         self.assertEqual(metrix.hotMetrics["internal.handouts.median"], 2)
         self.assertEqual(metrix.hotMetrics["internal.handouts.max"], 3)
@@ -345,3 +368,52 @@ class StateTest(unittest.TestCase):
         self.assertTrue(len(metrix.bridgeHandouts) > 0)
         metrix.reset()
         self.assertTrue(len(metrix.bridgeHandouts) == 0)
+
+    def test_handouts_bridgeTypes(self):
+        """A bridge should be counted separately for each type of bridge line
+        it is handed out as.
+        """
+        metrix = metrics.InternalMetrics()
+        bridges = copy.deepcopy(util.generateFakeBridges())
+        v4Req = HTTPSBridgeRequest()
+        v4Req.withIPversion({})
+        v6Req = HTTPSBridgeRequest()
+        v6Req.withIPversion({"ipv6": "4"})
+        ptReq = HTTPSBridgeRequest()
+        ptReq.withIPversion({})
+        ptReq.withPluggableTransportType({"transport": ["obfs4"]})
+
+        for req in (v4Req, v6Req, ptReq, v4Req):
+            metrix.recordHandoutsPerBridge(req, bridges[:2])
+
+        self.assertEqual(len(metrix.handoutIndices), 3)
+        self.assertEqual(sorted(metrix.bridgeHandouts), [1, 1, 1, 1, 2, 2])
+        self.assertNotIn("internal.handouts.unique-bridges", metrix.hotMetrics)
+
+        # The statistics are calculated when the metrics are rotated.
+        metrix.rotate()
+        lines = metrix.getMetrics()
+        self.assertIn("internal.handouts.unique-bridges 6", lines)
+        self.assertIn("internal.handouts.max 2", lines)
+
+    def test_handouts_benchmark(self):
+        """Time recording handouts for many requests, and exporting the
+        statistics about them.
+        """
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        metrix = metrics.InternalMetrics()
+        bridges = copy.deepcopy(util.generateFakeBridges())
+        req = HTTPSBridgeRequest()
+        req.withIPversion({})
+        req.isValid(True)
+
+        print("Recording 100000 handouts of 3 bridges:")
+        with util.Benchmarker():
+            for i in range(100000):
+                n = i % (len(bridges) - 2)
+                metrix.recordHandoutsPerBridge(req, bridges[n:n+3])
+        print("Calculating the statistics:")
+        with util.Benchmarker():
+            metrix.rotate()
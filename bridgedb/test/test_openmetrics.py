@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of BridgeDB, a Tor bridge distribution system.
+#
+# :copyright: (c) 2007-2017, The Tor Project, Inc.
+# :license: see LICENSE for licensing information
+
+"""Unittests for the :mod:`bridgedb.openmetrics` module."""
+
+from __future__ import print_function
+
+import json
+import threading
+
+from twisted.internet.error import CannotListenError
+from twisted.python.threadpool import ThreadPool
+from twisted.test.proto_helpers import MemoryReactor
+from twisted.trial import unittest
+
+from bridgedb import openmetrics
+from bridgedb import safelog
+from bridgedb.test.https_helpers import DummyRequest
+from bridgedb.test.util import Benchmarker
+
+
+class MetricsReactor(MemoryReactor):
+    """A :api:`twisted.test.proto_helpers.MemoryReactor` with a threadpool."""
+
+    def __init__(self, failListening=False):
+        MemoryReactor.__init__(self)
+        self.threadpool = ThreadPool()
+        self.failListening = failListening
+
+    def getThreadPool(self):
+        return self.threadpool
+
+    def listenTCP(self, port, factory, backlog=50, interface=''):
+        if self.failListening:
+            raise CannotListenError(interface, port, "in use")
+        return MemoryReactor.listenTCP(self, port, factory, backlog, interface)
+
+
+class DummyConfig(object):
+    METRICS_HTTP_PORT = 9099
+    METRICS_HTTP_BIND_IP = None
+
+
+class MetricTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.openmetrics.Counter`,
+    :class:`bridgedb.openmetrics.Gauge`, and
+    :class:`bridgedb.openmetrics.Histogram`.
+    """
+
+    def test_Counter_render(self):
+        counter = openmetrics.Counter("test_events", "Some events.",
+                                      ("kind",))
+        counter.inc("a")
+        counter.inc("b", amount=3)
+        counter.inc("a")
+
+        self.assertEqual(counter.get("a"), 2)
+        self.assertEqual(counter.render(), [
+            "# HELP test_events_total Some events.",
+            "# TYPE test_events_total counter",
+            'test_events_total{kind="a"} 2',
+            'test_events_total{kind="b"} 3'])
+
+    def test_Counter_wrongLabels(self):
+        counter = openmetrics.Counter("test_events", "Some events.",
+                                      ("kind",))
+        self.assertRaises(ValueError, counter.inc)
+        self.assertRaises(ValueError, counter.inc, "a", "b")
+
+    def test_Counter_escapesLabels(self):
+        counter = openmetrics.Counter("test_events", "Some events.",
+                                      ("kind",))
+        counter.inc('a "b"\\\nc')
+        self.assertEqual(counter.render()[-1],
+                         'test_events_total{kind="a \\"b\\"\\\\\\nc"} 1')
+
+    def test_Counter_threads(self):
+        """Incrementing a counter from several threads shouldn't lose any
+        increments.
+        """
+        counter = openmetrics.Counter("test_events", "Some events.")
+
+        def incMany():
+            for _ in range(10000):
+                counter.inc()
+
+        threads = [threading.Thread(target=incMany) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.get(), 40000)
+
+    def test_Gauge_set(self):
+        gauge = openmetrics.Gauge("test_size", "A size.", ("ring", "subring"))
+        gauge.set(5, "https", "IPv4")
+        gauge.set(7, "https", "IPv4")
+        self.assertEqual(gauge.render()[-1],
+                         'test_size{ring="https",subring="IPv4"} 7')
+
+        gauge.clear()
+        self.assertIsNone(gauge.get("https", "IPv4"))
+
+    def test_Gauge_setFunction(self):
+        gauge = openmetrics.Gauge("test_size", "A size.")
+        values = [3]
+        gauge.setFunction(lambda: values[0])
+        self.assertEqual(gauge.render()[-1], "test_size 3")
+        values[0] = 4
+        self.assertEqual(gauge.render()[-1], "test_size 4")
+
+    def test_Gauge_setFunction_raises(self):
+        """A gauge whose function raises an exception should render no
+        samples, rather than failing.
+        """
+        gauge = openmetrics.Gauge("test_size", "A size.")
+        gauge.setFunction(lambda: 1 // 0)
+        self.assertEqual(len(gauge.render()), 2)
+
+    def test_Histogram_observe(self):
+        histogram = openmetrics.Histogram("test_seconds", "Durations.",
+                                          ("op",), buckets=(1, 0.1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "x")
+
+        self.assertEqual(histogram.buckets, (0.1, 1, float("inf")))
+        self.assertEqual(histogram.get("x"), (4, 3.65))
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{op="x",le="0.1"} 2',
+            'test_seconds_bucket{op="x",le="1"} 3',
+            'test_seconds_bucket{op="x",le="+Inf"} 4',
+            'test_seconds_sum{op="x"} 3.65',
+            'test_seconds_count{op="x"} 4'])
+
+    def test_Histogram_time(self):
+        histogram = openmetrics.Histogram("test_seconds", "Durations.",
+                                          ("op",))
+        with histogram.time("x"):
+            pass
+        count, total = histogram.get("x")
+        self.assertEqual(count, 1)
+        self.assertGreaterEqual(total, 0)
+        self.assertIsNone(histogram.get("y"))
+
+    def test_Histogram_time_raises(self):
+        """A duration should be observed even if its context raises."""
+        histogram = openmetrics.Histogram("test_seconds", "Durations.")
+
+        def fail():
+            with histogram.time():
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(histogram.get()[0], 1)
+
+    def test_Histogram_benchmark(self):
+        """How long does it take to time something?"""
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        histogram = openmetrics.Histogram("test_seconds", "Durations.",
+                                          ("op",))
+        print("Timing 100000 empty contexts:")
+        with Benchmarker():
+            for _ in range(100000):
+                with histogram.time("x"):
+                    pass
+
+
+class RequestTimerTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.openmetrics.RequestTimer` and
+    :func:`bridgedb.openmetrics.stage`.
+    """
+
+    def setUp(self):
+        openmetrics.REQUEST_DURATION.clear()
+        openmetrics.REQUEST_STAGE_DURATION.clear()
+        self.budget = openmetrics.slowRequestBudget
+        self.sampleRate = openmetrics.slowRequestSampleRate
+        self.safeLogging = safelog.safe_logging
+
+    def tearDown(self):
+        openmetrics.REQUEST_DURATION.clear()
+        openmetrics.REQUEST_STAGE_DURATION.clear()
+        openmetrics.setSlowRequestLog(self.budget, self.sampleRate)
+        safelog.setSafeLogging(self.safeLogging)
+
+    def answer(self, client="1.2.3.4"):
+        """Pretend to answer a request, in two stages."""
+        with openmetrics.RequestTimer("https") as timer:
+            timer.client = client
+            with openmetrics.stage("client-ip"):
+                pass
+            with timer.stage("ring-build"):
+                with openmetrics.stage("ring-lookup"):
+                    pass
+        return timer
+
+    def test_RequestTimer_stages(self):
+        timer = self.answer()
+
+        self.assertEqual([name for name, _ in timer.stages],
+                         ["client-ip", "ring-lookup", "ring-build"])
+        self.assertGreaterEqual(timer.duration,
+                                dict(timer.stages)["ring-build"])
+        self.assertEqual(openmetrics.REQUEST_DURATION.get("https")[0], 1)
+        self.assertEqual(
+            openmetrics.REQUEST_STAGE_DURATION.get("https", "client-ip")[0], 1)
+        self.assertIsNone(openmetrics.currentRequest())
+
+    def test_RequestTimer_nested(self):
+        """Once a nested timer's context exits, the outer timer should be
+        current again.
+        """
+        with openmetrics.RequestTimer("email") as outer:
+            with openmetrics.RequestTimer("moat") as inner:
+                self.assertIs(openmetrics.currentRequest(), inner)
+            self.assertIs(openmetrics.currentRequest(), outer)
+        self.assertIsNone(openmetrics.currentRequest())
+
+    def test_RequestTimer_raises(self):
+        """A request which raises an exception should still be timed."""
+        def fail():
+            with openmetrics.RequestTimer("https"):
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(openmetrics.REQUEST_DURATION.get("https")[0], 1)
+        self.assertIsNone(openmetrics.currentRequest())
+
+    def test_pauseRequest(self):
+        """A paused request should only be finished once it is answered, and
+        the stages timed while answering it should be counted.
+        """
+        with openmetrics.RequestTimer("https") as timer:
+            with openmetrics.stage("client-ip"):
+                pass
+            resumed = openmetrics.pauseRequest()
+        self.assertIs(resumed, timer)
+        self.assertIsNone(openmetrics.currentRequest())
+        self.assertIsNone(timer.duration)
+        self.assertIsNone(openmetrics.REQUEST_DURATION.get("https"))
+
+        with resumed:
+            self.assertIs(openmetrics.currentRequest(), timer)
+            with openmetrics.stage("template"):
+                pass
+        self.assertIsNone(openmetrics.currentRequest())
+        self.assertEqual([name for name, _ in timer.stages],
+                         ["client-ip", "template"])
+        self.assertEqual(openmetrics.REQUEST_DURATION.get("https")[0], 1)
+
+    def test_pauseRequest_noRequest(self):
+        """Pausing when no request is being timed should do nothing."""
+        with openmetrics.pauseRequest():
+            with openmetrics.stage("template"):
+                pass
+        self.assertEqual(openmetrics.REQUEST_STAGE_DURATION.samples(), [])
+
+    def test_stage_noRequest(self):
+        """Timing a stage when no request is being timed should do nothing."""
+        with openmetrics.stage("ring-build"):
+            pass
+        self.assertEqual(openmetrics.REQUEST_STAGE_DURATION.samples(), [])
+
+    def getSlowRequestLogs(self):
+        """Pretend to answer a request, and get the lines logged about it.
+
+        Other tests disable logging, so patch :func:`logging.warning` rather
+        than using ``assertLogs()``.
+        """
+        logged = []
+        self.patch(openmetrics.logging, "warning", logged.append)
+        self.answer()
+        return logged
+
+    def test_slowRequestLog(self):
+        openmetrics.setSlowRequestLog(0)
+        safelog.setSafeLogging(False)
+        logged = self.getSlowRequestLogs()
+
+        self.assertEqual(len(logged), 1)
+        record = json.loads(logged[0].split("Slow request: ", 1)[1])
+        self.assertEqual(record["distributor"], "https")
+        self.assertEqual(record["client"], "1.2.3.4")
+        self.assertEqual(record["budget_ms"], 0)
+        self.assertEqual([name for name, _ in record["stages_ms"]],
+                         ["client-ip", "ring-lookup", "ring-build"])
+
+    def test_slowRequestLog_safelogging(self):
+        openmetrics.setSlowRequestLog(0)
+        safelog.setSafeLogging(True)
+        logged = self.getSlowRequestLogs()
+
+        self.assertNotIn("1.2.3.4", logged[0])
+        self.assertIn("[scrubbed]", logged[0])
+
+    def test_slowRequestLog_notSampled(self):
+        openmetrics.setSlowRequestLog(0, sampleRate=0)
+        self.assertEqual(self.getSlowRequestLogs(), [])
+
+    def test_slowRequestLog_fast(self):
+        openmetrics.setSlowRequestLog(60)
+        self.assertEqual(self.getSlowRequestLogs(), [])
+
+    def test_slowRequestLog_disabled(self):
+        openmetrics.setSlowRequestLog(None)
+        self.assertEqual(self.getSlowRequestLogs(), [])
+
+
+class RegistryTests(unittest.TestCase):
+    """Tests for :class:`bridgedb.openmetrics.Registry` and
+    :class:`bridgedb.openmetrics.MetricsResource`.
+    """
+
+    def setUp(self):
+        self.registry = openmetrics.Registry()
+        self.counter = self.registry.register(
+            openmetrics.Counter("test_events", "Some events."))
+        self.gauge = self.registry.register(
+            openmetrics.Gauge("test_size", "A size."))
+
+    def test_Registry_render(self):
+        self.counter.inc()
+        self.gauge.set(2)
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP test_events_total Some events.",
+            "# TYPE test_events_total counter",
+            "test_events_total 1",
+            "# HELP test_size A size.",
+            "# TYPE test_size gauge",
+            "test_size 2", ""]))
+
+    def test_Registry_clear(self):
+        self.counter.inc()
+        self.registry.clear()
+        self.assertIsNone(self.counter.get())
+
+    def test_MetricsResource_render_GET(self):
+        self.counter.inc()
+        request = DummyRequest([b"metrics"])
+        request.method = b"GET"
+        page = openmetrics.MetricsResource(self.registry).render(request)
+
+        self.assertIsInstance(page, bytes)
+        self.assertIn(b"test_events_total 1\n", page)
+        self.assertEqual(request.outgoingHeaders[b"content-type"],
+                         openmetrics.CONTENT_TYPE)
+
+    def test_REGISTRY_render_counters(self):
+        """The HELP and TYPE lines of counters should name the ``_total``
+        metric, as their samples do.
+        """
+        openmetrics.PAGE_CACHE_EVENTS.clear()
+        self.addCleanup(openmetrics.PAGE_CACHE_EVENTS.clear)
+        openmetrics.PAGE_CACHE_EVENTS.inc("index", "hit")
+        lines = openmetrics.REGISTRY.render().splitlines()
+        start = lines.index("# HELP bridgedb_page_cache_events_total Hits, "
+                            "misses, and evictions in the caches of rendered "
+                            "static pages.")
+        self.assertEqual(lines[start + 1:start + 3], [
+            "# TYPE bridgedb_page_cache_events_total counter",
+            'bridgedb_page_cache_events_total{page="index",event="hit"} 1'])
+        for counter in (openmetrics.RING_CACHE_EVENTS,
+                        openmetrics.QRCODE_CACHE_EVENTS):
+            self.assertIn("# TYPE %s_total counter" % counter.name, lines)
+            self.assertNotIn("# TYPE %s counter" % counter.name, lines)
+
+    def test_REGISTRY_render(self):
+        """All of BridgeDB's own metrics should render."""
+        openmetrics.REQUEST_DURATION.clear()
+        self.addCleanup(openmetrics.REQUEST_DURATION.clear)
+        openmetrics.REQUEST_DURATION.observe(0.01, "https")
+        self.assertIn('bridgedb_request_duration_seconds_count'
+                      '{distributor="https"} 1',
+                      openmetrics.REGISTRY.render())
+
+
+class AddMetricsServerTests(unittest.TestCase):
+    """Tests for :func:`bridgedb.openmetrics.addMetricsServer`."""
+
+    def tearDown(self):
+        openmetrics.THREADPOOL_QUEUE_DEPTH.setFunction(None)
+        openmetrics.THREADPOOL_WORKERS_BUSY.setFunction(None)
+
+    def test_addMetricsServer(self):
+        reactor = MetricsReactor()
+        site = openmetrics.addMetricsServer(DummyConfig(), reactor)
+
+        port, factory, _, interface = reactor.tcpServers[0]
+        self.assertEqual(port, 9099)
+        self.assertEqual(interface, "127.0.0.1")
+        self.assertIs(factory, site)
+        self.assertIsInstance(site.resource.getStaticEntity(b"metrics"),
+                              openmetrics.MetricsResource)
+
+        rendered = openmetrics.REGISTRY.render()
+        self.assertIn("bridgedb_threadpool_queue_depth 0\n", rendered)
+        self.assertIn("bridgedb_threadpool_workers_busy 0\n", rendered)
+
+    def test_addMetricsServer_bindIP(self):
+        config = DummyConfig()
+        config.METRICS_HTTP_BIND_IP = "::1"
+        reactor = MetricsReactor()
+        openmetrics.addMetricsServer(config, reactor)
+        self.assertEqual(reactor.tcpServers[0][3], "::1")
+
+    def test_addMetricsServer_cannotListen(self):
+        reactor = MetricsReactor(failListening=True)
+        self.assertRaises(SystemExit, openmetrics.addMetricsServer,
+                          DummyConfig(), reactor)
@@ -16,7 +16,9 @@ import glob
 import hashlib
 import io
 import os
+import pickle
 import textwrap
+import types
 
 from twisted.trial import unittest
 from twisted.trial.unittest import SkipTest
@@ -284,7 +286,9 @@ EXVgdbhn8RrQiVT69evPXjdr6hmgllUofRT7LimvR60=
 class ParseDescriptorsTests(unittest.TestCase):
     """Unittests for :class:`bridgedb.parse.descriptors` module."""
 
-    skip = True if not HAS_STEM else False
+    # Trial skips a class whenever ``skip`` isn't ``None``, even if it's
+    # ``False``:
+    skip = None if HAS_STEM else "Couldn't import Stem."
 
     def setUp(self):
         """Test if we have Stem installed. Skip these tests if it's missing."""
@@ -323,6 +327,24 @@ class ParseDescriptorsTests(unittest.TestCase):
         self.assertEqual(bridge.address, self.expectedIPBridge0)
         self.assertEqual(bridge.fingerprint, self.expectedFprBridge0)
 
+    def test_parse_descriptors_iterServerDescriptorsFile(self):
+        """``b.p.descriptors.iterServerDescriptorsFile`` should lazily yield
+        the same descriptors as ``parseServerDescriptorsFile``.
+        """
+        descFile = self.writeTestDescriptorsToFile('bridge-descriptors',
+                                                   BRIDGE_SERVER_DESCRIPTOR,
+                                                   BRIDGE_SERVER_DESCRIPTOR_ED25519)
+        routers = descriptors.iterServerDescriptorsFile(descFile)
+        self.assertIsInstance(routers, types.GeneratorType)
+
+        first = next(routers)
+        self.assertIsInstance(first, RelayDescriptor)
+        self.assertEqual(first.fingerprint, self.expectedFprBridge0)
+
+        expected = descriptors.parseServerDescriptorsFile(descFile)
+        self.assertEqual([first.digest()] + [r.digest() for r in routers],
+                         [r.digest() for r in expected])
+
     def test_parse_descriptors_parseNetworkStatusFile_return_type(self):
         """``b.p.descriptors.parseNetworkStatusFile`` should return a dict."""
         # Write the descriptor to a file for testing. This is necessary
@@ -465,6 +487,81 @@ class ParseDescriptorsTests(unittest.TestCase):
                           descriptors.parseNetworkStatusFile,
                           descFile, skipAnnotations=False)
 
+    def test_parse_descriptors_parseNetworkStatusFileFast(self):
+        """``b.p.descriptors.parseNetworkStatusFileFast`` should return the
+        same fields as Stem, as NetworkStatusRecords.
+        """
+        descFile = 'networkstatus-bridges'
+
+        with open(descFile, 'wb') as fh:
+            fh.write(b'@type bridge-network-status 1.2\n')
+            fh.write(b'published 2014-11-04 12:30:00\n')
+            fh.write(BRIDGE_NETWORKSTATUS_0)
+            fh.write(BRIDGE_NETWORKSTATUS_1.replace(
+                b'w Bandwidth=24361\n', b''))
+            fh.flush()
+
+        routers = descriptors.parseNetworkStatusFileFast(descFile,
+                                                         validate=True)
+        self.assertEqual(len(routers), 2)
+        for router in routers:
+            self.assertIsInstance(router, descriptors.NetworkStatusRecord)
+
+        bridge = routers[0]
+        self.assertEqual(bridge.fingerprint, self.expectedFprBridge0)
+        self.assertEqual(bridge.address, self.expectedIPBridge0)
+        self.assertEqual(bridge.or_port, 4056)
+        self.assertEqual(bridge.or_addresses,
+                         [(u'c5fd:4467:98a7:90be:c76a:b449:8e6f:f0a7', 4055,
+                           True)])
+        self.assertEqual(bridge.flags,
+                         [u'Fast', u'Guard', u'Running', u'Stable', u'Valid'])
+        self.assertEqual(bridge.bandwidth, 1678904)
+        self.assertIsNone(routers[1].bandwidth)
+
+    def test_parse_descriptors_parseNetworkStatusFileFast_bad_nickname(self):
+        """``b.p.descriptors.parseNetworkStatusFileFast`` with a bridge
+        networkstatus descriptor which has a nickname that is too long should
+        raise InvalidRouterNickname.
+        """
+        unparseable = BRIDGE_NETWORKSTATUS_0.replace(
+            b'MiserLandfalls',
+            b'MiserLandfallsWaterfallsSnowfallsAvalanche')
+        descFile = self.writeTestDescriptorsToFile('networkstatus-bridges',
+                                                   unparseable)
+        self.assertRaises(descriptors.InvalidRouterNickname,
+                          descriptors.parseNetworkStatusFileFast,
+                          descFile)
+
+    def test_parse_descriptors_parseNetworkStatusFileFast_IPv6_ORAddress(self):
+        """``b.p.descriptors.parseNetworkStatusFileFast`` should raise a
+        ValueError for a Bridge whose primary ORAddress is IPv6.
+        """
+        unparseable = BRIDGE_NETWORKSTATUS_0.replace(
+            b'2.215.61.223', b'[2837:fcd2:387b:e376:34c:1ec7:11ff:1686]')
+        descFile = self.writeTestDescriptorsToFile('networkstatus-bridges',
+                                                   unparseable)
+        self.assertRaises(ValueError,
+                          descriptors.parseNetworkStatusFileFast,
+                          descFile)
+
+    def test_parse_descriptors_parseNetworkStatusFileFast_benchmark(self):
+        """Benchmark ``b.p.descriptors.parseNetworkStatusFileFast`` against
+        ``b.p.descriptors.parseNetworkStatusFile``.
+        """
+        raise SkipTest(("This test takes a while to complete. "
+                        "Run it on your own free time."))
+
+        descFile = self.writeTestDescriptorsToFile(
+            'networkstatus-bridges',
+            *([BRIDGE_NETWORKSTATUS_0, BRIDGE_NETWORKSTATUS_1] * 5000))
+
+        print()
+        with Benchmarker():
+            descriptors.parseNetworkStatusFile(descFile)
+        with Benchmarker():
+            descriptors.parseNetworkStatusFileFast(descFile)
+
     def test_parse_descriptors_parseExtraInfoFiles_return_type(self):
         """The return type of ``b.p.descriptors.parseExtraInfoFiles``
         should be a dictionary (after deduplication).
@@ -508,6 +605,47 @@ class ParseDescriptorsTests(unittest.TestCase):
 
         self.assertEqual(len(routers), 1)
 
+    def test_parse_descriptors_deduplicate_generator(self):
+        """``b.p.descriptors.deduplicate`` should consume a generator,
+        keeping only the newest descriptor for each router, and the later of
+        two with identical timestamps.
+        """
+        routers = descriptors.iterExtraInfoFiles(
+            io.BytesIO(BRIDGE_EXTRA_INFO_DESCRIPTOR_NEWEST_DUPLICATE),
+            io.BytesIO(BRIDGE_EXTRA_INFO_DESCRIPTOR),
+            io.BytesIO(BRIDGE_EXTRA_INFO_DESCRIPTOR_NEWEST_DUPLICATE.replace(
+                b'transport obfs2', b'transport obfs5')))
+        newest = descriptors.deduplicate(routers, statistics=True)
+
+        self.assertEqual(len(newest), 1)
+        bridge = newest[self.expectedFprBridge0]
+        self.assertEqual(
+            bridge.published,
+            datetime.datetime.strptime("2014-12-04 03:10:25", "%Y-%m-%d %H:%M:%S"))
+        self.assertIn('obfs5', bridge.transport)
+
+    def test_parse_descriptors_iterExtraInfoFiles(self):
+        """``b.p.descriptors.iterExtraInfoFiles`` should yield every
+        parseable descriptor, without deduplicating them.
+        """
+        unparseable = BRIDGE_EXTRA_INFO_DESCRIPTOR.replace(
+            b"bridge-ip-transports <OR>=8",
+            b"bridge-ip-transports <OR>")
+        descFile = self.writeTestDescriptorsToFile("unparseable-descriptor",
+                                                   unparseable)
+        routers = descriptors.iterExtraInfoFiles(
+            io.BytesIO(BRIDGE_EXTRA_INFO_DESCRIPTOR),
+            descFile,
+            io.BytesIO(BRIDGE_EXTRA_INFO_DESCRIPTOR_NEWER_DUPLICATE))
+        self.assertIsInstance(routers, types.GeneratorType)
+
+        published = [router.published for router in routers]
+        self.assertEqual(published, [
+            datetime.datetime.strptime("2014-11-04 06:23:22", "%Y-%m-%d %H:%M:%S"),
+            datetime.datetime.strptime("2014-11-04 08:10:25", "%Y-%m-%d %H:%M:%S")])
+        self.assertEqual(
+            len(glob.glob("*_unparseable-descriptor.unparseable")), 1)
+
     def test_parse_descriptors_parseExtraInfoFiles_two_files(self):
         """Test for ``b.p.descriptors.parseExtraInfoFiles`` with two
         bridge extrainfo files, and check that only the newest extrainfo
@@ -841,6 +979,112 @@ class ParseDescriptorsTests(unittest.TestCase):
         self.assertEqual(bridge.address, u'80.92.79.70')
         self.assertEqual(bridge.fingerprint, u'312D64274C29156005843EECB19C6865FA3CC10C')
 
+    def test_parse_descriptors_splitDescriptorFile(self):
+        """Each chunk should start at a descriptor's annotations."""
+        descFile = self.writeTestDescriptorsToFile('bridge-descriptors',
+                                                   BRIDGE_SERVER_DESCRIPTOR,
+                                                   BRIDGE_SERVER_DESCRIPTOR)
+        chunks = descriptors.splitDescriptorFile(descFile, b'router ', 1)
+        size = len(BRIDGE_SERVER_DESCRIPTOR)
+        self.assertEqual(chunks, [(0, size), (size, 2 * size)])
+
+        chunks = descriptors.splitDescriptorFile(descFile, b'router ')
+        self.assertEqual(chunks, [(0, 2 * size)])
+
+    def test_parse_descriptors_splitDescriptorFile_skipAnnotations(self):
+        """When skipping annotations, the first chunk should start at the
+        first descriptor.
+        """
+        header = b'signature and stuff from the BridgeAuth would go here\n'
+        descFile = self.writeTestDescriptorsToFile('networkstatus-bridges',
+                                                   header,
+                                                   BRIDGE_NETWORKSTATUS_0,
+                                                   BRIDGE_NETWORKSTATUS_1)
+        chunks = descriptors.splitDescriptorFile(descFile, b'r ', 1,
+                                                 skipAnnotations=True)
+        middle = len(header) + len(BRIDGE_NETWORKSTATUS_0)
+        self.assertEqual(chunks, [(len(header), middle),
+                                  (middle, middle + len(BRIDGE_NETWORKSTATUS_1))])
+
+    def test_parse_descriptors_parseDescriptorFiles(self):
+        """Parsing in parallel should give the same descriptors as parsing
+        each file in turn.
+        """
+        nsFile = self.writeTestDescriptorsToFile('networkstatus-bridges',
+                                                 b'some headers\n',
+                                                 BRIDGE_NETWORKSTATUS_0,
+                                                 BRIDGE_NETWORKSTATUS_1)
+        serverFile = self.writeTestDescriptorsToFile('bridge-descriptors',
+                                                     BRIDGE_SERVER_DESCRIPTOR,
+                                                     BRIDGE_SERVER_DESCRIPTOR_ED25519)
+        eiFile = self.writeTestDescriptorsToFile('cached-extrainfo',
+                                                 BRIDGE_EXTRA_INFO_DESCRIPTOR,
+                                                 BRIDGE_EXTRA_INFO_DESCRIPTOR_NEWEST_DUPLICATE,
+                                                 BRIDGE_EXTRA_INFO_DESCRIPTOR_ED25519)
+        files = [(descriptors.NETWORKSTATUS, nsFile),
+                 (descriptors.SERVER_DESCRIPTOR, serverFile),
+                 (descriptors.EXTRA_INFO, eiFile)]
+        ns, servers, extrainfos = descriptors.parseDescriptorFiles(
+            files, processes=2, chunkSize=1)
+
+        expected = descriptors.parseNetworkStatusFile(nsFile)
+        self.assertEqual(len(ns), 2)
+        for record, router in zip(ns, expected):
+            self.assertIsInstance(record, descriptors.NetworkStatusRecord)
+            for field in record._fields:
+                self.assertEqual(getattr(record, field), getattr(router, field))
+
+        expected = descriptors.parseServerDescriptorsFile(serverFile)
+        self.assertEqual(len(servers), 2)
+        for record, router in zip(servers, expected):
+            self.assertEqual(record.fingerprint, router.fingerprint)
+            self.assertEqual(record.published, router.published)
+            self.assertEqual(record.digest(), router.digest())
+
+        expected = descriptors.parseExtraInfoFiles(eiFile)
+        extrainfos = descriptors.deduplicate(extrainfos)
+        self.assertEqual(sorted(extrainfos), sorted(expected))
+        for fingerprint, record in extrainfos.items():
+            self.assertEqual(record.published, expected[fingerprint].published)
+            self.assertEqual(record.transport, expected[fingerprint].transport)
+            self.assertEqual(str(record), str(expected[fingerprint]))
+
+        # The records must survive being sent between processes:
+        for record in ns + servers + list(extrainfos.values()):
+            self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+
+    def test_parse_descriptors_parseDescriptorFiles_unparseable(self):
+        """Unparseable extrainfo descriptors should be skipped, and the file
+        they were in should be copied for debugging.
+        """
+        unparseable = BRIDGE_EXTRA_INFO_DESCRIPTOR.replace(
+            b"MiserLandfalls E08B324D20AD0A13E114F027AB9AC3F32CA696A0",
+            b"DontParseMe F373CC1D86D82267F1F1F5D39470F0E0A022122E").replace(
+                b"bridge-ip-transports <OR>=8",
+                b"bridge-ip-transports <OR>")
+        eiFile = self.writeTestDescriptorsToFile('cached-extrainfo.new',
+                                                 BRIDGE_EXTRA_INFO_DESCRIPTOR,
+                                                 unparseable)
+        [extrainfos] = descriptors.parseDescriptorFiles(
+            [(descriptors.EXTRA_INFO, eiFile)], processes=2, chunkSize=1)
+        self.assertEqual([r.fingerprint for r in extrainfos],
+                         ["E08B324D20AD0A13E114F027AB9AC3F32CA696A0"])
+        self.assertEqual(
+            len(glob.glob("*_cached-extrainfo.new.unparseable")), 1)
+
+    def test_parse_descriptors_parseDescriptorFiles_bad_nickname(self):
+        """An invalid nickname in a networkstatus document should raise
+        InvalidRouterNickname, as with parseNetworkStatusFile().
+        """
+        unparseable = BRIDGE_NETWORKSTATUS_0.replace(
+            b'MiserLandfalls',
+            b'MiserLandfallsWaterfallsSnowfallsAvalanche')
+        descFile = self.writeTestDescriptorsToFile('networkstatus-bridges',
+                                                   unparseable)
+        self.assertRaises(descriptors.InvalidRouterNickname,
+                          descriptors.parseDescriptorFiles,
+                          [(descriptors.NETWORKSTATUS, descFile)], 2)
+
     def test_parse_descriptors_copyUnparseableDescriptorFile_return_value(self):
         """``b.p.descriptors._copyUnparseableDescriptorFile()`` should return
         True when the new file is successfully created.
@@ -12,10 +12,13 @@
 
 """Tests for :mod:`bridgedb.qrcodes`."""
 
+from __future__ import print_function
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from bridgedb import qrcodes
+from bridgedb.test.util import Benchmarker
 
 
 class GenerateQRTests(unittest.TestCase):
@@ -71,3 +74,159 @@ class GenerateQRTests(unittest.TestCase):
         """Calling generateQR() with imageFormat=u'FOOBAR' should return None.
         """
         self.assertIsNone(qrcodes.generateQR(self.bridgelines, imageFormat=u'FOOBAR'))
+
+
+class QRCodeCacheTests(unittest.TestCase):
+    """Unittests for :class:`bridgedb.qrcodes.QRCodeCache`."""
+
+    def setUp(self):
+        self.bridgelines = ["obfs4 1.2.3.4:443 %040x" % n for n in range(3)]
+        self.generated = []
+        self.generating = []
+
+    def generate(self, bridgelines):
+        self.generated.append(bridgelines)
+        return "data:%s" % ",".join(bridgelines)
+
+    def runLater(self, function, *args):
+        """Pretend to run **function** in a thread, until :meth:`finish` is
+        called.
+        """
+        d = defer.Deferred()
+        self.generating.append((d, function, args))
+        return d
+
+    def finish(self):
+        while self.generating:
+            d, function, args = self.generating.pop(0)
+            try:
+                result = function(*args)
+            except Exception as error:
+                d.errback(error)
+            else:
+                d.callback(result)
+
+    def makeCache(self, size=8):
+        return qrcodes.QRCodeCache(size=size, generate=self.generate,
+                                   runInThread=self.runLater)
+
+    def getResult(self, d):
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(len(results), 1, "The Deferred hasn't fired.")
+        return results[0]
+
+    def test_get(self):
+        """The first request for a QRCode should wait for it to be generated,
+        and later ones should get it straight away.
+        """
+        cache = self.makeCache()
+        d = cache.get(self.bridgelines)
+        self.assertFalse(d.called)
+        self.finish()
+        self.assertEqual(self.getResult(d),
+                         self.generate(self.bridgelines))
+
+        d = cache.get(list(self.bridgelines))
+        self.assertTrue(d.called)
+        self.assertEqual(self.getResult(d), self.generate(self.bridgelines))
+        self.assertEqual(len(self.generated), 3)
+        self.assertEqual(cache[self.bridgelines],
+                         self.generate(self.bridgelines))
+
+    def test_get_pending(self):
+        """Requests for a QRCode which is being generated should wait for it,
+        rather than generating it again.
+        """
+        cache = self.makeCache()
+        first = cache.get(self.bridgelines)
+        second = cache.get(self.bridgelines)
+        self.assertEqual(len(self.generating), 1)
+        self.finish()
+        self.assertEqual(self.getResult(first), self.getResult(second))
+        self.assertEqual(len(self.generated), 1)
+
+    def test_get_noBridgelines(self):
+        cache = self.makeCache()
+        self.assertIsNone(self.getResult(cache.get([])))
+        self.assertEqual(self.generating, [])
+
+    def test_get_evicts(self):
+        """The least recently used QRCode should be forgotten once there are
+        too many.
+        """
+        cache = self.makeCache(size=2)
+        for lines in ("a", "b", "a", "c"):
+            cache.get([lines])
+            self.finish()
+
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(KeyError, cache.__getitem__, ["b"])
+        self.assertEqual(cache[["a"]], "data:a")
+        self.assertEqual(cache[["c"]], "data:c")
+
+    def test_get_failed(self):
+        """If a QRCode couldn't be generated, everyone waiting for it should
+        get ``None``, and it should be tried again next time.
+        """
+        self.generate = lambda bridgelines: 1 // 0
+        cache = self.makeCache()
+        d = cache.get(self.bridgelines)
+        self.finish()
+        self.assertIsNone(self.getResult(d))
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(cache.get(self.bridgelines).called)
+
+    def test_get_generateQRFailed(self):
+        """If generateQR() couldn't make a QRCode, ``None`` shouldn't be
+        cached, so that it's made once the qrcode module works again.
+        """
+        QRCode = qrcodes.qrcode.QRCode
+        failures = []
+
+        def brokenOnce():
+            if not failures:
+                failures.append(True)
+                raise ValueError("Broken")
+            return QRCode()
+
+        self.patch(qrcodes.qrcode, 'QRCode', brokenOnce)
+        cache = qrcodes.QRCodeCache(runInThread=defer.maybeDeferred)
+
+        self.assertIsNone(self.getResult(cache.get(self.bridgelines)))
+        self.assertEqual(len(cache), 0)
+        self.assertRaises(KeyError, cache.__getitem__, self.bridgelines)
+
+        uri = self.getResult(cache.get(self.bridgelines))
+        self.assertTrue(uri.startswith("data:image/jpeg;base64,"))
+        self.assertEqual(cache[self.bridgelines], uri)
+
+    def test_get_thread(self):
+        """Generate a real QRCode in the reactor's threadpool."""
+        cache = qrcodes.QRCodeCache()
+        d = cache.get(self.bridgelines)
+        d.addCallback(self.assertTrue)
+        d.addCallback(lambda _: self.assertTrue(
+            cache[self.bridgelines].startswith("data:image/jpeg;base64,")))
+        return d
+
+    def test_generateQRDataURI(self):
+        uri = qrcodes.generateQRDataURI(self.bridgelines)
+        self.assertTrue(uri.startswith("data:image/jpeg;base64,"))
+        self.assertIsNone(qrcodes.generateQRDataURI([]))
+
+    def test_QRCodeCache_benchmark(self):
+        """Compare generating a QRCode for every request with caching them."""
+        raise unittest.SkipTest(("This test takes a while to complete. "
+                                 "Run it on your own free time."))
+
+        cache = qrcodes.QRCodeCache(runInThread=defer.maybeDeferred)
+        print("generateQRDataURI() for 100 requests:")
+        with Benchmarker():
+            for _ in range(100):
+                qrcodes.generateQRDataURI(self.bridgelines)
+
+        print("QRCodeCache.get() for 100 requests:")
+        with Benchmarker():
+            for _ in range(100):
+                cache.get(self.bridgelines)
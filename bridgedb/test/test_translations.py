@@ -7,6 +7,8 @@
 #             (c) 2014-2017, The Tor Project, Inc.
 # :license: 3-Clause BSD, see LICENSE for licensing information
 
+import builtins
+import gettext
 
 from twisted.trial import unittest
 
@@ -69,6 +71,70 @@ class TranslationsMiscTests(unittest.TestCase):
         self.assertEqual(parsed[2], 'en_US')
         #self.assertEqual(parsed[3], 'en-gb')
 
+    def test_getRequestedLangs(self):
+        """getRequestedLangs() should give the same languages as
+        getLocaleFromHTTPRequest() for the same header and ``lang`` argument.
+        """
+        request = DummyRequest([b"options"])
+        request.args.update({'lang': ['fa']})
+
+        self.assertEqual(translations.getRequestedLangs(None, 'fa'),
+                         translations.getLocaleFromHTTPRequest(request))
+        self.assertEqual(translations.getRequestedLangs(None),
+                         ['en', 'en_US'])
+
+    def test_getTranslationFiles(self):
+        """getTranslationFiles() should return a tuple, and remember it."""
+        files = translations.getTranslationFiles(('en', 'en_US'))
+        self.assertIsInstance(files, tuple)
+        self.assertIs(translations.getTranslationFiles(('en', 'en_US')), files)
+        self.assertEqual(translations.getTranslationFiles(('xx',)), ())
+
+    def test_getTranslations(self):
+        """getTranslations() should return the same chain of translations each
+        time it's asked for the same languages.
+        """
+        language = translations.getTranslations(['xx', 'yy'])
+        self.assertIsInstance(language, gettext.NullTranslations)
+        self.assertIs(translations.getTranslations(['xx', 'yy']), language)
+        self.assertEqual(language.gettext("Get Bridges!"), "Get Bridges!")
+
+    def test_getTranslations_str(self):
+        """getTranslations() should treat a string as a single language, not
+        as a list of one-letter languages.
+        """
+        self.assertIs(translations.getTranslations('fa'),
+                      translations.getTranslations(['fa']))
+
+    def test_getTranslations_noInstall(self):
+        """getTranslations() shouldn't install the translations as the global
+        ``_`` function, unlike installTranslations().
+        """
+        missing = object()
+        original = getattr(builtins, '_', missing)
+        self.addCleanup(lambda: setattr(builtins, '_', original)
+                        if original is not missing else
+                        builtins.__dict__.pop('_', None))
+
+        builtins._ = oldGettext = lambda text: text
+        translations.getTranslations(['zz'])
+        self.assertIs(builtins._, oldGettext)
+
+        language = translations.installTranslations(['zz'])
+        self.assertEqual(builtins._, language.gettext)
+
+    def test_loadTranslationChain(self):
+        """loadTranslationChain() should chain together the translations in
+        each of the files, in order.
+        """
+        files = translations.getTranslationFiles(('de', 'fa', 'ru'))
+        if len(files) < 2:
+            self.skipTest("Compiled translations unavailable")
+
+        language = translations.loadTranslationChain(files)
+        self.assertIsInstance(language, gettext.GNUTranslations)
+        self.assertIsInstance(language._fallback, gettext.GNUTranslations)
+
     def test_getLocaleFromPlusAddr(self):
         emailAddr = 'bridges@torproject.org'
         replyLocale = translations.getLocaleFromPlusAddr(emailAddr)
@@ -7,6 +7,7 @@
 #             (c) 2007-2017, The Tor Project, Inc.
 # :license: 3-Clause BSD, see LICENSE for licensing information
 
+import functools
 import gettext
 import logging
 import os
@@ -75,7 +76,34 @@ def getLocaleFromHTTPRequest(request):
     :rtype: list
     :returns: All requested languages.
     """
-    header = request.getHeader('accept-language')
+    langs = getLangsFromHTTPRequest(request)
+    installTranslations(langs)
+    return langs
+
+def getLangsFromHTTPRequest(request):
+    """Retrieve the languages from an HTTP ``Accept-Language:`` header, and
+    the ``lang`` argument, if there is one, without installing them.
+
+    :type request: :api:`twisted.web.server.Request`
+    :param request: An incoming request from a client.
+    :rtype: list
+    :returns: All requested languages.
+    """
+    return getRequestedLangs(request.getHeader('accept-language'),
+                             request.args.get("lang", [None,])[0])
+
+def getRequestedLangs(header, chosenLang=None):
+    """Get the languages which a client asked for.
+
+    :type header: str or ``None``
+    :param header: The contents of the client's ``Accept-Language:`` header,
+        if they sent one.
+    :type chosenLang: str or ``None``
+    :param chosenLang: The language which the client chose with a ``lang``
+        argument, if any.  It comes first.
+    :rtype: list
+    :returns: All requested languages.
+    """
     if header is None:
         logging.debug("Client sent no 'Accept-Language' header. Using fallback.")
         header = 'en,en-US'
@@ -85,7 +113,6 @@ def getLocaleFromHTTPRequest(request):
         logging.debug("Client Accept-Language (top 5): %s" % langs[:5])
 
     # Check if we got a ?lang=foo argument, and if we did, insert it first
-    chosenLang = request.args.get("lang", [None,])[0]
     if chosenLang:
         logging.debug("Client requested language: %r" % chosenLang)
         langs.insert(0, chosenLang)
@@ -94,9 +121,26 @@ def getLocaleFromHTTPRequest(request):
 
     langs = list(map(lambda l: l if isinstance(l, str) else l.decode('utf-8'), langs))
 
-    installTranslations(langs)
     return langs
 
+@functools.lru_cache(maxsize=1024)
+def getTranslationFiles(langs):
+    """Get the translation files which :func:`getTranslations` would
+    chain together for **langs**.
+
+    Two lists of languages with the same translation files get the same
+    translations, so this can be used to tell whether something translated
+    for one would be the same for the other.  Finding the files means
+    checking whether each of them exists, so the answers for the most
+    recently asked for languages are remembered.
+
+    :param tuple langs: A tuple of language codes.
+    :rtype: tuple
+    :returns: The paths of the translation files, in order.
+    """
+    return tuple(gettext.find("bridgedb", localedir=TRANSLATIONS_DIR,
+                              languages=langs, all=True))
+
 def getLocaleFromPlusAddr(address):
     """See whether the user sent his email to a 'plus' address, for instance to
     bridges+fa@bridges.torproject.org. Plus addresses are the current
@@ -110,29 +154,64 @@ def getLocaleFromPlusAddr(address):
 
     return replyLocale
 
+def getTranslations(langs):
+    """Get a ``gettext.translation`` chain for all **langs**.
+
+    The chain for each set of translation files is only loaded once, and is
+    then shared by every request for languages which have those same files,
+    so it mustn't be changed.  Nothing is installed globally: callers should
+    use the returned object's ``gettext()`` method, i.e. by passing it to
+    templates as ``_``.
+
+    :type langs: list or str
+    :param langs: A list of language codes, or a single language code.
+    :returns: A ``gettext.NullTranslation`` or ``gettext.GNUTranslation`` with
+        fallback languages set.
+    """
+    if isinstance(langs, str):
+        langs = [langs]
+    return loadTranslationChain(getTranslationFiles(tuple(langs)))
+
+@functools.lru_cache(maxsize=128)
+def loadTranslationChain(files):
+    """Load the translation **files** into a chain of translations, each of
+    which falls back to the next.
+
+    :param tuple files: The paths of some translation files, as returned from
+        :func:`getTranslationFiles`.
+    :returns: A ``gettext.NullTranslation`` if there are no **files**,
+        otherwise a ``gettext.GNUTranslation`` with fallback languages set.
+    """
+    language = None
+    for path in files:
+        try:
+            with open(path, 'rb') as fp:
+                translation = gettext.GNUTranslations(fp)
+        except (IOError, OSError) as error:
+            logging.error(str(error))
+            continue
+        if language is None:
+            language = translation
+        else:
+            language.add_fallback(translation)
+
+    if language is None:
+        language = gettext.NullTranslations()
+    return language
+
 def installTranslations(langs):
-    """Create a ``gettext.translation`` chain for all **langs**.
+    """Get the ``gettext.translation`` chain for all **langs** from
+    :func:`getTranslations`, and install it as the global ``_`` function.
 
-    Attempt to install the first language in the **langs** list. If that
-    fails, we receive a ``gettext.NullTranslation`` object, and if it worked
-    then we have a ``gettext.GNUTranslation`` object. Whichever one we end up
-    with, get the other languages and add them as fallbacks to the
-    first. Lastly, install this chain of translations.
+    Installing the translations changes them for everything else in this
+    process, so code which renders something for a client should use
+    :func:`getTranslations` instead.
 
     :param list langs: A list of language codes.
     :returns: A ``gettext.NullTranslation`` or ``gettext.GNUTranslation`` with
         fallback languages set.
     """
-    try:
-        language = gettext.translation("bridgedb", localedir=TRANSLATIONS_DIR,
-                                       languages=langs, fallback=True)
-        for lang in langs:
-            language.add_fallback(
-                gettext.translation("bridgedb", localedir=TRANSLATIONS_DIR,
-                                    languages=langs, fallback=True))
-    except IOError as error:
-        logging.error(str(error))
-
+    language = getTranslations(langs)
     language.install()
     return language
 